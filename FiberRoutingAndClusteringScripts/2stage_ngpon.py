@@ -4,6 +4,8 @@ import math
 import os
 import json
 
+import ScratchWorkspace as sw
+
 arcpy.env.overwriteOutput = True
 
 
@@ -24,10 +26,14 @@ def check_exists(name_in):
 ########################################################################################################################
 def main(network_nd, clustering_allocation, ff_protection, sp_protection, buildings, intersections, co, sr_rn1, sr_rn2,
          output_dir, output_fds, output_name, joint_planning=False, bs='#', sc='#', sc_wdm='#', brownfield_duct='#',
-         save_lmf_df=False, save_clusters=False):
+         save_lmf_df=False, save_clusters=False, save_duct_index=False, co_capacity='#', result_store='#',
+         local_search='#', steiner=False, duct_sharing='#', od_dir='#'):
 
     pro = False
 
+    # The scratch data of the planning are released at its end
+    sw.begin_stage('planning_hpon')
+
     ####################################################################################################################
     # TDM demands clustering
     facilities = 'Intersections'
@@ -49,8 +55,7 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, buildi
     if joint_planning and sc != '#' and not sc_wdm:
         arcpy.AddMessage('TDM demands include buildings and Small Cells (SCs)')
 
-        demands = os.path.join('in_memory', 'Buildings_and_small_cells')
-        check_exists(demands)
+        demands = sw.scratch_name('Buildings_and_small_cells')
         arcpy.Merge_management([buildings, sc], demands)
 
         if clustering_allocation:
@@ -62,7 +67,8 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, buildi
         else:
             import BuildingsClusterCPM as cmpm
             name_clst_lmf = output_name_rn2 + '_build_and_sc_cmpm'
-            n_clusters_lmf = cmpm.main(network_nd, demands, sr_rn2, intersections, output_fds_cluster, pro, name_clst_lmf)
+            n_clusters_lmf = cmpm.main(network_nd, demands, sr_rn2, intersections, output_fds_cluster, pro,
+                                       name_clst_lmf, od_dir)
     else:
         if clustering_allocation:
             import ClusteringLocationAllocation as clst
@@ -72,7 +78,16 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, buildi
         else:
             import BuildingsClusterCPM as cmpm
             name_clst_lmf = output_name_rn2 + '_build_cmpm'
-            n_clusters_lmf = cmpm.main(network_nd, buildings, sr_rn2, intersections, output_fds_cluster, pro, name_clst_lmf)
+            n_clusters_lmf = cmpm.main(network_nd, buildings, sr_rn2, intersections, output_fds_cluster, pro,
+                                       name_clst_lmf, od_dir)
+
+    # Improve the clusters for the given number of seconds, the heads of the second stage are fed from the first one
+    local_search_result = {}
+    if local_search != '#':
+        import LocalSearch as ls
+        local_search_result['lmf'] = ls.improve_clusters(network_nd, intersections, output_fds_cluster, name_clst_lmf,
+                                                         n_clusters_lmf, sr_rn2, brownfield_duct=brownfield_duct,
+                                                         time_budget=local_search)
 
     ####################################################################################################################
     # WDM demands clustering
@@ -96,8 +111,7 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, buildi
     if joint_planning and sc != '#' and sc_wdm:
         arcpy.AddMessage('WDM demands include Base Stations (BSs), Small Cells (SCs) and Remote Nodes 2 (RN2)')
 
-        demands = os.path.join('in_memory', 'all_wdm_demands')
-        check_exists(demands)
+        demands = sw.scratch_name('all_wdm_demands')
         arcpy.Merge_management([rns2, sc, bs], demands)
 
         field_objects = arcpy.ListFields(demands)
@@ -113,8 +127,7 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, buildi
     elif joint_planning and sc != '#' and not sc_wdm:
         arcpy.AddMessage('WDM demands include Base Stations (BSs) and Remote Nodes 2 (RN2)')
 
-        demands = os.path.join('in_memory', 'all_wdm_demands')
-        check_exists(demands)
+        demands = sw.scratch_name('all_wdm_demands')
         arcpy.Merge_management([rns2, bs], demands)
 
         field_objects = arcpy.ListFields(demands)
@@ -134,6 +147,11 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, buildi
         n_clusters_df = clst.main(network_nd, rns2, intersections, facilities, sr_rn1, output_fds_cluster,
                                   name_clst_df, pro, '#')
 
+    if local_search != '#':
+        local_search_result['df'] = ls.improve_clusters(network_nd, intersections, output_fds_cluster, name_clst_df,
+                                                        n_clusters_df, sr_rn1, co, brownfield_duct,
+                                                        time_budget=local_search)
+
     # Save the cluster heads
     name_rns1 = 'Cluster_heads_{0}'.format(name_clst_df)
     rns1 = os.path.join(output_fds_cluster, name_rns1)
@@ -144,6 +162,8 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, buildi
 
     import ShortestPathRouting as spr
     planning_result = {}
+    if local_search_result:
+        planning_result['local_search'] = local_search_result
 
     # LMF
     a = 0
@@ -154,35 +174,36 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, buildi
                                                                              name_clst_lmf, output_fds, pro,
                                                                              brownfield_duct=brownfield_duct,
                                                                              save_lmf_df=save_lmf_df,
-                                                                             save_clusters=save_clusters)
+                                                                             save_clusters=save_clusters,
+                                                                             steiner=steiner,
+                                                                             duct_sharing=duct_sharing,
+                                                                             planning_result_in=planning_result)
 
     #DF
     planning_result['df'], planning_result['d_d'], a, b, df, c = spr.main(network_nd, n_clusters_df, 'DF', co,
                                                                           name_clst_df, output_fds, pro,
                                                                           brownfield_duct=brownfield_duct,
                                                                           save_lmf_df=save_lmf_df,
-                                                                          save_clusters=save_clusters)
+                                                                          save_clusters=save_clusters,
+                                                                          steiner=steiner,
+                                                                          duct_sharing=duct_sharing,
+                                                                          planning_result_in=planning_result)
 
     #FF
     if not ff_protection:
         planning_result['ff'], planning_result['f_d'], a, b, ff, c = spr.main(network_nd, 1, 'FF', co, name_clst_df,
                                                                               output_fds, pro,
                                                                               brownfield_duct=brownfield_duct,
-                                                                              save_clusters=save_clusters)
+                                                                              save_clusters=save_clusters,
+                                                                              co_capacity=co_capacity,
+                                                                              planning_result_in=planning_result,
+                                                                              duct_sharing=duct_sharing)
     else:
         planning_result['ff'], planning_result['f_d'], \
-        planning_result['ff_sp_p'], planning_result['f_d_add_p'], ff, ff_p = spr.main(network_nd, 1, 'FF', co,
-                                                                                      name_clst_df,
-                                                                                      output_fds, pro, ff_protection,
-                                                                                      sp_protection,
-                                                                                      brownfield_duct=brownfield_duct,
-                                                                                      save_clusters=save_clusters)
-
-    arcpy.AddMessage(planning_result)
-
-    output_file_planning = os.path.join(output_dir, '{0}.txt'.format(output_name))
-    f_p = open(output_file_planning, 'w')
-    json.dump(planning_result, f_p)
+        planning_result['ff_sp_p'], planning_result['f_d_add_p'], ff, ff_p = spr.main(
+            network_nd, 1, 'FF', co, name_clst_df, output_fds, pro, ff_protection, sp_protection,
+            brownfield_duct=brownfield_duct, save_clusters=save_clusters, co_capacity=co_capacity,
+            planning_result_in=planning_result)
 
     # Save total fibers and ducts to be used as brownfield for further scenarios
     total_fiber = os.path.join(output_fds, 'Total_fiber_{0}'.format(output_name))
@@ -201,6 +222,35 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, buildi
 
     arcpy.AddGeometryAttributes_management(total_duct, 'LENGTH_GEODESIC', 'METERS')
 
+    # Trench and equipment counts for the cost evaluation
+    import CostModel as cm
+    planning_result['trench'], planning_result['trench_reused'] = cm.trench_lengths(network_nd, total_duct,
+                                                                                     brownfield_duct)
+    planning_result['equipment'] = cm.equipment_counts([(cm.splitter(sr_rn2), n_clusters_lmf),
+                                                      (cm.splitter(sr_rn1), n_clusters_df),
+                                                      ('olt_port', n_clusters_df)])
+
+    arcpy.AddMessage(planning_result)
+
+    output_file_planning = os.path.join(output_dir, '{0}.txt'.format(output_name))
+    with open(output_file_planning, 'w') as f_p:
+        json.dump(planning_result, f_p)
+
+    # Append the run to the store shared by all the scenarios
+    if result_store != '#':
+        import ResultStore as rs
+        rs.append(result_store, {'name': output_name, 'topology': 'hpon', 'sr_rn1': sr_rn1, 'sr_rn2': sr_rn2,
+                                 'ff_protection': ff_protection, 'sp_protection': sp_protection,
+                                 'brownfield': brownfield_duct, 'local_search': local_search, 'steiner': steiner,
+                                 'duct_sharing': duct_sharing, 'co_capacity': co_capacity}, planning_result)
+
+    # Snap the ducts to the network edges once, the following scenarios can pass the index as the brownfield
+    if save_duct_index:
+        import BrownfieldIndex as bfi
+        bfi.main(network_nd, total_duct, output_dir, 'Total_duct_{0}'.format(output_name))
+
+    sw.end_stage()
+
     return
 
 
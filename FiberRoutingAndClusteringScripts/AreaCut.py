@@ -1,6 +1,13 @@
 import arcpy
 import os
 
+import numpy as np
+
+import NetworkGraph as ng
+import PlanarGraph as pg
+import CoordinateTransform as ct
+import ScratchWorkspace as sw
+
 
 def check_exists(name_in):
     """
@@ -31,27 +38,26 @@ def area_cut(roads_in, widths_in, area_in, output_dir_in, output_name_in):
     """
     arcpy.overwriteOutput = 1
 
+    # The intermediate polygons and points are released at the end of the cut
+    sw.begin_stage('area_cut')
+
     # Transform roads (lines) into a polygon
-    area_path = os.path.join('in_memory', 'area')
-    check_exists(area_path)
+    area_path = sw.scratch_name('area')
 
     area = arcpy.FeatureToPolygon_management(roads_in, area_path)
 
     # Dissolve a multipart polygon
-    area_dissolved_path = os.path.join('in_memory', 'area_dissolved')
-    check_exists(area_dissolved_path)
+    area_dissolved_path = sw.scratch_name('area_dissolved')
 
     arcpy.Dissolve_management(area, area_dissolved_path)
 
     # Get central point
-    centroid_path = os.path.join('in_memory', 'centroid')
-    check_exists(centroid_path)
+    centroid_path = sw.scratch_name('centroid')
 
     arcpy.arcpy.FeatureToPoint_management(area_dissolved_path, centroid_path)
 
     # Create a circular buffer around with the radius of half of the needed width
-    buffer_out = os.path.join('in_memory', 'buffer')
-    check_exists(buffer_out)
+    buffer_out = sw.scratch_name('buffer')
 
     width = str(widths_in) + ' Meters'
     arcpy.Buffer_analysis(centroid_path, buffer_out, width)
@@ -72,7 +78,7 @@ def area_cut(roads_in, widths_in, area_in, output_dir_in, output_name_in):
     arcpy.TrimLine_edit(name_streets_out)
 
     # Get intersections
-    out_feature_class = os.path.join('in_memory', 'intersections_tmp')
+    out_feature_class = sw.scratch_name('intersections_tmp')
     arcpy.Intersect_analysis(name_streets_out, out_feature_class, output_type='POINT')
     arcpy.DeleteIdentical_management(out_feature_class, 'Shape')
 
@@ -80,10 +86,160 @@ def area_cut(roads_in, widths_in, area_in, output_dir_in, output_name_in):
     check_exists(name_intersections_out)
     arcpy.FeatureToPoint_management(out_feature_class, name_intersections_out)
 
+    sw.end_stage()
+
     return square_path, name_streets_out, name_intersections_out
 
 
-def main(streets_full, area, output_fds, output_name, buildings=False):
+def read_polylines(lines_in):
+    """
+    This function reads the vertices of all the lines, every part of a multipart line is a separate polyline.
+
+    :param lines_in: line feature class
+    :return: list of the vertices arrays (m, 2), the spatial reference of the lines
+    """
+    spatial_ref = arcpy.Describe(lines_in).spatialReference
+
+    polylines = []
+    with arcpy.da.SearchCursor(lines_in, 'SHAPE@') as cursor:
+        for row in cursor:
+            if row[0] is None:
+                continue
+            for part in row[0]:
+                points = [(p.X, p.Y) for p in part if p is not None]
+                if len(points) > 1:
+                    polylines.append(np.asarray(points, dtype=np.float64))
+
+    return polylines, spatial_ref
+
+
+def clip_segments(p0, p1, x_min, y_min, x_max, y_max):
+    """
+    Vectorized Liang-Barsky clipping of the segments to the rectangle.
+
+    :param p0: start points of the segments, array (n, 2)
+    :param p1: end points of the segments, array (n, 2)
+    :return: flags of the segments inside the rectangle, clipped start and end points, the clipping parameters t0, t1
+    """
+    d = p1 - p0
+    t0 = np.zeros(len(p0))
+    t1 = np.ones(len(p0))
+    keep = np.ones(len(p0), dtype=bool)
+
+    for p, q in ((-d[:, 0], p0[:, 0] - x_min), (d[:, 0], x_max - p0[:, 0]),
+                 (-d[:, 1], p0[:, 1] - y_min), (d[:, 1], y_max - p0[:, 1])):
+        parallel = p == 0
+        keep &= ~(parallel & (q < 0))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = np.where(parallel, 0.0, q / np.where(parallel, 1.0, p))
+        t0 = np.where(~parallel & (p < 0), np.maximum(t0, r), t0)
+        t1 = np.where(~parallel & (p > 0), np.minimum(t1, r), t1)
+
+    keep &= t0 <= t1
+
+    return keep, p0 + d * t0[:, np.newaxis], p0 + d * t1[:, np.newaxis], t0, t1
+
+
+def area_cut_fast(roads_in, widths_in, area_in, output_dir_in, output_name_in):
+    """
+    This function makes the same cut as area_cut, but in one pass over the coordinate arrays: the center is the median
+    of the road vertices, all the road segments are clipped to the square at once and the planar graph of the clipped
+    streets gives the trimmed streets and the intersections. Only the three results are written.
+
+    :param roads_in:    line feature class that will be cut
+    :param widths_in:   the half of the side of the square in meters (the radius of the buffer in area_cut)
+    :param area_in:     the area in km^2 as in the procedural area generation
+    :param output_dir_in:   path, where to save the results
+    :param output_name_in:
+    :return: paths to the resulting feature classes - polygon square, lines, intersections
+    """
+    polylines, spatial_ref = read_polylines(roads_in)
+
+    vertices = np.concatenate(polylines)
+    x_c, y_c = np.median(vertices[:, 0]), np.median(vertices[:, 1])
+
+    # Half width of the square in the units of the spatial reference, the geographic one is measured in the UTM zone
+    # of the center
+    if spatial_ref.type == 'Geographic':
+        zone = ct.utm_zone(x_c, y_c)
+        width = widths_in * ct.scale_factor([(x_c, y_c)], zone)[0]
+        sides = ct.inverse(ct.forward([(x_c, y_c)], zone) + np.array([[width, 0.0], [0.0, width]]), zone)
+        dx = sides[0, 0] - x_c
+        dy = sides[1, 1] - y_c
+    else:
+        dx = dy = widths_in / spatial_ref.metersPerUnit
+
+    x_min, y_min, x_max, y_max = x_c - dx, y_c - dy, x_c + dx, y_c + dy
+
+    # All the segments of all the lines are clipped in one pass
+    lengths = np.asarray([len(line) for line in polylines])
+    line_id = np.repeat(np.arange(len(polylines)), lengths - 1)
+    ptr = np.concatenate([[0], np.cumsum(lengths)])
+    first = np.concatenate([np.arange(ptr[k], ptr[k + 1] - 1) for k in range(len(polylines))])
+
+    keep, c0, c1, t0, t1 = clip_segments(vertices[first], vertices[first + 1], x_min, y_min, x_max, y_max)
+
+    # Join the consecutive clipped segments of the same line back into the lines
+    clipped = []
+    current = []
+    previous = -1
+    for s in np.nonzero(keep)[0].tolist():
+        if current and (line_id[s] != line_id[previous] or s != previous + 1 or t0[s] > 0 or t1[previous] < 1):
+            clipped.append(np.asarray(current))
+            current = []
+        if not current:
+            current.append(c0[s])
+        current.append(c1[s])
+        previous = s
+    if current:
+        clipped.append(np.asarray(current))
+
+    # Split at the crossings, merge the vertices and prune the dangles in one pass
+    streets, intersections, graph = pg.build(clipped, spatial_ref.type == 'Geographic',
+                                             spatial_reference=spatial_ref.exportToString())
+
+    # Save the square
+    square_name = '{0}_area{1}_ply'.format(output_name_in, area_in)
+    square_path = os.path.join(output_dir_in, square_name)
+    check_exists(square_path)
+    arcpy.CreateFeatureclass_management(output_dir_in, square_name, 'POLYGON', spatial_reference=spatial_ref)
+    with arcpy.da.InsertCursor(square_path, 'SHAPE@') as cursor:
+        corners = [(x_min, y_min), (x_min, y_max), (x_max, y_max), (x_max, y_min), (x_min, y_min)]
+        cursor.insertRow([arcpy.Polygon(arcpy.Array([arcpy.Point(x, y) for x, y in corners]), spatial_ref)])
+
+    # Save the streets
+    streets_name = '{0}_area{1}_streets'.format(output_name_in, area_in)
+    name_streets_out = os.path.join(output_dir_in, streets_name)
+    check_exists(name_streets_out)
+    arcpy.CreateFeatureclass_management(output_dir_in, streets_name, 'POLYLINE', spatial_reference=spatial_ref)
+    oids = []
+    with arcpy.da.InsertCursor(name_streets_out, 'SHAPE@') as cursor:
+        for line in streets:
+            oids.append(cursor.insertRow([arcpy.Polyline(arcpy.Array([arcpy.Point(x, y) for x, y in line.tolist()]),
+                                                         spatial_ref)]))
+
+    # Every street is one edge of the graph, the edges get the object ids of the written streets as if the graph
+    # was read from them
+    graph['edge_oid'] = np.asarray(oids, dtype=np.int64)
+
+    # Save the intersections
+    intersections_name = '{0}_area{1}_intersections'.format(output_name_in, area_in)
+    name_intersections_out = os.path.join(output_dir_in, intersections_name)
+    check_exists(name_intersections_out)
+    arcpy.CreateFeatureclass_management(output_dir_in, intersections_name, 'POINT', spatial_reference=spatial_ref)
+    with arcpy.da.InsertCursor(name_intersections_out, 'SHAPE@XY') as cursor:
+        for x, y in intersections.tolist():
+            cursor.insertRow([(x, y)])
+
+    # The routable graph of the cut streets is kept, so the routing on them and on the network dataset built from
+    # them does not have to read them again
+    ng.graph_cache[ng.source_key(name_streets_out)] = graph
+
+    return square_path, name_streets_out, name_intersections_out
+
+
+def main(streets_full, area, output_fds, output_name, buildings=False, fast=False):
 
     if area == 1:
         width = 500
@@ -100,7 +256,10 @@ def main(streets_full, area, output_fds, output_name, buildings=False):
     elif area == 100:
         width = 5000
 
-    streets_cut_path = area_cut(streets_full, width, area, output_fds, output_name)[1]
+    if fast:
+        streets_cut_path = area_cut_fast(streets_full, width, area, output_fds, output_name)[1]
+    else:
+        streets_cut_path = area_cut(streets_full, width, area, output_fds, output_name)[1]
     arcpy.AddMessage('The initial area was cut into a square of {0}km^2'.format(area))
 
     if buildings:
@@ -0,0 +1,253 @@
+import math
+import time
+import heapq
+import random
+
+import numpy as np
+
+import NetworkGraph as ng
+
+# Above this number of the sources the potential only looks at the target, the lower bound to the nearest of many
+# sources costs more than it saves
+MAX_BOUND_ENDS = 16
+
+
+def geometry(graph):
+    """
+    The metric coordinates of the nodes and the straight distances between the ends of every edge are computed once
+    and kept with the graph.
+
+    :param graph: graph, dict
+    :return: list of the x coordinates, list of the y coordinates, straight lengths of the edges - array (n_edges)
+    """
+    if 'node_metric' not in graph:
+        xy = ng.metric_xy(graph, graph['node_xy'])
+        u = np.asarray(graph['edge_u'], dtype=np.int64)
+        v = np.asarray(graph['edge_v'], dtype=np.int64)
+        chord = np.hypot(xy[u, 0] - xy[v, 0], xy[u, 1] - xy[v, 1])
+        graph['node_metric'] = (xy[:, 0].tolist(), xy[:, 1].tolist(), chord)
+    return graph['node_metric']
+
+
+def bound_scale(graph, weights=None, overrides=None):
+    """
+    The lower bound of the distance between two nodes is their straight distance times the smallest ratio of the
+    weight and the straight length over all the edges. It never exceeds the weight of an edge, so the bounds are
+    consistent for any weights, e.g., with the discounts, they are only less tight.
+
+    :param graph: graph, dict
+    :param weights: edge weights, the edge lengths if None
+    :param overrides: dict edge id - weight of the query, replacing the weights
+    :return: scale of the straight distances
+    """
+    chord = geometry(graph)[2]
+    positive = chord > 0
+    if not positive.any():
+        return 0.0
+
+    if weights is None and 'bound_scale' in graph:
+        scale = graph['bound_scale']
+    else:
+        ratio = np.asarray(graph['weight'] if weights is None else weights, dtype=np.float64)[positive]
+        scale = float(max(0.0, (ratio / chord[positive]).min()))
+        if weights is None:
+            graph['bound_scale'] = scale
+
+    for edge, weight in (overrides or {}).items():
+        if chord[edge] > 0:
+            scale = min(scale, max(0.0, weight) / chord[edge])
+
+    return scale
+
+
+def search(graph, sources, target_ends, weights=None, overrides=None):
+    """
+    Bidirectional A* between the sources and the target ends. Both searches use the average of the straight-line
+    bounds to the target and from the sources as the potential, so they are two Dijkstra searches on the same reduced
+    weights and meet in the middle. The search stops when the smallest keys of the two queues together reach the
+    shortest connection found so far.
+
+    :param graph: graph, dict
+    :param sources: list of (node id, initial distance) pairs
+    :param target_ends: list of (node id, distance from the node to the target) pairs
+    :param weights: edge weights, the edge lengths if None
+    :param overrides: dict edge id - weight of the query, the weights are not copied
+    :return: distance, meeting node, forward predecessor edges dict, forward source index dict, backward predecessor
+             edges dict
+    """
+    x, y = geometry(graph)[:2]
+    scale = bound_scale(graph, weights, overrides)
+
+    if weights is None:
+        weights = graph['weight']
+    elif isinstance(weights, np.ndarray):
+        weights = weights.tolist()
+    if overrides is None:
+        overrides = {}
+
+    indptr = graph['indptr']
+    adj_node = graph['adj_node']
+    adj_edge = graph['adj_edge']
+    inf = float('inf')
+
+    # The potentials are the halves of the bounds to the target minus the bounds from the sources
+    to_ends = [(x[node], y[node], rest) for node, rest in target_ends] if scale > 0 else []
+    from_ends = [(x[node], y[node], d) for node, d in sources] if 0 < scale and len(sources) <= MAX_BOUND_ENDS else []
+    hypot = math.hypot
+    potentials = {}
+
+    def potential(node):
+        xn = x[node]
+        yn = y[node]
+        to_bound = inf if to_ends else 0.0
+        for xe, ye, rest in to_ends:
+            to_bound = min(to_bound, scale * hypot(xn - xe, yn - ye) + rest)
+        from_bound = inf if from_ends else 0.0
+        for xe, ye, rest in from_ends:
+            from_bound = min(from_bound, scale * hypot(xn - xe, yn - ye) + rest)
+        potentials[node] = 0.5 * (to_bound - from_bound)
+        return potentials[node]
+
+    dist = ({}, {})
+    pred = ({}, {})
+    root = {}
+    heaps = ([], [])
+    best = inf
+    meet = -1
+
+    # The forward keys add the potential, the backward keys subtract it
+    for side, ends in ((0, sources), (1, target_ends)):
+        sign = 1.0 - 2.0 * side
+        for k, (node, d) in enumerate(ends):
+            if d < dist[side].get(node, inf):
+                dist[side][node] = d
+                pred[side][node] = -1
+                if side == 0:
+                    root[node] = k
+                heaps[side].append((d + sign * potential(node), d, node))
+    for node, d in dist[1].items():
+        if d + dist[0].get(node, inf) < best:
+            best = d + dist[0][node]
+            meet = node
+    heapq.heapify(heaps[0])
+    heapq.heapify(heaps[1])
+
+    settled = (set(), set())
+    while heaps[0] and heaps[1]:
+        if heaps[0][0][0] + heaps[1][0][0] >= best:
+            break
+
+        side = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+        key, d, node = heapq.heappop(heaps[side])
+        if node in settled[side]:
+            continue
+        settled[side].add(node)
+
+        side_dist = dist[side]
+        side_pred = pred[side]
+        other_dist = dist[1 - side]
+        heap = heaps[side]
+        sign = 1.0 - 2.0 * side
+        for j in range(indptr[node], indptr[node + 1]):
+            nbr = adj_node[j]
+            edge = adj_edge[j]
+            nd = d + (overrides[edge] if edge in overrides else weights[edge])
+            if nd < side_dist.get(nbr, inf):
+                side_dist[nbr] = nd
+                side_pred[nbr] = edge
+                if side == 0:
+                    root[nbr] = root[node]
+                if nbr in other_dist and nd + other_dist[nbr] < best:
+                    best = nd + other_dist[nbr]
+                    meet = nbr
+                p = potentials[nbr] if nbr in potentials else potential(nbr)
+                heapq.heappush(heap, (nd + sign * p, nd, nbr))
+
+    return best, meet, pred[0], root, pred[1]
+
+
+def route_pieces(graph, facilities_in, incident_in, weights=None, overrides=None):
+    """
+    This function routes one incident to its closest facility with the bidirectional A*, the result is the same as
+    the one of NetworkGraph.route_pieces for a single incident.
+
+    :param graph: graph, dict
+    :param facilities_in: list of (edge id, offset along the edge) pairs
+    :param incident_in: (edge id, offset along the edge) pair
+    :param weights: edge weights, the edge lengths if None
+    :param overrides: dict edge id - weight of this query, e.g., the penalties of the working path or the discounts of
+                      the shared ducts, the weights are not copied
+    :return: list with one (facility index, 0, pieces) tuple, empty if the incident can not be reached
+    """
+    edge_w = graph['weight'] if weights is None else weights
+    if overrides is None:
+        overrides = {}
+
+    def scaled(edge, length):
+        weight = overrides[edge] if edge in overrides else edge_w[edge]
+        return length * weight / max(graph['edge_length'][edge], 1e-9)
+
+    sources = []
+    for edge, pos in facilities_in:
+        sources.append((int(graph['edge_u'][edge]), scaled(edge, pos)))
+        sources.append((int(graph['edge_v'][edge]), scaled(edge, graph['edge_length'][edge] - pos)))
+
+    edge, pos = incident_in
+    target_ends = [(int(graph['edge_u'][edge]), scaled(edge, pos)),
+                   (int(graph['edge_v'][edge]), scaled(edge, graph['edge_length'][edge] - pos))]
+
+    d, node, pred, root, pred_back = search(graph, sources, target_ends, weights, overrides)
+
+    # Directly along the edge
+    direct = -1
+    for k, (f_edge, f_pos) in enumerate(facilities_in):
+        if f_edge == edge and scaled(edge, abs(f_pos - pos)) <= d:
+            d = scaled(edge, abs(f_pos - pos))
+            direct = k
+
+    if direct != -1:
+        return [(direct, 0, [(edge, float(facilities_in[direct][1]), float(pos))])]
+    if node == -1:
+        return []
+
+    nodes, edges = ng.trace_path(graph, pred, node)
+    nodes_back, edges_back = ng.trace_path(graph, pred_back, node)
+    nodes += nodes_back[-2::-1]
+    edges += edges_back[::-1]
+    k = root[nodes[0]] // 2
+
+    return [(k, 0, ng.path_pieces(graph, facilities_in[k], nodes, edges, incident_in))]
+
+
+def benchmark(graph, n_queries=100, seed_in=0):
+    """
+    This function compares the bidirectional A* to the plain Dijkstra search stopped at the target on the same random
+    node pairs.
+
+    :param graph: graph, dict
+    :param n_queries: number of the queries
+    :param seed_in: seed of the random pairs
+    :return: dict with the query times, the speedup and the number of the different distances
+    """
+    rnd = random.Random(seed_in)
+    pairs = [(rnd.randrange(graph['n_nodes']), rnd.randrange(graph['n_nodes'])) for _ in range(n_queries)]
+
+    start = time.time()
+    plain = []
+    for s, t in pairs:
+        plain.append(ng.dijkstra(graph, [s], targets=[t])[0].get(t, float('inf')))
+    time_dijkstra = time.time() - start
+
+    geometry(graph)
+    start = time.time()
+    bidirectional = []
+    for s, t in pairs:
+        bidirectional.append(search(graph, [(s, 0.0)], [(t, 0.0)])[0])
+    time_bidirectional = time.time() - start
+
+    mismatch = sum(1 for a, b in zip(plain, bidirectional) if abs(a - b) > 1e-6 * max(1.0, abs(a)) and a != b)
+
+    return {'dijkstra': time_dijkstra,
+            'bidirectional': time_bidirectional,
+            'speedup': time_dijkstra / max(time_bidirectional, 1e-9),
+            'mismatch': mismatch}
@@ -0,0 +1,274 @@
+import os
+import math
+
+import numpy as np
+
+import NetworkGraph as ng
+
+# Indices that were already loaded in this process, the key is the path to the .npz file
+index_cache = {}
+
+# Indices snapped from the duct feature classes in this process, the key is the path, the state of the feature class
+# and the fingerprint of the graph
+snapped_cache = {}
+
+
+def snap_ducts(graph, segments_in, tolerance_in=5.0):
+    """
+    This function finds the network edges that are covered by the existing ducts. Every edge is sampled at its vertices
+    and at the middle of its segments, the edge is covered if all the samples are within the tolerance from the ducts.
+    The samples are kept in a uniform grid, so every duct segment is compared only with the samples around it.
+
+    :param graph: graph, dict
+    :param segments_in: duct segments in the spatial reference of the graph, array (n, 4) - x1, y1, x2, y2
+    :param tolerance_in: search tolerance, meters
+    :return: covered edges, boolean array (n_edges)
+    """
+    shape_ptr = graph['shape_ptr']
+    vertices = ng.metric_xy(graph, graph['shape_xy'])
+
+    # Samples: the vertices and the middle points of all the edge segments
+    n_vertices = np.diff(shape_ptr)
+    middle = (vertices[:-1] + vertices[1:]) / 2.0
+    inner = np.ones(len(vertices) - 1, dtype=bool) if len(vertices) > 0 else np.zeros(0, dtype=bool)
+    inner[shape_ptr[1:-1] - 1] = False
+    samples = np.concatenate([vertices, middle[inner]])
+    sample_edge = np.concatenate([np.repeat(np.arange(graph['n_edges']), n_vertices),
+                                  np.repeat(np.arange(graph['n_edges']), n_vertices - 1)])
+
+    covered = np.zeros(len(samples), dtype=bool)
+
+    segments = np.asarray(segments_in, dtype=np.float64).reshape(-1, 4)
+    if len(segments) == 0 or len(samples) == 0:
+        return np.zeros(graph['n_edges'], dtype=bool)
+
+    a = ng.metric_xy(graph, segments[:, 0:2])
+    b = ng.metric_xy(graph, segments[:, 2:4])
+
+    cell = max(tolerance_in * 10.0, 1.0)
+    cells = np.floor(samples / cell).astype(np.int64)
+    grid = {}
+    for i, key in enumerate(map(tuple, cells.tolist())):
+        grid.setdefault(key, []).append(i)
+
+    # Candidate (segment, sample) pairs from the cells overlapping the bounding box of the segment
+    low = np.floor((np.minimum(a, b) - tolerance_in) / cell).astype(np.int64)
+    high = np.floor((np.maximum(a, b) + tolerance_in) / cell).astype(np.int64)
+    pair_seg = []
+    pair_sample = []
+    for s in range(len(segments)):
+        for i in range(low[s, 0], high[s, 0] + 1):
+            for j in range(low[s, 1], high[s, 1] + 1):
+                members = grid.get((i, j))
+                if members:
+                    pair_seg.extend([s] * len(members))
+                    pair_sample.extend(members)
+
+    if not pair_seg:
+        return np.zeros(graph['n_edges'], dtype=bool)
+
+    pair_seg = np.asarray(pair_seg)
+    pair_sample = np.asarray(pair_sample)
+
+    # Point to segment distances in one pass
+    ab = b[pair_seg] - a[pair_seg]
+    ap = samples[pair_sample] - a[pair_seg]
+    len2 = np.maximum((ab ** 2).sum(axis=1), 1e-12)
+    t = np.clip((ap * ab).sum(axis=1) / len2, 0.0, 1.0)
+    d2 = ((ap - ab * t[:, np.newaxis]) ** 2).sum(axis=1)
+
+    covered[pair_sample[d2 <= tolerance_in ** 2]] = True
+
+    # The edge is covered if none of its samples is uncovered
+    uncovered = np.bincount(sample_edge[~covered], minlength=graph['n_edges'])
+
+    return uncovered == 0
+
+
+def read_segments(duct_in, graph):
+    """
+    This function reads all the segments of the duct polylines in the spatial reference of the graph.
+
+    :param duct_in: line feature class, path
+    :param graph: graph, dict
+    :return: array (n, 4) - x1, y1, x2, y2
+    """
+    import arcpy
+
+    spatial_ref = arcpy.SpatialReference()
+    spatial_ref.loadFromString(graph['spatial_reference'])
+
+    segments = []
+    with arcpy.da.SearchCursor(duct_in, 'SHAPE@', spatial_reference=spatial_ref) as cursor:
+        for row in cursor:
+            if row[0] is None:
+                continue
+            for part in row[0]:
+                points = [(p.X, p.Y) for p in part if p is not None]
+                for i in range(len(points) - 1):
+                    segments.append(points[i] + points[i + 1])
+
+    return np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+
+
+def build_index(graph, duct_in, discount_in=0.001, tolerance_in=5.0):
+    """
+    This function snaps the existing ducts to the network edges. It replaces the line barriers with the scaled cost,
+    which are snapped again in every closest facility solve.
+
+    :param graph: graph, dict
+    :param duct_in: brownfield ducts, line feature class
+    :param discount_in: the scale of the cost of the edges with the existing ducts
+    :param tolerance_in: search tolerance, meters
+    :return: index, dict
+    """
+    covered = snap_ducts(graph, read_segments(duct_in, graph), tolerance_in)
+
+    index = {'bitmap': np.packbits(covered),
+             'n_edges': graph['n_edges'],
+             'discount': float(discount_in),
+             'fingerprint': ng.graph_fingerprint(graph)}
+
+    return index
+
+
+def covered_edges(index):
+    """
+    :param index: index, dict
+    :return: covered edges, boolean array (n_edges)
+    """
+    return np.unpackbits(index['bitmap'])[:index['n_edges']].astype(bool)
+
+
+def save_index(index, path_in):
+    """
+    :param index: index, dict
+    :param path_in: path to the .npz file
+    :return:
+    """
+    np.savez(path_in, bitmap=index['bitmap'], n_edges=index['n_edges'], discount=index['discount'],
+             fingerprint=index['fingerprint'])
+    return
+
+
+def load_index(path_in, graph=None):
+    """
+    This function loads the index and checks that it was snapped to the same network.
+
+    :param path_in: path to the .npz file
+    :param graph: graph, dict
+    :return: index, dict
+    """
+    if path_in in index_cache:
+        index = index_cache[path_in]
+    else:
+        data = np.load(path_in)
+        index = {'bitmap': data['bitmap'],
+                 'n_edges': int(data['n_edges']),
+                 'discount': float(data['discount']),
+                 'fingerprint': int(data['fingerprint'])}
+        index_cache[path_in] = index
+
+    if graph is not None:
+        if index['n_edges'] != graph['n_edges'] or index['fingerprint'] != ng.graph_fingerprint(graph):
+            raise ValueError('The brownfield index {0} was built for a different network'.format(path_in))
+
+    return index
+
+
+def duct_state(duct_in):
+    """
+    :param duct_in: line feature class, path
+    :return: number of the features and the extent, a feature class written again under the same name is snapped again
+    """
+    import arcpy
+
+    extent = arcpy.Describe(duct_in).extent
+    return (int(arcpy.GetCount_management(duct_in).getOutput(0)),
+            round(extent.XMin, 6), round(extent.YMin, 6), round(extent.XMax, 6), round(extent.YMax, 6))
+
+
+def get_index(graph, brownfield_duct):
+    """
+    This function returns the index of the brownfield for the graph, either loaded from the .npz file or snapped from
+    the feature class. The ducts are snapped once per process and graph, not in every stage and protection pass.
+
+    :param graph: graph, dict
+    :param brownfield_duct: brownfield ducts, either a line feature class or a snapped index
+    :return: index, dict
+    """
+    if is_index(brownfield_duct):
+        return load_index(brownfield_duct, graph)
+
+    key = (brownfield_duct, duct_state(brownfield_duct), ng.graph_fingerprint(graph))
+    if key not in snapped_cache:
+        snapped_cache[key] = build_index(graph, brownfield_duct)
+    return snapped_cache[key]
+
+
+def apply_index(index, weights_in):
+    """
+    This function applies the discount of the brownfield ducts as the weight overrides.
+
+    :param index: index, dict
+    :param weights_in: edge weights, array
+    :return: new edge weights, array
+    """
+    weights = np.asarray(weights_in, dtype=np.float64)
+    return np.where(covered_edges(index), weights * index['discount'], weights)
+
+
+def index_path(output_dir, name_in):
+    """
+    The index is saved next to the outputs of the run with the same name as the ducts feature class.
+
+    :param output_dir: directory of the planning results
+    :param name_in: name of the ducts feature class, e.g., Total_duct_...
+    :return: path to the .npz file
+    """
+    return os.path.join(output_dir, '{0}.npz'.format(name_in))
+
+
+def is_index(brownfield_duct):
+    """
+    :param brownfield_duct: brownfield ducts, either a line feature class or a snapped index
+    :return: if the brownfield is a snapped index, binary
+    """
+    return brownfield_duct != '#' and brownfield_duct.lower().endswith('.npz')
+
+
+def main(network_nd, duct_in, output_dir, name_in, discount_in=0.001, tolerance_in=5.0):
+    """
+    This function snaps the ducts to the network once and saves the index, so it can be passed as brownfield to all
+    the following scenarios on the same network.
+
+    :return: path to the index
+    """
+    import arcpy
+
+    graph = ng.get_graph(network_nd)
+    index = build_index(graph, duct_in, discount_in, tolerance_in)
+
+    out_path = index_path(output_dir, name_in)
+    save_index(index, out_path)
+    index_cache[out_path] = index
+
+    arcpy.AddMessage('{0} of {1} network edges have an existing duct'.format(int(covered_edges(index).sum()),
+                                                                            index['n_edges']))
+
+    return out_path
+
+
+if __name__ == '__main__':
+    import arcpy
+
+    network_nd_in = arcpy.GetParameterAsText(0)
+    duct_in = arcpy.GetParameterAsText(1)
+    output_dir_in = arcpy.GetParameterAsText(2)
+    name_in = arcpy.GetParameterAsText(3)
+
+    discount = arcpy.GetParameterAsText(4)
+    if not discount:
+        discount = 0.001
+
+    main(network_nd_in, duct_in, output_dir_in, name_in, float(discount))
@@ -1,10 +1,8 @@
 import arcpy
 import os
-import math
 import time
 
-# Check out the Network Analyst extension license
-arcpy.CheckOutExtension("Network")
+import ScratchWorkspace as sw
 
 
 def check_exists(name_in):
@@ -134,10 +132,19 @@ def make_attribute_dict(fc, key_field, attr_list=['*']):
     return attdict
 
 
-def main(nd, nodes, sr, intersections, output_dir_fc, pro, name_clst):
-
+def layer_clustering(nd, nodes, sr, pro):
+    """
+    This function clusters the nodes on the OD cost matrix layer of the network dataset, all the lines of the matrix
+    are copied to the memory.
+
+    :param nd: network dataset, path
+    :param nodes: nodes to cluster, point feature class
+    :param sr: splitting ratio
+    :param pro: ArcGIS Pro or ArcMap
+    :return: clustering dict cluster number - dict with the 'members' list of (node id, index in the matrix),
+             number of the clusters, name of the id field of the nodes
+    """
     n_nodes = int(arcpy.GetCount_management(nodes).getOutput(0))
-    n_clusters = int(math.ceil(float(n_nodes) / float(sr)))
 
     ###########################################################################################################
     # Get the cost matrix: OD
@@ -147,8 +154,7 @@ def main(nd, nodes, sr, intersections, output_dir_fc, pro, name_clst):
     layer_name = "ODcostMatrix"
     impedance = "Length"
 
-    layer_path = os.path.join('in_memory', 'od_layer')
-    check_exists(layer_path)
+    layer_path = sw.scratch_name('od_layer')
 
     # Create and get the layer object from the result object. The OD cost matrix layer can
     # now be referenced using the layer object.
@@ -176,7 +182,7 @@ def main(nd, nodes, sr, intersections, output_dir_fc, pro, name_clst):
     else:
         lines_sublayer = layer_object.listLayers(lines_layer_name)[0]
 
-    lines = os.path.join('in_memory', lines_layer_name)
+    lines = sw.scratch_name(lines_layer_name)
 
     arcpy.management.CopyFeatures(lines_sublayer, lines)
 
@@ -185,18 +191,13 @@ def main(nd, nodes, sr, intersections, output_dir_fc, pro, name_clst):
     ################################################################################################################
     leng = int(arcpy.GetCount_management(lines_sublayer).getOutput(0))  # Number of paths from every BS to every intersection
 
+    # The clusters are filled up to the splitting ratio, the members of the split last clusters are reassigned with
+    # the flow in main
     if sr < n_nodes:
         thr = int(sr)
     else:
         thr = int(n_nodes)
 
-    # Make the # of clusters more to avoid the splitting of the clusters
-    if thr != int(n_nodes):
-        n_clusters_tmp = int(math.ceil(float(n_nodes) / float(sr)))
-        n_clusters = n_clusters_tmp + int(math.ceil(float(n_clusters_tmp)/2))
-        arcpy.AddMessage(n_clusters)
-        thr = int(math.ceil(float(n_nodes)/float(n_clusters)))
-
     # Convert  attribute table of lines from optimization to python nested dict
     cost = make_attribute_dict(lines, "ObjectID", ["OriginID", 'DestinationID', 'DestinationRank', 'Total_Length'])
     cost_keys = ["ObjectID", "OriginID", 'DestinationID', 'DestinationRank', 'Total_Length']
@@ -257,48 +258,144 @@ def main(nd, nodes, sr, intersections, output_dir_fc, pro, name_clst):
 
         else:
             break
+    return clustering, len(clustering), node_id_field
+
+
+def matrix_clustering(nd, nodes, sr, od_dir, name_clst):
+    """
+    This function clusters the nodes on the OD matrix computed from the graph of the network dataset. The matrix is
+    written in the chunks of the rows to the memory maps in od_dir, so only a bounded part of it is in the memory, see
+    ODMatrix. The graph and its contraction hierarchy are cached in od_dir as well.
+
+    :param nd: network dataset, path
+    :param nodes: nodes to cluster, point feature class
+    :param sr: splitting ratio
+    :param od_dir: directory of the matrix files
+    :param name_clst: name of the clustering, the name of the matrix files
+    :return: see layer_clustering, the index in the matrix is the row of the node
+    """
+    import NetworkGraph as ng
+    import ContractionHierarchy as ch
+    import PlanningSession as ps
+    import ODMatrix as om
+
+    graph = ng.get_graph(nd, od_dir)
+    ch.get_hierarchy(graph, ch.hierarchy_path(nd, od_dir))
+
+    points = ps.read_locations(graph, nodes)
+    n_skipped = int(arcpy.GetCount_management(nodes).getOutput(0)) - len(points['ids'])
+    if n_skipped > 0:
+        arcpy.AddWarning('{0} nodes could not be snapped to the network and are not clustered'.format(n_skipped))
+
+    # Only the neighbours a cluster is opened with are sorted, as in the clustering of the sessions
+    k = 4 * int(sr)
+    od = om.build(graph, points['locations'], os.path.join(od_dir, 'OD_{0}'.format(name_clst)), k=k)
+    clusters = om.cpm(od, sr, k=k)
+
+    clustering = {}
+    for cl, members in enumerate(clusters, 1):
+        clustering[cl] = {'members': [(points['ids'][i], i) for i in members]}
+
+    return clustering, len(clusters), get_ids(nodes)
+
+
+def id_clause(layer_in, id_field, ids_in):
+    """
+    :return: where clause selecting the features with the ids
+    """
+    return '{0} IN ({1})'.format(arcpy.AddFieldDelimiters(layer_in, id_field), ','.join(str(i) for i in ids_in))
+
+
+def flow_assignment(nd, nodes, intersections, clustering, heads_in, sr, od_dir='#'):
+    """
+    This function reassigns the nodes to the heads of the CPM clusters with the minimum total network distance and at
+    most sr nodes per head, see GraphClustering.flow_heads. The nodes, which can not reach their head, open the new
+    heads among the intersections. The nodes or the heads, which can not be located on the streets, keep their CPM
+    clusters.
+
+    :param nd: network dataset, path
+    :param nodes: nodes to cluster, point feature class
+    :param intersections: candidate locations of the heads, point feature class
+    :param clustering: clustering dict, see layer_clustering
+    :param heads_in: intersection id of the head of every cluster, list
+    :param sr: splitting ratio
+    :param od_dir: directory of the graph files, '#' to keep the graph only in memory
+    :return: intersection id of every head, the new ones appended - list, list of the lists of the node ids per head
+    """
+    import NetworkGraph as ng
+    import GraphClustering as gc
+    import PlanningSession as ps
+
+    graph = ng.get_graph(nd, od_dir)
+    points = ps.read_locations(graph, nodes)
+    candidates = ps.read_locations(graph, intersections)
+
+    cluster_of = {}
+    for cl in range(len(heads_in)):
+        for node_id, index in clustering[cl + 1]['members']:
+            cluster_of[node_id] = cl
+
+    # Only the clusters with the located head take part in the flow, their capacity is what the fixed nodes leave
+    candidate_index = dict((c_id, c) for c, c_id in enumerate(candidates['ids']))
+    heads = [cl for cl in range(len(heads_in)) if heads_in[cl] in candidate_index]
+    head_index = dict((cl, h) for h, cl in enumerate(heads))
+
+    located = [i for i, node_id in enumerate(points['ids']) if cluster_of.get(node_id) in head_index]
+    located_ids = set(points['ids'][i] for i in located)
+    members = [[node_id for node_id, index in clustering[cl + 1]['members'] if node_id not in located_ids]
+               for cl in range(len(heads_in))]
+    capacity = [int(sr) - len(members[cl]) for cl in heads]
+
+    heads_located, clusters = gc.flow_heads(graph, [points['locations'][i] for i in located], points['xy'][located],
+                                            candidates['locations'], candidates['xy'],
+                                            [candidate_index[heads_in[cl]] for cl in heads], sr,
+                                            labels_in=[head_index[cluster_of[points['ids'][i]]] for i in located],
+                                            capacity_in=capacity)
+
+    heads_out = list(heads_in)
+    for h, flow_members in enumerate(clusters):
+        if h >= len(heads):
+            heads.append(len(heads_out))
+            heads_out.append(candidates['ids'][heads_located[h]])
+            members.append([])
+        members[heads[h]].extend(points['ids'][located[j]] for j in flow_members)
+
+    return heads_out, members
+
+
+def main(nd, nodes, sr, intersections, output_dir_fc, pro, name_clst, od_dir='#', reassign=False):
+    # Check out the Network Analyst extension license
+    arcpy.CheckOutExtension("Network")
+
+    # The scratch data of the clustering are released at its end
+    sw.begin_stage('clustering')
+
+    # The OD matrix is either the layer of the network dataset or the memory maps in od_dir
+    if od_dir == '#':
+        clustering, n_clusters, node_id_field = layer_clustering(nd, nodes, sr, pro)
+    else:
+        clustering, n_clusters, node_id_field = matrix_clustering(nd, nodes, sr, od_dir, name_clst)
 
     # print(clustering)
 
     # By select by attribute select all the cluster members
-    nodes_layer = os.path.join('in_memory', 'nodes')
-    check_exists(nodes_layer)
+    nodes_layer = sw.scratch_name('nodes')
     arcpy.MakeFeatureLayer_management(nodes, nodes_layer)
 
-    int_layer = os.path.join('in_memory', 'int_layer')
-    check_exists(int_layer)
+    int_layer = sw.scratch_name('int_layer')
     arcpy.MakeFeatureLayer_management(intersections, int_layer)
 
     int_id_field = get_ids(intersections)
 
-    cluster_heads = []
-
+    # The head of every cluster is the intersection closest to its centroid
+    heads = []
     for i in range(0, n_clusters):
-        n_members = len(clustering[i+1]['members'])
-        # print('***********************************************************')
-        # print('Cluster # {0}'.format(i))
-        # print('# Members {0}'.format(n_members))
-
-        for j in range(0, n_members):
-            # print('Iterating through member # {0}'.format(j))
-            if j == 0:
-                clause_nodes = '{0} = {1}'.format(node_id_field, clustering[i+1]['members'][j][0])
-
-            elif j > 0:
-                clause_nodes += ' OR {0} = {1}'.format(node_id_field, clustering[i+1]['members'][j][0])
-
-        # print(clause_nodes)
+        clause_nodes = id_clause(nodes_layer, node_id_field, [member[0] for member in clustering[i+1]['members']])
         arcpy.SelectLayerByAttribute_management(nodes_layer, selection_type='NEW_SELECTION', where_clause=clause_nodes)
 
-        name_cluster = 'Cluster_{0}_{1}'.format(i, name_clst)
-        out_cluster = os.path.join(output_dir_fc, name_cluster)
-        check_exists(out_cluster)
-        arcpy.CopyFeatures_management(nodes_layer, out_cluster)
-
         # Find the centroid of the cluster
-        out_cluster_head_tmp = os.path.join('in_memory', 'cluster_head_tmp')
-        check_exists(out_cluster_head_tmp)
-        arcpy.MeanCenter_stats(out_cluster, out_cluster_head_tmp)
+        out_cluster_head_tmp = sw.scratch_name('cluster_head_tmp')
+        arcpy.MeanCenter_stats(nodes_layer, out_cluster_head_tmp)
 
         # Find the closest intersection to the centroid
         arcpy.Near_analysis(out_cluster_head_tmp, intersections, method='GEODESIC')
@@ -306,20 +403,40 @@ def main(nd, nodes, sr, intersections, output_dir_fc, pro, name_clst):
         with arcpy.da.SearchCursor(out_cluster_head_tmp, 'NEAR_FID') as cursor:
             for row in cursor:
                 intersection_id = row[0]
+        sw.discard([out_cluster_head_tmp])
+        heads.append(intersection_id)
+
+    # On request, the nodes are reassigned to the heads with the min-cost flow, the clusters left without any node are
+    # dropped
+    if reassign:
+        heads, members = flow_assignment(nd, nodes, intersections, clustering, heads, sr, od_dir)
+    else:
+        members = [[node_id for node_id, index in clustering[cl + 1]['members']] for cl in range(n_clusters)]
+    kept = [cl for cl in range(len(heads)) if members[cl]]
+    n_clusters = len(kept)
+
+    cluster_heads = []
 
-        clause_int = '{0} = {1}'.format(int_id_field, intersection_id)
+    for i, cl in enumerate(kept):
+        clause_nodes = id_clause(nodes_layer, node_id_field, members[cl])
+        arcpy.SelectLayerByAttribute_management(nodes_layer, selection_type='NEW_SELECTION', where_clause=clause_nodes)
+
+        name_cluster = 'Cluster_{0}_{1}'.format(i, name_clst)
+        out_cluster = os.path.join(output_dir_fc, name_cluster)
+        check_exists(out_cluster)
+        arcpy.CopyFeatures_management(nodes_layer, out_cluster)
+
+        clause_int = '{0} = {1}'.format(int_id_field, heads[cl])
         arcpy.SelectLayerByAttribute_management(int_layer, selection_type='NEW_SELECTION', where_clause=clause_int)
 
         name_cluster_head = 'Cluster_head_{0}_{1}'.format(i, name_clst)
-        # print(name_cluster_head)
         out_cluster_head = os.path.join(output_dir_fc, name_cluster_head)
         check_exists(out_cluster_head)
         arcpy.CopyFeatures_management(int_layer, out_cluster_head)
         cluster_heads.append(out_cluster_head)
 
     # Merge clusterheads
-    merge_name = os.path.join('in_memory', 'Merged_cluster_heads_sr{0}'.format(sr))
-    check_exists(merge_name)
+    merge_name = sw.scratch_name('Merged_cluster_heads_sr{0}'.format(sr))
     arcpy.Merge_management(cluster_heads, merge_name)
 
     # Save them to a file
@@ -327,6 +444,8 @@ def main(nd, nodes, sr, intersections, output_dir_fc, pro, name_clst):
     check_exists(name_cluster_heads)
     arcpy.CopyFeatures_management(merge_name, name_cluster_heads)
 
+    sw.end_stage()
+
     return n_clusters
 
 
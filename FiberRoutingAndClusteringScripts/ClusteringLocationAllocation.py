@@ -2,6 +2,8 @@ import arcpy
 import os
 import math
 
+import ScratchWorkspace as sw
+
 
 def check_exists(name_in):
     """
@@ -41,128 +43,197 @@ def get_ids(layer_in):
     return ids, points_id
 
 
+def id_clause(layer_in, id_field, ids_in):
+    """
+    :return: where clause selecting the features with the ids
+    """
+    return '{0} IN ({1})'.format(arcpy.AddFieldDelimiters(layer_in, id_field), ','.join(str(i) for i in ids_in))
+
+
+def flow_assignment(network_nd, demands_sublayer, facilities_sublayer, sr, default_cutoff='#'):
+    """
+    This function assigns the demands to the facilities chosen by the location-allocation. If the solver allocated
+    every demand, its allocation is kept and the network graph is not read. Otherwise the demands are assigned with
+    the minimum total network distance and at most sr demands per facility, see GraphClustering.flow_heads: the
+    allocation of the solver is the start, the demands it left without a facility are assigned by moving the others
+    and the ones, which still have no facility with a free port within the cutoff, open the new candidate facilities
+    within the cutoff, so the solver does not have to be run again with more facilities. The demands and the
+    facilities, which can not be located on the streets, keep the allocation of the solver.
+
+    :param network_nd: network dataset, path
+    :param demands_sublayer: demands of the solved layer, feature layer
+    :param facilities_sublayer: facilities of the solved layer, feature layer
+    :param sr: splitting ratio
+    :param default_cutoff: maximum network distance of a demand from its facility, '#' for no limit
+    :return: list of the facility ids, list of the lists of the demand ids per facility
+    :raise ValueError: if a demand is not allocated by the solver and can not be located on the streets or has no
+                       free candidate facility within the cutoff
+    """
+    with arcpy.da.SearchCursor(facilities_sublayer, ['OID@', 'DemandCount']) as cursor:
+        chosen = [row[0] for row in cursor if (row[1] or 0) > 0]
+    with arcpy.da.SearchCursor(demands_sublayer, ['OID@', 'FacilityID']) as cursor:
+        allocated = dict((row[0], row[1]) for row in cursor)
+
+    if all(f_id is not None for f_id in allocated.values()):
+        members = dict((f_id, []) for f_id in chosen)
+        for d_id, f_id in allocated.items():
+            members.setdefault(f_id, []).append(d_id)
+        return list(members.keys()), list(members.values())
+
+    import NetworkGraph as ng
+    import GraphClustering as gc
+    import PlanningSession as ps
+
+    max_distance = None if default_cutoff == '#' else float(default_cutoff)
+
+    graph = ng.get_graph(network_nd)
+    points = ps.read_locations(graph, demands_sublayer)
+    candidates = ps.read_locations(graph, facilities_sublayer)
+    candidate_index = dict((c_id, c) for c, c_id in enumerate(candidates['ids']))
+
+    # The demands or the facilities off the streets keep the allocation of the solver
+    located = set(points['ids'])
+    fixed = {}
+    n_lost = 0
+    for d_id, f_id in allocated.items():
+        if d_id in located and (f_id is None or f_id in candidate_index):
+            continue
+        if f_id is None:
+            n_lost += 1
+        else:
+            fixed.setdefault(f_id, []).append(d_id)
+    if n_lost > 0:
+        raise ValueError('{0} demands were not allocated by the solver and could not be located on the streets'.format(
+            n_lost))
+
+    flow = [i for i, d_id in enumerate(points['ids']) if allocated[d_id] is None or allocated[d_id] in candidate_index]
+    heads = [candidate_index[f_id] for f_id in chosen if f_id in candidate_index]
+    head_index = dict((candidates['ids'][c], h) for h, c in enumerate(heads))
+    labels = [head_index.get(allocated[points['ids'][i]], -1) for i in flow]
+    capacity = [int(sr) - len(fixed.get(candidates['ids'][c], [])) for c in heads]
+
+    heads, clusters = gc.flow_heads(graph, [points['locations'][i] for i in flow], points['xy'][flow],
+                                    candidates['locations'], candidates['xy'], heads, sr, max_distance,
+                                    labels_in=labels, capacity_in=capacity)
+
+    facilities_ids = [candidates['ids'][c] for c in heads]
+    members = [fixed.pop(f_id, []) + [points['ids'][flow[j]] for j in cluster]
+               for f_id, cluster in zip(facilities_ids, clusters)]
+    for f_id, d_ids in fixed.items():
+        facilities_ids.append(f_id)
+        members.append(d_ids)
+
+    return facilities_ids, members
+
+
 def main(network_nd, demands, intersections, facilities, sr, output_fds, output_name, pro, default_cutoff='#', lines='#'):
     # Check out the Network Analyst extension license
     arcpy.CheckOutExtension("Network")
     # Set overwriting out the files to TRUE
     arcpy.overwriteOutput = 1
 
+    # The scratch data of the clustering are released at its end
+    sw.begin_stage('clustering')
+
     n_demands_in = int(arcpy.GetCount_management(demands).getOutput(0))
     number_of_facilities_to_find = int(math.ceil(float(n_demands_in) / float(sr)))
 
-    n_nulls = 1
-
     # Set variables
     layer_name = 'LocAlloc_Clustering'
     impedance_attribute = 'Length'
     problem_type = 'MAXIMIZE_CAPACITATED_COVERAGE'
     line_shape = 'STRAIGHT_LINES'
 
-    while n_nulls != 0:
-        #print('Number of facilities to find = {0}'.format(number_of_facilities_to_find))
-        if default_cutoff != '#':
-            # MakeLocationAllocationLayer_na (in_network_dataset, out_network_analysis_layer, impedance_attribute,
-            # {loc_alloc_from_to}, {loc_alloc_problem_type}, {number_facilities_to_find}, {impedance_cutoff},
-            # {impedance_transformation}, {impedance_parameter}, {target_market_share}, {accumulate_attribute_name},
-            # {UTurn_policy}, {restriction_attribute_name}, {hierarchy}, {output_path_shape}, {default_capacity},
-            # {time_of_day})
-            # http://desktop.arcgis.com/en/arcmap/10.3/tools/network-analyst-toolbox/make-location-allocation-layer.htm
-            result_object = arcpy.na.MakeLocationAllocationLayer(network_nd, layer_name, impedance_attribute,
-                                                                 loc_alloc_problem_type=problem_type,
-                                                                 number_facilities_to_find=number_of_facilities_to_find,
-                                                                 UTurn_policy='NO_UTURNS', output_path_shape=line_shape,
-                                                                 default_capacity=sr, impedance_cutoff=default_cutoff)
-        else:
-            result_object = arcpy.na.MakeLocationAllocationLayer(network_nd, layer_name, impedance_attribute,
-                                                                 loc_alloc_problem_type=problem_type,
-                                                                 number_facilities_to_find=number_of_facilities_to_find,
-                                                                 UTurn_policy='NO_UTURNS', output_path_shape=line_shape,
-                                                                 default_capacity=sr)
-
-        # Get the layer object from the result object. The location-allocation layer
-        # can now be referenced using the layer object.
-        layer_object = result_object.getOutput(0)
-
-        # Get the names of all the sublayers within the location-allocation layer.
-        subLayerNames = arcpy.na.GetNAClassNames(layer_object)
-
-        # Stores the layer names that we will use later
-        facilities_layer_name = subLayerNames["Facilities"]
-        demand_points_layer_name = subLayerNames["DemandPoints"]
-        # lines_layer_name = subLayerNames["LALines"]
-
-        # Load facilities - Intersections
-        if facilities == "Nodes":
-            arcpy.na.AddLocations(layer_object, facilities_layer_name, demands)
-        else:
-            if number_of_facilities_to_find <= n_demands_in:
-                arcpy.na.AddLocations(layer_object, facilities_layer_name, intersections)
-                arcpy.na.AddLocations(layer_object, facilities_layer_name, intersections)
-
-                if lines != '#':
-                    additional_facilities_middle_of_streets = os.path.join('in_memory', 'middle_points')
-                    check_exists(additional_facilities_middle_of_streets)
-                    arcpy.FeatureToPoint_management(lines, additional_facilities_middle_of_streets, 'INSIDE')
-
-                    arcpy.na.AddLocations(layer_object, facilities_layer_name, additional_facilities_middle_of_streets)
-
-            else:
-                arcpy.na.AddLocations(layer_object, facilities_layer_name, intersections)
-
-        # Load demands - BSs
-        arcpy.na.AddLocations(layer_object, demand_points_layer_name, demands)
-
-        # Solve the location-allocation layer
-        arcpy.na.Solve(layer_object)
-
-        # Get the Lines Sublayer (all the distances)
-        if pro:
-            # lines_sublayer = layer_object.listLayers(lines_layer_name)[0]
-            facilities_sublayer_tmp = layer_object.listLayers(facilities_layer_name)[0]
-            demands_sublayer_tmp = layer_object.listLayers(demand_points_layer_name)[0]
-        elif not pro:
-            # lines_sublayer = arcpy.mapping.ListLayers(layer_object, lines_layer_name)[0]
-            facilities_sublayer_tmp = arcpy.mapping.ListLayers(layer_object, facilities_layer_name)[0]
-            demands_sublayer_tmp = arcpy.mapping.ListLayers(layer_object, demand_points_layer_name)[0]
+    #print('Number of facilities to find = {0}'.format(number_of_facilities_to_find))
+    if default_cutoff != '#':
+        # MakeLocationAllocationLayer_na (in_network_dataset, out_network_analysis_layer, impedance_attribute,
+        # {loc_alloc_from_to}, {loc_alloc_problem_type}, {number_facilities_to_find}, {impedance_cutoff},
+        # {impedance_transformation}, {impedance_parameter}, {target_market_share}, {accumulate_attribute_name},
+        # {UTurn_policy}, {restriction_attribute_name}, {hierarchy}, {output_path_shape}, {default_capacity},
+        # {time_of_day})
+        # http://desktop.arcgis.com/en/arcmap/10.3/tools/network-analyst-toolbox/make-location-allocation-layer.htm
+        result_object = arcpy.na.MakeLocationAllocationLayer(network_nd, layer_name, impedance_attribute,
+                                                             loc_alloc_problem_type=problem_type,
+                                                             number_facilities_to_find=number_of_facilities_to_find,
+                                                             UTurn_policy='NO_UTURNS', output_path_shape=line_shape,
+                                                             default_capacity=sr, impedance_cutoff=default_cutoff)
+    else:
+        result_object = arcpy.na.MakeLocationAllocationLayer(network_nd, layer_name, impedance_attribute,
+                                                             loc_alloc_problem_type=problem_type,
+                                                             number_facilities_to_find=number_of_facilities_to_find,
+                                                             UTurn_policy='NO_UTURNS', output_path_shape=line_shape,
+                                                             default_capacity=sr)
+
+    # Get the layer object from the result object. The location-allocation layer
+    # can now be referenced using the layer object.
+    layer_object = result_object.getOutput(0)
+
+    # Get the names of all the sublayers within the location-allocation layer.
+    subLayerNames = arcpy.na.GetNAClassNames(layer_object)
+
+    # Stores the layer names that we will use later
+    facilities_layer_name = subLayerNames["Facilities"]
+    demand_points_layer_name = subLayerNames["DemandPoints"]
+    # lines_layer_name = subLayerNames["LALines"]
+
+    # Load facilities - Intersections
+    if facilities == "Nodes":
+        arcpy.na.AddLocations(layer_object, facilities_layer_name, demands)
+    else:
+        if number_of_facilities_to_find <= n_demands_in:
+            arcpy.na.AddLocations(layer_object, facilities_layer_name, intersections)
+            arcpy.na.AddLocations(layer_object, facilities_layer_name, intersections)
+
+            if lines != '#':
+                additional_facilities_middle_of_streets = sw.scratch_name('middle_points')
+                arcpy.FeatureToPoint_management(lines, additional_facilities_middle_of_streets, 'INSIDE')
+
+                arcpy.na.AddLocations(layer_object, facilities_layer_name, additional_facilities_middle_of_streets)
 
-        facilities_sublayer = os.path.join('in_memory', 'Facilities')
-        check_exists(facilities_sublayer)
-        arcpy.MakeFeatureLayer_management(facilities_sublayer_tmp, facilities_sublayer)
-
-        # facilities_sublayer_path = os.path.join(r'D:\GISworkspace\Test_for_Scripting.gdb\NewYork_JOCN_big', 'Facilities')
-        # arcpy.CopyFeatures_management(facilities_sublayer, facilities_sublayer_path)
-
-        demands_sublayer = os.path.join('in_memory', 'Demands')
-        check_exists(demands_sublayer)
-        arcpy.MakeFeatureLayer_management(demands_sublayer_tmp, demands_sublayer)
+        else:
+            arcpy.na.AddLocations(layer_object, facilities_layer_name, intersections)
 
-        # demands_sublayer_path = os.path.join(r'D:\GISworkspace\Test_for_Scripting.gdb\NewYork_JOCN_big', 'Demands')
-        # arcpy.CopyFeatures_management(demands_sublayer, demands_sublayer_path)
+    # Load demands - BSs
+    arcpy.na.AddLocations(layer_object, demand_points_layer_name, demands)
 
-        clause_demands = 'FacilityID IS NULL'
-        arcpy.SelectLayerByAttribute_management(demands_sublayer, selection_type='NEW_SELECTION',
-                                                where_clause=clause_demands)
+    # Solve the location-allocation layer
+    arcpy.na.Solve(layer_object)
 
-        n_nulls = int(arcpy.GetCount_management(demands_sublayer).getOutput(0))
+    # Get the Lines Sublayer (all the distances)
+    if pro:
+        # lines_sublayer = layer_object.listLayers(lines_layer_name)[0]
+        facilities_sublayer_tmp = layer_object.listLayers(facilities_layer_name)[0]
+        demands_sublayer_tmp = layer_object.listLayers(demand_points_layer_name)[0]
+    elif not pro:
+        # lines_sublayer = arcpy.mapping.ListLayers(layer_object, lines_layer_name)[0]
+        facilities_sublayer_tmp = arcpy.mapping.ListLayers(layer_object, facilities_layer_name)[0]
+        demands_sublayer_tmp = arcpy.mapping.ListLayers(layer_object, demand_points_layer_name)[0]
 
-        number_of_facilities_to_find += 5
+    facilities_sublayer = sw.scratch_name('Facilities')
+    arcpy.MakeFeatureLayer_management(facilities_sublayer_tmp, facilities_sublayer)
 
-    clause_facilities = '"DemandCount" > 1'
+    demands_sublayer = sw.scratch_name('Demands')
+    arcpy.MakeFeatureLayer_management(demands_sublayer_tmp, demands_sublayer)
 
-    arcpy.SelectLayerByAttribute_management(facilities_sublayer, selection_type='NEW_SELECTION',
-                                            where_clause=clause_facilities)
+    # The demands left without a facility by the solver are assigned with the min-cost flow instead of solving again
+    # with more facilities until every demand is allocated
+    facilities_ids, clusters = flow_assignment(network_nd, demands_sublayer, facilities_sublayer, sr, default_cutoff)
+    kept = [h for h in range(len(facilities_ids)) if clusters[h]]
+    n_clusters = len(kept)
 
-    n_clusters = int(arcpy.GetCount_management(facilities_sublayer).getOutput(0))
+    point_id = get_ids(facilities_sublayer)[1]
+    demand_id = get_ids(demands_sublayer)[1]
 
     name_cluster_heads = 'Cluster_heads_{0}'.format(output_name)
     out_cluster_heads = os.path.join(output_fds, name_cluster_heads)
     check_exists(out_cluster_heads)
+    arcpy.SelectLayerByAttribute_management(facilities_sublayer, selection_type='NEW_SELECTION',
+                                            where_clause=id_clause(facilities_sublayer, point_id,
+                                                                   [facilities_ids[h] for h in kept]))
     arcpy.CopyFeatures_management(facilities_sublayer, out_cluster_heads)
 
-    facilities_ids, point_id = get_ids(facilities_sublayer)
-
-    for i in range(len(facilities_ids)):
-        clause_facilities = '"{0}" = {1}'.format(point_id, facilities_ids[i])
+    for i, h in enumerate(kept):
+        clause_facilities = '"{0}" = {1}'.format(point_id, facilities_ids[h])
         arcpy.SelectLayerByAttribute_management(facilities_sublayer, selection_type='NEW_SELECTION',
                                                 where_clause=clause_facilities)
         name_cluster_head = 'Cluster_head_{0}_{1}'.format(i, output_name)
@@ -170,14 +241,15 @@ def main(network_nd, demands, intersections, facilities, sr, output_fds, output_
         check_exists(out_cluster_head)
         arcpy.CopyFeatures_management(facilities_sublayer, out_cluster_head)
 
-        clause_demands = '"FacilityID" = {0}'.format(facilities_ids[i])
         arcpy.SelectLayerByAttribute_management(demands_sublayer, selection_type='NEW_SELECTION',
-                                                where_clause=clause_demands)
+                                                where_clause=id_clause(demands_sublayer, demand_id, clusters[h]))
         name_cluster = 'Cluster_{0}_{1}'.format(i, output_name)
         out_cluster = os.path.join(output_fds, name_cluster)
         check_exists(out_cluster)
         arcpy.CopyFeatures_management(demands_sublayer, out_cluster)
 
+    sw.end_stage()
+
     return n_clusters
 
 
@@ -0,0 +1,581 @@
+import os
+import time
+import heapq
+import random
+
+import numpy as np
+
+import NetworkGraph as ng
+import GraphClustering as gc
+
+
+def witness_search(adjacency, source, excluded, targets, cutoff, max_settled):
+    """
+    Local search of the contraction: the paths around the contracted node. The search is bounded, a missed witness
+    only adds a needless shortcut, the distances stay exact.
+
+    :param adjacency: list of dicts neighbour - (weight, middle node, edge id) of the remaining graph
+    :param source: start node
+    :param excluded: the node being contracted
+    :param targets: the search stops when all of these nodes are settled, set
+    :param cutoff: the search stops at this distance
+    :param max_settled: the search stops after this number of the settled nodes
+    :return: dict node - distance, upper bounds of the distances without the excluded node
+    """
+    dist = {source: 0.0}
+    heap = [(0.0, source)]
+    remaining = set(targets)
+    settled = 0
+    while heap and remaining:
+        d, node = heapq.heappop(heap)
+        if d > dist[node]:
+            continue
+        if d > cutoff or settled == max_settled:
+            break
+        settled += 1
+        remaining.discard(node)
+        for nbr, (w, mid, edge) in adjacency[node].items():
+            if nbr == excluded:
+                continue
+            nd = d + w
+            if nd < dist.get(nbr, float('inf')):
+                dist[nbr] = nd
+                heapq.heappush(heap, (nd, nbr))
+    return dist
+
+
+def shortcuts(adjacency, node_in, max_settled):
+    """
+    :return: list of (node, node, weight) shortcuts needed if the node is contracted
+    """
+    neighbours = list(adjacency[node_in].items())
+    out = []
+    for i, (a, (w_a, mid_a, edge_a)) in enumerate(neighbours[:-1]):
+        others = neighbours[i + 1:]
+        cutoff = w_a + max(w_b for b, (w_b, mid_b, edge_b) in others)
+        dist = witness_search(adjacency, a, node_in, [b for b, value in others], cutoff, max_settled)
+        for b, (w_b, mid_b, edge_b) in others:
+            if dist.get(b, float('inf')) > w_a + w_b:
+                out.append((a, b, w_a + w_b))
+    return out
+
+
+def build_hierarchy(graph, weights=None, max_settled=50):
+    """
+    This function contracts the nodes of the street graph one by one, the least important first: a contracted node is
+    replaced by the shortcuts between its neighbours, unless there is a path around it that is not longer. The order
+    is by the edge difference (added shortcuts minus the removed edges) and the number of the contracted neighbours,
+    so the hierarchy stays flat and the upward searches stay small. Every edge of the hierarchy goes up from a node to
+    a more important one, the middle node of a shortcut gives its two halves to unpack the paths.
+
+    :param graph: graph, dict
+    :param weights: edge weights, the edge lengths if None
+    :param max_settled: limit of the witness searches
+    :return: hierarchy, dict: 'rank' of every node, the upward edges 'lo', 'hi', 'w', 'mid' node of the shortcut or -1,
+             'edge' id of the street or -1, 'ptr' of the upward edges of every node, 'level' of every node, 'weight'
+    """
+    n = graph['n_nodes']
+    weights = np.asarray(graph['weight'] if weights is None else weights, dtype=np.float64)
+
+    adjacency = [{} for _ in range(n)]
+    for edge, (u, v, w) in enumerate(zip(graph['edge_u'].tolist(), graph['edge_v'].tolist(), weights.tolist())):
+        if u != v and w < adjacency[u].get(v, (float('inf'),))[0]:
+            adjacency[u][v] = (w, -1, edge)
+            adjacency[v][u] = (w, -1, edge)
+
+    deleted = [0] * n
+    cache = {}
+
+    def priority(node):
+        cache[node] = shortcuts(adjacency, node, max_settled)
+        return 2 * (len(cache[node]) - len(adjacency[node])) + deleted[node]
+
+    heap = [(priority(node), node) for node in range(n)]
+    heapq.heapify(heap)
+
+    # Lazy updates: a node, whose neighbourhood changed, gets its priority again only when it is on the top
+    dirty = [False] * n
+    rank = np.full(n, -1, dtype=np.int64)
+    arcs = []
+    r = 0
+    while heap:
+        p, node = heapq.heappop(heap)
+        if rank[node] != -1:
+            continue
+        if dirty[node]:
+            dirty[node] = False
+            p = priority(node)
+            if heap and p > heap[0][0]:
+                heapq.heappush(heap, (p, node))
+                continue
+
+        rank[node] = r
+        r += 1
+        for nbr, (w, mid, edge) in adjacency[node].items():
+            arcs.append((node, nbr, w, mid, edge))
+        for a, b, w in cache.pop(node):
+            if w < adjacency[a].get(b, (float('inf'),))[0]:
+                adjacency[a][b] = (w, node, -1)
+                adjacency[b][a] = (w, node, -1)
+
+        for nbr in adjacency[node]:
+            del adjacency[nbr][node]
+            deleted[nbr] += 1
+            dirty[nbr] = True
+        adjacency[node] = {}
+
+    lo, hi, w, mid, edge = (np.asarray(column) for column in zip(*arcs)) if arcs else [np.zeros(0)] * 5
+    return make_hierarchy(rank, lo.astype(np.int64), hi.astype(np.int64), w.astype(np.float64),
+                          mid.astype(np.int64), edge.astype(np.int64), weights)
+
+
+def make_hierarchy(rank, lo, hi, w, mid, edge, weights):
+    """
+    :return: hierarchy, dict, the upward edges sorted by the lower node, with the levels of the nodes
+    """
+    n = len(rank)
+    order = np.argsort(lo, kind='stable')
+    lo, hi, w, mid, edge = lo[order], hi[order], w[order], mid[order], edge[order]
+    ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(lo, minlength=n), out=ptr[1:])
+
+    # Level: the longest upward path below the node, the nodes of one level do not share an upward edge
+    level = np.zeros(n, dtype=np.int64)
+    level_list = level.tolist()
+    for j in np.argsort(rank[lo], kind='stable').tolist():
+        a = int(lo[j])
+        b = int(hi[j])
+        if level_list[a] + 1 > level_list[b]:
+            level_list[b] = level_list[a] + 1
+    level[:] = level_list
+
+    return {'rank': rank, 'lo': lo, 'hi': hi, 'w': w, 'mid': mid, 'edge': edge, 'ptr': ptr, 'level': level,
+            'weight': np.asarray(weights, dtype=np.float64)}
+
+
+def save_hierarchy(hierarchy, path_in):
+    """
+    :param hierarchy: hierarchy, dict
+    :param path_in: path to the .npz file
+    :return:
+    """
+    np.savez(path_in, **dict((key, hierarchy[key]) for key in ('rank', 'lo', 'hi', 'w', 'mid', 'edge', 'ptr',
+                                                                 'level', 'weight')))
+    return
+
+
+def load_hierarchy(path_in):
+    """
+    :param path_in: path to the .npz file
+    :return: hierarchy, dict
+    """
+    data = np.load(path_in)
+    return dict((key, data[key]) for key in data.files)
+
+
+def hierarchy_path(nd_in, cache_dir='#'):
+    """
+    :return: path of the .npz file of the hierarchy next to the cached graph, '#' if there is no cache directory
+    """
+    if cache_dir == '#':
+        return '#'
+    return os.path.join(cache_dir, '{0}_hierarchy.npz'.format(os.path.basename(nd_in)))
+
+
+def get_hierarchy(graph, path_in='#', weights=None):
+    """
+    The hierarchy is kept with the graph, so the distance queries of the clustering and the routing on this graph use
+    it. If the path is specified, the contraction runs only once for the network, a file of a different network or
+    weights is built again.
+
+    :param graph: graph, dict
+    :param path_in: path to the .npz file, '#' to keep the hierarchy only in memory
+    :param weights: edge weights, e.g., with the brownfield discount, the edge lengths if None
+    :return: hierarchy, dict
+    """
+    if usable(graph, weights) is None:
+        weights = np.asarray(graph['weight'] if weights is None else weights, dtype=np.float64)
+        hierarchy = None
+        if path_in != '#' and os.path.exists(path_in):
+            hierarchy = load_hierarchy(path_in)
+            if not np.array_equal(hierarchy['weight'], weights):
+                hierarchy = None
+        if hierarchy is None:
+            hierarchy = build_hierarchy(graph, weights)
+            if path_in != '#':
+                save_hierarchy(hierarchy, path_in)
+        graph['hierarchy'] = hierarchy
+    return graph['hierarchy']
+
+
+def usable(graph, weights=None):
+    """
+    :return: the hierarchy of the graph, if it was contracted with these weights, otherwise None
+    """
+    hierarchy = graph.get('hierarchy')
+    if hierarchy is None:
+        return None
+    weights = graph['weight'] if weights is None else weights
+    if len(weights) == len(hierarchy['weight']) and np.array_equal(np.asarray(weights), hierarchy['weight']):
+        return hierarchy
+    return None
+
+
+def index_ranges(ptr, nodes):
+    """
+    :return: indices of the upward edges of all the nodes, array
+    """
+    starts = ptr[nodes]
+    counts = ptr[nodes + 1] - starts
+    if counts.sum() == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return offsets + np.arange(counts.sum())
+
+
+def upward_closure(hierarchy, nodes_in):
+    """
+    :return: mask of the nodes reachable upwards from the nodes, all the upward searches from them stay within it
+    """
+    mask = np.zeros(len(hierarchy['rank']), dtype=bool)
+    frontier = np.unique(np.asarray(nodes_in, dtype=np.int64))
+    while len(frontier):
+        mask[frontier] = True
+        nbrs = hierarchy['hi'][index_ranges(hierarchy['ptr'], frontier)]
+        frontier = np.unique(nbrs[~mask[nbrs]])
+    return mask
+
+
+def sweep_order(hierarchy):
+    """
+    :return: the upward edges by the level of the upper node and by the descending level of the lower node
+    """
+    if 'order_up' not in hierarchy:
+        level = hierarchy['level']
+        hierarchy['order_up'] = np.lexsort((hierarchy['hi'], level[hierarchy['hi']]))
+        hierarchy['order_down'] = np.lexsort((hierarchy['lo'], -level[hierarchy['lo']]))
+    return hierarchy['order_up'], hierarchy['order_down']
+
+
+def groups(levels, heads):
+    """
+    :return: list of (start, end, starts of the heads within the group, heads) of every level of the sorted edges
+    """
+    out = []
+    if len(levels) == 0:
+        return out
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(levels)) + 1, [len(levels)]))
+    for a, b in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        h = heads[a:b]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(h)) + 1))
+        out.append((a, b, starts, h[starts]))
+    return out
+
+
+def relax(d, tails, heads_group, w):
+    """
+    All the edges of one level at once: the distance of every head is the minimum over its edges. The rows of the
+    distances are the nodes, so every edge reads one contiguous row of all the sources.
+    """
+    a, b, starts, heads = heads_group
+    values = d[tails[a:b]] + w[a:b, None]
+    best = np.minimum.reduceat(values, starts, axis=0)
+    d[heads] = np.minimum(d[heads], best)
+    return
+
+
+def location_ends(graph, locations_in, weights):
+    """
+    :return: nodes and the offsets of both ends of every location, arrays (n, 2)
+    """
+    ends = gc.location_nodes(graph, locations_in, weights)
+    nodes = np.asarray([[u, v] for (u, d_u), (v, d_v) in ends], dtype=np.int64).reshape(-1, 2)
+    offsets = np.asarray([[d_u, d_v] for (u, d_u), (v, d_v) in ends], dtype=np.float64).reshape(-1, 2)
+    return nodes, offsets
+
+
+def distance_rows(graph, hierarchy, sources_in, targets_in, chunk=None, max_cells=1 << 22):
+    """
+    This function computes the network distances from the sources to the targets in the blocks of the rows. The
+    targets select the part of the hierarchy their upward searches reach, every block of the sources is swept upwards
+    over the part its searches reach and then downwards over the part of the targets, level by level, all the edges
+    of a level and all the sources of the block at once. The sweeps replace the per-source searches and the scans of
+    the buckets of the targets, which are the dense products for the large matrices.
+
+    :param graph: graph, dict
+    :param hierarchy: hierarchy, dict
+    :param sources_in: list of (edge id, offset along the edge) pairs
+    :param targets_in: list of (edge id, offset along the edge) pairs
+    :param chunk: number of the sources per block, from max_cells if None
+    :param max_cells: size of the working matrix of a block
+    :return: generator of (first source index, distances array (block, n targets)), inf for the unreachable pairs
+    """
+    weights = hierarchy['weight']
+    if len(sources_in) == 0:
+        return
+
+    s_nodes, s_offsets = location_ends(graph, sources_in, weights)
+    t_nodes, t_offsets = location_ends(graph, targets_in, weights)
+
+    order_up, order_down = sweep_order(hierarchy)
+    lo = hierarchy['lo']
+    hi = hierarchy['hi']
+    level = hierarchy['level']
+
+    target_mask = upward_closure(hierarchy, t_nodes.ravel())
+    down = order_down[target_mask[lo[order_down]]]
+
+    # The locations on the same edge are connected directly along it as well
+    targets_on_edge = {}
+    for j, (edge, pos) in enumerate(targets_in):
+        targets_on_edge.setdefault(edge, []).append(j)
+
+    # The columns are at most all the nodes
+    n_s = len(sources_in)
+    if chunk is None:
+        chunk = max(1, int(max_cells // max(1, len(level))))
+
+    for first in range(0, n_s, chunk):
+        block = slice(first, min(first + chunk, n_s))
+        k = block.stop - block.start
+        source_mask = upward_closure(hierarchy, s_nodes[block].ravel())
+        mask = source_mask | target_mask
+        columns = np.full(len(level), -1, dtype=np.int64)
+        columns[mask] = np.arange(int(mask.sum()))
+
+        up = order_up[source_mask[lo[order_up]]]
+
+        d = np.full((int(mask.sum()), k), np.inf)
+        np.minimum.at(d, (columns[s_nodes[block].ravel()], np.repeat(np.arange(k), 2)), s_offsets[block].ravel())
+
+        tails = columns[lo[up]]
+        heads = columns[hi[up]]
+        w = hierarchy['w'][up]
+        for group in groups(level[hi[up]], heads):
+            relax(d, tails, group, w)
+
+        tails = columns[hi[down]]
+        heads = columns[lo[down]]
+        w = hierarchy['w'][down]
+        for group in groups(-level[lo[down]], heads):
+            relax(d, tails, group, w)
+
+        out = np.minimum(d[columns[t_nodes[:, 0]]] + t_offsets[:, :1], d[columns[t_nodes[:, 1]]] + t_offsets[:, 1:]).T
+
+        for i in range(block.start, block.stop):
+            edge, pos = sources_in[i]
+            factor = weights[edge] / max(graph['edge_length'][edge], 1e-9)
+            for j in targets_on_edge.get(edge, ()):
+                out[i - block.start, j] = min(out[i - block.start, j], abs(targets_in[j][1] - pos) * factor)
+
+        yield block.start, out
+    return
+
+
+def many_to_many(graph, hierarchy, sources_in, targets_in, out=None):
+    """
+    :param graph: graph, dict
+    :param hierarchy: hierarchy, dict
+    :param sources_in: list of (edge id, offset along the edge) pairs
+    :param targets_in: list of (edge id, offset along the edge) pairs
+    :param out: array (n sources, n targets) the distances are written to, e.g., a memory map, a new one if None
+    :return: distances, inf for the unreachable pairs - array (n sources, n targets)
+    """
+    if out is None:
+        out = np.empty((len(sources_in), len(targets_in)))
+    for first, rows in distance_rows(graph, hierarchy, sources_in, targets_in):
+        out[first:first + len(rows)] = rows
+    return out
+
+
+def k_nearest(graph, hierarchy, locations_in, k):
+    """
+    The same as GraphClustering.k_nearest, the rows of the distance matrix are computed in blocks and only the k
+    smallest of every row are kept.
+
+    :return: list of the lists of (distance, location index) pairs, sorted by the distance
+    """
+    n = len(locations_in)
+    k = min(k, n)
+    nearest = []
+    for first, rows in distance_rows(graph, hierarchy, locations_in, locations_in):
+        if k < n:
+            part = np.argpartition(rows, k - 1, axis=1)[:, :k]
+        else:
+            part = np.tile(np.arange(n), (len(rows), 1))
+        for r, row in enumerate(rows):
+            nearest.append(sorted((float(row[j]), int(j)) for j in part[r] if row[j] < np.inf))
+    return nearest
+
+
+def upward_search(hierarchy, sources):
+    """
+    Dijkstra over the upward edges only, the search space is small and it is complete.
+
+    :param sources: list of (node, initial distance, source index) tuples
+    :return: dicts node - distance, node - upward edge it was reached with or -1, node - source index
+    """
+    ptr = hierarchy['ptr']
+    hi = hierarchy['hi']
+    w = hierarchy['w']
+
+    dist = {}
+    pred = {}
+    root = {}
+    heap = []
+    for node, d, k in sources:
+        if d < dist.get(node, float('inf')):
+            dist[node] = d
+            pred[node] = -1
+            root[node] = k
+            heap.append((d, node))
+    heapq.heapify(heap)
+
+    done = set()
+    while heap:
+        d, node = heapq.heappop(heap)
+        if node in done:
+            continue
+        done.add(node)
+        for j in range(int(ptr[node]), int(ptr[node + 1])):
+            nbr = int(hi[j])
+            nd = d + float(w[j])
+            if nd < dist.get(nbr, float('inf')):
+                dist[nbr] = nd
+                pred[nbr] = j
+                root[nbr] = root[node]
+                heapq.heappush(heap, (nd, nbr))
+    return dist, pred, root
+
+
+def unpack(hierarchy, arc_in, node_from):
+    """
+    This function replaces the shortcut by the streets it stands for.
+
+    :param arc_in: upward edge
+    :param node_from: end of the edge the path starts at
+    :return: list of the nodes and list of the edge ids of the path
+    """
+    lo = hierarchy['lo']
+    hi = hierarchy['hi']
+    ptr = hierarchy['ptr']
+
+    def find(a, b):
+        for j in range(int(ptr[a]), int(ptr[a + 1])):
+            if int(hi[j]) == b:
+                return j
+        return -1
+
+    nodes = [node_from]
+    edges = []
+    stack = [(arc_in, node_from)]
+    while stack:
+        arc, start = stack.pop()
+        end = int(hi[arc]) if int(lo[arc]) == start else int(lo[arc])
+        middle = int(hierarchy['mid'][arc])
+        if middle == -1:
+            edges.append(int(hierarchy['edge'][arc]))
+            nodes.append(end)
+        else:
+            # The middle node is below both ends, the halves are its upward edges
+            stack.append((find(middle, end), middle))
+            stack.append((find(middle, start), start))
+    return nodes, edges
+
+
+def route_pieces(graph, hierarchy, facilities_in, incident_in):
+    """
+    The same as NetworkGraph.route_pieces for one incident: the upward searches from the facilities and from the
+    incident meet at the top of the shortest path, the path is unpacked to the streets.
+
+    :param graph: graph, dict
+    :param hierarchy: hierarchy, dict
+    :param facilities_in: list of (edge id, offset along the edge) pairs
+    :param incident_in: (edge id, offset along the edge) pair
+    :return: list with one (facility index, 0, pieces) tuple, empty if the incident is not reachable
+    """
+    weights = hierarchy['weight']
+    f_ends = gc.location_nodes(graph, facilities_in, weights)
+    t_ends = gc.location_nodes(graph, [incident_in], weights)[0]
+
+    forward = upward_search(hierarchy, [(node, d, 2 * k + j) for k, ends in enumerate(f_ends)
+                                        for j, (node, d) in enumerate(ends)])
+    backward = upward_search(hierarchy, [(node, d, j) for j, (node, d) in enumerate(t_ends)])
+
+    best = (float('inf'), -1)
+    for node, d in backward[0].items():
+        if node in forward[0] and forward[0][node] + d < best[0]:
+            best = (forward[0][node] + d, node)
+
+    edge, pos = incident_in
+    factor = weights[edge] / max(graph['edge_length'][edge], 1e-9)
+    direct = [(abs(f_pos - pos) * factor, k) for k, (f_edge, f_pos) in enumerate(facilities_in) if f_edge == edge]
+    if direct and min(direct)[0] <= best[0]:
+        k = min(direct)[1]
+        return [(k, 0, [(edge, float(facilities_in[k][1]), float(pos))])]
+    if best[1] == -1:
+        return []
+
+    def down(search, node):
+        # Path from the top back to the start of the search
+        dist, pred, root = search
+        nodes = [node]
+        edges = []
+        while pred[node] != -1:
+            arc = pred[node]
+            below = int(hierarchy['lo'][arc])
+            part_nodes, part_edges = unpack(hierarchy, arc, node)
+            nodes.extend(part_nodes[1:])
+            edges.extend(part_edges)
+            node = below
+        return nodes, edges, root[node]
+
+    f_nodes, f_edges, k = down(forward, best[1])
+    t_nodes, t_edges, j = down(backward, best[1])
+    f_nodes.reverse()
+    f_edges.reverse()
+    nodes = f_nodes + t_nodes[1:]
+    edges = f_edges + t_edges
+
+    return [(k // 2, 0, ng.path_pieces(graph, facilities_in[k // 2], nodes, edges, incident_in))]
+
+
+def benchmark(graph, n_sources=1000, n_targets=1000, n_checks=20, seed_in=0, path_in='#'):
+    """
+    This function contracts the graph, if it has no hierarchy yet, and compares the many-to-many distances to the
+    Dijkstra searches from a sample of the sources.
+
+    :param path_in: path to the .npz file of the hierarchy, the preprocessing is then only the loading, if it exists
+    :return: dict with the times, seconds, and the largest difference of the distances
+    """
+    random.seed(seed_in)
+    result = {}
+
+    start = time.time()
+    hierarchy = get_hierarchy(graph, path_in)
+    result['preprocessing'] = time.time() - start
+    result['shortcuts'] = int((hierarchy['mid'] != -1).sum())
+
+    edges = [random.randrange(graph['n_edges']) for _ in range(n_sources + n_targets)]
+    locations = [(edge, random.random() * float(graph['edge_length'][edge])) for edge in edges]
+    sources = locations[:n_sources]
+    targets = locations[n_sources:]
+
+    start = time.time()
+    matrix = many_to_many(graph, hierarchy, sources, targets)
+    result['many_to_many'] = time.time() - start
+
+    error = 0.0
+    start = time.time()
+    for i in random.sample(range(n_sources), min(n_checks, n_sources)):
+        dist = ng.dijkstra(graph, list(gc.location_nodes(graph, [sources[i]])[0]))[0]
+        for j, ((u, d_u), (v, d_v)) in enumerate(gc.location_nodes(graph, targets)):
+            d = min(dist.get(u, np.inf) + d_u, dist.get(v, np.inf) + d_v)
+            if targets[j][0] == sources[i][0]:
+                d = min(d, abs(targets[j][1] - sources[i][1]))
+            if d < np.inf or matrix[i, j] < np.inf:
+                error = max(error, abs(d - matrix[i, j]))
+    result['dijkstra_per_source'] = (time.time() - start) / max(1, min(n_checks, n_sources))
+    result['max_error'] = float(error)
+
+    return result
@@ -0,0 +1,188 @@
+import math
+
+import numpy as np
+
+# WGS 1984 ellipsoid and the UTM constants
+SEMI_MAJOR = 6378137.0
+FLATTENING = 1 / 298.257223563
+K0 = 0.9996
+FALSE_EASTING = 500000.0
+FALSE_NORTHING_SOUTH = 10000000.0
+
+zone_cache = {}
+
+
+def utm_zone(lon, lat):
+    """
+    This function finds the UTM zone of a point, including the exceptions of the south-west Norway and Svalbard.
+
+    :param lon: longitude, degrees
+    :param lat: latitude, degrees
+    :return: zone, (zone number, if it is the northern zone) tuple
+    """
+    number = int(math.floor((lon + 180.0) / 6.0)) % 60 + 1
+
+    if 56.0 <= lat < 64.0 and 3.0 <= lon < 12.0:
+        number = 32
+    elif 72.0 <= lat < 84.0 and 0.0 <= lon < 42.0:
+        number = 2 * int(math.floor((lon + 3.0) / 12.0)) + 31
+
+    return number, lat >= 0
+
+
+def detect_zone(xy_in):
+    """
+    :param xy_in: geographic coordinates, longitude and latitude, array (n, 2)
+    :return: zone of the center of the extent of the points, see utm_zone
+    """
+    xy_in = np.asarray(xy_in, dtype=np.float64).reshape(-1, 2)
+    if len(xy_in) == 0:
+        return utm_zone(0.0, 0.0)
+
+    center = (xy_in.min(axis=0) + xy_in.max(axis=0)) / 2.0
+    return utm_zone(float(center[0]), float(center[1]))
+
+
+def zone_name(zone):
+    """
+    :param zone: (zone number, if it is the northern zone) tuple
+    :return: name of the projected coordinate system, it can be directly translated to a spatial reference
+    """
+    return 'WGS 1984 UTM Zone {0}{1}'.format(zone[0], 'N' if zone[1] else 'S')
+
+
+def zone_parameters(zone):
+    """
+    The parameters of the Krueger series of the transverse Mercator projection are computed once per zone.
+
+    :param zone: (zone number, if it is the northern zone) tuple
+    :return: dict with the central meridian, the false northing, the rectifying radius and the series coefficients
+    """
+    if zone not in zone_cache:
+        n = FLATTENING / (2.0 - FLATTENING)
+        zone_cache[zone] = {
+            'lon0': math.radians(6.0 * zone[0] - 183.0),
+            'false_northing': 0.0 if zone[1] else FALSE_NORTHING_SOUTH,
+            'radius': SEMI_MAJOR / (1.0 + n) * (1.0 + n ** 2 / 4.0 + n ** 4 / 64.0),
+            'n': n,
+            'e': 2.0 * math.sqrt(n) / (1.0 + n),
+            'alpha': (n / 2.0 - 2.0 * n ** 2 / 3.0 + 5.0 * n ** 3 / 16.0,
+                      13.0 * n ** 2 / 48.0 - 3.0 * n ** 3 / 5.0,
+                      61.0 * n ** 3 / 240.0),
+            'beta': (n / 2.0 - 2.0 * n ** 2 / 3.0 + 37.0 * n ** 3 / 96.0,
+                     n ** 2 / 48.0 + n ** 3 / 15.0,
+                     17.0 * n ** 3 / 480.0),
+            'delta': (2.0 * n - 2.0 * n ** 2 / 3.0 - 2.0 * n ** 3,
+                      7.0 * n ** 2 / 3.0 - 8.0 * n ** 3 / 5.0,
+                      56.0 * n ** 3 / 15.0)}
+    return zone_cache[zone]
+
+
+def conformal(xy_in, parameters):
+    """
+    :param xy_in: geographic coordinates, array (n, 2)
+    :param parameters: parameters of the zone
+    :return: the conformal coordinates xi', eta' of the points, tangent of the conformal latitude and the longitude
+             from the central meridian, radians - arrays (n)
+    """
+    lon = np.radians(xy_in[:, 0]) - parameters['lon0']
+    sin_lat = np.sin(np.radians(xy_in[:, 1]))
+    e = parameters['e']
+
+    t = np.sinh(np.arctanh(sin_lat) - e * np.arctanh(e * sin_lat))
+    xi = np.arctan2(t, np.cos(lon))
+    eta = np.arctanh(np.sin(lon) / np.sqrt(1.0 + t ** 2))
+
+    return xi, eta, t, lon
+
+
+def forward(xy_in, zone=None):
+    """
+    Vectorized forward transverse Mercator projection of the geographic coordinates to the UTM coordinates, the series
+    are accurate to the millimeters within the zone.
+
+    :param xy_in: geographic coordinates, longitude and latitude, array (n, 2)
+    :param zone: (zone number, if it is the northern zone) tuple, detected from the points if None
+    :return: easting and northing, meters - array (n, 2)
+    """
+    xy_in = np.asarray(xy_in, dtype=np.float64).reshape(-1, 2)
+    if zone is None:
+        zone = detect_zone(xy_in)
+    parameters = zone_parameters(zone)
+
+    xi, eta, t, lon = conformal(xy_in, parameters)
+    x = eta.copy()
+    y = xi.copy()
+    for j, alpha in enumerate(parameters['alpha'], 1):
+        x += alpha * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+        y += alpha * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+
+    scale = K0 * parameters['radius']
+    return np.column_stack([FALSE_EASTING + scale * x, parameters['false_northing'] + scale * y])
+
+
+def inverse(xy_in, zone):
+    """
+    Vectorized inverse of forward.
+
+    :param xy_in: easting and northing, meters - array (n, 2)
+    :param zone: (zone number, if it is the northern zone) tuple
+    :return: geographic coordinates, longitude and latitude, array (n, 2)
+    """
+    xy_in = np.asarray(xy_in, dtype=np.float64).reshape(-1, 2)
+    parameters = zone_parameters(zone)
+
+    scale = K0 * parameters['radius']
+    xi = (xy_in[:, 1] - parameters['false_northing']) / scale
+    eta = (xy_in[:, 0] - FALSE_EASTING) / scale
+
+    xi_p = xi.copy()
+    eta_p = eta.copy()
+    for j, beta in enumerate(parameters['beta'], 1):
+        xi_p -= beta * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+        eta_p -= beta * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+
+    chi = np.arcsin(np.sin(xi_p) / np.cosh(eta_p))
+    lat = chi.copy()
+    for j, delta in enumerate(parameters['delta'], 1):
+        lat += delta * np.sin(2 * j * chi)
+    lon = parameters['lon0'] + np.arctan2(np.sinh(eta_p), np.cos(xi_p))
+
+    return np.column_stack([np.degrees(lon), np.degrees(lat)])
+
+
+def scale_factor(xy_in, zone):
+    """
+    The point scale factor of the projection, the distances on the ground are the projected distances divided by it.
+    It is 0.9996 on the central meridian and up to about 1.001 at the border of the zone on the equator.
+
+    :param xy_in: geographic coordinates, longitude and latitude, array (n, 2)
+    :param zone: (zone number, if it is the northern zone) tuple
+    :return: scale factors, array (n)
+    """
+    xy_in = np.asarray(xy_in, dtype=np.float64).reshape(-1, 2)
+    parameters = zone_parameters(zone)
+    n = parameters['n']
+
+    xi, eta, t, lon = conformal(xy_in, parameters)
+    sigma = np.ones(len(xy_in))
+    tau = np.zeros(len(xy_in))
+    for j, alpha in enumerate(parameters['alpha'], 1):
+        sigma += 2 * j * alpha * np.cos(2 * j * xi) * np.cosh(2 * j * eta)
+        tau += 2 * j * alpha * np.sin(2 * j * xi) * np.sinh(2 * j * eta)
+
+    tan_lat = np.tan(np.radians(xy_in[:, 1]))
+    return K0 * parameters['radius'] / SEMI_MAJOR * np.sqrt(
+        (1.0 + ((1.0 - n) / (1.0 + n) * tan_lat) ** 2) * (sigma ** 2 + tau ** 2) / (t ** 2 + np.cos(lon) ** 2))
+
+
+def ground_lengths(xy_in, zone):
+    """
+    :param xy_in: geographic coordinates of the vertices of a line, array (n, 2)
+    :param zone: (zone number, if it is the northern zone) tuple
+    :return: lengths of the segments of the line on the ground, meters - array (n - 1)
+    """
+    xy_in = np.asarray(xy_in, dtype=np.float64).reshape(-1, 2)
+    metric = forward(xy_in, zone)
+    lengths = np.sqrt((np.diff(metric, axis=0) ** 2).sum(axis=1))
+    return lengths / scale_factor((xy_in[:-1] + xy_in[1:]) / 2.0, zone)
@@ -0,0 +1,245 @@
+import os
+import csv
+import json
+
+import numpy as np
+
+# Keys of planning_result that are summed into the quantities of the cost items
+FIBER_KEYS = ['lmf', 'df', 'ff', 'ff_sp_p', 'fiber', 'fiber_p']
+DUCT_KEYS = ['lm_d', 'd_d', 'f_d', 'f_d_add_p', 'duct', 'duct_add_p']
+COPPER_KEYS = ['copper']
+
+# The cost items with the length in meters, the equipment items follow in the order of their first appearance
+LENGTH_ITEMS = ['trench', 'fiber', 'copper']
+
+
+def splitter(sr_in):
+    """
+    :param sr_in: splitting ratio
+    :return: name of the splitter (remote node) item, e.g., splitter_1x32
+    """
+    return 'splitter_1x{0}'.format(int(sr_in))
+
+
+def equipment_counts(pairs_in):
+    """
+    This function collects the equipment of a topology, the counts of the same item are summed (e.g., two stages with
+    the same splitting ratio).
+
+    :param pairs_in: list of (item, count) pairs
+    :return: dict item - count
+    """
+    counts = {}
+    for item, count in pairs_in:
+        counts[item] = counts.get(item, 0) + int(count)
+    return counts
+
+
+def quantities(planning_result):
+    """
+    This function turns the planning result of any topology main into the quantities of the cost items. The trench is
+    the dissolved duct of all the stages without the part in the existing (brownfield) ducts, see trench_lengths. The
+    results saved before it have only the ducts of the single stages, their sum counts the shared streets repeatedly.
+
+    :param planning_result: planning result, dict
+    :return: dict item - quantity
+    """
+    if 'trench' in planning_result:
+        trench = float(planning_result['trench']) - float(planning_result.get('trench_reused', 0) or 0)
+    else:
+        trench = sum(float(planning_result.get(key, 0) or 0) for key in DUCT_KEYS)
+
+    out = {'trench': max(trench, 0.0),
+           'fiber': sum(float(planning_result.get(key, 0) or 0) for key in FIBER_KEYS),
+           'copper': sum(float(planning_result.get(key, 0) or 0) for key in COPPER_KEYS)}
+
+    for item, count in planning_result.get('equipment', {}).items():
+        out[item] = out.get(item, 0.0) + float(count)
+
+    return out
+
+
+def trench_lengths(network_nd, total_duct, brownfield_duct='#'):
+    """
+    This function measures the trench of a plan: the dissolved duct of all its stages, so the streets shared by the
+    stages are counted once, and the part of it in the existing ducts, which is not trenched again. The part in the
+    existing ducts is the length of the network edges covered both by the duct of the plan and by the brownfield, see
+    BrownfieldIndex.covered_edges.
+
+    :param network_nd: network dataset, path
+    :param total_duct: dissolved duct of the plan with the LENGTH_GEO field, line feature class
+    :param brownfield_duct: brownfield ducts, either a line feature class or a snapped index, '#' if none
+    :return: trench, reused duct - meters
+    """
+    import arcpy
+
+    with arcpy.da.SearchCursor(total_duct, ['LENGTH_GEO']) as cursor:
+        trench = float(sum(row[0] or 0 for row in cursor))
+
+    reused = 0.0
+    if brownfield_duct != '#':
+        import NetworkGraph as ng
+        import BrownfieldIndex as bfi
+
+        graph = ng.get_graph(network_nd)
+        covered = bfi.covered_edges(bfi.build_index(graph, total_duct)) & \
+            bfi.covered_edges(bfi.get_index(graph, brownfield_duct))
+        reused = float(np.asarray(graph['edge_length'], dtype=np.float64)[covered].sum())
+
+    return trench, min(reused, trench)
+
+
+def quantity_matrix(quantities_in, items=None):
+    """
+    :param quantities_in: list of the quantities of the plans, dicts item - quantity
+    :param items: list of the items, all the items of the plans if None
+    :return: list of the items, array (n_plans, n_items)
+    """
+    if items is None:
+        items = list(LENGTH_ITEMS)
+        for q in quantities_in:
+            items.extend(item for item in q if item not in items)
+
+    matrix = np.zeros((len(quantities_in), len(items)))
+    for p, q in enumerate(quantities_in):
+        for j, item in enumerate(items):
+            matrix[p, j] = q.get(item, 0.0)
+
+    return items, matrix
+
+
+def price_matrix(prices_in, items):
+    """
+    :param prices_in: list of the price scenarios, dicts item - price per unit, the missing items cost nothing
+    :param items: list of the items
+    :return: array (n_scenarios, n_items)
+    """
+    matrix = np.zeros((len(prices_in), len(items)))
+    for s, prices in enumerate(prices_in):
+        for j, item in enumerate(items):
+            matrix[s, j] = float(prices.get(item, 0.0))
+    return matrix
+
+
+def align(items_in, matrix_in, items):
+    """
+    This function reorders the columns of the price matrix to the items of the quantity matrix.
+
+    :param items_in: list of the items of the columns of the matrix
+    :param matrix_in: array (n_scenarios, n_items_in)
+    :param items: list of the items of the result, the missing items cost nothing
+    :return: array (n_scenarios, n_items)
+    """
+    matrix_in = np.asarray(matrix_in, dtype=np.float64)
+    matrix = np.zeros((len(matrix_in), len(items)))
+    for j, item in enumerate(items):
+        if item in items_in:
+            matrix[:, j] = matrix_in[:, items_in.index(item)]
+    return matrix
+
+
+def evaluate(quantity_in, price_in, breakdown=False):
+    """
+    This function evaluates all the plans for all the price scenarios at once, the cost is one matrix product.
+
+    :param quantity_in: array (n_plans, n_items)
+    :param price_in: array (n_scenarios, n_items)
+    :param breakdown: return the cost of every item as well, binary
+    :return: cost, array (n_plans, n_scenarios), (and the cost per item, array (n_plans, n_scenarios, n_items))
+    """
+    quantity_in = np.asarray(quantity_in, dtype=np.float64)
+    price_in = np.asarray(price_in, dtype=np.float64)
+
+    cost = quantity_in.dot(price_in.T)
+    if breakdown:
+        return cost, quantity_in[:, np.newaxis, :] * price_in[np.newaxis, :, :]
+    return cost
+
+
+def price_grid(base_in, ranges_in):
+    """
+    This function builds the full factorial of the price assumptions around the base prices.
+
+    :param base_in: dict item - price
+    :param ranges_in: dict item - list of the prices to try
+    :return: list of the items, array (n_scenarios, n_items)
+    """
+    items = list(base_in)
+    items.extend(item for item in ranges_in if item not in items)
+
+    axes = [np.asarray(ranges_in.get(item, [base_in.get(item, 0.0)]), dtype=np.float64) for item in items]
+    grid = np.meshgrid(*axes, indexing='ij')
+
+    return items, np.stack([axis.ravel() for axis in grid], axis=1)
+
+
+def read_prices(path_in):
+    """
+    :param path_in: csv file, one scenario per row, the first column is the name of the scenario, the other columns are
+                    the prices per unit of the items
+    :return: list of the names of the scenarios, list of the price dicts
+    """
+    names = []
+    prices = []
+    with open(path_in) as f_p:
+        reader = csv.reader(f_p)
+        header = next(reader)
+        for row in reader:
+            if not row:
+                continue
+            names.append(row[0])
+            prices.append(dict((item, float(value)) for item, value in zip(header[1:], row[1:]) if value != ''))
+    return names, prices
+
+
+def read_result(path_in):
+    """
+    :param path_in: planning result, the .txt file of a topology main
+    :return: planning result, dict
+    """
+    with open(path_in) as f_p:
+        return json.load(f_p)
+
+
+def write_costs(path_in, plan_names, scenario_names, cost_in):
+    """
+    :param path_in: csv file, one scenario per row, one plan per column
+    :return:
+    """
+    with open(path_in, 'w') as f_p:
+        writer = csv.writer(f_p, lineterminator='\n')
+        writer.writerow(['scenario'] + list(plan_names))
+        for s, name in enumerate(scenario_names):
+            writer.writerow([name] + ['{0:.2f}'.format(c) for c in cost_in[:, s]])
+    return
+
+
+def main(results_in, prices_in, output_in):
+    """
+    This function evaluates the saved planning results of several runs for all the price scenarios without rerunning
+    the planning.
+
+    :param results_in: list of the .txt files of the planning results
+    :param prices_in: csv file with the price scenarios
+    :param output_in: csv file with the cost of every plan in every scenario
+    :return: cost, array (n_plans, n_scenarios)
+    """
+    plan_names = [os.path.splitext(os.path.basename(path))[0] for path in results_in]
+    items, q = quantity_matrix([quantities(read_result(path)) for path in results_in])
+
+    scenario_names, prices = read_prices(prices_in)
+    cost = evaluate(q, price_matrix(prices, items))
+
+    write_costs(output_in, plan_names, scenario_names, cost)
+
+    return cost
+
+
+if __name__ == '__main__':
+    import arcpy
+
+    results = arcpy.GetParameterAsText(0).split(';')
+    prices_csv = arcpy.GetParameterAsText(1)
+    output_csv = arcpy.GetParameterAsText(2)
+
+    main(results, prices_csv, output_csv)
@@ -0,0 +1,169 @@
+import heapq
+
+import numpy as np
+
+import NetworkGraph as ng
+
+
+def scaled(graph, weights, edge, length):
+    """
+    :return: weighted length of the part of the edge, the offsets are weighted with the same factor as the whole edge
+    """
+    return length * weights[edge] / max(graph['edge_length'][edge], 1e-9)
+
+
+def decrease(graph, weights, tree, seeds, bound):
+    """
+    This function updates the shortest path tree after some edges got cheaper. Only the nodes, whose distance
+    decreases, are searched again: the search starts from the ends of the cheaper edges and stops at the nodes that do
+    not improve, so an update touches the neighbourhood of the new route and not the whole tree.
+
+    The first search stopped when all the incidents were settled, the nodes closer than its bound are exact, the
+    others are the upper bounds. The update keeps this: the nodes beyond the bound are improved but not expanded.
+
+    :param graph: graph, dict
+    :param weights: edge weights after the decrease, list
+    :param tree: (dist, pred, root) dicts of the shortest path tree, updated in place
+    :param seeds: list of (distance, node, predecessor edge, root) candidates
+    :param bound: distance of the last settled node of the first search
+    :return: number of the improved nodes
+    """
+    dist, pred, root = tree
+    indptr = graph['indptr']
+    adj_node = graph['adj_node']
+    adj_edge = graph['adj_edge']
+    inf = float('inf')
+
+    heap = []
+    for d, node, edge, k in seeds:
+        if d < dist.get(node, inf):
+            dist[node] = d
+            pred[node] = edge
+            root[node] = k
+            heap.append((d, node))
+    heapq.heapify(heap)
+
+    # The expanded nodes are not improved again, the rounding errors could otherwise make a cycle of the predecessors
+    done = set()
+    while heap:
+        d, node = heapq.heappop(heap)
+        if node in done or d > dist[node]:
+            continue
+        done.add(node)
+        if d > bound:
+            continue
+
+        for j in range(indptr[node], indptr[node + 1]):
+            nbr = adj_node[j]
+            nd = d + weights[adj_edge[j]]
+            if nbr not in done and nd < dist.get(nbr, inf):
+                dist[nbr] = nd
+                pred[nbr] = adj_edge[j]
+                root[nbr] = root[node]
+                heapq.heappush(heap, (nd, nbr))
+
+    return len(done)
+
+
+def route_pieces(graph, facilities_in, incidents_in, weights=None, discount=0.5, order=None, shared=None):
+    """
+    This function routes the incidents one by one to their closest facilities. After every route the edges it uses
+    cost only the discount times their weight, so the following routes prefer the ducts already carrying fiber: the
+    fiber gets longer and the duct shorter. The shortest path tree is searched once and updated after every route
+    with the decreased weights instead of a new search.
+
+    :param graph: graph, dict
+    :param facilities_in: list of (edge id, offset along the edge) pairs
+    :param incidents_in: list of (edge id, offset along the edge) pairs
+    :param weights: edge weights, list, updated in place with the discount, so the following calls share the ducts
+                    as well, the edge lengths if None
+    :param discount: factor of the weight of the edges carrying fiber, 0..1
+    :param order: order the incidents are routed in, the nearest first if None
+    :param shared: edges already carrying fiber, e.g., of the other clusters, set, updated in place
+    :return: list of (facility index, incident index, list of (edge id, offset from, offset to) pieces) tuples as in
+             NetworkGraph.route_pieces
+    """
+    if not incidents_in:
+        return []
+
+    if weights is None:
+        weights = list(graph['weight'])
+    elif isinstance(weights, np.ndarray):
+        weights = weights.tolist()
+
+    sources = []
+    for edge, pos in facilities_in:
+        sources.append((int(graph['edge_u'][edge]), scaled(graph, weights, edge, pos)))
+        sources.append((int(graph['edge_v'][edge]), scaled(graph, weights, edge, graph['edge_length'][edge] - pos)))
+
+    targets = set()
+    for edge, pos in incidents_in:
+        targets.add(int(graph['edge_u'][edge]))
+        targets.add(int(graph['edge_v'][edge]))
+
+    dist, pred, root = ng.dijkstra(graph, sources, weights, targets=targets)
+    if targets.issubset(dist):
+        bound = max(dist[node] for node in targets)
+    else:
+        # The search ran out of the nodes, all the reachable ones are exact
+        bound = float('inf')
+
+    facilities_on_edge = {}
+    for k, (edge, pos) in enumerate(facilities_in):
+        facilities_on_edge.setdefault(edge, []).append(k)
+
+    def best_route(i):
+        edge, pos = incidents_in[i]
+        best = (float('inf'), None, -1)
+        for node, rest in ((int(graph['edge_u'][edge]), pos),
+                           (int(graph['edge_v'][edge]), graph['edge_length'][edge] - pos)):
+            if node in dist:
+                best = min(best, (dist[node] + scaled(graph, weights, edge, rest), node, -1))
+        for k in facilities_on_edge.get(edge, []):
+            d = scaled(graph, weights, edge, abs(facilities_in[k][1] - pos))
+            if d <= best[0]:
+                best = (d, None, k)
+        return best
+
+    if order is None:
+        order = sorted(range(len(incidents_in)), key=lambda i: best_route(i)[0])
+
+    if shared is None:
+        shared = set()
+
+    routes = []
+    for i in order:
+        d, node, direct = best_route(i)
+        if direct != -1:
+            pieces = [(incidents_in[i][0], float(facilities_in[direct][1]), float(incidents_in[i][1]))]
+            k = direct
+        elif node is None:
+            continue
+        else:
+            nodes, edges = ng.trace_path(graph, pred, node)
+            k = root[node] // 2
+            pieces = ng.path_pieces(graph, facilities_in[k], nodes, edges, incidents_in[i])
+        routes.append((k, i, pieces))
+
+        cheaper = [edge for edge, a, b in pieces if edge not in shared]
+        if not cheaper:
+            continue
+        shared.update(cheaper)
+
+        # The cheaper edges are relaxed in both directions, the facilities on them get the closer starts
+        seeds = []
+        for edge in cheaper:
+            weights[edge] *= discount
+            u = int(graph['edge_u'][edge])
+            v = int(graph['edge_v'][edge])
+            if u in dist:
+                seeds.append((dist[u] + weights[edge], v, edge, root[u]))
+            if v in dist:
+                seeds.append((dist[v] + weights[edge], u, edge, root[v]))
+            for k2 in facilities_on_edge.get(edge, []):
+                pos = facilities_in[k2][1]
+                seeds.append((scaled(graph, weights, edge, pos), u, -1, 2 * k2))
+                seeds.append((scaled(graph, weights, edge, graph['edge_length'][edge] - pos), v, -1, 2 * k2 + 1))
+        decrease(graph, weights, (dist, pred, root), seeds, bound)
+
+    return routes
@@ -1,5 +1,4 @@
 import arcpy
-import math
 import os
 import json
 
@@ -20,7 +19,9 @@ def check_exists(name_in):
 
 
 def main(network_nd, clustering_allocation, ff_protection, sp_protection, demands, intersections, co, pro, output_dir,
-         output_fds, sr_fttb, output_name, brownfield_duct, save_lmf_df, save_clusters):
+         output_fds, sr_fttb, output_name, brownfield_duct, save_lmf_df, save_clusters, save_duct_index=False,
+         co_capacity='#', result_store='#', local_search='#', steiner=False,
+         duct_sharing='#', od_dir='#'):
 
     import ShortestPathRouting as spr
     planning_result = {}
@@ -43,12 +44,20 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, demand
     if clustering_allocation:
         import ClusteringLocationAllocation as clst
         name_clst = output_name_fttb + '_loc'
-        clst.main(network_nd, demands, intersections, facilities, sr_fttb, output_fds_cluster, name_clst, pro,'#')
+        n_clusters = clst.main(network_nd, demands, intersections, facilities, sr_fttb, output_fds_cluster, name_clst,
+                               pro, '#')
 
     else:
         import BuildingsClusterCPM as cmpm
         name_clst = output_name_fttb + '_cmpm'
-        cmpm.main(network_nd, demands, sr_fttb, intersections, output_fds_cluster, pro, name_clst)
+        n_clusters = cmpm.main(network_nd, demands, sr_fttb, intersections, output_fds_cluster, pro, name_clst, od_dir)
+
+    # Improve the clusters for the given number of seconds, the heads are fed from the CO
+    if local_search != '#':
+        import LocalSearch as ls
+        planning_result['local_search'] = {'lmf': ls.improve_clusters(network_nd, intersections, output_fds_cluster,
+                                                                      name_clst, n_clusters, sr_fttb, co,
+                                                                      brownfield_duct, time_budget=local_search)}
 
     if not save_clusters:
         name_rns_in = os.path.join('in_memory', 'Cluster_heads_{0}'.format(name_clst))
@@ -60,8 +69,6 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, demand
     arcpy.AddMessage('Clustering was finished, starting with fiber routing with shortest path')
 
     # Fiber routing: shortest path
-    n_nodes = int(arcpy.GetCount_management(demands).getOutput(0))
-    n_clusters = int(math.ceil(float(n_nodes) / float(sr_fttb)))
     a = 0
     b = 0
     c = 0
@@ -72,13 +79,19 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, demand
                                                                                  name_clst,output_fds, pro,
                                                                                  brownfield_duct='#',
                                                                                  save_lmf_df=save_lmf_df,
-                                                                                 save_clusters=save_clusters)
+                                                                                 save_clusters=save_clusters,
+                                                                                 steiner=steiner,
+                                                                                 duct_sharing=duct_sharing,
+                                                                                 planning_result_in=planning_result)
     else:
         planning_result['lmf'], planning_result['lm_d'], a, b, lmf, c = spr.main(network_nd, n_clusters, 'LMF', co,
                                                                                  name_clst, output_fds, pro,
                                                                                  brownfield_duct=brownfield_duct,
                                                                                  save_lmf_df=save_lmf_df,
-                                                                                 save_clusters=save_clusters)
+                                                                                 save_clusters=save_clusters,
+                                                                                 steiner=steiner,
+                                                                                 duct_sharing=duct_sharing,
+                                                                                 planning_result_in=planning_result)
     # FF
     if not ff_protection:
         if brownfield_duct == '#':
@@ -86,35 +99,31 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, demand
             planning_result['ff'], planning_result['f_d'], a, b, ff, c = spr.main(network_nd, n_clusters, 'FF', co,
                                                                                   name_clst, output_fds, pro,
                                                                                   brownfield_duct='#',
-                                                                                  save_clusters=save_clusters)
+                                                                                  save_clusters=save_clusters,
+                                                                                  co_capacity=co_capacity,
+                                                                                  planning_result_in=planning_result,
+                                                                                  duct_sharing=duct_sharing)
         else:
             planning_result['ff'], planning_result['f_d'], a, b, ff, c = spr.main(network_nd, n_clusters, 'FF', co,
                                                                                   name_clst,output_fds, pro,
                                                                                   brownfield_duct=brownfield_duct,
-                                                                                  save_clusters=save_clusters)
+                                                                                  save_clusters=save_clusters,
+                                                                                  co_capacity=co_capacity,
+                                                                                  planning_result_in=planning_result,
+                                                                                  duct_sharing=duct_sharing)
     else:
         if brownfield_duct == '#':
             planning_result['ff'], planning_result['f_d'], \
-            planning_result['ff_sp_p'], planning_result['f_d_add_p'], ff, ff_p = spr.main(network_nd, n_clusters, 'FF',
-                                                                                          co,
-                                                                                          name_clst, output_fds, pro,
-                                                                                          ff_protection=ff_protection,
-                                                                                          sp_protection_in=sp_protection,
-                                                                                          save_clusters=save_clusters)
+            planning_result['ff_sp_p'], planning_result['f_d_add_p'], ff, ff_p = spr.main(
+                network_nd, n_clusters, 'FF', co, name_clst, output_fds, pro, ff_protection=ff_protection,
+                sp_protection_in=sp_protection, save_clusters=save_clusters, co_capacity=co_capacity,
+                planning_result_in=planning_result)
         else:
             planning_result['ff'], planning_result['f_d'], \
-            planning_result['ff_sp_p'], planning_result['f_d_add_p'], ff, ff_p = spr.main(network_nd, n_clusters, 'FF',
-                                                                                          co, name_clst, output_fds,
-                                                                                          pro, ff_protection=ff_protection,
-                                                                                          sp_protection_in=sp_protection,
-                                                                                          brownfield_duct=brownfield_duct,
-                                                                                          save_clusters=save_clusters)
-
-    arcpy.AddMessage(planning_result)
-
-    output_file_planning = os.path.join(output_dir, '{0}.txt'.format(output_name))
-    f_p = open(output_file_planning, 'w')
-    json.dump(planning_result, f_p)
+            planning_result['ff_sp_p'], planning_result['f_d_add_p'], ff, ff_p = spr.main(
+                network_nd, n_clusters, 'FF', co, name_clst, output_fds, pro, ff_protection=ff_protection,
+                sp_protection_in=sp_protection, brownfield_duct=brownfield_duct, save_clusters=save_clusters,
+                co_capacity=co_capacity, planning_result_in=planning_result)
 
     # Save total fibers and ducts to be used as brownfield for further scenarios
     total_fiber = os.path.join(output_fds, 'Total_fiber_{0}'.format(output_name_fttb))
@@ -133,6 +142,31 @@ def main(network_nd, clustering_allocation, ff_protection, sp_protection, demand
 
     arcpy.AddGeometryAttributes_management(total_duct, 'LENGTH_GEODESIC', 'METERS')
 
+    # Trench and equipment counts for the cost evaluation
+    import CostModel as cm
+    planning_result['trench'], planning_result['trench_reused'] = cm.trench_lengths(network_nd, total_duct,
+                                                                                     brownfield_duct)
+    planning_result['equipment'] = cm.equipment_counts([(cm.splitter(sr_fttb), n_clusters), ('olt_port', n_clusters)])
+
+    arcpy.AddMessage(planning_result)
+
+    output_file_planning = os.path.join(output_dir, '{0}.txt'.format(output_name))
+    with open(output_file_planning, 'w') as f_p:
+        json.dump(planning_result, f_p)
+
+    # Append the run to the store shared by all the scenarios
+    if result_store != '#':
+        import ResultStore as rs
+        rs.append(result_store, {'name': output_name, 'topology': 'fttb', 'sr': sr_fttb, 'ff_protection': ff_protection,
+                                 'sp_protection': sp_protection, 'brownfield': brownfield_duct,
+                                 'local_search': local_search, 'steiner': steiner, 'duct_sharing': duct_sharing,
+                                 'co_capacity': co_capacity}, planning_result)
+
+    # Snap the ducts to the network edges once, the following scenarios can pass the index as the brownfield
+    if save_duct_index:
+        import BrownfieldIndex as bfi
+        bfi.main(network_nd, total_duct, output_dir, 'Total_duct_{0}'.format(output_name_fttb))
+
     return
 
 
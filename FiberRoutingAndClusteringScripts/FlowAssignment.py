@@ -0,0 +1,152 @@
+import heapq
+
+import numpy as np
+
+
+def head_moves(arcs_in, members_in, h):
+    """
+    The residual network is searched over the heads only: a path from the head h to the head h2 moves one member j of
+    h to h2 for the cost c(j, h2) - c(j, h), only the cheapest member for every h2 is kept.
+
+    :return: dict h2 - (cost of the move, demand)
+    """
+    moves = {}
+    for j in members_in[h]:
+        base = arcs_in[j][h]
+        for h2, cost in arcs_in[j].items():
+            if h2 != h and (h2 not in moves or cost - base < moves[h2][0]):
+                moves[h2] = (cost - base, j)
+    return moves
+
+
+def assign(arcs_in, capacity_in, order=None):
+    """
+    This function assigns the demands to the heads with the minimum total cost, no head gets more demands than its
+    capacity. It is the min-cost flow from the demands over the sparse arcs to the heads, solved with the successive
+    shortest paths: every demand is added along the shortest path in the residual network, which may move already
+    assigned demands to the other heads. The potentials of the heads keep the reduced costs non-negative, so every path
+    is found with Dijkstra, which stops at the first head with a free port.
+
+    Every demand first takes its cheapest head while it has room, all the demands at their cheapest heads are an optimal
+    flow already, so only the demands, whose cheapest head is full, are added along the paths. If all the demands can
+    be assigned, the total cost is the minimum. Otherwise, the number of the assigned demands is the maximum.
+
+    :param arcs_in: list of dicts head - cost, the allowed heads of every demand, e.g., the nearest ones
+    :param capacity_in: capacity of every head, a number for all the heads or a list
+    :param order: order the demands are added in, the order of arcs_in if None
+    :return: head of every demand, -1 if there is no free port reachable over the arcs - array (n)
+    """
+    n = len(arcs_in)
+    k = 1 + max([max(arcs) for arcs in arcs_in if arcs] or [-1])
+    if isinstance(capacity_in, (int, float)):
+        capacity = [int(capacity_in)] * k
+    else:
+        capacity = [int(c) for c in capacity_in]
+        k = max(k, len(capacity))
+        capacity.extend([0] * (k - len(capacity)))
+
+    labels = [-1] * n
+    load = [0] * k
+    members = [set() for _ in range(k)]
+
+    rest = []
+    for i in (range(n) if order is None else order):
+        if not arcs_in[i]:
+            continue
+        h = min(arcs_in[i], key=arcs_in[i].get)
+        if load[h] < capacity[h]:
+            labels[i] = h
+            load[h] += 1
+            members[h].add(i)
+        else:
+            rest.append(i)
+
+    # Potentials of the heads (0..k-1) and the sink (k), the moves of every head are cached until its members change
+    pi = [0.0] * (k + 1)
+    sink = k
+    moves = [None] * k
+
+    # The heads of a failed search can not reach a free port any more, the following searches skip them
+    dead = [False] * k
+
+    inf = float('inf')
+    for i in rest:
+        start = dict((h, cost - pi[h]) for h, cost in arcs_in[i].items() if not dead[h])
+        if not start:
+            continue
+        offset = min(start.values())
+
+        dist = {}
+        pred = {}
+        heap = []
+        for h, d in start.items():
+            dist[h] = d - offset
+            pred[h] = (-1, i)
+            heap.append((d - offset, h))
+        heapq.heapify(heap)
+
+        # The settled heads are not relaxed again, the rounding errors of the potentials could otherwise make a cycle
+        settled = []
+        done = set()
+        found = False
+        while heap:
+            d, h = heapq.heappop(heap)
+            if h in done:
+                continue
+            settled.append(h)
+            done.add(h)
+            if h == sink:
+                found = True
+                break
+
+            if load[h] < capacity[h]:
+                nd = d + pi[h] - pi[sink]
+                if nd < dist.get(sink, inf):
+                    dist[sink] = nd
+                    pred[sink] = (h, -1)
+                    heapq.heappush(heap, (nd, sink))
+
+            if moves[h] is None:
+                moves[h] = head_moves(arcs_in, members, h)
+            for h2, (cost, j) in moves[h].items():
+                if dead[h2] or h2 in done:
+                    continue
+                nd = d + cost + pi[h] - pi[h2]
+                if nd < dist.get(h2, inf):
+                    dist[h2] = nd
+                    pred[h2] = (h, j)
+                    heapq.heappush(heap, (nd, h2))
+
+        if not found:
+            for h in settled:
+                dead[h] = True
+            continue
+
+        # The potentials of the settled heads are updated with the early stop, d(sink) for all the others
+        d_sink = dist[sink]
+        for h in settled:
+            pi[h] += dist[h] - d_sink
+
+        # Augment: every head on the path takes the demand moved to it, the last one uses its free port
+        h = pred[sink][0]
+        load[h] += 1
+        while True:
+            previous, j = pred[h]
+            if previous != -1:
+                members[previous].discard(j)
+                moves[previous] = None
+            labels[j] = h
+            members[h].add(j)
+            moves[h] = None
+            if previous == -1:
+                break
+            h = previous
+
+    return np.asarray(labels, dtype=np.int64)
+
+
+def total_cost(arcs_in, labels_in):
+    """
+    :return: total cost of the assignment, the unassigned demands are not counted
+    """
+    return float(sum(arcs_in[i][h] for i, h in enumerate(labels_in) if h != -1))
@@ -0,0 +1,558 @@
+import math
+
+import numpy as np
+
+import NetworkGraph as ng
+
+
+def location_nodes(graph, locations_in, weights=None):
+    """
+    :param graph: graph, dict
+    :param locations_in: list of (edge id, offset along the edge) pairs
+    :param weights: edge weights, the edge lengths if None
+    :return: list of the (node, weighted distance from the location to the node) pairs of both ends of every location
+    """
+    if weights is None:
+        weights = graph['weight']
+
+    ends = []
+    for edge, pos in locations_in:
+        factor = weights[edge] / max(graph['edge_length'][edge], 1e-9)
+        ends.append(((int(graph['edge_u'][edge]), pos * factor),
+                     (int(graph['edge_v'][edge]), (graph['edge_length'][edge] - pos) * factor)))
+    return ends
+
+
+def k_nearest(graph, locations_in, k, weights=None):
+    """
+    This function finds the k nearest locations of every location by the network distance. The search from every
+    location is limited by a cutoff, which is doubled until k locations are within it, so only the neighbourhood is
+    explored and not the whole network.
+
+    :param graph: graph, dict
+    :param locations_in: list of (edge id, offset along the edge) pairs
+    :param k: number of the neighbours, the location itself included
+    :param weights: edge weights, the edge lengths if None
+    :return: list of the lists of (distance, location index) pairs, sorted by the distance
+    """
+    # The rows of the distance matrix from the contraction hierarchy replace the searches, if the graph has one
+    import ContractionHierarchy as ch
+    hierarchy = ch.usable(graph, weights)
+    if hierarchy is not None:
+        return ch.k_nearest(graph, hierarchy, locations_in, k)
+
+    if weights is None:
+        weights = graph['weight']
+    elif isinstance(weights, np.ndarray):
+        weights = weights.tolist()
+
+    n = len(locations_in)
+    k = min(k, n)
+    ends = location_nodes(graph, locations_in, weights)
+
+    # Locations by the nodes they can be reached through
+    at_node = {}
+    on_edge = {}
+    for i, ((u, d_u), (v, d_v)) in enumerate(ends):
+        at_node.setdefault(u, []).append((i, d_u))
+        at_node.setdefault(v, []).append((i, d_v))
+        on_edge.setdefault(locations_in[i][0], []).append(i)
+
+    cutoff_start = 2.0 * float(np.median(weights)) if len(weights) > 0 else 1.0
+
+    nearest = []
+    for i, (edge, pos) in enumerate(locations_in):
+        factor = weights[edge] / max(graph['edge_length'][edge], 1e-9)
+        cutoff = cutoff_start
+        while True:
+            dist = ng.dijkstra(graph, list(ends[i]), weights, cutoff=cutoff)[0]
+
+            best = {}
+            for node, d in dist.items():
+                for j, d_j in at_node.get(node, ()):
+                    if d + d_j < best.get(j, float('inf')):
+                        best[j] = d + d_j
+            for j in on_edge[edge]:
+                d = abs(locations_in[j][1] - pos) * factor
+                if d < best.get(j, float('inf')):
+                    best[j] = d
+
+            # The distances within the cutoff are exact, all the reachable locations are found if the search did
+            # not reach the cutoff
+            found = sorted((d, j) for j, d in best.items() if d <= cutoff)
+            if len(found) >= k or all(d <= cutoff for d in dist.values()):
+                nearest.append(sorted((d, j) for j, d in best.items())[:k])
+                break
+            cutoff *= 2.0
+
+    return nearest
+
+
+def cluster_size(n, sr):
+    """
+    The same members per cluster as in BuildingsClusterCPM. The clusters are filled up to the splitting ratio, the
+    members of the last clusters are reassigned with the flow afterwards, see flow_clusters.
+
+    :param n: number of the locations
+    :param sr: splitting ratio
+    :return: maximum number of the members per cluster
+    """
+    return min(int(sr), n)
+
+
+def cpm(nearest, sr, max_distance=None):
+    """
+    Cost Matrix Penalty Matrix clustering of BuildingsClusterCPM on the in-memory distances. The penalty of a location
+    is the sum of the distances to its nearest neighbours. The locations are processed from the smallest penalty, every
+    location that is not clustered yet opens a cluster with its nearest not clustered neighbours.
+
+    :param nearest: list of the lists of (distance, location index) pairs, see k_nearest
+    :param sr: splitting ratio, maximum number of the locations per cluster
+    :param max_distance: maximum distance of a member from the location that opened the cluster, None for no limit
+    :return: list of the lists of the location indices
+    """
+    n = len(nearest)
+    if n == 0:
+        return []
+
+    thr = cluster_size(n, sr)
+
+    penalty = [sum(d for d, j in row[:thr]) for row in nearest]
+
+    flags = set()
+    clusters = []
+    for i in sorted(range(n), key=lambda x: penalty[x]):
+        if i in flags:
+            continue
+        members = []
+        for d, j in nearest[i]:
+            if len(members) == thr:
+                break
+            if j in flags or (max_distance is not None and d > max_distance):
+                continue
+            members.append(j)
+            flags.add(j)
+        if i not in flags:
+            members.append(i)
+            flags.add(i)
+        clusters.append(members)
+
+    return clusters
+
+
+def cluster_heads(clusters, xy_in, candidates_xy):
+    """
+    The head of every cluster is the candidate (intersection) nearest to the mean center of the cluster.
+
+    :param clusters: list of the lists of the location indices
+    :param xy_in: metric coordinates of the locations, array (n, 2)
+    :param candidates_xy: metric coordinates of the candidates, array (m, 2)
+    :return: candidate index of every cluster, list
+    """
+    heads = []
+    for members in clusters:
+        center = np.asarray(xy_in)[members].mean(axis=0)
+        heads.append(int(np.argmin(((np.asarray(candidates_xy) - center) ** 2).sum(axis=1))))
+    return heads
+
+
+def squared_distances(xy_in, centers_in):
+    """
+    :return: squared euclidean distances of all the points to all the centers, array (n, k)
+    """
+    xy = np.asarray(xy_in, dtype=np.float64)
+    centers = np.asarray(centers_in, dtype=np.float64)
+    d = (xy ** 2).sum(axis=1)[:, np.newaxis] - 2.0 * xy.dot(centers.T) + (centers ** 2).sum(axis=1)[np.newaxis, :]
+    return np.maximum(d, 0.0)
+
+
+def nearest_centers(xy_in, centers_in, m, chunk=4096):
+    """
+    The distances are computed in chunks of the points, so the full matrix is never in the memory.
+
+    :return: the m nearest centers of every point, array (n, m), and their squared distances, array (n, m)
+    """
+    xy = np.asarray(xy_in, dtype=np.float64).reshape(-1, 2)
+    m = min(m, len(centers_in))
+    nearest = np.zeros((len(xy), m), dtype=np.int64)
+    d_nearest = np.zeros((len(xy), m))
+    for start in range(0, len(xy), chunk):
+        d = squared_distances(xy[start:start + chunk], centers_in)
+        index = np.argpartition(d, m - 1, axis=1)[:, :m] if m < d.shape[1] else np.tile(np.arange(m), (len(d), 1))
+        nearest[start:start + chunk] = index
+        d_nearest[start:start + chunk] = np.take_along_axis(d, index, axis=1)
+    return nearest, d_nearest
+
+
+def balanced_assign(cost_in, capacity, candidates=None):
+    """
+    This function assigns every point to its cheapest cluster that still has room. In every round all the free points
+    pick their cheapest cluster with room and every cluster accepts the cheapest of them up to its room, so there are
+    at most as many rounds as clusters.
+
+    :param cost_in: cost of every point in every cluster, inf if not allowed, array (n, k), or in every candidate
+                    cluster, array (n, m)
+    :param capacity: maximum number of the points per cluster, a number or an array (k)
+    :param candidates: the clusters of the columns of every row, array (n, m), None if the columns are the clusters
+    :return: cluster of every point, -1 if no allowed cluster has room - array (n)
+    """
+    cost = np.asarray(cost_in, dtype=np.float64)
+    n = len(cost)
+    if candidates is None:
+        candidates = np.tile(np.arange(cost.shape[1]), (n, 1))
+    k = int(candidates.max()) + 1 if candidates.size > 0 else 0
+    k = max(k, np.size(capacity))
+
+    labels = np.full(n, -1, dtype=np.int64)
+    room = np.zeros(k, dtype=np.int64) + np.asarray(capacity, dtype=np.int64)
+
+    free = np.arange(n)
+    while len(free) > 0:
+        masked = np.where(room[candidates[free]] > 0, cost[free], np.inf)
+        column = np.argmin(masked, axis=1)
+        best = candidates[free, column]
+        best_cost = masked[np.arange(len(free)), column]
+
+        # The points without any allowed cluster with room stay unassigned, the room only decreases
+        reachable = np.isfinite(best_cost)
+        free, best, best_cost = free[reachable], best[reachable], best_cost[reachable]
+        if len(free) == 0:
+            break
+
+        # Rank of every point among the points that picked the same cluster
+        order = np.lexsort((best_cost, best))
+        picked = best[order]
+        rank = np.arange(len(order)) - np.searchsorted(picked, picked, side='left')
+        accepted = order[rank < room[picked]]
+
+        labels[free[accepted]] = best[accepted]
+        room -= np.bincount(best[accepted], minlength=k)
+
+        keep = np.ones(len(free), dtype=bool)
+        keep[accepted] = False
+        free = free[keep]
+
+    return labels
+
+
+def balanced_kmeans(xy_in, sr, n_clusters=None, n_iter=20, seed_in=0, n_candidates=8):
+    """
+    Size balanced k-means on the metric coordinates, no cluster gets more than sr points. The centers are seeded with
+    k-means++, every point is assigned among its nearest centers, all the distances are updated at once.
+
+    :param xy_in: metric coordinates of the points, array (n, 2)
+    :param sr: splitting ratio, maximum number of the points per cluster
+    :param n_clusters: number of the clusters, the smallest possible if None
+    :param n_iter: maximum number of the iterations
+    :param seed_in: seed of the k-means++ seeding
+    :param n_candidates: number of the nearest centers every point can be assigned to, the points, whose candidates
+                         are all full, take any center with room
+    :return: cluster of every point, array (n), centers, array (n_clusters, 2)
+    """
+    xy = np.asarray(xy_in, dtype=np.float64).reshape(-1, 2)
+    n = len(xy)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 2))
+    if n_clusters is None:
+        n_clusters = int(math.ceil(float(n) / float(sr)))
+    n_clusters = max(min(n_clusters, n), int(math.ceil(float(n) / float(sr))))
+
+    rnd = np.random.RandomState(seed_in)
+    centers = np.zeros((n_clusters, 2))
+    centers[0] = xy[rnd.randint(n)]
+    closest = ((xy - centers[0]) ** 2).sum(axis=1)
+    for c in range(1, n_clusters):
+        total = closest.sum()
+        i = rnd.choice(n, p=closest / total) if total > 0 else rnd.randint(n)
+        centers[c] = xy[i]
+        closest = np.minimum(closest, ((xy - centers[c]) ** 2).sum(axis=1))
+
+    labels = None
+    for _ in range(n_iter):
+        candidates, d = nearest_centers(xy, centers, n_candidates)
+        new_labels = balanced_assign(d, sr, candidates)
+
+        rest = np.nonzero(new_labels == -1)[0]
+        if len(rest) > 0:
+            room = int(sr) - np.bincount(new_labels[new_labels >= 0], minlength=n_clusters)
+            new_labels[rest] = balanced_assign(squared_distances(xy[rest], centers), room)
+
+        if labels is not None and (new_labels == labels).all():
+            break
+        labels = new_labels
+
+        counts = np.bincount(labels, minlength=n_clusters)
+        filled = counts > 0
+        centers[filled, 0] = np.bincount(labels, xy[:, 0], n_clusters)[filled] / counts[filled]
+        centers[filled, 1] = np.bincount(labels, xy[:, 1], n_clusters)[filled] / counts[filled]
+
+    return labels, centers
+
+
+def head_arcs(graph, locations_in, xy_in, heads_in, heads_xy, n_candidates=5, max_distance=None, weights=None,
+              extra=None):
+    """
+    This function computes the sparse network distances from every location to its nearest heads for the assignment.
+    The candidate heads of a location are the nearest ones by the euclidean distance, the search from every head stops
+    when all the locations it is a candidate of are reached.
+
+    :param graph: graph, dict
+    :param locations_in: list of (edge id, offset along the edge) pairs
+    :param xy_in: metric coordinates of the locations, array (n, 2)
+    :param heads_in: locations of the heads, list of (edge id, offset along the edge) pairs
+    :param heads_xy: metric coordinates of the heads, array (k, 2)
+    :param n_candidates: number of the candidate heads of every location
+    :param max_distance: maximum network distance of a location from its head, None for no limit
+    :param weights: edge weights, the edge lengths if None
+    :param extra: one more candidate head of every location, -1 for none, list, e.g., its present head
+    :return: list of dicts head index - network distance, the heads beyond max_distance or unreachable are left out
+    """
+    import ContractionHierarchy as ch
+    hierarchy = ch.usable(graph, weights)
+
+    if weights is None:
+        weights = graph['weight']
+    elif isinstance(weights, np.ndarray):
+        weights = weights.tolist()
+
+    n = len(locations_in)
+    arcs = [{} for _ in range(n)]
+    if n == 0 or len(heads_in) == 0:
+        return arcs
+
+    candidates = nearest_centers(xy_in, heads_xy, n_candidates)[0]
+    points_of = [[] for _ in range(len(heads_in))]
+    for i, row in enumerate(candidates.tolist()):
+        for c in row:
+            points_of[c].append(i)
+        if extra is not None and extra[i] >= 0 and extra[i] not in row:
+            points_of[extra[i]].append(i)
+
+    if hierarchy is not None:
+        # The rows of the heads from the contraction hierarchy, only the candidates are kept
+        for first, rows in ch.distance_rows(graph, hierarchy, heads_in, locations_in):
+            for c in range(first, first + len(rows)):
+                for i in points_of[c]:
+                    d = float(rows[c - first, i])
+                    if d < float('inf') and (max_distance is None or d <= max_distance):
+                        arcs[i][c] = d
+        return arcs
+
+    ends = location_nodes(graph, locations_in, weights)
+    inf = float('inf')
+    for c, (h_edge, h_pos) in enumerate(heads_in):
+        points = points_of[c]
+        if not points:
+            continue
+        factor = weights[h_edge] / max(graph['edge_length'][h_edge], 1e-9)
+        head_ends = location_nodes(graph, [(h_edge, h_pos)], weights)[0]
+
+        targets = set(node for i in points for node, d in ends[i])
+        dist = ng.dijkstra(graph, list(head_ends), weights, targets=targets, cutoff=max_distance)[0]
+
+        for i in points:
+            (u, d_u), (v, d_v) = ends[i]
+            d = min(dist.get(u, inf) + d_u, dist.get(v, inf) + d_v)
+            if locations_in[i][0] == h_edge:
+                d = min(d, abs(locations_in[i][1] - h_pos) * factor)
+            if d < inf and (max_distance is None or d <= max_distance):
+                arcs[i][c] = d
+
+    return arcs
+
+
+def refine_clusters(graph, locations_in, xy_in, labels_in, centers_in, sr, max_distance=None, weights=None,
+                    n_candidates=3):
+    """
+    This function refines the k-means clusters with the network distances. The head of every cluster is its member
+    closest to the center, the locations are assigned to the heads of the nearest clusters with the minimum total
+    network distance, see FlowAssignment.assign.
+
+    :param graph: graph, dict
+    :param locations_in: list of (edge id, offset along the edge) pairs
+    :param xy_in: metric coordinates of the locations, array (n, 2)
+    :param labels_in: cluster of every location, see balanced_kmeans
+    :param centers_in: centers of the clusters, array (k, 2)
+    :param sr: splitting ratio, maximum number of the locations per cluster
+    :param max_distance: maximum network distance of a member from the head, None for no limit
+    :param weights: edge weights, the edge lengths if None
+    :param n_candidates: number of the nearest clusters every location can be assigned to
+    :return: cluster of every location, -1 if none of its candidates can take it - array (n)
+    """
+    import FlowAssignment as fa
+
+    xy = np.asarray(xy_in, dtype=np.float64).reshape(-1, 2)
+    labels_in = np.asarray(labels_in)
+
+    heads = []
+    for c in range(len(centers_in)):
+        members = np.nonzero(labels_in == c)[0]
+        if len(members) > 0:
+            heads.append(members[np.argmin(((xy[members] - centers_in[c]) ** 2).sum(axis=1))])
+    if not heads:
+        return np.full(len(locations_in), -1, dtype=np.int64)
+
+    arcs = head_arcs(graph, locations_in, xy, [locations_in[h] for h in heads], xy[heads], n_candidates,
+                     max_distance, weights)
+    return fa.assign(arcs, sr)
+
+
+def kmeans_clusters(graph, locations_in, xy_in, sr, max_distance=None, weights=None, seed_in=0):
+    """
+    Clustering seeded with the balanced k-means: the k-means clusters are refined with the network distances and only
+    the locations, which none of the nearby clusters can take, are clustered with cpm. The network is searched once
+    per cluster instead of once per location.
+
+    :param graph: graph, dict
+    :param locations_in: list of (edge id, offset along the edge) pairs
+    :param xy_in: metric coordinates of the locations, array (n, 2)
+    :param sr: splitting ratio, maximum number of the locations per cluster
+    :param max_distance: maximum network distance of a member from the head, None for no limit
+    :param weights: edge weights, the edge lengths if None
+    :param seed_in: seed of the k-means++ seeding
+    :return: list of the lists of the location indices
+    """
+    labels, centers = balanced_kmeans(xy_in, sr, seed_in=seed_in)
+    labels = refine_clusters(graph, locations_in, xy_in, labels, centers, sr, max_distance, weights)
+
+    assigned = np.nonzero(labels >= 0)[0]
+    order = assigned[np.argsort(labels[assigned], kind='mergesort')]
+    bounds = np.cumsum(np.bincount(labels[assigned]))[:-1]
+    clusters = [members.tolist() for members in np.split(order, bounds) if len(members) > 0]
+
+    rest = np.nonzero(labels == -1)[0]
+    if len(rest) > 0:
+        nearest = k_nearest(graph, [locations_in[i] for i in rest], 4 * int(sr), weights)
+        clusters.extend([rest[members].tolist() for members in cpm(nearest, sr, max_distance)])
+
+    return clusters
+
+
+def flow_clusters(graph, locations_in, xy_in, heads_in, heads_xy, sr, max_distance=None, weights=None,
+                  n_candidates=5, labels_in=None):
+    """
+    This function assigns the locations to the chosen heads, e.g., the heads of the location-allocation, with the
+    minimum total network distance and at most sr locations per head. The locations, which none of their nearest heads
+    within max_distance can take, are stranded, see flow_heads for the opening of the new heads for them.
+
+    The present head of every location in labels_in, e.g., its CPM cluster, is one of its candidates as well, if it is
+    within max_distance. As long as labels_in is feasible, no location of it is stranded then.
+
+    :param graph: graph, dict
+    :param locations_in: list of (edge id, offset along the edge) pairs
+    :param xy_in: metric coordinates of the locations, array (n, 2)
+    :param heads_in: locations of the heads, list of (edge id, offset along the edge) pairs
+    :param heads_xy: metric coordinates of the heads, array (k, 2)
+    :param sr: splitting ratio, capacity of every head, a number or a list
+    :param max_distance: maximum network distance of a location from its head, None for no limit
+    :param weights: edge weights, the edge lengths if None
+    :param n_candidates: number of the nearest heads every location can be assigned to
+    :param labels_in: present head of every location, -1 for none, the heads get at most sr of them - list, None if
+                      there are no present heads
+    :return: list of the lists of the location indices per head, list of the stranded location indices
+    """
+    import FlowAssignment as fa
+
+    arcs = head_arcs(graph, locations_in, xy_in, heads_in, heads_xy, n_candidates, max_distance, weights, labels_in)
+    labels = fa.assign(arcs, sr)
+
+    clusters = [[] for _ in heads_in]
+    for i, h in enumerate(labels.tolist()):
+        if h != -1:
+            clusters[h].append(i)
+
+    return clusters, np.nonzero(labels == -1)[0].tolist()
+
+
+def open_heads(graph, locations_in, xy_in, candidates_in, candidates_xy, sr, max_distance=None, weights=None,
+               used=(), n_candidates=16):
+    """
+    This function opens the new heads for the locations, e.g., the ones stranded by the flow. The locations are
+    clustered with cpm and every cluster opens the candidate within max_distance of all its members with the smallest
+    total distance. If there is no such candidate, the one within max_distance of the most members is opened and the
+    rest of the cluster is left for the next call.
+
+    :param graph: graph, dict
+    :param locations_in: list of (edge id, offset along the edge) pairs
+    :param xy_in: metric coordinates of the locations, array (n, 2)
+    :param candidates_in: locations of the candidate heads, list of (edge id, offset along the edge) pairs
+    :param candidates_xy: metric coordinates of the candidates, array (m, 2)
+    :param sr: splitting ratio, maximum number of the locations per head
+    :param max_distance: maximum network distance of a location from its head, None for no limit
+    :param weights: edge weights, the edge lengths if None
+    :param used: candidate indices, which are heads already
+    :param n_candidates: number of the nearest candidates of every location
+    :return: list of (candidate index, list of the location indices) pairs
+    """
+    arcs = head_arcs(graph, locations_in, xy_in, candidates_in, candidates_xy, n_candidates, max_distance, weights)
+    used = set(used)
+    n_out = sum(1 for row in arcs if not set(row) - used)
+    if n_out > 0:
+        raise ValueError('{0} locations have no free candidate head within the distance {1}'.format(n_out,
+                                                                                                    max_distance))
+
+    opened = []
+    nearest = k_nearest(graph, locations_in, 4 * int(sr), weights)
+    for members in cpm(nearest, sr, max_distance):
+        while members:
+            count = {}
+            total = {}
+            for i in members:
+                for c, d in arcs[i].items():
+                    if c not in used:
+                        count[c] = count.get(c, 0) + 1
+                        total[c] = total.get(c, 0.0) + d
+            if not count:
+                break
+            head = min(count, key=lambda c: (-count[c], total[c]))
+            opened.append((head, [i for i in members if head in arcs[i]]))
+            used.add(head)
+            members = [i for i in members if head not in arcs[i]]
+
+    return opened
+
+
+def flow_heads(graph, locations_in, xy_in, candidates_in, candidates_xy, heads_in, sr, max_distance=None,
+               weights=None, labels_in=None, capacity_in=None):
+    """
+    This function assigns the locations to the heads with the flow, see flow_clusters, and opens the new heads among
+    the candidates for the stranded locations until every location has a head within max_distance, see open_heads.
+    The flow keeps the assignment of the previous round feasible, so every round strands fewer locations.
+
+    :param graph: graph, dict
+    :param locations_in: list of (edge id, offset along the edge) pairs
+    :param xy_in: metric coordinates of the locations, array (n, 2)
+    :param candidates_in: locations of the candidate heads, list of (edge id, offset along the edge) pairs
+    :param candidates_xy: metric coordinates of the candidates, array (m, 2)
+    :param heads_in: candidate index of every present head, list
+    :param sr: splitting ratio, capacity of the new heads
+    :param max_distance: maximum network distance of a location from its head, None for no limit
+    :param weights: edge weights, the edge lengths if None
+    :param labels_in: present head of every location, -1 for none, list, see flow_clusters
+    :param capacity_in: capacity of every present head, sr for all if None
+    :return: candidate index of every head, the new ones appended - list, list of the lists of the location indices
+             per head
+    :raise ValueError: if a location has no free candidate within max_distance, see open_heads
+    """
+    xy = np.asarray(xy_in, dtype=np.float64).reshape(-1, 2)
+    candidates_xy = np.asarray(candidates_xy, dtype=np.float64).reshape(-1, 2)
+    heads = list(heads_in)
+    capacity = [int(sr)] * len(heads) if capacity_in is None else [int(c) for c in capacity_in]
+    labels = labels_in
+
+    while True:
+        clusters, stranded = flow_clusters(graph, locations_in, xy, [candidates_in[c] for c in heads],
+                                           candidates_xy[heads], capacity, max_distance, weights, labels_in=labels)
+        if not stranded:
+            return heads, clusters
+
+        labels = [-1] * len(locations_in)
+        for h, members in enumerate(clusters):
+            for i in members:
+                labels[i] = h
+        for c, members in open_heads(graph, [locations_in[i] for i in stranded], xy[stranded], candidates_in,
+                                     candidates_xy, sr, max_distance, weights, used=heads):
+            heads.append(c)
+            capacity.append(int(sr))
+            for j in members:
+                labels[stranded[j]] = len(heads) - 1
@@ -0,0 +1,559 @@
+import os
+import json
+
+import NetworkGraph as ng
+import SegmentIndex as si
+
+STAGE_KEYS = {'LMF': ('lmf', 'lm_d'),
+              'DF': ('df', 'd_d'),
+              'FF': ('ff', 'f_d')}
+
+# The first stage of fttcab is the copper from the DSLAMs in the cabinets
+COPPER_KEYS = ('copper', 'copper_d')
+
+
+def check_exists(name_in):
+    """
+    This function check existence of the feature class, which name is specified, and deletes it, if it exists. Some
+    arcpy functions even with the activated overwrite output return errors if the feature class already exists
+
+    :param name_in: check if this file already exists
+    :return:
+    """
+    import arcpy
+
+    if arcpy.Exists(name_in):
+        arcpy.Delete_management(name_in)
+    return
+
+
+def location_key(location_in):
+    """
+    The demands are identified by their position on the street graph, so the added and removed demands can be matched
+    with the ones of the previous run without any common id field.
+
+    :param location_in: (edge id, offset along the edge) pair
+    :return: key, string
+    """
+    return '{0}:{1:.2f}'.format(int(location_in[0]), float(location_in[1]))
+
+
+def new_stage(stage_in, sr_in, keys_in=None, items_in=None):
+    """
+    :param stage_in: 'LMF', 'DF' or 'FF'
+    :param sr_in: splitting ratio, the maximum number of the demands per head, None for the feeder
+    :param keys_in: keys of the fiber and duct lengths in the planning result, the ones of STAGE_KEYS if None
+    :param items_in: equipment items of every head of the stage, see CostModel.equipment_counts
+    :return: stage, dict
+    """
+    return {'stage': stage_in,
+            'sr': sr_in,
+            'keys': list(keys_in or STAGE_KEYS[stage_in]),
+            'items': list(items_in or []),
+            'demands': {},
+            'heads': {},
+            'assign': {},
+            'routes': {},
+            'usage': {},
+            'fiber': 0.0,
+            'duct': 0.0}
+
+
+def update_usage(stage, pieces_in, sign):
+    """
+    This function adds (sign 1) or removes (sign -1) the pieces of one route from the edge multiset of the stage. The
+    fiber changes by the length of the pieces, the duct only by the change of the union of the pieces on the touched
+    edges, the rest of the stage is not recomputed.
+
+    :param stage: stage, dict
+    :param pieces_in: list of (edge id, offset from, offset to) pieces
+    :param sign: 1 or -1
+    :return:
+    """
+    usage = stage['usage']
+    touched = {}
+    for edge, a, b in pieces_in:
+        key = str(edge)
+        if key not in touched:
+            touched[key] = ng.interval_union(usage.get(key, []))
+
+        interval = [min(a, b), max(a, b)]
+        if sign > 0:
+            usage.setdefault(key, []).append(interval)
+        else:
+            usage[key].remove(interval)
+            if not usage[key]:
+                del usage[key]
+
+    stage['fiber'] += sign * ng.pieces_length(pieces_in)
+    for key, before in touched.items():
+        stage['duct'] += ng.interval_union(usage.get(key, [])) - before
+
+    return
+
+
+def add_demand(stage, key, location_in):
+    """
+    :return: key of the demand, with a suffix if another demand is at the same location
+    """
+    unique = key
+    n = 1
+    while unique in stage['demands']:
+        unique = '{0}/{1}'.format(key, n)
+        n += 1
+    stage['demands'][unique] = list(location_in)
+    return unique
+
+
+def remove_demand(stage, key):
+    """
+    :return: the key of the removed demand, None if there is no demand at the location
+    """
+    matches = [k for k in stage['demands'] if k == key or k.startswith(key + '/')]
+    if not matches:
+        return None
+    unique = max(matches, key=len)
+
+    del stage['demands'][unique]
+    if unique in stage['routes']:
+        update_usage(stage, stage['routes'].pop(unique), -1)
+    stage['assign'].pop(unique, None)
+
+    return unique
+
+
+def members(stage):
+    """
+    :return: dict head key - number of the assigned demands
+    """
+    count = dict((head, 0) for head in stage['heads'])
+    for head in stage['assign'].values():
+        count[head] += 1
+    return count
+
+
+def connect(stage, demand, head, pieces_in):
+    """
+    This function assigns the demand to the head and keeps its route.
+    """
+    stage['assign'][demand] = head
+    stage['routes'][demand] = [list(piece) for piece in pieces_in]
+    update_usage(stage, pieces_in, 1)
+    return
+
+
+def assign_demand(graph, state, stage, demand, weights=None, cutoff=None):
+    """
+    This function connects a new demand to the closest head with the spare capacity. If there is none within the
+    cutoff, a new head is opened at the closest free candidate intersection.
+
+    :return: key of the new head, None if the demand was connected to an existing one
+    """
+    import arcpy
+
+    location = stage['demands'][demand]
+
+    count = members(stage)
+    if stage['sr'] is None:
+        open_heads = list(stage['heads'])
+    else:
+        open_heads = [head for head in stage['heads'] if count[head] < stage['sr']]
+
+    if open_heads:
+        routes = ng.route_pieces(graph, [stage['heads'][head] for head in open_heads], [location], weights, cutoff)
+        if routes:
+            k, i, pieces = routes[0]
+            connect(stage, demand, open_heads[k], pieces)
+            return None
+
+    candidates = [key for key in state['candidates'] if key not in state['used_candidates']]
+    if not candidates:
+        arcpy.AddWarning('There is no free intersection to open a new cluster for {0}'.format(demand))
+        return None
+
+    routes = ng.route_pieces(graph, [state['candidates'][key] for key in candidates], [location], weights)
+    if not routes:
+        arcpy.AddWarning('The demand {0} can not be reached from any intersection'.format(demand))
+        return None
+
+    k, i, pieces = routes[0]
+    head = candidates[k]
+    state['used_candidates'].append(head)
+    stage['heads'][head] = state['candidates'][head]
+    connect(stage, demand, head, pieces)
+
+    return head
+
+
+def apply_delta(graph, state, added_in, removed_in, weights=None, cutoff=None):
+    """
+    This function applies the change of the demands to the previous plan. Only the affected clusters are touched: the
+    removed demands are disconnected, a head without any demand is closed, the added demands are connected to the
+    closest head with the spare capacity or open a new cluster. The opened and closed heads are the changed demands of
+    the next stage, down to the feeder.
+
+    :param graph: graph, dict
+    :param state: state of the plan, dict
+    :param added_in: list of (edge id, offset along the edge) pairs
+    :param removed_in: list of (edge id, offset along the edge) pairs
+    :param weights: edge weights, the edge lengths if None
+    :param cutoff: maximum distance to an existing head, a new cluster is opened further away
+    :return:
+    """
+    import arcpy
+
+    added = [(location_key(location), location) for location in added_in]
+    removed = [location_key(location) for location in removed_in]
+
+    for stage in state['stages']:
+        next_added = []
+        next_removed = []
+
+        for key in removed:
+            if remove_demand(stage, key) is None:
+                arcpy.AddWarning('There is no demand at {0} in the {1} stage'.format(key, stage['stage']))
+
+        # Recount after all the removals, the heads left without the members are closed
+        count = members(stage)
+        if stage['sr'] is not None:
+            for head in list(stage['heads']):
+                if count[head] == 0:
+                    next_removed.append(location_key(stage['heads'].pop(head)))
+                    if head in state['used_candidates']:
+                        state['used_candidates'].remove(head)
+
+        for key, location in added:
+            demand = add_demand(stage, key, location)
+            head = assign_demand(graph, state, stage, demand, weights, None if stage['sr'] is None else cutoff)
+            if head is not None:
+                next_added.append((location_key(stage['heads'][head]), stage['heads'][head]))
+
+        added = next_added
+        removed = next_removed
+
+    return
+
+
+def stage_equipment(topology, stages_in):
+    """
+    The equipment of every clustering stage is the same as in the main of the topology: the heads of the first fttcab
+    stage are the cabinets with the DSLAMs, the other heads are the splitters, the ones of the last stage are fed from
+    an OLT port each.
+
+    :param topology: 'fttb', 'fttcab' or 'hpon'
+    :param stages_in: list of (stage, name of the clusters, number of the clusters, splitting ratio)
+    :return: list of (keys of the planning result, equipment items) pairs, one per stage
+    """
+    import CostModel as cm
+
+    out = []
+    for i, (stage_name, name_clst, n_clusters, sr) in enumerate(stages_in):
+        if topology == 'fttcab' and i == 0:
+            out.append((COPPER_KEYS, ['cabinet', 'dslam']))
+            continue
+        items = [cm.splitter(sr)]
+        if i == len(stages_in) - 1:
+            items.append('olt_port')
+        out.append((STAGE_KEYS[stage_name], items))
+    return out
+
+
+def state_from_run(graph, stages_in, co, intersections, name_in, output_fds, weights=None, topology='fttb'):
+    """
+    This function builds the state of the previous run from its clusters, which were saved with save_clusters. The
+    members of every cluster are routed once to their head on the graph, the feeder from all the heads of the last
+    stage to the closest CO.
+
+    :param graph: graph, dict
+    :param stages_in: list of (stage, name of the clusters, number of the clusters, splitting ratio), e.g.,
+                      [('LMF', 'x_FTTB_sr32_loc', 10, 32)]
+    :param co: COs, point feature class
+    :param intersections: the candidate heads for the new clusters, point feature class
+    :param name_in: name of the run
+    :param output_fds: feature dataset with the clusters
+    :param topology: 'fttb', 'fttcab' or 'hpon', see stage_equipment
+    :return: state, dict
+    """
+    import arcpy
+
+    state = {'name': name_in,
+             'topology': topology,
+             'stages': [],
+             'candidates': {},
+             'used_candidates': []}
+
+    ids, locations = si.read_locations(intersections, graph)
+    for location in locations:
+        state['candidates'][location_key(location)] = list(location)
+
+    previous_heads = None
+    for (stage_name, name_clst, n_clusters, sr), (keys, items) in zip(stages_in, stage_equipment(topology, stages_in)):
+        stage = new_stage(stage_name, sr, keys, items)
+
+        for i in range(n_clusters):
+            cluster = os.path.join(output_fds, 'Cluster_{0}_{1}'.format(i, name_clst))
+            cluster_head = os.path.join(output_fds, 'Cluster_head_{0}_{1}'.format(i, name_clst))
+            if not arcpy.Exists(cluster) or not arcpy.Exists(cluster_head):
+                continue
+
+            head_ids, head_locations = si.read_locations(cluster_head, graph)
+            if not head_locations:
+                continue
+            head = location_key(head_locations[0])
+            stage['heads'][head] = list(head_locations[0])
+            if head in state['candidates']:
+                state['used_candidates'].append(head)
+
+            demand_ids, demand_locations = si.read_locations(cluster, graph)
+            demands = [add_demand(stage, location_key(location), location) for location in demand_locations]
+            for k, i_demand, pieces in ng.route_pieces(graph, [head_locations[0]], demand_locations, weights):
+                connect(stage, demands[i_demand], head, pieces)
+
+        # The heads of one stage are the demands of the next one
+        if previous_heads is not None and set(previous_heads) != set(stage['demands']):
+            arcpy.AddWarning('The demands of the {0} stage are not the heads of the previous stage'.format(stage_name))
+        previous_heads = dict(stage['heads'])
+        state['stages'].append(stage)
+
+    # Feeder, every head is connected to its closest CO
+    stage = new_stage('FF', None)
+    co_ids, co_locations = si.read_locations(co, graph)
+    co_keys = ['co_{0}'.format(co_id) for co_id in co_ids]
+    for key, location in zip(co_keys, co_locations):
+        stage['heads'][key] = list(location)
+    heads = list(previous_heads.items())
+    demands = [add_demand(stage, key, location) for key, location in heads]
+    for k, i, pieces in ng.route_pieces(graph, co_locations, [location for key, location in heads], weights):
+        connect(stage, demands[i], co_keys[k], pieces)
+    state['stages'].append(stage)
+
+    return state
+
+
+def save_state(state, path_in):
+    """
+    :param state: state, dict
+    :param path_in: path to the .json file
+    :return:
+    """
+    with open(path_in, 'w') as f_p:
+        json.dump(state, f_p)
+    return
+
+
+def load_state(path_in):
+    """
+    :param path_in: path to the .json file
+    :return: state, dict
+    """
+    with open(path_in) as f_p:
+        return json.load(f_p)
+
+
+def state_path(output_dir, name_in):
+    """
+    :return: path of the state of the run
+    """
+    return os.path.join(output_dir, '{0}_state.json'.format(name_in))
+
+
+def trench_lengths(state, covered=None):
+    """
+    The trench is the union of the duct of all the fiber stages on every edge, the streets shared by the stages are
+    counted once as in the dissolved Total_duct of the mains. The copper stage uses the existing lines.
+
+    :param state: state, dict
+    :param covered: the edges with the existing ducts, boolean array (n_edges), see BrownfieldIndex.covered_edges
+    :return: trench, reused duct - meters
+    """
+    import CostModel as cm
+
+    usage = {}
+    for stage in state['stages']:
+        if stage.get('keys', STAGE_KEYS[stage['stage']])[1] not in cm.DUCT_KEYS:
+            continue
+        for key, intervals in stage['usage'].items():
+            usage.setdefault(key, []).extend(intervals)
+
+    trench = 0.0
+    reused = 0.0
+    for key, intervals in usage.items():
+        length = ng.interval_union(intervals)
+        trench += length
+        if covered is not None and covered[int(key)]:
+            reused += length
+    return trench, reused
+
+
+def planning_result(state, covered=None):
+    """
+    :param state: state, dict
+    :param covered: the edges with the existing ducts, boolean array (n_edges), None if there is no brownfield
+    :return: fiber and duct lengths of every stage, the trench and the equipment of the current heads, dict
+    """
+    import CostModel as cm
+
+    result = {}
+    pairs = []
+    for stage in state['stages']:
+        fiber_key, duct_key = stage.get('keys', STAGE_KEYS[stage['stage']])
+        result[fiber_key] = stage['fiber']
+        result[duct_key] = stage['duct']
+        pairs.extend((item, len(stage['heads'])) for item in stage.get('items', []))
+    result['trench'], result['trench_reused'] = trench_lengths(state, covered)
+    result['equipment'] = cm.equipment_counts(pairs)
+    return result
+
+
+def write_stages(graph, state, output_fds):
+    """
+    This function writes the routes of every stage of the current plan.
+
+    :return: list of the feature classes
+    """
+    out = []
+    for stage in state['stages']:
+        routes = []
+        heads = sorted(stage['heads'])
+        demands = sorted(stage['routes'])
+        for i, demand in enumerate(demands):
+            pieces = stage['routes'][demand]
+            routes.append((heads.index(stage['assign'][demand]), i, ng.pieces_vertices(graph, pieces),
+                           ng.pieces_length(pieces)))
+
+        name_out = 'SP_{0}_{1}_incremental'.format(stage['stage'], state['name'])
+        check_exists(os.path.join(output_fds, name_out))
+        out.append(ng.write_routes(graph, routes, output_fds, name_out))
+
+    return out
+
+
+def parse_stages(stages_in):
+    """
+    :param stages_in: stages as the text of the toolbox value table, e.g., 'LMF x_FTTB_sr32_loc 10 32;DF y 3 32'
+    :return: list of (stage, name of the clusters, number of the clusters, splitting ratio), see state_from_run
+    """
+    stages = []
+    for row in stages_in.split(';'):
+        if row.strip():
+            stage_name, name_clst, n_clusters, sr = row.split()
+            stages.append((stage_name.upper(), name_clst.strip("'"), int(n_clusters), int(sr)))
+    return stages
+
+
+def main(network_nd, demands_added, demands_removed, output_dir, output_fds, output_name, cutoff='#',
+         stages='#', co='#', intersections='#', brownfield_duct='#', topology='fttb', result_store='#'):
+    """
+    This function updates the plan of a previous FiberLayout, fttcab or 2stage_ngpon run with the added and removed
+    demands, instead of planning the whole area again. The state of the run (the assignment and the routes as the edge
+    pieces) is saved next to the planning result. If there is no state yet, it is built once from the saved clusters.
+    The lengths and the equipment of the planning result of the run are updated in place.
+
+    :param network_nd: network dataset, path
+    :param demands_added: point feature class or '#'
+    :param demands_removed: point feature class or '#'
+    :param output_dir: directory of the planning results
+    :param output_fds: feature dataset of the run
+    :param output_name: name of the run
+    :param cutoff: maximum distance to an existing head in meters, '#' for no limit
+    :param stages: only for the first update, see state_from_run
+    :param co: only for the first update, CO point feature class
+    :param intersections: only for the first update, the candidate heads
+    :param brownfield_duct: brownfield ducts, either a line feature class or a snapped index, '#' if none
+    :param topology: only for the first update, 'fttb', 'fttcab' or 'hpon', see stage_equipment
+    :param result_store: the .sqlite file the updated run is appended to, see ResultStore, '#' if none
+    :return: planning result, dict
+    """
+    import arcpy
+
+    arcpy.env.overwriteOutput = True
+
+    graph = ng.get_graph(network_nd)
+
+    weights = None
+    covered = None
+    if brownfield_duct != '#':
+        import BrownfieldIndex as bfi
+        index = bfi.get_index(graph, brownfield_duct)
+        weights = bfi.apply_index(index, graph['weight'])
+        covered = bfi.covered_edges(index)
+
+    path_state = state_path(output_dir, output_name)
+    if os.path.exists(path_state):
+        state = load_state(path_state)
+    else:
+        if stages == '#':
+            raise ValueError('There is no state of {0}, the stages of the previous run are needed'.format(output_name))
+        if co == '#' or intersections == '#':
+            raise ValueError('There is no state of {0}, the COs and the intersections are needed'.format(output_name))
+        if isinstance(stages, str):
+            stages = parse_stages(stages)
+        arcpy.AddMessage('Building the state of the previous run')
+        state = state_from_run(graph, stages, co, intersections, output_name, output_fds, weights, topology)
+
+    added = []
+    if demands_added != '#':
+        added = si.read_locations(demands_added, graph)[1]
+    removed = []
+    if demands_removed != '#':
+        removed = si.read_locations(demands_removed, graph)[1]
+
+    arcpy.AddMessage('Applying {0} added and {1} removed demands'.format(len(added), len(removed)))
+    apply_delta(graph, state, added, removed, weights, None if cutoff == '#' else float(cutoff))
+
+    save_state(state, path_state)
+    write_stages(graph, state, output_fds)
+
+    # The planning result of the run is updated, the keys the update does not know about are kept
+    output_file_planning = os.path.join(output_dir, '{0}.txt'.format(output_name))
+    result = {}
+    if os.path.exists(output_file_planning):
+        with open(output_file_planning) as f_p:
+            result = json.load(f_p)
+    result.update(planning_result(state, covered))
+    arcpy.AddMessage(result)
+
+    with open(output_file_planning, 'w') as f_p:
+        json.dump(result, f_p)
+
+    if result_store != '#':
+        import ResultStore as rs
+        srs = [stage['sr'] for stage in state['stages'] if stage['sr'] is not None]
+        rs.append(result_store, {'name': output_name, 'topology': state.get('topology', topology),
+                                 'sr': srs[-1] if srs else None, 'brownfield': brownfield_duct}, result)
+
+    return result
+
+
+if __name__ == '__main__':
+    import arcpy
+
+    network_nd_in = arcpy.GetParameterAsText(0)
+
+    demands_added_in = arcpy.GetParameterAsText(1)
+    if not demands_added_in:
+        demands_added_in = '#'
+
+    demands_removed_in = arcpy.GetParameterAsText(2)
+    if not demands_removed_in:
+        demands_removed_in = '#'
+
+    output_dir_in = arcpy.GetParameterAsText(3)
+    output_fds_in = arcpy.GetParameterAsText(4)
+    output_name_in = arcpy.GetParameterAsText(5)
+
+    cutoff_in = arcpy.GetParameterAsText(6)
+    if not cutoff_in:
+        cutoff_in = '#'
+
+    # Only needed for the first update of a run, when there is no state yet
+    stages_in = arcpy.GetParameterAsText(7) or '#'
+    co_in = arcpy.GetParameterAsText(8) or '#'
+    intersections_in = arcpy.GetParameterAsText(9) or '#'
+    topology_in = arcpy.GetParameterAsText(10) or 'fttb'
+
+    brownfield_duct_in = arcpy.GetParameterAsText(11) or '#'
+    result_store_in = arcpy.GetParameterAsText(12) or '#'
+
+    main(network_nd_in, demands_added_in, demands_removed_in, output_dir_in, output_fds_in, output_name_in, cutoff_in,
+         stages_in, co_in, intersections_in, brownfield_duct_in, topology_in, result_store_in)
@@ -0,0 +1,332 @@
+import os
+import sys
+import json
+import socket
+import asyncio
+import itertools
+import importlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import ScratchWorkspace as sw
+
+# Modules with the main function of every kind of the job, the parameters of the job are the arguments of main
+MAINS = {'p2p': 'p2p',
+         'fttb': 'FiberLayout',
+         'fttcab': 'fttcab',
+         'hpon': '2stage_ngpon',
+         'tiled': 'TiledPlanning',
+         'incremental': 'IncrementalPlanning'}
+
+# Jobs planned in a session kept by the worker, see PlanningSession
+SESSION_JOBS = ['compare', 'plan_p2p', 'plan_fttb', 'plan_fttcab', 'plan_hpon']
+SESSION_KEYS = ['network_nd', 'demands', 'intersections', 'co', 'cache_dir', 'brownfield_duct', 'clustering',
+                'routing', 'hierarchy', 'od_dir', 'lines']
+
+FINAL = ('done', 'error')
+
+# State of the worker process, it stays loaded between the jobs
+progress_queue = None
+sessions = {}
+
+
+def init_worker(queue_in):
+    """
+    The worker imports arcpy and checks out the Network Analyst license once, the networks read by the jobs stay in
+    NetworkGraph.graph_cache and the sessions in sessions.
+    """
+    global progress_queue
+    progress_queue = queue_in
+
+    try:
+        import arcpy
+        arcpy.CheckOutExtension('Network')
+    except ImportError:
+        pass
+    return
+
+
+def report(job_id, status, **kwargs):
+    """
+    This function sends a message about the job to the server. All the messages of a job go through the same queue, so
+    they arrive in order.
+    """
+    message = {'id': job_id, 'status': status}
+    message.update(kwargs)
+    progress_queue.put(message)
+    return
+
+
+def forward_messages(job_id):
+    """
+    This function sends the progress of the running job to the server: the messages and the warnings added to arcpy
+    by the job, they are still added to arcpy as well, and the stages of the planning, see ScratchWorkspace.
+
+    :param job_id: id of the job
+    :return: function restoring arcpy and the stages after the job
+    """
+    def stage(name_in, usage=None):
+        if usage is None:
+            report(job_id, 'progress', stage=name_in)
+        else:
+            report(job_id, 'progress', stage=name_in, scratch=usage)
+
+    sw.set_listener(stage)
+
+    originals = {}
+    try:
+        import arcpy
+    except ImportError:
+        arcpy = None
+    if arcpy is not None:
+        for name, level in (('AddMessage', 'message'), ('AddWarning', 'warning')):
+            originals[name] = getattr(arcpy, name)
+
+            def add(message, original=originals[name], level=level):
+                report(job_id, 'progress', level=level, message=str(message))
+                return original(message)
+            setattr(arcpy, name, add)
+
+    def restore():
+        sw.set_listener(None)
+        for name, original in originals.items():
+            setattr(arcpy, name, original)
+
+    return restore
+
+
+def to_json(value):
+    """
+    The numpy values of the results are converted to the plain ones.
+    """
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError('Not serializable: {0}'.format(type(value).__name__))
+
+
+def get_session(params_in):
+    """
+    :param params_in: parameters of the job, the inputs of the session are taken from SESSION_KEYS
+    :return: session, it is opened once per worker and inputs
+    """
+    import PlanningSession as ps
+
+    key = tuple(params_in.get(name, '#') for name in SESSION_KEYS)
+    if key not in sessions:
+        sessions[key] = ps.open_session(*key)
+    return sessions[key]
+
+
+def run_job(job_in):
+    """
+    This function runs one job in the worker. The result of the topology mains that write only the .txt file is read
+    from it. The scratch data of the job are released after it, also after an error, so the warm worker does not
+    collect the in_memory datasets of all its jobs.
+
+    :param job_in: dict: 'id', 'kind' one of MAINS or SESSION_JOBS, 'params' dict with the arguments
+    :return:
+    """
+    job_id = job_in['id']
+    kind = job_in.get('kind')
+    params = dict(job_in.get('params', {}))
+
+    report(job_id, 'started', worker=os.getpid())
+    restore = forward_messages(job_id)
+    error = None
+    try:
+        if kind in SESSION_JOBS:
+            import PlanningSession as ps
+            session = get_session(params)
+            result = getattr(ps, kind)(session, **dict((name, value) for name, value in params.items()
+                                                       if name not in SESSION_KEYS))
+        elif kind in MAINS:
+            result = importlib.import_module(MAINS[kind]).main(**params)
+            if result is None and 'output_dir' in params and 'output_name' in params:
+                path = os.path.join(params['output_dir'], '{0}.txt'.format(params['output_name']))
+                if os.path.exists(path):
+                    with open(path) as f_p:
+                        result = json.load(f_p)
+        else:
+            raise ValueError('Unknown kind of the job: {0}'.format(kind))
+        result = json.loads(json.dumps(result, default=to_json))
+    except Exception as e:
+        error = '{0}: {1}'.format(type(e).__name__, e)
+    finally:
+        # The client does not expect any progress after the final message. The scratch data left by the job are
+        # released before the next one, its usage is sent with the result
+        restore()
+        scratch_usage = sw.release_all()
+
+    if error is not None:
+        report(job_id, 'error', message=error)
+    else:
+        report(job_id, 'done', result=result, scratch=scratch_usage)
+    return
+
+
+def send(writer, message):
+    writer.write((json.dumps(message, default=to_json) + '\n').encode('utf-8'))
+    return
+
+
+async def run_server(address_in, n_workers=4):
+    """
+    This function accepts the jobs, one JSON object per line, and dispatches them to the pool of the warm workers. The
+    client gets the messages of its jobs as JSON lines: 'queued', 'started' with the pid of the worker, 'progress'
+    while the job runs, either with the 'message' and its 'level' added to arcpy or with the 'stage' begun, and with
+    its 'scratch' usage, when the stage ends, and finally 'done' with the result or 'error' with the message. The 'tag'
+    of the job is returned in all the messages.
+
+    :param address_in: (host, port) pair or the path of the Unix socket
+    :param n_workers: number of the worker processes
+    :return:
+    """
+    loop = asyncio.get_event_loop()
+    # The workers are spawned, not forked, so they do not inherit the sockets of the clients
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    pool = ProcessPoolExecutor(n_workers, mp_context=context, initializer=init_worker, initargs=(queue,))
+
+    counter = itertools.count()
+    clients = {}
+
+    def forward(message):
+        writer, tag, finished = clients[message['id']]
+        message['tag'] = tag
+        send(writer, message)
+        if message['status'] in FINAL and not finished.done():
+            finished.set_result(message['status'])
+
+    def read_progress():
+        while True:
+            message = queue.get()
+            if message is None:
+                break
+            loop.call_soon_threadsafe(forward, message)
+
+    reader_thread = threading.Thread(target=read_progress)
+    reader_thread.daemon = True
+    reader_thread.start()
+
+    def crashed(job_id, future):
+        # The job could not report itself, e.g., the worker died
+        if job_id in clients and future.exception() is not None and not clients[job_id][2].done():
+            forward({'id': job_id, 'status': 'error', 'message': str(future.exception())})
+
+    async def handle(reader, writer):
+        jobs = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+
+            try:
+                job = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                send(writer, {'status': 'error', 'message': 'Invalid job: {0}'.format(e)})
+                continue
+
+            job_id = next(counter)
+            clients[job_id] = (writer, job.get('tag'), loop.create_future())
+            job['id'] = job_id
+            jobs.append(job_id)
+
+            forward({'id': job_id, 'status': 'queued'})
+            future = loop.run_in_executor(pool, run_job, job)
+            future.add_done_callback(lambda f, job_id=job_id: crashed(job_id, f))
+
+        # The client closed its side, the results are still sent
+        if jobs:
+            await asyncio.wait([clients[job_id][2] for job_id in jobs])
+        for job_id in jobs:
+            del clients[job_id]
+
+        await writer.drain()
+        writer.close()
+
+    if isinstance(address_in, tuple):
+        server = await asyncio.start_server(handle, address_in[0], address_in[1])
+    else:
+        server = await asyncio.start_unix_server(handle, address_in)
+
+    try:
+        await server.serve_forever()
+    finally:
+        server.close()
+        pool.shutdown()
+        queue.put(None)
+    return
+
+
+def serve(address_in, n_workers=4):
+    """
+    This function runs the server until it is interrupted.
+
+    :param address_in: 'host:port' or the path of the Unix socket
+    :param n_workers: number of the worker processes
+    :return:
+    """
+    asyncio.new_event_loop().run_until_complete(run_server(parse_address(address_in), n_workers))
+    return
+
+
+def parse_address(address_in):
+    """
+    :param address_in: 'host:port' or the path of the Unix socket
+    :return: (host, port) pair or the path
+    """
+    host, sep, port = address_in.rpartition(':')
+    if sep and port.isdigit():
+        return host or 'localhost', int(port)
+    return address_in
+
+
+def submit(address_in, jobs_in, callback=None):
+    """
+    This function sends the jobs to the server and waits for all of them.
+
+    :param address_in: 'host:port' or the path of the Unix socket
+    :param jobs_in: list of the jobs, dicts: 'kind', 'params', optionally 'tag', the index of the job by default
+    :param callback: function called with every message as it arrives, e.g., to show the progress
+    :return: list of the final messages in the order of the jobs
+    """
+    address = parse_address(address_in)
+    if isinstance(address, tuple):
+        sock = socket.create_connection(address)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+
+    tags = []
+    lines = []
+    for i, job in enumerate(jobs_in):
+        job = dict(job)
+        job.setdefault('tag', i)
+        tags.append(job['tag'])
+        lines.append(json.dumps(job) + '\n')
+
+    final = {}
+    with sock:
+        sock.sendall(''.join(lines).encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+
+        with sock.makefile('r') as f_p:
+            for line in f_p:
+                message = json.loads(line)
+                if callback is not None:
+                    callback(message)
+                if message['status'] in FINAL:
+                    final[message.get('tag')] = message
+
+    return [final.get(tag) for tag in tags]
+
+
+if __name__ == '__main__':
+    # The server is a long running process started from the command line: JobServer.py host:port [n_workers]
+    address_main = sys.argv[1] if len(sys.argv) > 1 else 'localhost:8642'
+    n_workers_main = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    serve(address_main, n_workers_main)
@@ -0,0 +1,322 @@
+import os
+import time
+import heapq
+import random
+
+import numpy as np
+
+import NetworkGraph as ng
+
+
+def distances(graph, node_in, weights=None):
+    """
+    :param graph: graph, dict
+    :param node_in: source node
+    :param weights: edge weights, the edge lengths if None
+    :return: distances from the node to all the nodes, inf for the unreachable ones - array (n_nodes)
+    """
+    dist = ng.dijkstra(graph, [node_in], weights)[0]
+    out = np.full(graph['n_nodes'], np.inf)
+    out[list(dist.keys())] = list(dist.values())
+    return out
+
+
+def build_landmarks(graph, n_landmarks=16, weights=None):
+    """
+    This function selects the landmarks with the farthest point heuristic: every next landmark is the node farthest
+    from all the landmarks selected so far. The landmarks at the border of the network give the tightest lower bounds
+    of the distances through the triangle inequality.
+
+    :param graph: graph, dict
+    :param n_landmarks: number of the landmarks
+    :param weights: edge weights the landmark distances are computed with, the edge lengths if None
+    :return: landmarks, dict: 'nodes' list of the nodes, 'dist' distances from every landmark, array (n_landmarks,
+             n_nodes), 'weight' the weights of the edges
+    """
+    if weights is None:
+        weights = np.asarray(graph['weight'], dtype=np.float64)
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+
+    n_landmarks = min(n_landmarks, graph['n_nodes'])
+
+    nodes = []
+    dist = []
+    closest = distances(graph, 0, weights)
+    for i in range(n_landmarks):
+        # The unreachable nodes are candidates as well, so every component gets a landmark
+        candidates = np.where(np.isinf(closest), np.finfo(np.float64).max, closest)
+        candidates[nodes] = -1.0
+        node = int(np.argmax(candidates))
+        if candidates[node] <= 0:
+            break
+
+        nodes.append(node)
+        dist.append(distances(graph, node, weights))
+        closest = dist[-1] if i == 0 else np.minimum(closest, dist[-1])
+
+    return {'nodes': np.asarray(nodes, dtype=np.int64),
+            'dist': np.asarray(dist).reshape(len(nodes), graph['n_nodes']),
+            'weight': weights}
+
+
+def landmarks_path(nd_in, cache_dir='#'):
+    """
+    :return: path of the .npz file of the landmarks next to the cached graph, '#' if there is no cache directory
+    """
+    if cache_dir == '#':
+        return '#'
+    return os.path.join(cache_dir, '{0}_landmarks.npz'.format(os.path.basename(nd_in)))
+
+
+def save_landmarks(landmarks, path_in, graph):
+    """
+    :param landmarks: landmarks, dict
+    :param path_in: path to the .npz file
+    :param graph: graph the landmarks were computed on, dict
+    :return:
+    """
+    np.savez(path_in, nodes=landmarks['nodes'], dist=landmarks['dist'], weight=landmarks['weight'],
+             n_nodes=graph['n_nodes'], fingerprint=ng.graph_fingerprint(graph))
+    return
+
+
+def load_landmarks(path_in, graph):
+    """
+    This function loads the landmarks and checks that they were computed on the same graph with the same weights.
+
+    :param path_in: path to the .npz file
+    :param graph: graph, dict
+    :return: landmarks, dict
+    """
+    data = np.load(path_in)
+    if 'fingerprint' not in data or int(data['n_nodes']) != graph['n_nodes'] or \
+            int(data['fingerprint']) != ng.graph_fingerprint(graph) or \
+            not np.array_equal(data['weight'], np.asarray(graph['weight'], dtype=np.float64)):
+        raise ValueError('The landmarks {0} were computed for a different network'.format(path_in))
+    return {'nodes': data['nodes'], 'dist': data['dist'], 'weight': data['weight']}
+
+
+def get_landmarks(graph, n_landmarks=16, path_in='#'):
+    """
+    The landmarks are kept with the graph, so all the queries on the same network share them, see
+    NetworkGraph.route_pieces. If the path is specified, they are computed only once at all, a file of a different
+    network or weights is computed again.
+
+    :param graph: graph, dict
+    :param n_landmarks: number of the landmarks
+    :param path_in: path to the .npz file, '#' to keep the landmarks only in memory
+    :return: landmarks, dict
+    """
+    if 'landmarks' not in graph:
+        if path_in != '#' and os.path.exists(path_in):
+            try:
+                graph['landmarks'] = load_landmarks(path_in, graph)
+            except ValueError:
+                pass
+        if 'landmarks' not in graph:
+            graph['landmarks'] = build_landmarks(graph, n_landmarks)
+            if path_in != '#':
+                save_landmarks(graph['landmarks'], path_in, graph)
+    return graph['landmarks']
+
+
+def bound_scale(landmarks, weights):
+    """
+    The bounds are computed with the weights of the preprocessing. If the weights of the query are smaller on some
+    edges (e.g., the brownfield discount), the bounds are scaled down by the smallest ratio to stay admissible.
+
+    :return: scale of the lower bounds
+    """
+    if weights is None:
+        return 1.0
+    ratio = np.asarray(weights, dtype=np.float64) / np.maximum(landmarks['weight'], 1e-12)
+    return float(min(1.0, ratio.min())) if len(ratio) > 0 else 1.0
+
+
+def astar(graph, landmarks, sources, target_ends, weights=None):
+    """
+    Goal directed search (A*, landmarks, triangle inequality). The distance from a node to the target is at least
+    |d(l, node) - d(l, target)| for every landmark l, the search only expands the nodes that can lie on a shorter path.
+
+    :param graph: graph, dict
+    :param landmarks: landmarks, dict
+    :param sources: list of (node id, initial distance) pairs
+    :param target_ends: list of (node id, distance from the node to the target) pairs
+    :param weights: edge weights, the edge lengths if None
+    :return: distance, the target end node reached, predecessor edges dict, source index dict
+    """
+    scale = bound_scale(landmarks, weights)
+    if weights is None:
+        weights = graph['weight']
+    elif isinstance(weights, np.ndarray):
+        weights = weights.tolist()
+
+    indptr = graph['indptr']
+    adj_node = graph['adj_node']
+    adj_edge = graph['adj_edge']
+
+    # The rows of the nodes, the unreachable distances are nan and do not bound anything
+    if 'rows' not in landmarks:
+        landmarks['rows'] = np.ascontiguousarray(np.where(np.isinf(landmarks['dist']), np.nan, landmarks['dist']).T)
+    rows = landmarks['rows']
+    end_rows = rows[[node for node, rest in target_ends]]
+    end_rest = np.asarray([rest for node, rest in target_ends], dtype=np.float64)
+    end_nodes = dict((node, rest) for node, rest in target_ends)
+
+    bounds = {}
+
+    def heuristic(node):
+        if node not in bounds:
+            gap = np.fmax.reduce(np.abs(end_rows - rows[node]), axis=1)
+            bounds[node] = float((scale * np.fmax(gap, 0.0) + end_rest).min())
+        return bounds[node]
+
+    dist = {}
+    pred = {}
+    root = {}
+    heap = []
+    for k, (node, d) in enumerate(sources):
+        if d < dist.get(node, float('inf')):
+            dist[node] = d
+            pred[node] = -1
+            root[node] = k
+            heap.append((d + heuristic(node), d, node))
+    heapq.heapify(heap)
+
+    best = (float('inf'), -1)
+    settled = set()
+    while heap:
+        f, d, node = heapq.heappop(heap)
+        if f >= best[0]:
+            break
+        if node in settled:
+            continue
+        settled.add(node)
+
+        if node in end_nodes:
+            best = min(best, (d + end_nodes[node], node))
+
+        for k in range(indptr[node], indptr[node + 1]):
+            nbr = adj_node[k]
+            nd = d + weights[adj_edge[k]]
+            if nd < dist.get(nbr, float('inf')):
+                dist[nbr] = nd
+                pred[nbr] = adj_edge[k]
+                root[nbr] = root[node]
+                heapq.heappush(heap, (nd + heuristic(nbr), nd, nbr))
+
+    return best[0], best[1], pred, root
+
+
+def route_pieces(graph, landmarks, facilities_in, incident_in, weights=None):
+    """
+    This function routes one incident to its closest facility with the goal directed search, the result is the same as
+    the one of NetworkGraph.route_pieces for a single incident.
+
+    :param graph: graph, dict
+    :param landmarks: landmarks, dict
+    :param facilities_in: list of (edge id, offset along the edge) pairs
+    :param incident_in: (edge id, offset along the edge) pair
+    :param weights: edge weights, the edge lengths if None
+    :return: list with one (facility index, 0, pieces) tuple, empty if the incident can not be reached
+    """
+    edge_w = graph['weight'] if weights is None else weights
+
+    def scaled(edge, length):
+        return length * edge_w[edge] / max(graph['edge_length'][edge], 1e-9)
+
+    sources = []
+    for edge, pos in facilities_in:
+        sources.append((int(graph['edge_u'][edge]), scaled(edge, pos)))
+        sources.append((int(graph['edge_v'][edge]), scaled(edge, graph['edge_length'][edge] - pos)))
+
+    edge, pos = incident_in
+    target_ends = [(int(graph['edge_u'][edge]), scaled(edge, pos)),
+                   (int(graph['edge_v'][edge]), scaled(edge, graph['edge_length'][edge] - pos))]
+
+    d, node, pred, root = astar(graph, landmarks, sources, target_ends, weights)
+
+    # Directly along the edge
+    direct = -1
+    for k, (f_edge, f_pos) in enumerate(facilities_in):
+        if f_edge == edge and scaled(edge, abs(f_pos - pos)) <= d:
+            d = scaled(edge, abs(f_pos - pos))
+            direct = k
+
+    if direct != -1:
+        return [(direct, 0, [(edge, float(facilities_in[direct][1]), float(pos))])]
+    if node == -1:
+        return []
+
+    nodes, edges = ng.trace_path(graph, pred, node)
+    k = root[nodes[0]] // 2
+
+    return [(k, 0, ng.path_pieces(graph, facilities_in[k], nodes, edges, incident_in))]
+
+
+def benchmark(graph, n_queries=100, n_landmarks=16, seed_in=0):
+    """
+    This function compares the point to point queries with the landmarks and with the bidirectional A* to the plain
+    Dijkstra search stopped at the target on the same random node pairs.
+
+    :param graph: graph, dict
+    :param n_queries: number of the queries
+    :param n_landmarks: number of the landmarks
+    :param seed_in: seed of the random pairs
+    :return: dict with the preprocessing time, the query times and the number of the different distances
+    """
+    import BidirectionalSearch as bs
+
+    start = time.time()
+    landmarks = build_landmarks(graph, n_landmarks)
+    preprocessing = time.time() - start
+
+    rnd = random.Random(seed_in)
+    pairs = [(rnd.randrange(graph['n_nodes']), rnd.randrange(graph['n_nodes'])) for _ in range(n_queries)]
+
+    start = time.time()
+    plain = []
+    for s, t in pairs:
+        plain.append(ng.dijkstra(graph, [s], targets=[t])[0].get(t, float('inf')))
+    time_dijkstra = time.time() - start
+
+    start = time.time()
+    alt = []
+    for s, t in pairs:
+        alt.append(astar(graph, landmarks, [(s, 0.0)], [(t, 0.0)])[0])
+    time_alt = time.time() - start
+
+    bs.geometry(graph)
+    start = time.time()
+    bidirectional = []
+    for s, t in pairs:
+        bidirectional.append(bs.search(graph, [(s, 0.0)], [(t, 0.0)])[0])
+    time_bidirectional = time.time() - start
+
+    mismatch = sum(1 for a, b, c in zip(plain, alt, bidirectional)
+                   if any(abs(a - x) > 1e-6 * max(1.0, abs(a)) and a != x for x in (b, c)))
+
+    return {'preprocessing': preprocessing,
+            'dijkstra': time_dijkstra,
+            'alt': time_alt,
+            'bidirectional': time_bidirectional,
+            'speedup': time_dijkstra / max(time_alt, 1e-9),
+            'speedup_bidirectional': time_dijkstra / max(time_bidirectional, 1e-9),
+            'mismatch': mismatch}
+
+
+if __name__ == '__main__':
+    import arcpy
+
+    network_nd_in = arcpy.GetParameterAsText(0)
+
+    n_queries_in = arcpy.GetParameterAsText(1)
+    if not n_queries_in:
+        n_queries_in = 100
+
+    n_landmarks_in = arcpy.GetParameterAsText(2)
+    if not n_landmarks_in:
+        n_landmarks_in = 16
+
+    arcpy.AddMessage(benchmark(ng.get_graph(network_nd_in), int(n_queries_in), int(n_landmarks_in)))
@@ -0,0 +1,424 @@
+import os
+import time
+
+import numpy as np
+
+import NetworkGraph as ng
+import GraphClustering as gc
+import ScratchWorkspace as sw
+
+# Moves of the local search
+MOVES = ['shift', 'relocate', 'swap']
+
+
+def check_exists(name_in):
+    """
+    This function check existence of the feature class, which name is specified, and deletes it, if it exists.
+
+    :param name_in: check if this file already exists
+    :return:
+    """
+    import arcpy
+
+    if arcpy.Exists(name_in):
+        arcpy.Delete_management(name_in)
+    return
+
+
+def site_distances(state, s):
+    """
+    The search from every site is done once and only within its radius, the distances are cached.
+
+    :param state: state of the local search, see improve
+    :param s: index of the site
+    :return: distances from the site to the nodes, dict
+    """
+    cache = state['cache']
+    if s not in cache:
+        graph = state['graph']
+        radius = state['radius'].get(s)
+        ends = gc.location_nodes(graph, [state['sites'][s]], state['weights'])[0]
+        dist = ng.dijkstra(graph, list(ends), state['weights'], cutoff=radius)[0]
+        if radius is not None:
+            # The nodes beyond the radius are only reached, not settled
+            dist = dict((node, d) for node, d in dist.items() if d <= radius)
+        cache[s] = dist
+    return cache[s]
+
+
+def distance(state, j, s):
+    """
+    :param state: state of the local search, see improve
+    :param j: index of the location
+    :param s: index of the site
+    :return: network distance between them, inf if the site can not serve the location
+    """
+    dist = site_distances(state, s)
+    (u, d_u), (v, d_v) = state['ends'][j]
+    d = min(dist.get(u, state['inf']) + d_u, dist.get(v, state['inf']) + d_v)
+
+    edge, pos = state['locations'][j]
+    s_edge, s_pos = state['sites'][s]
+    if edge == s_edge:
+        d = min(d, abs(pos - s_pos) * state['weights'][edge] / max(state['graph']['edge_length'][edge], 1e-9))
+
+    if state['max_distance'] is not None and d > state['max_distance']:
+        return state['inf']
+    return d
+
+
+def feeder_distance(state, s):
+    """
+    :return: network distance of the site from the nearest CO, 0 if the COs are not given
+    """
+    if state['feeder'] is None:
+        return 0.0
+    (u, d_u), (v, d_v) = gc.location_nodes(state['graph'], [state['sites'][s]], state['weights'])[0]
+    return min(state['feeder'].get(u, state['inf']) + d_u, state['feeder'].get(v, state['inf']) + d_v)
+
+
+def cluster_cost(state, members_in, s):
+    """
+    :return: fiber of the cluster served from the site s, the unreachable members are not counted
+    """
+    cost = feeder_distance(state, s)
+    for j in members_in:
+        d = distance(state, j, s)
+        if d < state['inf']:
+            cost += d
+    return cost
+
+
+def count_unreachable(state, clusters_in, heads_in):
+    """
+    :return: number of the members beyond the maximum distance from their heads
+    """
+    return sum(1 for members, s in zip(clusters_in, heads_in) for j in members
+               if distance(state, j, s) == state['inf'])
+
+
+def improve(graph, locations_in, xy_in, clusters_in, heads_in, sites_in, sites_xy, sr, co_in=None, weights=None,
+            max_distance=None, shift_sites=None, n_sites=5, n_neighbours=4, factor=1.5, time_budget=None,
+            max_iter=20):
+    """
+    This function improves the clusters with the local search over three moves: shift the head of a cluster to a
+    nearby candidate site, relocate a member to a neighbouring cluster with a free port and swap the members of two
+    neighbouring clusters. The cost is the total fiber from the heads to the members and from the CO to the heads.
+
+    Every move is scored by its delta: the distances of a member to the heads around are looked up in the searches
+    cached per site, so a relocation or a swap costs O(1) and a shift O(sr). Every site is searched once, only within
+    factor times the radius of the cluster it serves. The first improving move is taken, the passes over the clusters
+    are repeated until no move improves, max_iter passes or the time budget.
+
+    :param graph: graph, dict
+    :param locations_in: locations of the members, list of (edge id, offset along the edge) pairs
+    :param xy_in: metric coordinates of the members, array (n, 2)
+    :param clusters_in: list of the lists of the member indices
+    :param heads_in: site index of the head of every cluster
+    :param sites_in: candidate locations of the heads, list of (edge id, offset along the edge) pairs
+    :param sites_xy: metric coordinates of the sites, array (m, 2)
+    :param sr: splitting ratio, maximum number of the members per cluster
+    :param co_in: locations of the COs, the feeder to the heads is part of the cost, None to skip it
+    :param weights: edge weights, the edge lengths if None
+    :param max_distance: maximum network distance of a member from the head, None for no limit
+    :param shift_sites: indices of the sites the heads can be shifted to, all the sites if None
+    :param n_sites: number of the candidate sites of every cluster, the nearest ones to its centre
+    :param n_neighbours: number of the neighbouring clusters of every cluster, the ones with the nearest heads
+    :param factor: radius of the cached searches in the radius of the cluster
+    :param time_budget: seconds, None for no limit
+    :param max_iter: maximum number of the passes
+    :return: list of the lists of the member indices, site index of every head, statistics, dict: 'before' and
+             'after' total fiber without the unreachable members, 'gain', 'unreachable' number of the members beyond
+             max_distance before and after, 'moves' dict move - number, 'iterations', 'time'
+    """
+    start = time.time()
+    if weights is None:
+        weights = graph['weight']
+    elif isinstance(weights, np.ndarray):
+        weights = weights.tolist()
+
+    xy = np.asarray(xy_in, dtype=np.float64).reshape(-1, 2)
+    sites_xy = np.asarray(sites_xy, dtype=np.float64).reshape(-1, 2)
+    clusters = [list(members) for members in clusters_in]
+    heads = [int(s) for s in heads_in]
+    inf = float('inf')
+    shift_sites = np.arange(len(sites_xy)) if shift_sites is None else np.asarray(shift_sites, dtype=np.int64)
+
+    state = {'graph': graph,
+             'weights': weights,
+             'locations': locations_in,
+             'ends': gc.location_nodes(graph, locations_in, weights),
+             'sites': sites_in,
+             'max_distance': max_distance,
+             'feeder': None,
+             'radius': {},
+             'cache': {},
+             'inf': inf}
+
+    if co_in:
+        co_ends = [end for ends in gc.location_nodes(graph, co_in, weights) for end in ends]
+        state['feeder'] = ng.dijkstra(graph, co_ends, weights)[0]
+
+    # Radius of every cluster: the distance of the farthest member from the head, one bounded search per head
+    radius = []
+    for members, s in zip(clusters, heads):
+        ends = gc.location_nodes(graph, [sites_in[s]], weights)[0]
+        targets = set(node for j in members for node, d in state['ends'][j])
+        dist = ng.dijkstra(graph, list(ends), weights, targets=targets, cutoff=max_distance)[0]
+        far = 0.0
+        for j in members:
+            (u, d_u), (v, d_v) = state['ends'][j]
+            d = min(dist.get(u, inf) + d_u, dist.get(v, inf) + d_v)
+            if d < inf:
+                far = max(far, d)
+        radius.append(far)
+    typical = float(np.median(radius)) if radius else 0.0
+    radius = [factor * max(r, typical) for r in radius]
+    if max_distance is not None:
+        radius = [min(r, max_distance) for r in radius]
+
+    def set_radius(s, r):
+        # A site already searched keeps its radius
+        if s not in state['cache'] and r > state['radius'].get(s, -1.0):
+            state['radius'][s] = r
+
+    for a, s in enumerate(heads):
+        set_radius(s, radius[a])
+
+    used = {}
+    for s in heads:
+        used[s] = used.get(s, 0) + 1
+
+    before = sum(cluster_cost(state, members, s) for members, s in zip(clusters, heads))
+    unreachable = count_unreachable(state, clusters, heads)
+    moves = dict((move, 0) for move in MOVES)
+    eps = 1e-6
+
+    iterations = 0
+    out_of_time = False
+    while iterations < max_iter and not out_of_time:
+        iterations += 1
+        improved = False
+
+        # The candidate sites and the neighbours follow the clusters, they are updated every pass
+        centres = np.asarray([xy[members].mean(axis=0) if members else sites_xy[s]
+                              for members, s in zip(clusters, heads)])
+        candidates = shift_sites[gc.nearest_centers(centres, sites_xy[shift_sites], n_sites)[0]].tolist()
+        neighbours = gc.nearest_centers(sites_xy[heads], sites_xy[heads], n_neighbours + 1)[0].tolist()
+
+        for a in range(len(clusters)):
+            if time_budget is not None and time.time() - start > time_budget:
+                out_of_time = True
+                break
+
+            # Shift: the head moves to a free candidate site, the delta is summed over the members only. The sites are
+            # compared by the number of the unreachable members first, then by the fiber of the reachable ones as in
+            # cluster_cost, so a shift never strands a member to save its fiber
+            h = heads[a]
+            best = h
+            best_missing = sum(1 for j in clusters[a] if distance(state, j, h) == inf)
+            best_cost = cluster_cost(state, clusters[a], h) - eps
+            for s in candidates[a]:
+                if used.get(s, 0) > 0:
+                    continue
+                set_radius(s, radius[a])
+                missing = 0
+                cost = feeder_distance(state, s)
+                for j in clusters[a]:
+                    d = distance(state, j, s)
+                    if d == inf:
+                        missing += 1
+                    else:
+                        cost += d
+                    if missing > best_missing or (missing == best_missing and cost >= best_cost):
+                        break
+                if missing < best_missing or (missing == best_missing and cost < best_cost):
+                    best, best_missing, best_cost = s, missing, cost
+            if best != h:
+                used[h] -= 1
+                used[best] = used.get(best, 0) + 1
+                heads[a] = best
+                moves['shift'] += 1
+                improved = True
+
+            # Relocate and swap with the neighbouring clusters
+            for b in neighbours[a]:
+                if b == a:
+                    continue
+                h_a, h_b = heads[a], heads[b]
+                for j in list(clusters[a]):
+                    if len(clusters[a]) <= 1:
+                        break
+                    delta = distance(state, j, h_b) - distance(state, j, h_a)
+                    if not delta < -eps:
+                        continue
+
+                    if len(clusters[b]) < sr:
+                        clusters[a].remove(j)
+                        clusters[b].append(j)
+                        moves['relocate'] += 1
+                        improved = True
+                        continue
+
+                    best_l, best_delta = -1, -eps
+                    for l in clusters[b]:
+                        d_l = distance(state, l, h_a)
+                        if d_l == inf:
+                            continue
+                        delta_l = delta + d_l - distance(state, l, h_b)
+                        if delta_l < best_delta:
+                            best_l, best_delta = l, delta_l
+                    if best_l != -1:
+                        clusters[a].remove(j)
+                        clusters[b].remove(best_l)
+                        clusters[a].append(best_l)
+                        clusters[b].append(j)
+                        moves['swap'] += 1
+                        improved = True
+
+        if not improved:
+            break
+
+    after = sum(cluster_cost(state, members, s) for members, s in zip(clusters, heads))
+
+    stats = {'before': float(before),
+             'after': float(after),
+             'gain': float(before - after),
+             'unreachable': [unreachable, count_unreachable(state, clusters, heads)],
+             'moves': moves,
+             'iterations': iterations,
+             'time': time.time() - start}
+
+    return clusters, heads, stats
+
+
+def improve_clusters(network_nd, intersections, output_fds, name_clst, n_clusters, sr, co='#', brownfield_duct='#',
+                     max_distance='#', time_budget=60, max_iter=20):
+    """
+    This function improves the clusters written by BuildingsClusterCPM or ClusteringLocationAllocation in place:
+    Cluster_i, Cluster_head_i and Cluster_heads of the name are rewritten if any move improved them, so the routing
+    that follows uses the improved clusters.
+
+    :param network_nd: network dataset, path
+    :param intersections: candidate locations of the heads, point feature class
+    :param output_fds: where the clusters are
+    :param name_clst: name of the clusters
+    :param n_clusters: number of the clusters
+    :param sr: splitting ratio
+    :param co: COs, the feeder to the heads is part of the cost, '#' for the heads of an inner stage
+    :param brownfield_duct: brownfield ducts, either a line feature class or a snapped index, '#' if none
+    :param max_distance: maximum network distance of a member from the head, e.g., the DSL reach, '#' for no limit
+    :param time_budget: seconds
+    :param max_iter: maximum number of the passes
+    :return: statistics, dict, see improve
+    """
+    import arcpy
+    import ShortestPathRouting as spr
+    import PlanningSession as ps
+
+    graph = ng.get_graph(network_nd)
+    weights = spr.graph_weights(graph, brownfield_duct)
+
+    sites = ps.read_locations(graph, intersections)
+    site_ids = list(sites['ids'])
+    site_locations = list(sites['locations'])
+    site_xy = [sites['xy']]
+    site_index = dict((location, s) for s, location in enumerate(site_locations))
+    n_intersections = len(site_locations)
+
+    indices = []
+    member_ids = []
+    locations = []
+    xy = []
+    clusters = []
+    heads = []
+    for i in range(n_clusters):
+        cluster_fc = os.path.join(output_fds, 'Cluster_{0}_{1}'.format(i, name_clst))
+        head_fc = os.path.join(output_fds, 'Cluster_head_{0}_{1}'.format(i, name_clst))
+        if not arcpy.Exists(cluster_fc) or not arcpy.Exists(head_fc):
+            continue
+
+        members = ps.read_locations(graph, cluster_fc)
+        head = ps.read_locations(graph, head_fc)
+        if not members['locations'] or not head['locations']:
+            continue
+
+        # The heads are the intersections, the other heads are added as the sites that only they can use
+        location = head['locations'][0]
+        if location not in site_index:
+            site_index[location] = len(site_locations)
+            site_ids.append(None)
+            site_locations.append(location)
+            site_xy.append(head['xy'][:1])
+
+        indices.append(i)
+        clusters.append(list(range(len(locations), len(locations) + len(members['locations']))))
+        heads.append(site_index[location])
+        member_ids.extend((i, oid) for oid in members['ids'])
+        locations.extend(members['locations'])
+        xy.append(members['xy'])
+
+    if not clusters:
+        return {}
+
+    co_locations = None
+    if co != '#':
+        co_locations = ps.read_locations(graph, co)['locations']
+
+    max_distance = None if max_distance == '#' else float(max_distance)
+    new_clusters, new_heads, stats = improve(graph, locations, np.concatenate(xy), clusters, heads, site_locations,
+                                             np.concatenate(site_xy), sr, co_locations, weights, max_distance,
+                                             np.arange(n_intersections), time_budget=time_budget, max_iter=max_iter)
+
+    arcpy.AddMessage('Local search of {0}: {1} moves, the fiber from {2:.0f} to {3:.0f}'.format(
+        name_clst, sum(stats['moves'].values()), stats['before'], stats['after']))
+    if not sum(stats['moves'].values()):
+        return stats
+
+    # Members: every cluster gets the field with the new cluster, the members that could not be located keep theirs
+    new_cluster = {}
+    for k, members in enumerate(new_clusters):
+        for j in members:
+            new_cluster[member_ids[j]] = indices[k]
+
+    cluster_fcs = []
+    for i in indices:
+        cluster_fc = os.path.join(output_fds, 'Cluster_{0}_{1}'.format(i, name_clst))
+        if 'LS_CLUSTER' not in [field.name for field in arcpy.ListFields(cluster_fc)]:
+            arcpy.AddField_management(cluster_fc, 'LS_CLUSTER', 'LONG')
+        with arcpy.da.UpdateCursor(cluster_fc, ['OID@', 'LS_CLUSTER']) as cursor:
+            for row in cursor:
+                row[1] = new_cluster.get((i, row[0]), i)
+                cursor.updateRow(row)
+        cluster_fcs.append(cluster_fc)
+
+    merged = sw.scratch_name('ls_members_{0}'.format(name_clst))
+    arcpy.Merge_management(cluster_fcs, merged)
+
+    for i in indices:
+        cluster_fc = os.path.join(output_fds, 'Cluster_{0}_{1}'.format(i, name_clst))
+        check_exists(cluster_fc)
+        arcpy.Select_analysis(merged, cluster_fc, 'LS_CLUSTER = {0}'.format(i))
+    sw.discard([merged])
+
+    # Heads: the shifted ones are copied from the intersections
+    oid_field = arcpy.AddFieldDelimiters(intersections, arcpy.Describe(intersections).OIDFieldName)
+    for k, i in enumerate(indices):
+        if new_heads[k] == heads[k]:
+            continue
+        head_fc = os.path.join(output_fds, 'Cluster_head_{0}_{1}'.format(i, name_clst))
+        check_exists(head_fc)
+        arcpy.Select_analysis(intersections, head_fc, '{0} = {1}'.format(oid_field, site_ids[new_heads[k]]))
+
+    head_fcs = [os.path.join(output_fds, 'Cluster_head_{0}_{1}'.format(i, name_clst)) for i in range(n_clusters)]
+    head_fcs = [head_fc for head_fc in head_fcs if arcpy.Exists(head_fc)]
+
+    merge_name = sw.scratch_name('ls_heads_{0}'.format(name_clst))
+    arcpy.Merge_management(head_fcs, merge_name)
+
+    name_cluster_heads = os.path.join(output_fds, 'Cluster_heads_{0}'.format(name_clst))
+    check_exists(name_cluster_heads)
+    arcpy.CopyFeatures_management(merge_name, name_cluster_heads)
+    sw.discard([merge_name])
+
+    return stats
@@ -0,0 +1,750 @@
+import os
+import math
+import heapq
+import zlib
+
+import numpy as np
+
+import CoordinateTransform as ct
+
+# Mean radius of the earth in meters, used for the metric approximation of the geographic coordinates
+EARTH_RADIUS = 6371008.8
+
+# Graphs that were already read in this process, the key is the path to the edge source, see source_key
+graph_cache = {}
+
+
+def network_edge_sources(nd_in):
+    """
+    This function returns the paths to the edge sources of the network dataset. The sources are stored in the same
+    feature dataset as the network dataset itself.
+
+    :param nd_in: network dataset, path
+    :return: list of the paths to the line feature classes, the spatial reference of the network dataset
+    """
+    import arcpy
+
+    desc = arcpy.Describe(nd_in)
+    fds = os.path.dirname(desc.catalogPath)
+    sources = [os.path.join(fds, source.name) for source in desc.edgeSources]
+
+    return sources, desc.spatialReference
+
+
+def source_key(nd_in):
+    """
+    A network dataset with a single edge source has the graph of the source, e.g., of the streets written by
+    AreaCut.area_cut_fast, so the network dataset and its streets share one entry of graph_cache.
+
+    :param nd_in: network dataset or line feature class, path
+    :return: the normalized path to the only edge source, otherwise to the network dataset
+    """
+    import arcpy
+
+    path = nd_in
+    if arcpy.Describe(nd_in).dataType == 'NetworkDataset':
+        sources = network_edge_sources(nd_in)[0]
+        if len(sources) == 1:
+            path = sources[0]
+    return os.path.normcase(os.path.normpath(path))
+
+
+def build_graph(node_xy, edge_u, edge_v, edge_length, edge_oid=None, shape_xy=None, shape_ptr=None, geographic=True,
+                spatial_reference='#'):
+    """
+    This function builds the undirected street graph from the edge arrays. The adjacency is stored in the compressed
+    sparse row format twice: as numpy arrays for the vectorized computations and as python lists for the searches.
+
+    :param node_xy:     coordinates of the nodes, array (n_nodes, 2)
+    :param edge_u:      start node of every edge, array
+    :param edge_v:      end node of every edge, array
+    :param edge_length: length of every edge in meters, array
+    :param edge_oid:    object id of the edge in the source feature class, array
+    :param shape_xy:    vertices of all the edges one after another, array (n_vertices, 2)
+    :param shape_ptr:   start of the vertices of every edge in shape_xy, array (n_edges + 1)
+    :param geographic:  if the coordinates are in degrees, binary
+    :param spatial_reference: the spatial reference as a string, '#' if unknown
+    :return: graph, dict
+    """
+    node_xy = np.asarray(node_xy, dtype=np.float64).reshape(-1, 2)
+    edge_u = np.asarray(edge_u, dtype=np.int64)
+    edge_v = np.asarray(edge_v, dtype=np.int64)
+    edge_length = np.asarray(edge_length, dtype=np.float64)
+
+    n_nodes = len(node_xy)
+    n_edges = len(edge_u)
+
+    if edge_oid is None:
+        edge_oid = np.arange(1, n_edges + 1)
+
+    # Straight edges if no geometry is given
+    if shape_xy is None:
+        shape_xy = np.empty((2 * n_edges, 2))
+        shape_xy[0::2] = node_xy[edge_u]
+        shape_xy[1::2] = node_xy[edge_v]
+        shape_ptr = np.arange(0, 2 * n_edges + 1, 2)
+
+    # Every edge is stored in both directions
+    ends = np.concatenate([edge_u, edge_v])
+    others = np.concatenate([edge_v, edge_u])
+    edges = np.concatenate([np.arange(n_edges), np.arange(n_edges)])
+    order = np.argsort(ends, kind='mergesort')
+
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ends, minlength=n_nodes), out=indptr[1:])
+
+    graph = {'node_xy': node_xy,
+             'edge_u': edge_u,
+             'edge_v': edge_v,
+             'edge_length': edge_length,
+             'edge_oid': np.asarray(edge_oid, dtype=np.int64),
+             'shape_xy': np.asarray(shape_xy, dtype=np.float64).reshape(-1, 2),
+             'shape_ptr': np.asarray(shape_ptr, dtype=np.int64),
+             'geographic': bool(geographic),
+             'spatial_reference': spatial_reference,
+             'n_nodes': n_nodes,
+             'n_edges': n_edges,
+             'utm_zone': ct.detect_zone(node_xy) if geographic else None,
+             'indptr': indptr.tolist(),
+             'adj_node': others[order].tolist(),
+             'adj_edge': edges[order].tolist(),
+             'weight': edge_length.tolist()}
+
+    return graph
+
+
+def graph_fingerprint(graph):
+    """
+    The fingerprint of the edges of the graph, their source features and their end nodes. The data computed for a
+    graph, e.g., the brownfield index or the landmarks, can only be applied to the graph with the same fingerprint.
+
+    :param graph: graph, dict
+    :return: checksum, int
+    """
+    edges = np.stack([np.asarray(graph[key], dtype='<i8') for key in ('edge_oid', 'edge_u', 'edge_v')])
+    return zlib.crc32(edges.tobytes()) & 0xffffffff
+
+
+def read_network(nd_in, tolerance_in=1e-7):
+    """
+    This function reads the edge sources of the network dataset into the in-memory street graph. The edges are
+    connected at their end points (the default connectivity policy of the network datasets), the end points closer
+    than the tolerance are merged into one node.
+
+    :param nd_in:       network dataset or line feature class, path
+    :param tolerance_in: tolerance for merging the end points, units of the spatial reference
+    :return: graph, dict
+    """
+    import arcpy
+
+    # A line feature class (e.g., streets that are not yet a network dataset) is read as the only edge source
+    if arcpy.Describe(nd_in).dataType == 'NetworkDataset':
+        sources, spatial_ref = network_edge_sources(nd_in)
+    else:
+        sources, spatial_ref = [nd_in], arcpy.Describe(nd_in).spatialReference
+
+    node_ids = {}
+    node_xy = []
+    edge_u = []
+    edge_v = []
+    edge_length = []
+    edge_oid = []
+    shape_xy = []
+    shape_ptr = [0]
+
+    for source in sources:
+        with arcpy.da.SearchCursor(source, ['OID@', 'SHAPE@']) as cursor:
+            for row in cursor:
+                if row[1] is None:
+                    continue
+
+                points = [(p.X, p.Y) for part in row[1] for p in part if p is not None]
+                if len(points) < 2:
+                    continue
+
+                ends = []
+                for x, y in (points[0], points[-1]):
+                    key = (int(round(x / tolerance_in)), int(round(y / tolerance_in)))
+                    if key not in node_ids:
+                        node_ids[key] = len(node_xy)
+                        node_xy.append((x, y))
+                    ends.append(node_ids[key])
+
+                # Loops do not contribute to any shortest path
+                if ends[0] == ends[1]:
+                    continue
+
+                edge_u.append(ends[0])
+                edge_v.append(ends[1])
+                edge_length.append(row[1].getLength('GEODESIC', 'METERS'))
+                edge_oid.append(row[0])
+                shape_xy.extend(points)
+                shape_ptr.append(len(shape_xy))
+
+    return build_graph(node_xy, edge_u, edge_v, edge_length, edge_oid, shape_xy, shape_ptr,
+                       spatial_ref.type == 'Geographic', spatial_ref.exportToString())
+
+
+def save_graph(graph, path_in):
+    """
+    This function saves the graph to the .npz file, so the network has to be read only once.
+
+    :param graph: graph, dict
+    :param path_in: path to the .npz file
+    :return:
+    """
+    np.savez(path_in, node_xy=graph['node_xy'], edge_u=graph['edge_u'], edge_v=graph['edge_v'],
+             edge_length=graph['edge_length'], edge_oid=graph['edge_oid'], shape_xy=graph['shape_xy'],
+             shape_ptr=graph['shape_ptr'], geographic=graph['geographic'],
+             spatial_reference=graph['spatial_reference'])
+    return
+
+
+def load_graph(path_in):
+    """
+    This function loads the graph saved with save_graph.
+
+    :param path_in: path to the .npz file
+    :return: graph, dict
+    """
+    data = np.load(path_in)
+
+    return build_graph(data['node_xy'], data['edge_u'], data['edge_v'], data['edge_length'], data['edge_oid'],
+                       data['shape_xy'], data['shape_ptr'], bool(data['geographic']), str(data['spatial_reference']))
+
+
+def get_graph(nd_in, cache_dir='#'):
+    """
+    This function returns the street graph of the network dataset. The graph is read only once per process and, if
+    the cache directory is specified, only once at all. The graph of the cache directory carries the landmarks of the
+    single route queries as well, they are computed once and saved next to it, see Landmarks.get_landmarks.
+
+    :param nd_in: network dataset, path
+    :param cache_dir: directory for the graph .npz files, '#' to keep the graph only in memory
+    :return: graph, dict
+    """
+    if nd_in in graph_cache:
+        return graph_cache[nd_in]
+
+    key = source_key(nd_in)
+    if key in graph_cache:
+        graph_cache[nd_in] = graph_cache[key]
+        return graph_cache[key]
+
+    cache_path = '#'
+    if cache_dir != '#':
+        cache_path = os.path.join(cache_dir, '{0}_graph.npz'.format(os.path.basename(nd_in)))
+
+    if cache_path != '#' and os.path.exists(cache_path):
+        graph = load_graph(cache_path)
+    else:
+        graph = read_network(nd_in)
+        if cache_path != '#':
+            save_graph(graph, cache_path)
+
+    if cache_dir != '#':
+        import Landmarks as lm
+        lm.get_landmarks(graph, path_in=lm.landmarks_path(nd_in, cache_dir))
+
+    graph_cache[nd_in] = graph
+    graph_cache[key] = graph
+
+    return graph
+
+
+def metric_scale(geographic, lat0):
+    """
+    The geographic coordinates are approximated with the equirectangular projection around the latitude lat0, which is
+    accurate enough for the city-sized areas. The projection is a scaling of the coordinates.
+
+    :param geographic: if the coordinates are in degrees, binary
+    :param lat0: the mean latitude of the area, degrees
+    :return: scale factors for x and y, array (2)
+    """
+    if not geographic:
+        return np.ones(2)
+
+    meters_per_degree = math.radians(1.0) * EARTH_RADIUS
+    return np.array([meters_per_degree * math.cos(math.radians(lat0)), meters_per_degree])
+
+
+def metric_xy(graph, xy_in):
+    """
+    This function transforms the coordinates into the local metric coordinates of the graph. The geographic coordinates
+    are projected in memory to the UTM zone of the graph, see CoordinateTransform.
+
+    :param graph: graph, dict
+    :param xy_in: coordinates, array (n, 2)
+    :return: coordinates in meters, array (n, 2)
+    """
+    xy_in = np.asarray(xy_in, dtype=np.float64).reshape(-1, 2)
+    if graph['geographic']:
+        return ct.forward(xy_in, graph['utm_zone'])
+
+    return xy_in.copy()
+
+
+def read_points(fc_in, graph=None, spatial_reference='#'):
+    """
+    This function reads the ids and the coordinates of the points. If the graph or the spatial reference is given, the
+    coordinates are returned in that spatial reference.
+
+    :param fc_in: point feature class, path
+    :param graph: graph, dict
+    :param spatial_reference: spatial reference the points are projected to, string, '#' for the one of the graph
+    :return: list of the ids, coordinates array (n, 2)
+    """
+    import arcpy
+
+    if spatial_reference == '#' and graph is not None:
+        spatial_reference = graph['spatial_reference']
+
+    spatial_ref = None
+    if spatial_reference != '#':
+        spatial_ref = arcpy.SpatialReference()
+        spatial_ref.loadFromString(spatial_reference)
+
+    ids = []
+    xy = []
+    with arcpy.da.SearchCursor(fc_in, ['OID@', 'SHAPE@XY'], spatial_reference=spatial_ref) as cursor:
+        for row in cursor:
+            ids.append(row[0])
+            xy.append(row[1])
+
+    return ids, np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+
+
+def nearest_nodes(graph, xy_in):
+    """
+    This function finds the closest graph node to every point with a uniform grid over the nodes.
+
+    :param graph: graph, dict
+    :param xy_in: coordinates in the spatial reference of the graph, array (n, 2)
+    :return: list of the node ids
+    """
+    if 'node_grid' not in graph:
+        nodes = metric_xy(graph, graph['node_xy'])
+        extent = nodes.max(axis=0) - nodes.min(axis=0)
+        cell = max(math.sqrt(float(extent[0] * extent[1]) / max(graph['n_nodes'], 1)) * 2, 1.0)
+        cells = np.floor(nodes / cell).astype(np.int64)
+        grid = {}
+        for i, key in enumerate(map(tuple, cells.tolist())):
+            grid.setdefault(key, []).append(i)
+        graph['node_grid'] = (grid, cell, nodes)
+
+    grid, cell, nodes = graph['node_grid']
+    points = metric_xy(graph, xy_in)
+
+    result = []
+    for x, y in points.tolist():
+        cx = int(math.floor(x / cell))
+        cy = int(math.floor(y / cell))
+        best = -1
+        best_d = float('inf')
+        ring = 0
+        # Extend the search ring until no closer node can be found outside of it
+        while ring * cell <= math.sqrt(best_d) + cell and ring <= 100000:
+            for i in range(cx - ring, cx + ring + 1):
+                for j in range(cy - ring, cy + ring + 1):
+                    if max(abs(i - cx), abs(j - cy)) != ring:
+                        continue
+                    for node in grid.get((i, j), ()):
+                        d = (nodes[node, 0] - x) ** 2 + (nodes[node, 1] - y) ** 2
+                        if d < best_d:
+                            best_d = d
+                            best = node
+            ring += 1
+        result.append(best)
+
+    return result
+
+
+def dijkstra(graph, sources, weights=None, targets=None, cutoff=None):
+    """
+    Multi-source Dijkstra on the street graph. Every source can have an initial distance, this way the points that are
+    located in the middle of an edge are routed from the both ends of the edge.
+
+    :param graph: graph, dict
+    :param sources: list of node ids or (node id, initial distance) pairs
+    :param weights: edge weights, list or array, the edge lengths if None
+    :param targets: the search stops as soon as all of these nodes are settled, iterable
+    :param cutoff: the search stops at this distance
+    :return: distances, predecessor edges and the index of the source of the shortest path tree - dicts over the nodes
+    """
+    if weights is None:
+        weights = graph['weight']
+    elif isinstance(weights, np.ndarray):
+        weights = weights.tolist()
+
+    indptr = graph['indptr']
+    adj_node = graph['adj_node']
+    adj_edge = graph['adj_edge']
+
+    dist = {}
+    pred = {}
+    root = {}
+    heap = []
+
+    for k, source in enumerate(sources):
+        if isinstance(source, tuple):
+            node, d = source
+        else:
+            node, d = source, 0.0
+        if d < dist.get(node, float('inf')):
+            dist[node] = d
+            pred[node] = -1
+            root[node] = k
+            heap.append((d, node))
+    heapq.heapify(heap)
+
+    remaining = set(targets) if targets is not None else None
+    settled = set()
+
+    while heap:
+        d, node = heapq.heappop(heap)
+        if node in settled:
+            continue
+        if cutoff is not None and d > cutoff:
+            break
+        settled.add(node)
+
+        if remaining is not None:
+            remaining.discard(node)
+            if not remaining:
+                break
+
+        for k in range(indptr[node], indptr[node + 1]):
+            nbr = adj_node[k]
+            nd = d + weights[adj_edge[k]]
+            if nd < dist.get(nbr, float('inf')):
+                dist[nbr] = nd
+                pred[nbr] = adj_edge[k]
+                root[nbr] = root[node]
+                heapq.heappush(heap, (nd, nbr))
+
+    return dist, pred, root
+
+
+def other_end(graph, edge_in, node_in):
+    """
+    :param graph: graph, dict
+    :param edge_in: edge id
+    :param node_in: one of the end nodes of the edge
+    :return: the other end node of the edge
+    """
+    u = int(graph['edge_u'][edge_in])
+    if u == node_in:
+        return int(graph['edge_v'][edge_in])
+    return u
+
+
+def trace_path(graph, pred, node_in):
+    """
+    This function follows the predecessor edges from the node back to the root of the shortest path tree.
+
+    :param graph: graph, dict
+    :param pred: predecessor edges, dict
+    :param node_in: end node of the path
+    :return: list of the nodes and list of the edges of the path, both starting at the root
+    """
+    nodes = [node_in]
+    edges = []
+    node = node_in
+    while pred.get(node, -1) != -1:
+        edge = pred[node]
+        edges.append(edge)
+        node = other_end(graph, edge, node)
+        nodes.append(node)
+
+    nodes.reverse()
+    edges.reverse()
+
+    return nodes, edges
+
+
+def path_vertices(graph, nodes_in, edges_in):
+    """
+    This function concatenates the geometry of the edges of the path in the direction of the path.
+
+    :param graph: graph, dict
+    :param nodes_in: nodes of the path
+    :param edges_in: edges of the path
+    :return: list of the (x, y) vertices
+    """
+    shape_xy = graph['shape_xy']
+    shape_ptr = graph['shape_ptr']
+
+    vertices = []
+    for i, edge in enumerate(edges_in):
+        part = shape_xy[shape_ptr[edge]:shape_ptr[edge + 1]].tolist()
+        if graph['edge_u'][edge] != nodes_in[i]:
+            part.reverse()
+        if vertices:
+            part = part[1:]
+        vertices.extend(part)
+
+    return vertices
+
+
+def edge_cut(graph, edge_in, pos_from, pos_to):
+    """
+    This function returns the part of the edge geometry between the two offsets along the edge. The offsets are
+    measured in meters from the start node of the edge.
+
+    :param graph: graph, dict
+    :param edge_in: edge id
+    :param pos_from: offset, where the part starts
+    :param pos_to: offset, where the part ends
+    :return: list of the (x, y) vertices in the direction from pos_from to pos_to
+    """
+    part = graph['shape_xy'][graph['shape_ptr'][edge_in]:graph['shape_ptr'][edge_in + 1]]
+    metric = metric_xy(graph, part)
+
+    cum = np.concatenate([[0.0], np.cumsum(np.sqrt((np.diff(metric, axis=0) ** 2).sum(axis=1)))])
+    cum *= graph['edge_length'][edge_in] / max(cum[-1], 1e-9)
+
+    low, high = sorted([pos_from, pos_to])
+    inner = part[(cum > low) & (cum < high)].tolist()
+    vertices = [[float(np.interp(low, cum, part[:, 0])), float(np.interp(low, cum, part[:, 1]))]] + inner + \
+               [[float(np.interp(high, cum, part[:, 0])), float(np.interp(high, cum, part[:, 1]))]]
+
+    if pos_from > pos_to:
+        vertices.reverse()
+
+    return vertices
+
+
+def route_pieces(graph, facilities_in, incidents_in, weights=None, cutoff=None):
+    """
+    This function routes every incident to its closest facility. All the facilities are the sources of one search,
+    the incidents are reached through the end nodes of their edges or directly along their edge if the facility is on
+    the same edge. The route is kept compact as the list of the edge pieces it uses.
+
+    :param graph: graph, dict
+    :param facilities_in: list of (edge id, offset along the edge) pairs
+    :param incidents_in: list of (edge id, offset along the edge) pairs
+    :param weights: edge weights, the edge lengths if None
+    :param cutoff: the incidents further than this (weighted) distance are not routed
+    :return: list of (facility index, incident index, list of (edge id, offset from, offset to) pieces) tuples
+    """
+    # The single incident queries use the contraction hierarchy or the landmarks, if the graph has them, otherwise the
+    # bidirectional A*
+    if len(incidents_in) == 1:
+        import ContractionHierarchy as ch
+        hierarchy = ch.usable(graph, weights)
+        if hierarchy is not None:
+            routes = ch.route_pieces(graph, hierarchy, facilities_in, incidents_in[0])
+        elif 'landmarks' in graph:
+            import Landmarks as lm
+            routes = lm.route_pieces(graph, graph['landmarks'], facilities_in, incidents_in[0], weights)
+        else:
+            import BidirectionalSearch as bs
+            routes = bs.route_pieces(graph, facilities_in, incidents_in[0], weights)
+        if cutoff is not None:
+            routes = [route for route in routes if pieces_cost(graph, route[2], weights) <= cutoff]
+        return routes
+
+    if weights is None:
+        weights = graph['weight']
+    elif isinstance(weights, np.ndarray):
+        weights = weights.tolist()
+
+    # The offsets are weighted with the same factor as the whole edge
+    def scaled(edge, length):
+        return length * weights[edge] / max(graph['edge_length'][edge], 1e-9)
+
+    sources = []
+    for edge, pos in facilities_in:
+        sources.append((int(graph['edge_u'][edge]), scaled(edge, pos)))
+        sources.append((int(graph['edge_v'][edge]), scaled(edge, graph['edge_length'][edge] - pos)))
+
+    targets = set()
+    for edge, pos in incidents_in:
+        targets.add(int(graph['edge_u'][edge]))
+        targets.add(int(graph['edge_v'][edge]))
+
+    dist, pred, root = dijkstra(graph, sources, weights, targets=targets, cutoff=cutoff)
+
+    facilities_on_edge = {}
+    for k, (edge, pos) in enumerate(facilities_in):
+        facilities_on_edge.setdefault(edge, []).append(k)
+
+    routes = []
+    for i, (edge, pos) in enumerate(incidents_in):
+        u = int(graph['edge_u'][edge])
+        v = int(graph['edge_v'][edge])
+        length_e = float(graph['edge_length'][edge])
+
+        best = (float('inf'), None)
+        for node, rest in ((u, pos), (v, length_e - pos)):
+            if node in dist:
+                best = min(best, (dist[node] + scaled(edge, rest), node))
+
+        # Directly along the edge
+        direct = -1
+        for k in facilities_on_edge.get(edge, []):
+            d = scaled(edge, abs(facilities_in[k][1] - pos))
+            if d <= best[0]:
+                best = (d, None)
+                direct = k
+
+        if direct != -1:
+            routes.append((direct, i, [(edge, float(facilities_in[direct][1]), float(pos))]))
+            continue
+
+        if best[1] is None or (cutoff is not None and best[0] > cutoff):
+            continue
+
+        node = best[1]
+        nodes, edges = trace_path(graph, pred, node)
+        k = root[node] // 2
+        routes.append((k, i, path_pieces(graph, facilities_in[k], nodes, edges, incidents_in[i])))
+
+    return routes
+
+
+def path_pieces(graph, facility_in, nodes_in, edges_in, incident_in):
+    """
+    This function turns the node path between the end nodes of the facility edge and the incident edge into the
+    pieces: from the facility to the first node, the full edges, from the last node to the incident.
+
+    :param graph: graph, dict
+    :param facility_in: (edge id, offset along the edge) pair
+    :param nodes_in: list of the nodes of the path
+    :param edges_in: list of the edges of the path
+    :param incident_in: (edge id, offset along the edge) pair
+    :return: list of (edge id, offset from, offset to) pieces
+    """
+    f_edge, f_pos = facility_in
+    if nodes_in[0] == int(graph['edge_u'][f_edge]):
+        pieces = [(f_edge, float(f_pos), 0.0)]
+    else:
+        pieces = [(f_edge, float(f_pos), float(graph['edge_length'][f_edge]))]
+
+    for j, e in enumerate(edges_in):
+        if nodes_in[j] == int(graph['edge_u'][e]):
+            pieces.append((e, 0.0, float(graph['edge_length'][e])))
+        else:
+            pieces.append((e, float(graph['edge_length'][e]), 0.0))
+
+    edge, pos = incident_in
+    if nodes_in[-1] == int(graph['edge_u'][edge]):
+        pieces.append((edge, 0.0, float(pos)))
+    else:
+        pieces.append((edge, float(graph['edge_length'][edge]), float(pos)))
+
+    return [piece for piece in pieces if piece[1] != piece[2]]
+
+
+def pieces_length(pieces_in):
+    """
+    :param pieces_in: list of (edge id, offset from, offset to) pieces
+    :return: length of the route, meters
+    """
+    return float(sum(abs(b - a) for e, a, b in pieces_in))
+
+
+def pieces_vertices(graph, pieces_in):
+    """
+    :param graph: graph, dict
+    :param pieces_in: list of (edge id, offset from, offset to) pieces
+    :return: list of the (x, y) vertices of the route
+    """
+    vertices = []
+    for edge, a, b in pieces_in:
+        part = edge_cut(graph, edge, a, b)
+        vertices.extend(part[1:] if vertices else part)
+
+    return vertices
+
+
+def pieces_cost(graph, pieces_in, weights=None):
+    """
+    :param graph: graph, dict
+    :param pieces_in: list of (edge id, offset from, offset to) pieces
+    :param weights: edge weights, the edge lengths if None
+    :return: weighted length of the route
+    """
+    if weights is None:
+        return pieces_length(pieces_in)
+    return float(sum(abs(b - a) * weights[e] / max(graph['edge_length'][e], 1e-9) for e, a, b in pieces_in))
+
+
+def interval_union(intervals_in):
+    """
+    :param intervals_in: list of (low, high) pairs
+    :return: length covered by the intervals
+    """
+    total = 0.0
+    end = None
+    for low, high in sorted(intervals_in):
+        if end is None or low > end:
+            total += high - low
+            end = high
+        elif high > end:
+            total += high - end
+            end = high
+    return total
+
+
+def pieces_duct_length(routes_in):
+    """
+    The duct is the union of the routes: the pieces of the same edge are counted once.
+
+    :param routes_in: list of the routes, each a list of (edge id, offset from, offset to) pieces
+    :return: duct length, meters
+    """
+    usage = {}
+    for pieces in routes_in:
+        for edge, a, b in pieces:
+            usage.setdefault(edge, []).append((min(a, b), max(a, b)))
+    return float(sum(interval_union(intervals) for intervals in usage.values()))
+
+
+def closest_facility(graph, facilities_in, incidents_in, weights=None):
+    """
+    This function routes every incident to its closest facility, see route_pieces.
+
+    :return: list of (facility index, incident index, list of (x, y) vertices, length) tuples
+    """
+    routes = []
+    for k, i, pieces in route_pieces(graph, facilities_in, incidents_in, weights):
+        routes.append((k, i, pieces_vertices(graph, pieces), pieces_length(pieces)))
+
+    return routes
+
+
+def write_routes(graph, routes_in, output_fc_in, name_in):
+    """
+    This function saves the routes to a line feature class with the same main fields as the routes of the closest
+    facility solver (FacilityID, IncidentID and Total_Length).
+
+    :param graph: graph, dict
+    :param routes_in: list of (facility id, incident id, list of (x, y) vertices, length) tuples
+    :param output_fc_in: path to the feature dataset or the workspace
+    :param name_in: name of the feature class
+    :return: path to the feature class
+    """
+    import arcpy
+
+    spatial_ref = arcpy.SpatialReference()
+    spatial_ref.loadFromString(graph['spatial_reference'])
+
+    out_path = os.path.join(output_fc_in, name_in)
+    if arcpy.Exists(out_path):
+        arcpy.Delete_management(out_path)
+
+    arcpy.CreateFeatureclass_management(output_fc_in, name_in, 'POLYLINE', spatial_reference=spatial_ref)
+    arcpy.AddField_management(out_path, 'FacilityID', 'LONG')
+    arcpy.AddField_management(out_path, 'IncidentID', 'LONG')
+    arcpy.AddField_management(out_path, 'Total_Length', 'DOUBLE')
+
+    with arcpy.da.InsertCursor(out_path, ['SHAPE@', 'FacilityID', 'IncidentID', 'Total_Length']) as cursor:
+        for facility_id, incident_id, vertices, length in routes_in:
+            if len(vertices) > 1:
+                shape = arcpy.Polyline(arcpy.Array([arcpy.Point(x, y) for x, y in vertices]), spatial_ref)
+            else:
+                shape = None
+            cursor.insertRow([shape, facility_id, incident_id, length])
+
+    return out_path
@@ -0,0 +1,312 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+import NetworkGraph as ng
+import GraphClustering as gc
+import ContractionHierarchy as ch
+
+# Default bound of the working memory of the rows being computed or read, bytes
+DEFAULT_BUDGET = 256 * 2 ** 20
+
+# Inputs of the Dijkstra worker process, set once by init_dijkstra
+dijkstra_worker = {}
+
+
+def matrix_paths(path_in):
+    """
+    :param path_in: base path of the matrix, without the extension
+    :return: paths of the .npy files of the distances and of the sorted neighbour indices
+    """
+    return '{0}_dist.npy'.format(path_in), '{0}_order.npy'.format(path_in)
+
+
+def chunk_rows(graph, n_cols, n_workers, budget):
+    """
+    The rows of a chunk are computed in float64 together with the working matrix of the hierarchy sweep, which has a
+    column per origin and at most a row per node, and sorted with the int64 indices. The chunks of all the workers fit
+    into the budget, at least one row is computed at once.
+
+    :param graph: graph, dict
+    :param n_cols: number of the destinations
+    :param n_workers: number of the chunks computed at the same time
+    :param budget: bytes
+    :return: number of the origins per chunk
+    """
+    row_bytes = 16 * graph['n_nodes'] + 32 * n_cols
+    return max(1, int(budget // (max(1, n_workers) * row_bytes)))
+
+
+def dijkstra_rows(graph, origins_in, destinations_in, weights):
+    """
+    The distances from every origin with the complete Dijkstra search, if the graph has no hierarchy for the weights.
+
+    :param graph: graph, dict
+    :param origins_in: list of (edge id, offset along the edge) pairs
+    :param destinations_in: list of (edge id, offset along the edge) pairs
+    :param weights: edge weights
+    :return: distances, inf for the unreachable pairs - array (n origins, n destinations)
+    """
+    o_ends = gc.location_nodes(graph, origins_in, weights)
+    d_nodes, d_offsets = ch.location_ends(graph, destinations_in, weights)
+
+    on_edge = {}
+    for j, (edge, pos) in enumerate(destinations_in):
+        on_edge.setdefault(edge, []).append(j)
+
+    rows = np.empty((len(origins_in), len(destinations_in)))
+    node_dist = np.empty(graph['n_nodes'])
+    for i, (edge, pos) in enumerate(origins_in):
+        dist = ng.dijkstra(graph, list(o_ends[i]), weights)[0]
+        node_dist.fill(np.inf)
+        node_dist[list(dist.keys())] = list(dist.values())
+        rows[i] = np.minimum(node_dist[d_nodes[:, 0]] + d_offsets[:, 0], node_dist[d_nodes[:, 1]] + d_offsets[:, 1])
+
+        factor = weights[edge] / max(graph['edge_length'][edge], 1e-9)
+        for j in on_edge.get(edge, ()):
+            rows[i, j] = min(rows[i, j], abs(destinations_in[j][1] - pos) * factor)
+    return rows
+
+
+def write_rows(dist, order, first, rows):
+    """
+    :param dist: memory map of the distances
+    :param order: memory map of the sorted neighbour indices
+    :param first: index of the first origin of the rows
+    :param rows: distances, array (n origins, n destinations)
+    :return:
+    """
+    dist[first:first + len(rows)] = rows
+    # Sorted in float64 and stable, the ties keep the order of the destinations as in k_nearest
+    order[first:first + len(rows)] = np.argsort(rows, axis=1, kind='stable')[:, :order.shape[1]]
+    return
+
+
+def init_dijkstra(graph, origins_in, destinations_in, weights, path_in):
+    """
+    This function keeps the inputs in the worker process and maps the matrix files written by its chunks.
+    """
+    dist_path, order_path = matrix_paths(path_in)
+    dijkstra_worker.update({'graph': graph, 'origins': origins_in, 'destinations': destinations_in,
+                            'weights': weights, 'dist': np.load(dist_path, mmap_mode='r+'),
+                            'order': np.load(order_path, mmap_mode='r+')})
+    return
+
+
+def dijkstra_chunk(first, last):
+    """
+    This function computes the rows of the origins from first to last in the worker process, see init_dijkstra.
+    """
+    w = dijkstra_worker
+    rows = dijkstra_rows(w['graph'], w['origins'][first:last], w['destinations'], w['weights'])
+    write_rows(w['dist'], w['order'], first, rows)
+    w['dist'].flush()
+    w['order'].flush()
+    return
+
+
+def build(graph, origins_in, path_in, destinations_in=None, k=None, weights=None, n_workers=4,
+          budget=DEFAULT_BUDGET):
+    """
+    This function computes the OD matrix in the chunks of the origins and writes it to a float32 .npy memory map on
+    the disk, together with the indices of the destinations of every origin sorted by the distance. A bounded pool of
+    workers computes the chunks, at most n_workers chunks are in the memory at once, so the peak memory is bounded by
+    the budget and not by the size of the matrix. The rows are answered from the contraction hierarchy of the graph
+    by the threads, if it has one for the weights, its sweeps run in numpy. Otherwise every origin is searched with
+    Dijkstra in Python, which holds the GIL, so the chunks are computed by the processes instead, unless there is only
+    one worker. Every process keeps its own copy of the graph and writes its rows to the files, the budget does not
+    include the copies.
+
+    :param graph: graph, dict
+    :param origins_in: list of (edge id, offset along the edge) pairs
+    :param path_in: base path of the .npy files, see matrix_paths
+    :param destinations_in: list of (edge id, offset along the edge) pairs, the origins if None
+    :param k: number of the sorted neighbour indices kept per origin, all the destinations if None
+    :param weights: edge weights, the edge lengths if None
+    :param n_workers: number of the threads or of the processes
+    :param budget: bound of the working memory of the chunks, bytes
+    :return: OD matrix, dict: 'dist' distances, inf for the unreachable pairs - memory map (n origins, n destinations),
+             'order' sorted neighbour indices - memory map (n origins, k), 'path' base path
+    """
+    if destinations_in is None:
+        destinations_in = origins_in
+    n_o = len(origins_in)
+    n_d = len(destinations_in)
+    k = n_d if k is None else min(int(k), n_d)
+
+    hierarchy = ch.usable(graph, weights)
+    if hierarchy is not None:
+        # The sweep order is shared by the threads
+        ch.sweep_order(hierarchy)
+    elif weights is None:
+        weights = graph['weight']
+    elif isinstance(weights, np.ndarray):
+        weights = weights.tolist()
+
+    dist_path, order_path = matrix_paths(path_in)
+    dist = np.lib.format.open_memmap(dist_path, mode='w+', dtype=np.float32, shape=(n_o, n_d))
+    order = np.lib.format.open_memmap(order_path, mode='w+', dtype=np.int32, shape=(n_o, k))
+
+    if hierarchy is not None or n_workers <= 1:
+        def compute(first, last):
+            origins = origins_in[first:last]
+            if hierarchy is not None:
+                rows = next(ch.distance_rows(graph, hierarchy, origins, destinations_in, chunk=len(origins)))[1]
+            else:
+                rows = dijkstra_rows(graph, origins, destinations_in, weights)
+            write_rows(dist, order, first, rows)
+            return
+
+        pool = ThreadPoolExecutor(max(1, n_workers))
+    else:
+        # The workers map the files written so far
+        dist.flush()
+        order.flush()
+        compute = dijkstra_chunk
+        pool = ProcessPoolExecutor(max(1, n_workers), mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=init_dijkstra,
+                                   initargs=(graph, origins_in, destinations_in, weights, path_in))
+
+    chunk = chunk_rows(graph, n_d, n_workers, budget)
+    with pool:
+        pending = set()
+        for first in range(0, n_o, chunk):
+            if len(pending) >= max(1, n_workers):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(pool.submit(compute, first, min(first + chunk, n_o)))
+        for future in pending:
+            future.result()
+
+    dist.flush()
+    order.flush()
+    del dist, order
+
+    return open_matrix(path_in)
+
+
+def open_matrix(path_in):
+    """
+    :param path_in: base path of the .npy files written by build
+    :return: OD matrix, dict, see build - the files are mapped read-only
+    """
+    dist_path, order_path = matrix_paths(path_in)
+    return {'dist': np.load(dist_path, mmap_mode='r'),
+            'order': np.load(order_path, mmap_mode='r'),
+            'path': path_in}
+
+
+def penalties(od, thr, budget=DEFAULT_BUDGET):
+    """
+    The penalty of an origin is the sum of the distances to its thr nearest reachable destinations, as in the penalty
+    matrix of BuildingsClusterCPM. The rows are read from the map in the chunks that fit into the budget.
+
+    :param od: OD matrix, dict
+    :param thr: number of the nearest destinations
+    :param budget: bytes
+    :return: penalties, array (n origins)
+    """
+    dist = od['dist']
+    order = od['order']
+    thr = min(thr, order.shape[1])
+    chunk = max(1, int(budget // max(1, 4 * dist.shape[1] + 16 * thr)))
+
+    penalty = np.zeros(dist.shape[0])
+    for first in range(0, dist.shape[0], chunk):
+        rows = np.take_along_axis(np.asarray(dist[first:first + chunk]), np.asarray(order[first:first + chunk, :thr]),
+                                  axis=1).astype(np.float64)
+        penalty[first:first + chunk] = np.where(np.isfinite(rows), rows, 0.0).sum(axis=1)
+    return penalty
+
+
+def cpm(od, sr, max_distance=None, k=None, budget=DEFAULT_BUDGET):
+    """
+    The same as GraphClustering.cpm on the square OD matrix of the locations on the disk. Only the penalties and the
+    row of the location opening the cluster are in the memory.
+
+    :param od: OD matrix, dict, the destinations are the origins
+    :param sr: splitting ratio, maximum number of the locations per cluster
+    :param max_distance: maximum distance of a member from the location that opened the cluster, None for no limit
+    :param k: number of the nearest neighbours a cluster is opened with, as in the rows of k_nearest, all the sorted
+              ones if None
+    :param budget: bytes for the reading of the penalties
+    :return: list of the lists of the location indices
+    """
+    n = od['dist'].shape[0]
+    if n == 0:
+        return []
+
+    thr = gc.cluster_size(n, sr)
+    penalty = penalties(od, thr, budget)
+
+    flags = np.zeros(n, dtype=bool)
+    clusters = []
+    for i in np.argsort(penalty, kind='stable').tolist():
+        if flags[i]:
+            continue
+        row_order = np.asarray(od['order'][i, :k])
+        row_dist = np.asarray(od['dist'][i])[row_order]
+        members = []
+        for d, j in zip(row_dist.tolist(), row_order.tolist()):
+            if len(members) == thr:
+                break
+            if flags[j] or d == np.inf or (max_distance is not None and d > max_distance):
+                continue
+            members.append(j)
+            flags[j] = True
+        if not flags[i]:
+            members.append(i)
+            flags[i] = True
+        clusters.append(members)
+
+    return clusters
+
+
+def benchmark(graph, n_locations=2000, n_workers=4, budget=DEFAULT_BUDGET, path_in='#', seed_in=0):
+    """
+    This function builds the OD matrix of random locations on the disk and compares it and its CPM clusters to the
+    in-memory k nearest neighbours.
+
+    :param graph: graph, dict
+    :param n_locations: number of the random locations
+    :param n_workers: number of the threads or of the processes, see build
+    :param budget: bytes
+    :param path_in: base path of the matrix files, in the temporary directory if '#'
+    :param seed_in: seed of the random locations
+    :return: dict with the times, the size of the files, the number of the different distances and clusters
+    """
+    import tempfile
+
+    rnd = np.random.RandomState(seed_in)
+    edges = rnd.randint(0, graph['n_edges'], n_locations)
+    locations = [(int(e), float(rnd.uniform(0, graph['edge_length'][e]))) for e in edges]
+
+    if path_in == '#':
+        path_in = os.path.join(tempfile.mkdtemp(), 'od')
+
+    start = time.time()
+    od = build(graph, locations, path_in, k=128, n_workers=n_workers, budget=budget)
+    time_build = time.time() - start
+
+    start = time.time()
+    nearest = gc.k_nearest(graph, locations, 128)
+    time_nearest = time.time() - start
+
+    mismatch = 0
+    for i, row in enumerate(nearest):
+        d = np.asarray([dist for dist, j in row])
+        mapped = np.asarray(od['dist'][i])[np.asarray(od['order'][i])[:len(row)]].astype(np.float64)
+        mismatch += int(np.sum(np.abs(d - mapped) > 1e-6 * np.maximum(1.0, d) + 1e-3))
+
+    clusters = gc.cpm(nearest, 32)
+    clusters_od = cpm(od, 32)
+
+    return {'build': time_build,
+            'nearest': time_nearest,
+            'disk': sum(os.path.getsize(path) for path in matrix_paths(path_in)),
+            'mismatch': mismatch,
+            'clusters_equal': sorted(map(sorted, clusters)) == sorted(map(sorted, clusters_od))}
@@ -0,0 +1,289 @@
+import heapq
+import bisect
+
+import numpy as np
+
+import NetworkGraph as ng
+import CoordinateTransform as ct
+
+
+def segment_crossings(p0, p1, eps_in=1e-9):
+    """
+    This function finds all the points, where the segments cross or touch each other. The segments are swept from
+    left to right: a segment is only tested against the active segments (the ones whose x-range contains its start),
+    that overlap it also in y. The active segments are kept sorted by their ids, so they are inserted and removed with
+    the binary search and the events cost O(log n). For the street networks, where the segments are short compared to
+    the area, the active set stays small and the sweep is close to O((n + k) log n).
+
+    :param p0: start points of the segments, array (n, 2)
+    :param p1: end points of the segments, array (n, 2)
+    :param eps_in: tolerance of the segment parameter
+    :return: list of (segment, parameter along the segment) pairs, two per crossing
+    """
+    x_low = np.minimum(p0[:, 0], p1[:, 0])
+    x_high = np.maximum(p0[:, 0], p1[:, 0])
+    y_low = np.minimum(p0[:, 1], p1[:, 1])
+    y_high = np.maximum(p0[:, 1], p1[:, 1])
+    d = p1 - p0
+
+    crossings = []
+    active = []
+    ends = []
+
+    for s in np.argsort(x_low, kind='mergesort').tolist():
+        # Remove the segments that end before this one starts
+        while ends and ends[0][0] < x_low[s]:
+            del active[bisect.bisect_left(active, heapq.heappop(ends)[1])]
+
+        if active:
+            others = np.asarray(active)
+            others = others[(y_low[others] <= y_high[s]) & (y_high[others] >= y_low[s])]
+
+            if len(others) > 0:
+                denom = d[others, 0] * d[s, 1] - d[others, 1] * d[s, 0]
+                diff = p0[s] - p0[others]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    t_other = (diff[:, 0] * d[s, 1] - diff[:, 1] * d[s, 0]) / denom
+                    t_self = (diff[:, 0] * d[others, 1] - diff[:, 1] * d[others, 0]) / denom
+
+                # Parallel segments do not cross (the collinear overlaps are merged by the snapping of the vertices)
+                hit = (denom != 0) & (t_other >= -eps_in) & (t_other <= 1 + eps_in) & \
+                      (t_self >= -eps_in) & (t_self <= 1 + eps_in)
+
+                for o, t_o, t_s in zip(others[hit].tolist(), t_other[hit].tolist(), t_self[hit].tolist()):
+                    crossings.append((o, min(max(t_o, 0.0), 1.0)))
+                    crossings.append((s, min(max(t_s, 0.0), 1.0)))
+
+        bisect.insort(active, s)
+        heapq.heappush(ends, (x_high[s], s))
+
+    return crossings
+
+
+def merge_vertices(points_metric, tolerance_in):
+    """
+    This function merges the vertices closer than the tolerance. The vertices are hashed into a grid with the cell of
+    the tolerance, so only the neighbouring cells are compared, and the close vertices are joined with union-find.
+
+    :param points_metric: coordinates in meters, array (n, 2)
+    :param tolerance_in: snapping tolerance, meters
+    :return: the merged vertex of every point, array (n), the point representing every merged vertex, array
+    """
+    parent = list(range(len(points_metric)))
+
+    def find(a):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    cells = np.floor(points_metric / max(tolerance_in, 1e-9)).astype(np.int64).tolist()
+    grid = {}
+    for i, key in enumerate(map(tuple, cells)):
+        grid.setdefault(key, []).append(i)
+
+    tol2 = tolerance_in ** 2
+    for (cx, cy), members in grid.items():
+        for i in range(cx - 1, cx + 2):
+            for j in range(cy - 1, cy + 2):
+                for b in grid.get((i, j), ()):
+                    for a in members:
+                        if a < b and find(a) != find(b) and \
+                                ((points_metric[a] - points_metric[b]) ** 2).sum() <= tol2:
+                            parent[find(a)] = find(b)
+
+    roots = np.asarray([find(a) for a in range(len(points_metric))], dtype=np.int64)
+    unique, vertex = np.unique(roots, return_inverse=True)
+
+    return vertex, unique
+
+
+def prune_dangles(n_vertices, edges_in):
+    """
+    This function removes the dangles iteratively until a fixed point: every vertex of degree one is removed with its
+    edge, which can make its neighbour a new dangle.
+
+    :param n_vertices: number of the vertices
+    :param edges_in: list of (u, v) pairs
+    :return: flags of the remaining edges, degree of every vertex
+    """
+    degree = np.zeros(n_vertices, dtype=np.int64)
+    incident = [[] for _ in range(n_vertices)]
+    for e, (u, v) in enumerate(edges_in):
+        degree[u] += 1
+        degree[v] += 1
+        incident[u].append(e)
+        incident[v].append(e)
+
+    alive = np.ones(len(edges_in), dtype=bool)
+    queue = [a for a in range(n_vertices) if degree[a] == 1]
+
+    while queue:
+        a = queue.pop()
+        if degree[a] != 1:
+            continue
+        for e in incident[a]:
+            if alive[e]:
+                alive[e] = False
+                u, v = edges_in[e]
+                other = v if u == a else u
+                degree[a] -= 1
+                degree[other] -= 1
+                if degree[other] == 1:
+                    queue.append(other)
+                break
+
+    return alive, degree
+
+
+def merge_chains(edges_in, alive, degree):
+    """
+    This function joins the chains of the edges through the vertices of degree two into one street, so every street
+    goes from an intersection (or a dead end) to an intersection.
+
+    :return: list of the vertex sequences
+    """
+    incident = {}
+    for e in np.nonzero(alive)[0].tolist():
+        u, v = edges_in[e]
+        incident.setdefault(u, []).append(e)
+        incident.setdefault(v, []).append(e)
+
+    visited = set()
+    chains = []
+
+    def walk(start, e):
+        chain = [start]
+        node = start
+        while True:
+            visited.add(e)
+            u, v = edges_in[e]
+            node = v if u == node else u
+            chain.append(node)
+            if degree[node] != 2 or node == start:
+                return chain
+            nxt = [f for f in incident[node] if f not in visited]
+            if not nxt:
+                return chain
+            e = nxt[0]
+
+    for a in incident:
+        if degree[a] != 2:
+            for e in incident[a]:
+                if e not in visited:
+                    chains.append(walk(a, e))
+
+    # Closed loops of degree two vertices only
+    for a in incident:
+        for e in incident[a]:
+            if e not in visited:
+                chains.append(walk(a, e))
+
+    return chains
+
+
+def build(polylines_in, geographic=True, tolerance_in=0.5, prune=True, spatial_reference='#'):
+    """
+    This function builds the planar street graph from the raw polylines in one pass: the segments are split at their
+    crossings, the coincident vertices are merged, the dangles are pruned to a fixed point and the chains are merged
+    into the streets. The intersections (vertices of degree three and more) are the facilities for the clustering,
+    the graph is the routable graph of NetworkGraph.
+
+    :param polylines_in: list of the vertices arrays (m, 2)
+    :param geographic: if the coordinates are in degrees, binary
+    :param tolerance_in: snapping tolerance, meters
+    :param prune: remove the dangles, binary
+    :param spatial_reference: the spatial reference as a string
+    :return: list of the street vertices arrays, one per edge of the graph in the same order, so the streets written
+             in this order have the object ids of the edges, intersections array (n, 2), graph dict
+    """
+    polylines = [np.asarray(line, dtype=np.float64) for line in polylines_in if len(line) > 1]
+    if not polylines:
+        return [], np.zeros((0, 2)), ng.build_graph([], [], [], [], geographic=geographic,
+                                                    spatial_reference=spatial_reference)
+
+    vertices = np.concatenate(polylines)
+    lengths = np.asarray([len(line) for line in polylines])
+    ptr = np.concatenate([[0], np.cumsum(lengths)])
+    first = np.concatenate([np.arange(ptr[k], ptr[k + 1] - 1) for k in range(len(polylines))])
+    p0 = vertices[first]
+    p1 = vertices[first + 1]
+
+    # The geographic coordinates are merged and measured in the UTM zone of the streets
+    zone = ct.detect_zone(vertices) if geographic else None
+
+    # Split every segment at its crossings
+    splits = [[0.0, 1.0] for _ in range(len(p0))]
+    for s, t in segment_crossings(p0, p1):
+        splits[s].append(t)
+
+    points = []
+    pieces = []
+    for s in range(len(p0)):
+        ts = sorted(set(splits[s]))
+        start = len(points)
+        for t in ts:
+            points.append(p0[s] + (p1[s] - p0[s]) * t)
+        pieces.extend((start + k, start + k + 1) for k in range(len(ts) - 1))
+
+    points = np.asarray(points)
+    vertex, representative = merge_vertices(ct.forward(points, zone) if geographic else points, tolerance_in)
+    vertex_xy = points[representative]
+    n_vertices = len(vertex_xy)
+
+    edges = set()
+    for a, b in pieces:
+        u, v = vertex[a], vertex[b]
+        if u != v:
+            edges.add((min(u, v), max(u, v)))
+    edges = sorted(edges)
+
+    if prune:
+        alive, degree = prune_dangles(n_vertices, edges)
+    else:
+        alive = np.ones(len(edges), dtype=bool)
+        degree = np.bincount(np.asarray(edges).ravel(), minlength=n_vertices) if edges else \
+            np.zeros(n_vertices, dtype=np.int64)
+
+    chains = merge_chains(edges, alive, degree)
+    intersections = vertex_xy[degree >= 3]
+
+    # The routable graph over the ends of the streets
+    streets = []
+    node_ids = {}
+    edge_u = []
+    edge_v = []
+    edge_length = []
+    shape_xy = []
+    shape_ptr = [0]
+    for chain in chains:
+        # The loops are split in the middle, so they are not lost as the self-loop edges
+        if chain[0] == chain[-1]:
+            middle = len(chain) // 2
+            parts = [chain[:middle + 1], chain[middle:]]
+        else:
+            parts = [chain]
+
+        for part in parts:
+            street = vertex_xy[part]
+            ends = [node_ids.setdefault(part[0], len(node_ids)), node_ids.setdefault(part[-1], len(node_ids))]
+            if ends[0] == ends[1]:
+                continue
+            edge_u.append(ends[0])
+            edge_v.append(ends[1])
+            if geographic:
+                edge_length.append(float(ct.ground_lengths(street, zone).sum()))
+            else:
+                edge_length.append(float(np.sqrt((np.diff(street, axis=0) ** 2).sum(axis=1)).sum()))
+            shape_xy.extend(street.tolist())
+            shape_ptr.append(len(shape_xy))
+            streets.append(street)
+
+    node_xy = np.empty((len(node_ids), 2))
+    for key, i in node_ids.items():
+        node_xy[i] = vertex_xy[key]
+
+    graph = ng.build_graph(node_xy, edge_u, edge_v, edge_length, None, shape_xy, shape_ptr, geographic,
+                           spatial_reference)
+
+    return streets, intersections, graph
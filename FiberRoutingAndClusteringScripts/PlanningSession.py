@@ -0,0 +1,422 @@
+import os
+import csv
+import json
+
+import numpy as np
+
+import NetworkGraph as ng
+import SegmentIndex as si
+import GraphClustering as gc
+import ShortestPathTree as spt
+import CostModel as cm
+
+# Columns of the comparison table, the equipment columns follow
+TABLE_KEYS = ['lmf', 'lm_d', 'df', 'd_d', 'ff', 'f_d', 'ff_sp_p', 'f_d_add_p', 'fiber', 'duct', 'fiber_p', 'duct_add_p',
+              'copper', 'copper_d']
+
+# Keys of the feeder lengths in the planning results of the topologies with the remote nodes, see feeder_result
+FEEDER_KEYS = ['ff', 'f_d', 'ff_sp_p', 'f_d_add_p']
+
+
+def read_locations(graph, fc_in):
+    """
+    :param graph: graph, dict
+    :param fc_in: point feature class
+    :return: dict: 'ids', 'xy' metric coordinates of the points on the streets, 'locations' list of (edge id, offset)
+    """
+    ids, xy = ng.read_points(fc_in, graph)
+    snapped = si.snap_points(graph, xy)
+    valid = np.nonzero(snapped['edge'] >= 0)[0]
+
+    return {'ids': [ids[i] for i in valid],
+            'xy': ng.metric_xy(graph, snapped['xy'][valid]),
+            'locations': [(int(snapped['edge'][i]), float(snapped['pos'][i])) for i in valid]}
+
+
+def merge_locations(first_in, second_in):
+    """
+    :return: dict with the 'ids', 'xy' and 'locations' of both, see read_locations
+    """
+    return {'ids': first_in['ids'] + second_in['ids'],
+            'xy': np.vstack([first_in['xy'], second_in['xy']]),
+            'locations': first_in['locations'] + second_in['locations']}
+
+
+def open_session(network_nd, demands, intersections, co, cache_dir='#', brownfield_duct='#', clustering='cpm',
+                 routing='shortest', hierarchy=False, od_dir='#', lines='#'):
+    """
+    This function reads the network, the demands, the intersections and the CO once. All the topologies planned in the
+    session share them and the cached searches: the nearest neighbours of the demands, the clustered stages and the
+    complete search from the CO.
+
+    :param network_nd: network dataset, path
+    :param demands: demands, point feature class
+    :param intersections: candidate locations of the remote nodes, point feature class
+    :param co: CO, point feature class
+    :param cache_dir: directory for the graph .npz files, '#' to keep the graph only in memory
+    :param brownfield_duct: brownfield ducts, either a line feature class or a snapped index, '#' if none
+    :param clustering: 'cpm' or 'kmeans', the balanced k-means refined with the network distances, see
+                       GraphClustering.kmeans_clusters
+    :param routing: 'shortest' or 'steiner', the members of every cluster are connected with the Steiner tree, see
+                    SteinerRouting
+    :param hierarchy: contract the network, the distance matrices of the clustering and the routes of the single
+                      demands are then answered from the contraction hierarchy, see ContractionHierarchy
+    :param od_dir: directory of the distance matrices of the CPM clustering, they are computed in the chunks to the
+                   memory maps on the disk instead of keeping the nearest neighbours in the memory, see ODMatrix, '#'
+                   to keep them in the memory
+    :param lines: streets, their midpoints are the additional cabinet candidates of FTTCab as in fttcab, '#' if none
+    :return: session, dict
+    """
+    import ShortestPathRouting as spr
+
+    graph = ng.get_graph(network_nd, cache_dir)
+
+    weights = spr.graph_weights(graph, brownfield_duct)
+    if hierarchy and hierarchy != '#':
+        import ContractionHierarchy as ch
+        ch.get_hierarchy(graph, ch.hierarchy_path(network_nd, cache_dir), weights)
+
+    session = {'graph': graph,
+               'weights': weights,
+               'demands': read_locations(graph, demands),
+               'intersections': read_locations(graph, intersections),
+               'co': read_locations(graph, co),
+               'co_in': co,
+               'clustering': clustering,
+               'routing': routing,
+               'od_dir': od_dir,
+               'cache': {}}
+
+    session['cabinets'] = session['intersections']
+    if lines != '#':
+        import arcpy
+        import ScratchWorkspace as sw
+
+        middle_points = sw.scratch_name('middle_points')
+        arcpy.FeatureToPoint_management(lines, middle_points, 'INSIDE')
+        session['cabinets'] = merge_locations(session['intersections'], read_locations(graph, middle_points))
+        sw.discard([middle_points])
+
+    return session
+
+
+def nearest(session, key, locations_in, k):
+    """
+    The nearest neighbours are computed once with the largest k requested so far.
+
+    :return: list of the lists of (distance, location index) pairs
+    """
+    cache = session['cache']
+    if (key, 'nearest') not in cache or len(cache[(key, 'nearest')][0]) < min(k, len(locations_in)):
+        cache[(key, 'nearest')] = gc.k_nearest(session['graph'], locations_in, k, session['weights'])
+    return [row[:k] for row in cache[(key, 'nearest')]]
+
+
+def od_matrix(session, key, locations_in, k):
+    """
+    The same as nearest, the distance matrix is written to the memory maps in the directory of the session and only
+    the k nearest neighbours of every location are sorted.
+
+    :return: OD matrix, dict, see ODMatrix.build
+    """
+    import ODMatrix as om
+
+    cache = session['cache']
+    if (key, 'od') not in cache or cache[(key, 'od')]['order'].shape[1] < min(k, len(locations_in)):
+        # The old maps of the files are closed before they are written again
+        cache.pop((key, 'od'), None)
+        name = key if isinstance(key, str) else '_'.join(str(part) for part in key)
+        cache[(key, 'od')] = om.build(session['graph'], locations_in, os.path.join(session['od_dir'], 'OD_' + name),
+                                      k=k, weights=session['weights'])
+    return cache[(key, 'od')]
+
+
+def cluster_stage(session, key, points_in, sr, max_distance=None, sites='intersections'):
+    """
+    This function clusters the points of one stage and routes every cluster to its head. As in the mains with
+    reassign, the points are reassigned to the heads of the clusters with the minimum-cost flow, the points beyond
+    max_distance from their head get the new heads and the empty clusters are dropped, see GraphClustering.flow_heads.
+    The stage is cached, e.g., the last mile of FTTB and of the 2-stage NG-PON with the same splitting ratio is planned
+    once.
+
+    :param session: session, dict
+    :param key: name of the points, the key of the cache
+    :param points_in: dict with 'xy' and 'locations'
+    :param sr: splitting ratio
+    :param max_distance: maximum distance of a member from the cluster, None for no limit
+    :param sites: key of the candidate heads in the session, 'intersections' or 'cabinets'
+    :return: stage, dict: 'clusters', 'heads' dict with 'xy' and 'locations', 'fiber', 'duct'
+    """
+    cache = session['cache']
+    if (key, sr, max_distance, sites) in cache:
+        return cache[(key, sr, max_distance, sites)]
+
+    graph = session['graph']
+    intersections = session[sites]
+
+    if session['clustering'] == 'kmeans':
+        clusters = gc.kmeans_clusters(graph, points_in['locations'], points_in['xy'], sr, max_distance,
+                                      session['weights'])
+    elif session['od_dir'] != '#':
+        import ODMatrix as om
+        k = 4 * int(sr)
+        clusters = om.cpm(od_matrix(session, key, points_in['locations'], k), sr, max_distance, k)
+    else:
+        # Enough neighbours for the clusters and the skipped clustered neighbours
+        clusters = gc.cpm(nearest(session, key, points_in['locations'], 4 * int(sr)), sr, max_distance)
+    heads = gc.cluster_heads(clusters, points_in['xy'], intersections['xy'])
+
+    # The points, whose head is beyond max_distance from them, get the new heads
+    labels = [-1] * len(points_in['locations'])
+    for c, members in enumerate(clusters):
+        for i in members:
+            labels[i] = c
+    heads, clusters = gc.flow_heads(graph, points_in['locations'], points_in['xy'], intersections['locations'],
+                                    intersections['xy'], heads, sr, max_distance, session['weights'], labels_in=labels)
+    heads = [head for members, head in zip(clusters, heads) if members]
+    clusters = [members for members in clusters if members]
+
+    # The copper within the reach is routed along the shortest paths, the tree could make it longer than the reach
+    steiner = session['routing'] == 'steiner' and max_distance is None
+    if steiner:
+        import SteinerRouting as st
+
+    routes = []
+    for members, head in zip(clusters, heads):
+        member_locations = [points_in['locations'][i] for i in members]
+        if steiner:
+            head_routes = st.route_pieces(graph, intersections['locations'][head], member_locations,
+                                          session['weights'])
+        else:
+            head_routes = ng.route_pieces(graph, [intersections['locations'][head]], member_locations,
+                                          session['weights'])
+        routes.extend(pieces for k, i, pieces in head_routes)
+
+    stage = {'clusters': clusters,
+             'heads': {'xy': intersections['xy'][heads],
+                       'locations': [intersections['locations'][head] for head in heads]},
+             'fiber': float(sum(ng.pieces_length(pieces) for pieces in routes)),
+             'duct': ng.pieces_duct_length(routes)}
+    cache[(key, sr, max_distance, sites)] = stage
+
+    return stage
+
+
+def feeder(session, locations_in, ff_protection=False, sp_protection=True, co_capacity='#'):
+    """
+    The feeder of every topology is a tree of the same complete search from the CO. With the CO capacity or the
+    protection the feeder is routed as in ShortestPathRouting.main: the locations are assigned to the COs within their
+    ports, see ShortestPathRouting.assign_co, and the protection paths are searched for every route.
+
+    :param session: session, dict
+    :param locations_in: list of (edge id, offset along the edge) pairs
+    :param ff_protection: if the protection paths are required, binary
+    :param sp_protection: shortest disjoint path if True, the sharing of the other ducts if False, binary
+    :param co_capacity: number of the ports of every CO or the name of the field with the ports, '#' for no limit
+    :return: fiber length, duct length, with the protection also the protection fiber and its additional duct - meters
+    """
+    graph = session['graph']
+    if not ff_protection and co_capacity == '#':
+        cache = session['cache']
+        if 'feeder_search' not in cache:
+            cache['feeder_search'] = spt.search(graph, session['co']['locations'], session['weights'])
+
+        tree = spt.build_tree(graph, session['co']['locations'], locations_in, session['weights'],
+                              cache['feeder_search'])
+        return spt.tree_lengths(graph, tree)
+
+    import ShortestPathRouting as spr
+
+    co = session['co']
+    routes = spr.assign_co(graph, co['locations'], locations_in, session['weights'],
+                           spr.read_capacity(session['co_in'], co['ids'], co_capacity))
+    pieces = [route[2] for route in routes]
+    fiber = float(sum(ng.pieces_length(route) for route in pieces))
+    duct = ng.pieces_duct_length(pieces)
+    if not ff_protection:
+        return fiber, duct
+
+    pieces_p = [route[2] for route in spr.protection_pieces(graph, routes, co['locations'], locations_in,
+                                                            session['weights'], sp_protection)]
+    return (fiber, duct, float(sum(ng.pieces_length(route) for route in pieces_p)),
+            ng.pieces_duct_length(pieces + pieces_p) - duct)
+
+
+def feeder_result(planning_result, lengths_in, keys_in):
+    """
+    This function adds the lengths of the feeder to the planning result, the protection keys only with the protection.
+
+    :param planning_result: planning result, dict
+    :param lengths_in: lengths, see feeder
+    :param keys_in: keys of the fiber, the duct, the protection fiber and the additional duct
+    :return:
+    """
+    for key, length in zip(keys_in, lengths_in):
+        planning_result[key] = length
+    return
+
+
+def plan_p2p(session, ff_protection=False, sp_protection=True, co_capacity='#'):
+    """
+    :return: planning result with the same keys as p2p
+    """
+    planning_result = {}
+    feeder_result(planning_result, feeder(session, session['demands']['locations'], ff_protection, sp_protection,
+                                          co_capacity), ['fiber', 'duct', 'fiber_p', 'duct_add_p'])
+    planning_result['equipment'] = cm.equipment_counts([('olt_port', len(session['demands']['locations']))])
+    return planning_result
+
+
+def plan_fttb(session, sr_fttb, ff_protection=False, sp_protection=True, co_capacity='#'):
+    """
+    :return: planning result with the same keys as FiberLayout
+    """
+    lmf = cluster_stage(session, 'demands', session['demands'], sr_fttb)
+
+    planning_result = {'lmf': lmf['fiber'], 'lm_d': lmf['duct']}
+    feeder_result(planning_result, feeder(session, lmf['heads']['locations'], ff_protection, sp_protection,
+                                          co_capacity), FEEDER_KEYS)
+
+    n_rn = len(lmf['clusters'])
+    planning_result['equipment'] = cm.equipment_counts([(cm.splitter(sr_fttb), n_rn), ('olt_port', n_rn)])
+    return planning_result
+
+
+def plan_fttcab(session, sr_fttcab_rn, sr_fttcab_b_dsl, dsl_reach, ff_protection=False, sp_protection=True,
+                co_capacity='#'):
+    """
+    :return: planning result with the same keys as fttcab, the copper is always routed
+    """
+    copper = cluster_stage(session, 'demands', session['demands'], sr_fttcab_b_dsl, float(dsl_reach), 'cabinets')
+    df = cluster_stage(session, ('cabinets', sr_fttcab_b_dsl, float(dsl_reach)), copper['heads'], sr_fttcab_rn)
+
+    planning_result = {'copper': copper['fiber'], 'copper_d': copper['duct'], 'df': df['fiber'], 'd_d': df['duct']}
+    feeder_result(planning_result, feeder(session, df['heads']['locations'], ff_protection, sp_protection,
+                                          co_capacity), FEEDER_KEYS)
+
+    n_cab = len(copper['clusters'])
+    n_rn = len(df['clusters'])
+    planning_result['equipment'] = cm.equipment_counts([('cabinet', n_cab), ('dslam', n_cab),
+                                                        (cm.splitter(sr_fttcab_rn), n_rn), ('olt_port', n_rn)])
+    return planning_result
+
+
+def plan_hpon(session, sr_rn1, sr_rn2, ff_protection=False, sp_protection=True, co_capacity='#'):
+    """
+    :return: planning result with the same keys as 2stage_ngpon
+    """
+    lmf = cluster_stage(session, 'demands', session['demands'], sr_rn2)
+    df = cluster_stage(session, ('rn2', sr_rn2), lmf['heads'], sr_rn1)
+
+    planning_result = {'lmf': lmf['fiber'], 'lm_d': lmf['duct'], 'df': df['fiber'], 'd_d': df['duct']}
+    feeder_result(planning_result, feeder(session, df['heads']['locations'], ff_protection, sp_protection,
+                                          co_capacity), FEEDER_KEYS)
+
+    n_rn2 = len(lmf['clusters'])
+    n_rn1 = len(df['clusters'])
+    planning_result['equipment'] = cm.equipment_counts([(cm.splitter(sr_rn2), n_rn2), (cm.splitter(sr_rn1), n_rn1),
+                                                        ('olt_port', n_rn1)])
+    return planning_result
+
+
+def compare(session, sr_fttb=32, sr_fttcab_rn=32, sr_fttcab_b_dsl=8, dsl_reach=1000, sr_rn1=4, sr_rn2=8,
+            ff_protection=False, sp_protection=True, co_capacity='#'):
+    """
+    This function plans all four topologies in the session.
+
+    :return: list of the rows, dicts with the topology name and its planning result
+    """
+    feeder_options = {'ff_protection': ff_protection, 'sp_protection': sp_protection, 'co_capacity': co_capacity}
+    results = [('p2p', plan_p2p(session, **feeder_options)),
+               ('fttb', plan_fttb(session, sr_fttb, **feeder_options)),
+               ('fttcab', plan_fttcab(session, sr_fttcab_rn, sr_fttcab_b_dsl, dsl_reach, **feeder_options)),
+               ('hpon', plan_hpon(session, sr_rn1, sr_rn2, **feeder_options))]
+
+    table = []
+    for name, planning_result in results:
+        row = {'topology': name}
+        row.update(planning_result)
+        table.append(row)
+    return table
+
+
+def write_table(table, path_in):
+    """
+    This function writes the comparison table, one topology per row, the missing values are empty.
+
+    :param table: list of the rows, see compare
+    :param path_in: csv file
+    :return:
+    """
+    equipment = []
+    for row in table:
+        equipment.extend(item for item in row.get('equipment', {}) if item not in equipment)
+
+    with open(path_in, 'w') as f_p:
+        writer = csv.writer(f_p, lineterminator='\n')
+        writer.writerow(['topology'] + TABLE_KEYS + equipment)
+        for row in table:
+            writer.writerow([row['topology']] + [row.get(key, '') for key in TABLE_KEYS] +
+                            [row.get('equipment', {}).get(item, '') for item in equipment])
+    return
+
+
+def main(network_nd, demands, intersections, co, output_dir, output_name, sr_fttb=32, sr_fttcab_rn=32,
+         sr_fttcab_b_dsl=8, dsl_reach=1000, sr_rn1=4, sr_rn2=8, brownfield_duct='#', clustering='cpm',
+         routing='shortest', hierarchy=False, od_dir='#', lines='#', ff_protection=False, sp_protection=True,
+         co_capacity='#'):
+    """
+    This function compares the four topologies on the same area in one session. The stages are planned on the
+    in-memory graph: the clustering is the CPM of GraphClustering with the flow assignment of the mains and the routes
+    are the shortest paths, the feeder protection is searched as in ShortestPathRouting.route_fiber_graph. The session
+    does not support the location-allocation clustering, the local search and the duct sharing of the mains, for them
+    the topologies have to be planned one by one with their mains. The copper of FTTCab is always routed.
+
+    :return: comparison table, list of dicts
+    """
+    import arcpy
+
+    session = open_session(network_nd, demands, intersections, co, brownfield_duct=brownfield_duct,
+                           clustering=clustering, routing=routing, hierarchy=hierarchy, od_dir=od_dir, lines=lines)
+    table = compare(session, sr_fttb, sr_fttcab_rn, sr_fttcab_b_dsl, dsl_reach, sr_rn1, sr_rn2, ff_protection,
+                    sp_protection, co_capacity)
+
+    write_table(table, os.path.join(output_dir, '{0}_comparison.csv'.format(output_name)))
+    with open(os.path.join(output_dir, '{0}_comparison.txt'.format(output_name)), 'w') as f_p:
+        json.dump(table, f_p)
+
+    arcpy.AddMessage(table)
+
+    return table
+
+
+if __name__ == '__main__':
+    import arcpy
+
+    network_nd_in = arcpy.GetParameterAsText(0)
+    demands_in = arcpy.GetParameterAsText(1)
+    intersections_in = arcpy.GetParameterAsText(2)
+    co_in = arcpy.GetParameterAsText(3)
+
+    output_dir_in = arcpy.GetParameterAsText(4)
+    output_name_in = arcpy.GetParameterAsText(5)
+
+    sr_fttb_in = int(arcpy.GetParameterAsText(6))
+    sr_fttcab_rn_in = int(arcpy.GetParameterAsText(7))
+    sr_fttcab_b_dsl_in = int(arcpy.GetParameterAsText(8))
+    dsl_reach_in = int(arcpy.GetParameterAsText(9))
+    sr_rn1_in = int(arcpy.GetParameterAsText(10))
+    sr_rn2_in = int(arcpy.GetParameterAsText(11))
+
+    brownfield_duct_in = arcpy.GetParameterAsText(12)
+    if not brownfield_duct_in:
+        brownfield_duct_in = '#'
+
+    lines_in = arcpy.GetParameterAsText(13) or '#'
+    ff_protection_in = bool(arcpy.GetParameterAsText(14))
+    sp_protection_in = bool(arcpy.GetParameterAsText(15))
+    co_capacity_in = arcpy.GetParameterAsText(16) or '#'
+
+    main(network_nd_in, demands_in, intersections_in, co_in, output_dir_in, output_name_in, sr_fttb_in,
+         sr_fttcab_rn_in, sr_fttcab_b_dsl_in, dsl_reach_in, sr_rn1_in, sr_rn2_in, brownfield_duct_in,
+         lines=lines_in, ff_protection=ff_protection_in, sp_protection=sp_protection_in, co_capacity=co_capacity_in)
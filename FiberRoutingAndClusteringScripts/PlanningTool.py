@@ -0,0 +1,454 @@
+"""
+Command line entry point of the planning tool, one subcommand per topology and per helper tool, e.g.,
+
+    python PlanningTool.py fttb streets_ND demands intersections co C:\\out C:\\out\\x.gdb\\fds x --sr-fttb 32
+    python PlanningTool.py fttb ... --dry-run
+
+The geoprocessing backend (arcpy) and the planning modules are imported only when a command that needs them is run,
+so the help, the validation of the arguments and the dry runs do not load them.
+"""
+import os
+import sys
+import json
+import argparse
+import importlib
+
+# Defaults of the subparsers that are not the arguments of the called function
+META = ['command', 'dry_run', 'module', 'function', 'backend', 'inputs', 'prepare']
+
+# Extensions of the workspaces, whose contents are not files
+WORKSPACES = ('.gdb', '.sde', '.mdb')
+
+
+def optional(type_in):
+    """
+    The optional inputs of the mains are '#' if not specified.
+    """
+    def convert(value):
+        if value in ('#', ''):
+            return '#'
+        return type_in(value)
+    convert.__name__ = type_in.__name__
+    return convert
+
+
+def positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError('{0} is not a positive integer'.format(value))
+    return number
+
+
+def positive_float(value):
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError('{0} is not a positive number'.format(value))
+    return number
+
+
+def capacity(value):
+    """
+    :return: the number of the ports or the name of the field of the COs
+    """
+    return int(value) if value.isdigit() else value
+
+
+def input_exists(path_in):
+    """
+    The feature classes and the network datasets inside a geodatabase are not files, for them the geodatabase has to
+    exist.
+    """
+    if os.path.exists(path_in):
+        return True
+
+    parent = os.path.dirname(path_in)
+    while parent and parent != os.path.dirname(parent):
+        if os.path.exists(parent):
+            return parent.lower().endswith(WORKSPACES)
+        parent = os.path.dirname(parent)
+    return False
+
+
+def check_inputs(args):
+    """
+    :return: list of the error messages, empty if all the inputs exist
+    """
+    errors = []
+    for name in args.inputs:
+        values = getattr(args, name)
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            if value in ('#', None) or isinstance(value, bool):
+                continue
+            if not input_exists(value):
+                errors.append('{0}: {1} does not exist'.format(name, value))
+    return errors
+
+
+def add_command(subparsers, name_in, module_in, help_in, inputs_in, function_in='main', backend=True, prepare=None):
+    parser = subparsers.add_parser(name_in, help=help_in, description=help_in)
+    parser.set_defaults(module=module_in, function=function_in, backend=backend, inputs=inputs_in, prepare=prepare)
+    parser.add_argument('--dry-run', action='store_true',
+                        help='validate the arguments and print the call without running it')
+    return parser
+
+
+def add_outputs(parser, fds=True):
+    parser.add_argument('output_dir', help='directory of the planning results')
+    if fds:
+        parser.add_argument('output_fds', help='feature dataset of the output feature classes')
+    parser.add_argument('output_name', help='name of the run')
+    return
+
+
+def add_protection(parser):
+    parser.add_argument('--ff-protection', action='store_true', help='protect the feeder fiber')
+    parser.add_argument('--sp-protection', action='store_true', help='protection path disjoint from the working one')
+    return
+
+
+def add_run_options(parser, pro=True, duct_index=True, duct_sharing=True):
+    if pro:
+        parser.add_argument('--pro', action='store_true', help='running in ArcGIS Pro')
+    parser.add_argument('--brownfield-duct', type=optional(str), default='#',
+                        help='existing ducts, a line feature class or a snapped index')
+    if duct_index:
+        parser.add_argument('--save-duct-index', action='store_true',
+                            help='snap the total duct for the next scenarios')
+    if duct_sharing:
+        parser.add_argument('--duct-sharing', type=optional(positive_float), default='#',
+                            help='factor of the weight of the streets already carrying fiber, e.g., 0.5')
+    parser.add_argument('--co-capacity', type=optional(capacity), default='#',
+                        help='ports of every CO, a number or the name of the field of the COs')
+    parser.add_argument('--result-store', type=optional(str), default='#',
+                        help='.sqlite file the run is appended to')
+    return
+
+
+def add_clustering_options(parser, allocation=True):
+    if allocation:
+        parser.add_argument('--clustering-allocation', action='store_true',
+                            help='cluster with the location-allocation instead of CPM')
+        parser.add_argument('--od-dir', type=optional(str), default='#',
+                            help='directory of the CPM distance matrix computed from the graph in the chunks, on disk')
+    parser.add_argument('--save-lmf-df', action='store_true', help='keep the routes of the last mile and distribution')
+    parser.add_argument('--save-clusters', action='store_true', help='keep the clusters')
+    parser.add_argument('--local-search', type=optional(positive_float), default='#',
+                        help='seconds of the local search improving every clustering stage')
+    parser.add_argument('--steiner', action='store_true',
+                        help='connect every cluster with the Steiner tree of the streets, less trench')
+    return
+
+
+def prepare_benchmark(module_in, kwargs):
+    import NetworkGraph as ng
+    kwargs['graph'] = ng.get_graph(kwargs.pop('network_nd'), kwargs.pop('cache_dir'))
+    return kwargs
+
+
+def prepare_hierarchy(module_in, kwargs):
+    import NetworkGraph as ng
+    network_nd = kwargs.pop('network_nd')
+    cache_dir = kwargs.pop('cache_dir')
+    kwargs['graph'] = ng.get_graph(network_nd, cache_dir)
+    kwargs['path_in'] = module_in.hierarchy_path(network_nd, cache_dir)
+    return kwargs
+
+
+def prepare_od(module_in, kwargs):
+    import NetworkGraph as ng
+    import ContractionHierarchy as ch
+    network_nd = kwargs.pop('network_nd')
+    cache_dir = kwargs.pop('cache_dir')
+    kwargs['graph'] = ng.get_graph(network_nd, cache_dir)
+    ch.get_hierarchy(kwargs['graph'], ch.hierarchy_path(network_nd, cache_dir))
+    kwargs['budget'] = kwargs.pop('budget_mb') * 2 ** 20
+    return kwargs
+
+
+def prepare_serve(module_in, kwargs):
+    kwargs['address_in'] = kwargs.pop('address')
+    return kwargs
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='PlanningTool', description='Fixed access network planning')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    # Topologies
+    p = add_command(subparsers, 'p2p', 'p2p', 'Point-to-point fiber to every demand',
+                    ['network_nd', 'demands', 'co', 'output_dir', 'brownfield_duct'])
+    p.add_argument('network_nd')
+    p.add_argument('demands')
+    p.add_argument('co')
+    add_outputs(p)
+    add_protection(p)
+    add_run_options(p)
+    p.add_argument('--compact-tree', action='store_true', help='keep the feeder as one shortest path tree')
+
+    p = add_command(subparsers, 'fttb', 'FiberLayout', 'Fiber to the building',
+                    ['network_nd', 'demands', 'intersections', 'co', 'output_dir', 'brownfield_duct'])
+    p.add_argument('network_nd')
+    p.add_argument('demands')
+    p.add_argument('intersections')
+    p.add_argument('co')
+    add_outputs(p)
+    p.add_argument('--sr-fttb', type=positive_int, default=32, help='splitting ratio')
+    add_protection(p)
+    add_clustering_options(p)
+    add_run_options(p)
+
+    p = add_command(subparsers, 'fttcab', 'fttcab', 'Fiber to the cabinet with the copper last mile',
+                    ['network_nd', 'demands', 'intersections', 'co', 'output_dir', 'lines', 'brownfield_duct'])
+    p.add_argument('network_nd')
+    p.add_argument('demands')
+    p.add_argument('intersections')
+    p.add_argument('co')
+    add_outputs(p)
+    p.add_argument('--lines', type=optional(str), default='#',
+                   help='streets, their midpoints are the additional cabinet candidates')
+    p.add_argument('--sr-fttcab-rn', type=positive_int, default=32, help='splitting ratio of the remote nodes')
+    p.add_argument('--sr-fttcab-b-dsl', type=positive_int, default=8, help='demands per DSLAM')
+    p.add_argument('--dsl-reach', type=positive_float, default=1000, help='maximum copper length, meters')
+    p.add_argument('--copper-routes', action='store_true', help='route the copper')
+    add_protection(p)
+    add_clustering_options(p, allocation=False)
+    add_run_options(p)
+
+    p = add_command(subparsers, 'hpon', '2stage_ngpon', 'Two-stage NG-PON',
+                    ['network_nd', 'buildings', 'intersections', 'co', 'output_dir', 'bs', 'sc', 'brownfield_duct'])
+    p.add_argument('network_nd')
+    p.add_argument('buildings')
+    p.add_argument('intersections')
+    p.add_argument('co')
+    add_outputs(p)
+    p.add_argument('--sr-rn1', type=positive_int, default=4, help='splitting ratio of the first stage')
+    p.add_argument('--sr-rn2', type=positive_int, default=8, help='splitting ratio of the second stage')
+    p.add_argument('--joint-planning', action='store_true', help='plan the base stations and small cells as well')
+    p.add_argument('--bs', type=optional(str), default='#', help='base stations')
+    p.add_argument('--sc', type=optional(str), default='#', help='small cells')
+    p.add_argument('--sc-wdm', action='store_true', default=False, help='small cells over WDM')
+    add_protection(p)
+    add_clustering_options(p)
+    add_run_options(p, pro=False)
+
+    p = add_command(subparsers, 'tiled', 'TiledPlanning', 'Tiled planning of large service areas',
+                    ['network_nd', 'demands', 'intersections', 'co', 'output_dir', 'lines', 'brownfield_duct'])
+    p.add_argument('network_nd')
+    p.add_argument('topology', choices=['fttb', 'fttcab', 'hpon'])
+    p.add_argument('demands')
+    p.add_argument('intersections')
+    p.add_argument('co')
+    add_outputs(p)
+    p.add_argument('--tile-size', type=positive_float, default=2000, help='side of the tile core, meters')
+    p.add_argument('--halo', type=float, default=500, help='width of the halo, meters')
+    p.add_argument('--n-workers', type=positive_int, default=4)
+    p.add_argument('--clustering-allocation', action='store_true',
+                   help='cluster with the location-allocation instead of CPM')
+    p.add_argument('--sr', type=positive_int, default=32, help='splitting ratio of the remote nodes')
+    p.add_argument('--sr-rn2', type=positive_int, default=8, help='splitting ratio of the second stage (hpon)')
+    p.add_argument('--sr-dsl', type=positive_int, default=8, help='demands per DSLAM (fttcab)')
+    p.add_argument('--dsl-reach', type=positive_float, default=1000, help='maximum copper length, meters (fttcab)')
+    p.add_argument('--lines', type=optional(str), default='#')
+    p.add_argument('--local-search', type=optional(positive_float), default='#',
+                   help='seconds of the local search improving every clustering stage of every tile')
+    p.add_argument('--steiner', action='store_true',
+                   help='connect every cluster with the Steiner tree of the streets, less trench')
+    add_protection(p)
+    add_run_options(p, duct_index=False)
+
+    p = add_command(subparsers, 'incremental', 'IncrementalPlanning',
+                    'Update a plan with the added and removed demands',
+                    ['network_nd', 'demands_added', 'demands_removed', 'output_dir', 'co', 'intersections',
+                     'brownfield_duct'])
+    p.add_argument('network_nd')
+    p.add_argument('demands_added', type=optional(str), help="added demands or '#'")
+    p.add_argument('demands_removed', type=optional(str), help="removed demands or '#'")
+    add_outputs(p)
+    p.add_argument('--cutoff', type=optional(positive_float), default='#',
+                   help='maximum distance to an existing head, meters')
+    p.add_argument('--stages', nargs=4, action='append', metavar=('STAGE', 'CLUSTERS', 'N', 'SR'),
+                   help='only for the first update: stage (LMF, DF, FF), clusters, number of clusters, splitting ratio')
+    p.add_argument('--co', type=optional(str), default='#', help='only for the first update')
+    p.add_argument('--intersections', type=optional(str), default='#', help='only for the first update')
+    p.add_argument('--topology', choices=['fttb', 'fttcab', 'hpon'], default='fttb',
+                   help='only for the first update, the equipment of the stages')
+    p.add_argument('--brownfield-duct', type=optional(str), default='#',
+                   help='existing ducts, a line feature class or a snapped index')
+    p.add_argument('--result-store', type=optional(str), default='#', help='.sqlite file the run is appended to')
+
+    p = add_command(subparsers, 'compare', 'PlanningSession', 'Compare all the topologies in one session',
+                    ['network_nd', 'demands', 'intersections', 'co', 'output_dir', 'lines', 'brownfield_duct'])
+    p.add_argument('network_nd')
+    p.add_argument('demands')
+    p.add_argument('intersections')
+    p.add_argument('co')
+    add_outputs(p, fds=False)
+    p.add_argument('--sr-fttb', type=positive_int, default=32)
+    p.add_argument('--sr-fttcab-rn', type=positive_int, default=32)
+    p.add_argument('--sr-fttcab-b-dsl', type=positive_int, default=8)
+    p.add_argument('--dsl-reach', type=positive_float, default=1000)
+    p.add_argument('--sr-rn1', type=positive_int, default=4)
+    p.add_argument('--sr-rn2', type=positive_int, default=8)
+    p.add_argument('--brownfield-duct', type=optional(str), default='#')
+    p.add_argument('--clustering', choices=['cpm', 'kmeans'], default='cpm',
+                   help='kmeans: balanced k-means refined with the network distances')
+    p.add_argument('--routing', choices=['shortest', 'steiner'], default='shortest',
+                   help='steiner: connect every cluster with the Steiner tree of the streets')
+    p.add_argument('--hierarchy', action='store_true',
+                   help='answer the distance matrices from the contraction hierarchy of the network')
+    p.add_argument('--od-dir', type=optional(str), default='#',
+                   help='directory of the CPM distance matrices, kept on disk instead of the nearest neighbours')
+    p.add_argument('--lines', type=optional(str), default='#',
+                   help='streets, their midpoints are the additional cabinet candidates')
+    add_protection(p)
+    p.add_argument('--co-capacity', type=optional(capacity), default='#',
+                   help='ports of every CO, a number or the name of the field of the COs')
+
+    # Input preparation
+    p = add_command(subparsers, 'area-cut', 'AreaCut', 'Cut a square area out of the streets',
+                    ['streets_full', 'buildings'])
+    p.add_argument('streets_full')
+    p.add_argument('area', type=int, choices=[1, 4, 9, 16, 25, 36, 100], help='square kilometers')
+    p.add_argument('output_fds')
+    p.add_argument('output_name')
+    p.add_argument('--buildings', default=False, help='buildings to clip with the area')
+    p.add_argument('--fast', action='store_true', help='cut the arrays instead of the geoprocessing')
+
+    p = add_command(subparsers, 'regular-placement', 'RegularDemandsPlacement',
+                    'Place the demands regularly along the streets', ['area', 'streets'])
+    p.add_argument('area')
+    p.add_argument('streets')
+    p.add_argument('d', type=positive_int, help='distance between the demands, meters')
+    p.add_argument('output_fds')
+    p.add_argument('output_name')
+    p.add_argument('--vectorized', action='store_true')
+    p.add_argument('--lattice', choices=['square', 'hexagonal'], default='square')
+    p.add_argument('--spatial-ref-proj', type=optional(str), default='#', help='deprecated, ignored')
+
+    p = add_command(subparsers, 'brownfield-index', 'BrownfieldIndex', 'Snap the existing ducts to the network',
+                    ['network_nd', 'duct_in', 'output_dir'])
+    p.add_argument('network_nd')
+    p.add_argument('duct_in')
+    p.add_argument('output_dir')
+    p.add_argument('name_in')
+    p.add_argument('--discount', dest='discount_in', type=positive_float, default=0.001)
+    p.add_argument('--tolerance', dest='tolerance_in', type=positive_float, default=5.0)
+
+    # Evaluation and the other tools, they do not need the geoprocessing backend unless noted
+    p = add_command(subparsers, 'costs', 'CostModel', 'Evaluate the saved results for the price scenarios',
+                    ['results_in', 'prices_in'], backend=False)
+    p.add_argument('prices_in', help='csv file with the price scenarios')
+    p.add_argument('output_in', help='csv file with the costs')
+    p.add_argument('results_in', nargs='+', help='.txt files of the planning results')
+
+    p = add_command(subparsers, 'store', 'ResultStore', 'Aggregate a metric over the stored runs',
+                    ['path_in'], function_in='aggregate', backend=False)
+    p.add_argument('path_in', help='.sqlite file')
+    p.add_argument('metric_in', help="metric, e.g., 'ff'")
+    p.add_argument('--group-by', nargs='*', default=None)
+    p.add_argument('--function', dest='function_in', choices=['count', 'sum', 'avg', 'min', 'max'], default='avg')
+    p.add_argument('--where', dest='where_in', nargs='*', default=None, metavar='COLUMN=VALUE')
+
+    p = add_command(subparsers, 'benchmark', 'Landmarks',
+                    'Landmark and bidirectional A* point-to-point queries against Dijkstra',
+                    ['network_nd', 'cache_dir'], function_in='benchmark', prepare=prepare_benchmark)
+    p.add_argument('network_nd')
+    p.add_argument('--n-queries', type=positive_int, default=100)
+    p.add_argument('--n-landmarks', type=positive_int, default=16)
+    p.add_argument('--cache-dir', type=optional(str), default='#', help='directory of the graph .npz files')
+
+    p = add_command(subparsers, 'ch-benchmark', 'ContractionHierarchy',
+                    'Contraction hierarchy distance matrix against Dijkstra', ['network_nd', 'cache_dir'],
+                    function_in='benchmark', prepare=prepare_hierarchy)
+    p.add_argument('network_nd')
+    p.add_argument('--n-sources', type=positive_int, default=1000)
+    p.add_argument('--n-targets', type=positive_int, default=1000)
+    p.add_argument('--cache-dir', type=optional(str), default='#', help='directory of the graph and hierarchy files')
+
+    p = add_command(subparsers, 'od-benchmark', 'ODMatrix',
+                    'OD matrix in the chunks on disk against the in-memory nearest neighbours',
+                    ['network_nd', 'cache_dir'], function_in='benchmark', prepare=prepare_od)
+    p.add_argument('network_nd')
+    p.add_argument('--n-locations', type=positive_int, default=2000)
+    p.add_argument('--n-workers', type=positive_int, default=4)
+    p.add_argument('--budget-mb', type=positive_int, default=256, help='bound of the working memory of the chunks')
+    p.add_argument('--cache-dir', type=optional(str), default='#', help='directory of the graph and hierarchy files')
+
+    p = add_command(subparsers, 'serve', 'JobServer', 'Run the job server with the warm workers', [],
+                    function_in='serve', backend=False, prepare=prepare_serve)
+    p.add_argument('address', nargs='?', default='localhost:8642', help="'host:port' or the path of the Unix socket")
+    p.add_argument('--n-workers', type=positive_int, default=4)
+
+    return parser
+
+
+def parse_value(value):
+    for type_in in (int, float):
+        try:
+            return type_in(value)
+        except ValueError:
+            pass
+    return value
+
+
+def call_arguments(args):
+    """
+    :return: dict of the arguments of the called function
+    """
+    kwargs = dict((name, value) for name, value in vars(args).items() if name not in META and value is not None)
+
+    if 'stages' in kwargs:
+        kwargs['stages'] = [(stage, name, int(n), int(sr)) for stage, name, n, sr in kwargs['stages']]
+    if 'where_in' in kwargs:
+        kwargs['where_in'] = dict((pair.split('=', 1)[0], parse_value(pair.split('=', 1)[1]))
+                                  for pair in kwargs['where_in'])
+    return kwargs
+
+
+def to_json(value):
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    errors = check_inputs(args)
+    if getattr(args, 'stages', None):
+        errors.extend('stages: {0} is not a number'.format(value) for stage in args.stages for value in stage[2:]
+                      if not value.isdigit())
+    if getattr(args, 'where_in', None):
+        errors.extend('where: {0} is not COLUMN=VALUE'.format(pair) for pair in args.where_in if '=' not in pair)
+    if errors:
+        parser.error('; '.join(errors))
+
+    kwargs = call_arguments(args)
+    if args.dry_run:
+        print('{0}.{1}({2})'.format(args.module, args.function,
+                                    ', '.join('{0}={1!r}'.format(name, kwargs[name]) for name in sorted(kwargs))))
+        return None
+
+    if args.backend:
+        try:
+            import arcpy
+        except ImportError:
+            parser.exit(1, 'The command {0} needs the geoprocessing backend, arcpy can not be imported\n'.format(
+                args.command))
+
+    module = importlib.import_module(args.module)
+    if args.prepare is not None:
+        kwargs = args.prepare(module, kwargs)
+
+    result = getattr(module, args.function)(**kwargs)
+    if result is not None:
+        print(json.dumps(result, default=to_json))
+    return result
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,6 +1,11 @@
 import arcpy
 import os
 import sys
+import math
+
+import numpy as np
+
+import CoordinateTransform as ct
 
 
 def check_exists(name_in):
@@ -18,67 +23,199 @@ def check_exists(name_in):
 
 def regular_nodes_placement(area_in, distance_in, spatial_reference_in, name_in, output_gdb_in, output_fds_in):
     """
-    This function places the nodes regularly with the specified distance in meters. The input spatial reference shall be 
-    the corresponding meters projection to the general (in degrees). The output direction shall be either a database 
-    (.gdb) or a feature dataset with the same spatial reference. If the spatial reference is different, the resulting 
-    projection will be saved with the same spatial reference as the feature dataset and with no error. This will cause 
-    an empty points feature class.
+    This function places the nodes regularly with the specified distance in meters, the nodes are the label points of
+    the fishnet over the area. The area is projected in memory, so no projected copy of it and of the fishnet is saved,
+    see regular_nodes_placement_array.
 
-    :param area_in:                 area (cut), where the points will be generated 
+    :param area_in:                 area (cut), where the points will be generated
     :param distance_in:             distances between the generated points, meters
-    :param spatial_reference_in:    spatial reference -> projection coordinate system with meters
-    :param output_dir_in:           path to the storing location, either a .gdb or a feature dataset with the 
-                                    same projected spatial reference 
-    :param name_in:                 name to save the regular nodes as they have to be pushed to different streets for 
-                                    each generated topology              
+    :param spatial_reference_in:    deprecated and ignored, the area is projected to the UTM zone of its center
+    :param name_in:                 name to save the regular nodes as they have to be pushed to different streets for
+                                    each generated topology
+    :param output_gdb_in:           deprecated and ignored, nothing is saved to the gdb outside the feature dataset
+    :param output_fds_in:           path to the storing location
     :return:  path to the generated points
     """
+    return regular_nodes_placement_array(area_in, distance_in, name_in, output_fds_in)[0]
+
+
+def lattice_points(x_min, y_min, x_max, y_max, distance_in, lattice='square'):
+    """
+    This function generates the regular lattice of points over the extent. The square lattice has the same points as
+    the label points of the fishnet (the centers of the cells), the hexagonal lattice has the rows shifted by the half
+    of the distance in every second row, so all the neighbours are at the same distance.
+
+    :param x_min, y_min, x_max, y_max: extent in the projected coordinates, meters
+    :param distance_in: distance between the neighbouring points, meters
+    :param lattice: 'square' or 'hexagonal'
+    :return: coordinates, array (n, 2)
+    """
+    distance_in = float(distance_in)
+
+    if lattice == 'square':
+        dy = distance_in
+    elif lattice == 'hexagonal':
+        dy = distance_in * math.sqrt(3.0) / 2.0
+    else:
+        raise ValueError('Unknown lattice {0}'.format(lattice))
+
+    xs = x_min + distance_in / 2.0 + distance_in * np.arange(max(int(math.ceil((x_max - x_min) / distance_in)), 1))
+    ys = y_min + dy / 2.0 + dy * np.arange(max(int(math.ceil((y_max - y_min) / dy)), 1))
+
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    if lattice == 'hexagonal':
+        grid_x[1::2] += distance_in / 2.0
+
+    return np.column_stack([grid_x.ravel(), grid_y.ravel()])
 
-    arcpy.overwriteOutput = 1
-    # Project the polygon to projection with meters
-    area_proj_path = os.path.join(output_gdb_in, 'area_proj')
-    check_exists(area_proj_path)
-
-    # Project_management (in_dataset, out_dataset, out_coor_system, {transform_method}, {in_coor_system},
-    # {preserve_shape}, {max_deviation})
-    arcpy.Project_management(area_in, area_proj_path, spatial_reference_in)
-
-    # Create fishnet with label points (label points are the MBSs)
-    out_feature_class = os.path.join('in_memory', 'points')
-    tmp = arcpy.Describe(area_proj_path)
-    template = tmp.extent
-    origin = '{0} {1}'.format(str(template.XMin), str(template.YMin))
-    y_axis = '{0} {1}'.format(str(template.XMin), str(template.YMax))
-
-    # CreateFishnet_management(out_feature_class, origin_coord, y_axis_coord, cell_width, cell_height, number_rows,
-    # number_columns, {corner_coord}, {labels}, {template}, {geometry_type})
-    points = arcpy.CreateFishnet_management(out_feature_class=out_feature_class,
-                                            origin_coord=origin, y_axis_coord=y_axis,
-                                            cell_width=distance_in, cell_height=distance_in,
-                                            template=template)
-
-    # Clip the label points with the area polygon, in this way only relevant MBSs stay (that are within the area of
-    # interest
-    # Clip_management (in_raster, rectangle, out_raster, {in_template_dataset}, {nodata_value}, {clipping_geometry},
-    # {maintain_clipping_extent})
-    points_clip = os.path.join('in_memory', 'points_clip')
-    arcpy.Clip_analysis(points[1], area_proj_path, points_clip)
-
-    # Project the generated points back to the original coordinate system
-    # Get the original spatial reference
-    descript = arcpy.Describe(area_in)
-    spatial_ref_orig = descript.spatialReference
 
-    # Project
-    points_proj = os.path.join(output_fds_in, '{0}_regular{1}m'.format(name_in, str(distance_in)))
-    check_exists(points_proj)
+def points_in_polygon(xy_in, rings_in):
+    """
+    Vectorized even-odd point in polygon test. The holes and the multipart polygons are handled by the same rule, as
+    every ring edge that is crossed switches the inside flag.
+
+    :param xy_in: coordinates, array (n, 2)
+    :param rings_in: list of the rings, every ring is an array (m, 2)
+    :return: flags, boolean array (n)
+    """
+    x = xy_in[:, 0]
+    y = xy_in[:, 1]
+    inside = np.zeros(len(xy_in), dtype=bool)
+
+    for ring in rings_in:
+        ring = np.asarray(ring, dtype=np.float64)
+        x1, y1 = ring[:, 0], ring[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+
+        for k in range(len(ring)):
+            if y1[k] == y2[k]:
+                continue
+            crossing = (y1[k] > y) != (y2[k] > y)
+            x_cross = x1[k] + (y - y1[k]) * (x2[k] - x1[k]) / (y2[k] - y1[k])
+            inside ^= crossing & (x < x_cross)
+
+    return inside
+
 
-    arcpy.Project_management(points_clip, points_proj, spatial_ref_orig)
+def read_rings(area_in, spatial_reference_in=None):
+    """
+    This function reads the rings of the area polygons.
+
+    :param area_in: area, polygon feature class
+    :param spatial_reference_in: spatial reference of the coordinates, the one of the area if None
+    :return: list of the rings, every ring is an array (m, 2)
+    """
+    rings = []
+    with arcpy.da.SearchCursor(area_in, 'SHAPE@', spatial_reference=spatial_reference_in) as cursor:
+        for row in cursor:
+            if row[0] is None:
+                continue
+            for part in row[0]:
+                ring = []
+                # The interior rings are separated by the empty points
+                for point in part:
+                    if point is None:
+                        if len(ring) > 2:
+                            rings.append(np.asarray(ring))
+                        ring = []
+                    else:
+                        ring.append((point.X, point.Y))
+                if len(ring) > 2:
+                    rings.append(np.asarray(ring))
+
+    return rings
+
+
+def write_points(xy_in, spatial_reference_xy, spatial_reference_out, output_fds_in, name_in):
+    """
+    This function saves the points to a new feature class. The points are given in the projected coordinates and are
+    projected to the output spatial reference by the insert cursor.
+
+    :return: path to the feature class
+    """
+    out_path = os.path.join(output_fds_in, name_in)
+    check_exists(out_path)
+    arcpy.CreateFeatureclass_management(output_fds_in, name_in, 'POINT', spatial_reference=spatial_reference_out)
 
-    # Delete the area projection
-    arcpy.management.Delete(area_proj_path)
+    with arcpy.da.InsertCursor(out_path, 'SHAPE@') as cursor:
+        for x, y in xy_in.tolist():
+            cursor.insertRow([arcpy.PointGeometry(arcpy.Point(x, y), spatial_reference_xy)])
 
-    return points_proj
+    return out_path
+
+
+def regular_nodes_placement_array(area_in, distances_in, name_in, output_fds_in, lattice='square'):
+    """
+    This function places the nodes regularly without any geoprocessing: the area is read once and projected in memory
+    to its UTM zone (CoordinateTransform), the lattices for all the distances are generated and clipped as arrays,
+    projected back and only the results are saved.
+
+    :param area_in:                 area (cut), where the points will be generated
+    :param distances_in:            distance or a list of distances between the generated points, meters
+    :param name_in:                 name to save the regular nodes
+    :param output_fds_in:           path to the storing location
+    :param lattice:                 'square' (as the fishnet) or 'hexagonal'
+    :return: list of paths to the generated points, one for every distance
+    """
+    if not isinstance(distances_in, (list, tuple)):
+        distances_in = [distances_in]
+
+    spatial_ref_orig = arcpy.Describe(area_in).spatialReference
+    rings = read_rings(area_in, spatial_ref_orig)
+
+    # The lattice is generated in meters, the distances of the geographic area are corrected with the scale factor of
+    # the projection at its center
+    geographic = spatial_ref_orig.type == 'Geographic'
+    if geographic:
+        vertices = np.concatenate(rings)
+        zone = ct.detect_zone(vertices)
+        scale = ct.scale_factor((vertices.min(axis=0) + vertices.max(axis=0)) / 2.0, zone)[0]
+        rings = [ct.forward(ring, zone) for ring in rings]
+    else:
+        scale = 1.0
+        rings = [ring * spatial_ref_orig.metersPerUnit for ring in rings]
+
+    vertices = np.concatenate(rings)
+    x_min, y_min = vertices.min(axis=0)
+    x_max, y_max = vertices.max(axis=0)
+
+    if lattice == 'square':
+        name_lattice = 'regular'
+    else:
+        name_lattice = lattice
+
+    points_paths = []
+    for distance in distances_in:
+        points = lattice_points(x_min, y_min, x_max, y_max, distance * scale, lattice)
+        points = points[points_in_polygon(points, rings)]
+        if geographic:
+            points = ct.inverse(points, zone)
+        else:
+            points = points / spatial_ref_orig.metersPerUnit
+
+        name_points = '{0}_{1}{2}m'.format(name_in, name_lattice, str(distance))
+        points_paths.append(write_points(points, spatial_ref_orig, spatial_ref_orig, output_fds_in, name_points))
+
+    return points_paths
+
+
+def batch_placement(areas_in, distances_in, output_fds_in, lattice='square'):
+    """
+    This function generates the regular nodes for many areas (e.g., cities) and distances. Every area is projected to
+    its own UTM zone.
+
+    :param areas_in: list of the areas, polygon feature classes
+    :param distances_in: list of the distances, meters
+    :param output_fds_in: path to the storing location
+    :param lattice: 'square' or 'hexagonal'
+    :return: dict area -> list of paths to the generated points
+    """
+    result = {}
+    for area in areas_in:
+        name = os.path.basename(area)
+        result[area] = regular_nodes_placement_array(area, distances_in, name, output_fds_in, lattice)
+
+    return result
 
 
 def push_nodes_to_streets(nodes_in, streets_in, name_nodes_in, output_gdb_in, output_fds_in):
@@ -124,29 +261,66 @@ def push_nodes_to_streets(nodes_in, streets_in, name_nodes_in, output_gdb_in, ou
     return out_result
 
 
+def push_nodes_to_streets_index(nodes_in, graph, name_nodes_in, output_fds_in):
+    """
+    This function pushes the input nodes to the closest street as push_nodes_to_streets does, but with the street
+    segment index of the graph. The index is built once per graph, so pushing many demand sets to the same streets
+    costs only the projection of the points. The pushed nodes keep their edge and the offset along the edge, so the
+    routing on the graph does not have to locate them again.
+
+    :param nodes_in:        input nodes/ points / demands
+    :param graph:           street graph (NetworkGraph), dict
+    :param name_nodes_in:   the name for the output nodes
+    :param output_fds_in:   the path, where the pushed nodes will be saved
+    :return:                the path to the result
+    """
+    import NetworkGraph as ng
+    import SegmentIndex as si
+
+    ids, xy = ng.read_points(nodes_in, graph)
+    snapped = si.snap_points(graph, xy)
+
+    spatial_ref = arcpy.SpatialReference()
+    spatial_ref.loadFromString(graph['spatial_reference'])
+
+    name_out = '{0}_pushed'.format(name_nodes_in)
+    out_result = os.path.join(output_fds_in, name_out)
+    check_exists(out_result)
+    arcpy.CreateFeatureclass_management(output_fds_in, name_out, 'POINT', spatial_reference=spatial_ref)
+
+    arcpy.AddField_management(out_result, 'IN_FID', 'LONG')
+    arcpy.AddField_management(out_result, 'EDGE_ID', 'LONG')
+    arcpy.AddField_management(out_result, 'EDGE_OID', 'LONG')
+    arcpy.AddField_management(out_result, 'EDGE_POS', 'DOUBLE')
+    arcpy.AddField_management(out_result, 'NEAR_DIST', 'DOUBLE')
+
+    fields = ['SHAPE@XY', 'IN_FID', 'EDGE_ID', 'EDGE_OID', 'EDGE_POS', 'NEAR_DIST']
+    with arcpy.da.InsertCursor(out_result, fields) as cursor:
+        for i in range(len(ids)):
+            edge = int(snapped['edge'][i])
+            if edge < 0:
+                continue
+            cursor.insertRow([tuple(snapped['xy'][i]), ids[i], edge, int(graph['edge_oid'][edge]),
+                              float(snapped['pos'][i]), float(snapped['dist'][i])])
+
+    return out_result
+
+
 def utm_proj(fc_in):
     """
-    This function calculates the projection coordinate system. 
+    This function calculates the projection coordinate system, the UTM zone of the center of the extent.
 
     :param fc_in: the feature class  to be projected, feature class
 
     :return: it returns the string that can be directly translated to a spatial reference
     """
-    # arcpy.AddMessage('Calling ' + sys._getframe().f_code.co_name)
-
     area_extent = arcpy.Describe(fc_in).extent
-    y_min = float(area_extent.YMin)
-    x_min = float(area_extent.XMin)
-
-    # https://gis.stackexchange.com/questions/224707/calculating-utm-zones-using-arcgis-pro
-    zone_tmp = str(int((x_min + 186.0) / 6)) + ('S' if (y_min < 0) else 'N')
-    print(str(int((x_min + 186.0) / 6)))
-    zone = 'WGS 1984 UTM Zone {0}'.format(zone_tmp)
+    zone = ct.detect_zone([(area_extent.XMin, area_extent.YMin), (area_extent.XMax, area_extent.YMax)])
 
-    return zone
+    return ct.zone_name(zone)
 
 
-def main(area, streets, spatial_ref_proj, d, output_fds, output_name):
+def main(area, streets, spatial_ref_proj, d, output_fds, output_name, vectorized=False, lattice='square'):
 
     # Get the gdb path
     descript = arcpy.Describe(output_fds)
@@ -155,11 +329,25 @@ def main(area, streets, spatial_ref_proj, d, output_fds, output_name):
 
     arcpy.AddMessage(output_gdb)
 
+    if spatial_ref_proj not in ('#', '', None):
+        arcpy.AddWarning('The projected spatial reference is deprecated and ignored, the area is projected to the UTM '
+                         'zone of its center')
+
     # Place the nodes
-    demands_regular_path = regular_nodes_placement(area, d, spatial_ref_proj, output_name, output_gdb, output_fds)
+    if not vectorized:
+        demands_regular_path = regular_nodes_placement(area, d, spatial_ref_proj, output_name, output_gdb, output_fds)
 
-    # Push nodes to streets
-    push_nodes_to_streets(demands_regular_path, streets, output_name, output_gdb, output_fds)
+        # Push nodes to streets
+        push_nodes_to_streets(demands_regular_path, streets, output_name, output_gdb, output_fds)
+
+    else:
+        import NetworkGraph as ng
+        graph = ng.get_graph(streets)
+
+        # All the distances in one call, the pushed nodes are named after the generated ones
+        for demands_regular_path in regular_nodes_placement_array(area, d, output_name, output_fds, lattice):
+            push_nodes_to_streets_index(demands_regular_path, graph, os.path.basename(demands_regular_path),
+                                        output_fds)
 
     return
 
@@ -167,11 +355,8 @@ if __name__ == '__main__':
     area_in = arcpy.GetParameterAsText(0)
     streets_in = arcpy.GetParameterAsText(1)
 
-    zone_m = utm_proj(area_in)
-    spatial_ref_proj_in = arcpy.SpatialReference(zone_m)
-
     d_in = int(arcpy.GetParameterAsText(2))
     output_fds_in = arcpy.GetParameterAsText(3)
     output_name_in = arcpy.GetParameterAsText(4)
 
-    main(area_in, streets_in, spatial_ref_proj_in, d_in, output_fds_in, output_name_in)
\ No newline at end of file
+    main(area_in, streets_in, '#', d_in, output_fds_in, output_name_in)
\ No newline at end of file
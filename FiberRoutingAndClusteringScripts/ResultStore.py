@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+
+# Parameters of a run, the indexed columns the runs are filtered by
+PARAM_COLUMNS = [('name', 'TEXT'), ('topology', 'TEXT'), ('sr', 'INTEGER'), ('sr_rn1', 'INTEGER'),
+                 ('sr_rn2', 'INTEGER'), ('sr_dsl', 'INTEGER'), ('dsl_reach', 'REAL'), ('ff_protection', 'INTEGER'),
+                 ('sp_protection', 'INTEGER'), ('brownfield', 'TEXT'), ('local_search', 'REAL'), ('steiner', 'INTEGER'),
+                 ('duct_sharing', 'REAL'), ('co_capacity', 'TEXT'), ('time', 'REAL')]
+
+# Keys of planning_result, meters
+METRIC_COLUMNS = ['lmf', 'lm_d', 'df', 'd_d', 'ff', 'f_d', 'ff_sp_p', 'f_d_add_p', 'fiber', 'duct', 'fiber_p',
+                  'duct_add_p', 'copper', 'copper_d', 'trench', 'trench_reused']
+
+INDEXED = ['name', 'topology', 'sr', 'sr_rn1', 'sr_rn2', 'ff_protection', 'brownfield']
+
+COLUMNS = [column for column, sql_type in PARAM_COLUMNS] + METRIC_COLUMNS + ['equipment']
+
+AGGREGATES = ['count', 'sum', 'avg', 'min', 'max']
+
+
+def open_store(path_in):
+    """
+    This function opens the store of the planning results, a single SQLite file with one row per run. The table and
+    its indexes are created on the first use, the columns added since the store was created are added to it.
+
+    :param path_in: path to the .sqlite file
+    :return: connection
+    """
+    conn = sqlite3.connect(path_in)
+
+    columns = ['{0} {1}'.format(column, sql_type) for column, sql_type in PARAM_COLUMNS]
+    columns.extend('{0} REAL'.format(column) for column in METRIC_COLUMNS)
+    columns.append('equipment TEXT')
+
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, {0})'.format(', '.join(columns)))
+
+        existing = set(row[1] for row in conn.execute('PRAGMA table_info(runs)'))
+        for column in columns:
+            if column.split()[0] not in existing:
+                conn.execute('ALTER TABLE runs ADD COLUMN {0}'.format(column))
+        for column in INDEXED:
+            conn.execute('CREATE INDEX IF NOT EXISTS runs_{0} ON runs ({0})'.format(column))
+
+    return conn
+
+
+def run_row(params_in, planning_result):
+    """
+    :param params_in: dict parameter - value of the run, the missing parameters are NULL, '#' is NULL as well
+    :param planning_result: planning result, dict
+    :return: list of the values in the order of COLUMNS
+    """
+    row = []
+    for column, sql_type in PARAM_COLUMNS:
+        value = params_in.get(column)
+        if value == '#':
+            value = None
+        if value is not None and sql_type == 'INTEGER':
+            value = int(value)
+        elif value is not None and sql_type == 'REAL':
+            value = float(value)
+        row.append(value)
+
+    if row[COLUMNS.index('time')] is None:
+        row[COLUMNS.index('time')] = time.time()
+
+    for column in METRIC_COLUMNS:
+        value = planning_result.get(column)
+        row.append(None if value is None else float(value))
+
+    row.append(json.dumps(planning_result.get('equipment', {}), sort_keys=True))
+
+    return row
+
+
+def append(path_in, params_in, planning_result):
+    """
+    This function appends one run to the store.
+
+    :param path_in: path to the .sqlite file
+    :param params_in: dict parameter - value of the run, see PARAM_COLUMNS
+    :param planning_result: planning result, dict
+    :return: id of the run
+    """
+    return append_many(path_in, [(params_in, planning_result)])[0]
+
+
+def append_many(path_in, runs_in):
+    """
+    This function appends the runs in one transaction.
+
+    :param path_in: path to the .sqlite file
+    :param runs_in: list of (parameters, planning result) pairs
+    :return: list of the ids of the runs
+    """
+    sql = 'INSERT INTO runs ({0}) VALUES ({1})'.format(', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+
+    ids = []
+    with closing(open_store(path_in)) as conn:
+        with conn:
+            for params, planning_result in runs_in:
+                ids.append(conn.execute(sql, run_row(params, planning_result)).lastrowid)
+    return ids
+
+
+def check_column(column):
+    """
+    The names of the columns are put into the SQL, so only the known ones are accepted.
+    """
+    if column != 'run_id' and column not in COLUMNS:
+        raise ValueError('Unknown column of the result store: {0}'.format(column))
+    return column
+
+
+def where_clause(where_in):
+    """
+    :param where_in: dict column - condition, the condition is a value, a list of the values or an (operator, value)
+                     pair, e.g., {'topology': 'fttb', 'sr': [16, 32], 'fiber': ('<', 1e5)}, None for all the runs
+    :return: SQL condition, list of the arguments
+    """
+    if not where_in:
+        return '', []
+
+    conditions = []
+    args = []
+    for column, condition in sorted(where_in.items()):
+        check_column(column)
+        if isinstance(condition, tuple):
+            operator, value = condition
+            if operator not in ('=', '!=', '<', '<=', '>', '>='):
+                raise ValueError('Unknown operator: {0}'.format(operator))
+            conditions.append('{0} {1} ?'.format(column, operator))
+            args.append(value)
+        elif isinstance(condition, list):
+            conditions.append('{0} IN ({1})'.format(column, ', '.join('?' * len(condition))))
+            args.extend(condition)
+        elif condition is None:
+            conditions.append('{0} IS NULL'.format(column))
+        else:
+            conditions.append('{0} = ?'.format(column))
+            args.append(condition)
+
+    return ' WHERE ' + ' AND '.join(conditions), args
+
+
+def query(path_in, where_in=None, columns_in=None):
+    """
+    This function scans the runs matching the filter, the result is columnar: one array per column.
+
+    :param path_in: path to the .sqlite file
+    :param where_in: filter, see where_clause
+    :param columns_in: list of the columns, all if None
+    :return: dict column - array, the missing values of the metrics are nan, the equipment is a list of dicts
+    """
+    if columns_in is None:
+        columns_in = ['run_id'] + COLUMNS
+    for column in columns_in:
+        check_column(column)
+
+    where_sql, args = where_clause(where_in)
+    sql = 'SELECT {0} FROM runs{1} ORDER BY run_id'.format(', '.join(columns_in), where_sql)
+
+    with closing(open_store(path_in)) as conn:
+        rows = conn.execute(sql, args).fetchall()
+
+    out = {}
+    for j, column in enumerate(columns_in):
+        values = [row[j] for row in rows]
+        if column == 'equipment':
+            out[column] = [json.loads(value) if value else {} for value in values]
+        elif column in METRIC_COLUMNS or column in ('dsl_reach', 'time'):
+            out[column] = np.asarray([np.nan if value is None else value for value in values], dtype=np.float64)
+        elif column == 'run_id' or dict(PARAM_COLUMNS)[column] == 'INTEGER':
+            out[column] = np.asarray([-1 if value is None else value for value in values], dtype=np.int64)
+        else:
+            out[column] = np.asarray(['' if value is None else value for value in values], dtype=object)
+    return out
+
+
+def aggregate(path_in, metric_in, group_by=None, function_in='avg', where_in=None):
+    """
+    This function aggregates a metric over the runs matching the filter, e.g., the mean feeder fiber per topology and
+    splitting ratio. The runs without the metric are skipped.
+
+    :param path_in: path to the .sqlite file
+    :param metric_in: column, e.g., 'ff'
+    :param group_by: list of the columns, None for one group
+    :param function_in: one of AGGREGATES
+    :param where_in: filter, see where_clause
+    :return: list of (tuple of the group values, aggregated value, number of the runs) tuples
+    """
+    if function_in not in AGGREGATES:
+        raise ValueError('Unknown aggregate: {0}'.format(function_in))
+    check_column(metric_in)
+    group_by = [check_column(column) for column in (group_by or [])]
+
+    where_sql, args = where_clause(where_in)
+    not_null = '{0} IS NOT NULL'.format(metric_in)
+    where_sql = where_sql + ' AND ' + not_null if where_sql else ' WHERE ' + not_null
+
+    select = group_by + ['{0}({1})'.format(function_in.upper(), metric_in), 'COUNT(*)']
+    sql = 'SELECT {0} FROM runs{1}'.format(', '.join(select), where_sql)
+    if group_by:
+        sql += ' GROUP BY {0} ORDER BY {0}'.format(', '.join(group_by))
+
+    with closing(open_store(path_in)) as conn:
+        rows = conn.execute(sql, args).fetchall()
+
+    n = len(group_by)
+    return [(tuple(row[:n]), row[n], row[n + 1]) for row in rows if row[n + 1] > 0]
+
+
+def import_results(path_in, results_in, params_in=None):
+    """
+    This function imports the .txt files of the earlier runs, the name of the run is the name of the file.
+
+    :param path_in: path to the .sqlite file
+    :param results_in: list of the .txt files of the planning results
+    :param params_in: dict parameter - value shared by all the runs, e.g., the topology
+    :return: list of the ids of the runs
+    """
+    runs = []
+    for result in results_in:
+        params = dict(params_in or {})
+        params.setdefault('name', os.path.splitext(os.path.basename(result))[0])
+        with open(result) as f_p:
+            runs.append((params, json.load(f_p)))
+    return append_many(path_in, runs)
+
+
+if __name__ == '__main__':
+    import arcpy
+
+    store_in = arcpy.GetParameterAsText(0)
+    results = arcpy.GetParameterAsText(1).split(';')
+
+    topology_in = arcpy.GetParameterAsText(2)
+    if not topology_in:
+        topology_in = '#'
+
+    import_results(store_in, results, {'topology': topology_in})
@@ -0,0 +1,198 @@
+import os
+import time
+from contextlib import contextmanager
+
+# Scratch datasets of this process: the stack of the open stages, every stage with the paths it created, the usage of
+# the released stages and the function told about the stages, see set_listener
+scratch = {'counter': 0, 'stages': [], 'report': {}, 'listener': None}
+
+
+def process_memory():
+    """
+    :return: resident memory of the process, bytes, None if it can not be measured
+    """
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process(os.getpid()).memory_info().rss
+
+
+def set_listener(listener_in):
+    """
+    :param listener_in: function called with the name of every stage, when it begins, and with its usage as well, when
+                        it ends, e.g., to report the progress of a job, None for none
+    :return:
+    """
+    scratch['listener'] = listener_in
+    return
+
+
+def begin_stage(name_in):
+    """
+    This function opens a stage of the planning, e.g., the clustering or the routing of a fiber stage. The scratch
+    data created until the stage is ended belong to it. The stages can be nested, the inner one is ended first.
+
+    :param name_in: name of the stage, the usage of the stages with the same name is summed up
+    :return:
+    """
+    scratch['stages'].append({'name': name_in, 'paths': [], 'start': time.time(), 'memory': process_memory()})
+    if scratch['listener'] is not None:
+        scratch['listener'](name_in)
+    return
+
+
+def current_stage():
+    """
+    :return: the innermost open stage, a stage of the whole run is opened if there is none
+    """
+    if not scratch['stages']:
+        begin_stage('run')
+    return scratch['stages'][-1]
+
+
+def scratch_name(base_in, workspace_in='in_memory'):
+    """
+    This function hands out a unique name in the scratch workspace, so no dataset of a previous step or a previous
+    run has to be deleted before it is created. The dataset is deleted when the stage is ended.
+
+    :param base_in: base of the name, e.g., 'all_paths'
+    :param workspace_in: 'in_memory' or the path to a scratch geodatabase or folder
+    :return: path to the new dataset
+    """
+    scratch['counter'] += 1
+    path = os.path.join(workspace_in, '{0}_s{1}'.format(base_in, scratch['counter']))
+    current_stage()['paths'].append(path)
+    return path
+
+
+def track(path_in):
+    """
+    This function adds a dataset created under a fixed name, e.g., by a solver, to the scratch data of the stage.
+
+    :param path_in: path to the dataset
+    :return: path to the dataset
+    """
+    current_stage()['paths'].append(path_in)
+    return path_in
+
+
+def usage(paths_in):
+    """
+    :param paths_in: paths to the scratch datasets
+    :return: dict: 'datasets' number of the existing datasets, 'features' number of their rows, 'disk' bytes of the
+             ones saved to the folders
+    """
+    import arcpy
+
+    result = {'datasets': 0, 'features': 0, 'disk': 0}
+    for path in paths_in:
+        if not arcpy.Exists(path):
+            continue
+        result['datasets'] += 1
+        result['features'] += int(arcpy.GetCount_management(path).getOutput(0))
+        if os.path.isfile(path):
+            result['disk'] += os.path.getsize(path)
+        elif os.path.isdir(path):
+            result['disk'] += sum(os.path.getsize(os.path.join(folder, name))
+                                  for folder, subfolders, names in os.walk(path) for name in names)
+    return result
+
+
+def discard(paths_in):
+    """
+    This function deletes the scratch datasets, that are not needed any more before the end of the stage, e.g., in
+    every iteration of a loop.
+
+    :param paths_in: paths to the scratch datasets
+    :return:
+    """
+    import arcpy
+
+    paths_in = set(paths_in)
+    for stage in scratch['stages']:
+        stage['paths'] = [path for path in stage['paths'] if path not in paths_in]
+    for path in paths_in:
+        if arcpy.Exists(path):
+            arcpy.Delete_management(path)
+    return
+
+
+def end_stage():
+    """
+    This function deletes all the scratch data of the innermost stage and adds its usage to the report: the datasets
+    and the features left at its end, the bytes on the disk and the resident memory the stage added, if it can be
+    measured.
+
+    :return: usage of the stage, dict
+    """
+    import arcpy
+
+    stage = scratch['stages'].pop()
+    result = usage(stage['paths'])
+    memory = process_memory()
+    result['memory'] = memory - stage['memory'] if memory is not None and stage['memory'] is not None else None
+    result['time'] = time.time() - stage['start']
+
+    for path in reversed(stage['paths']):
+        if arcpy.Exists(path):
+            arcpy.Delete_management(path)
+
+    total = scratch['report'].setdefault(stage['name'], {})
+    for key, value in result.items():
+        if value is not None:
+            total[key] = total.get(key, 0) + value
+
+    arcpy.AddMessage('Scratch of {0}: {1} datasets, {2} features, {3} bytes on disk released'.format(
+        stage['name'], result['datasets'], result['features'], result['disk']))
+    if scratch['listener'] is not None:
+        scratch['listener'](stage['name'], result)
+    return result
+
+
+def end_stage_safely():
+    """
+    This function ends the innermost stage in the cleanup after an error. A failure of the release, e.g., on a dataset
+    the failed step left half-written, is only reported, so it does not replace the error of the step.
+
+    :return: usage of the stage, dict, empty if it could not be released
+    """
+    import arcpy
+
+    name = scratch['stages'][-1]['name']
+    try:
+        return end_stage()
+    except Exception as e:
+        arcpy.AddWarning('Scratch of {0} could not be released: {1}: {2}'.format(name, type(e).__name__, e))
+        return {}
+
+
+@contextmanager
+def stage(name_in):
+    """
+    This function opens a stage for the body of the with statement and ends it also when the body raises, so the
+    stages of a failed step do not stay open and their scratch data is released.
+
+    :param name_in: name of the stage, see begin_stage
+    :return: dict, filled with the usage of the stage when it is ended, see end_stage
+    """
+    result = {}
+    begin_stage(name_in)
+    try:
+        yield result
+    finally:
+        result.update(end_stage_safely())
+
+
+def release_all():
+    """
+    This function ends all the open stages, e.g., at the end of a job or after an error, and resets the report.
+
+    :return: usage per stage, dict stage name - dict
+    """
+    while scratch['stages']:
+        end_stage_safely()
+
+    report = scratch['report']
+    scratch['report'] = {}
+    return report
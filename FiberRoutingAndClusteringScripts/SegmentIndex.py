@@ -0,0 +1,203 @@
+import numpy as np
+
+import NetworkGraph as ng
+
+
+def build_index(graph, cell_in=None):
+    """
+    This function builds the uniform grid over the bounding boxes of all the street segments (the straight pieces
+    between the vertices of the edges). Every segment is registered in all the cells its bounding box overlaps, so a
+    point only has to be compared with the segments of the cells around it.
+
+    :param graph: graph, dict
+    :param cell_in: size of the grid cell in meters, the median segment length if None
+    :return: index, dict
+    """
+    shape_ptr = graph['shape_ptr']
+    vertices_xy = graph['shape_xy']
+    vertices = ng.metric_xy(graph, vertices_xy)
+
+    # The pairs of the consecutive vertices that belong to the same edge
+    valid = np.ones(max(len(vertices) - 1, 0), dtype=bool)
+    valid[shape_ptr[1:-1] - 1] = False
+    first = np.nonzero(valid)[0]
+
+    a = vertices[first]
+    b = vertices[first + 1]
+    seg_edge = np.searchsorted(shape_ptr, first, side='right') - 1
+    seg_len = np.sqrt(((b - a) ** 2).sum(axis=1))
+
+    # Offset of the segment start along its edge, scaled to the edge length (geodesic) of the graph
+    cum = np.cumsum(seg_len)
+    edge_total = np.bincount(seg_edge, weights=seg_len, minlength=graph['n_edges'])
+    edge_before = np.concatenate([[0.0], np.cumsum(edge_total)])[seg_edge]
+    scale = graph['edge_length'][seg_edge] / np.maximum(edge_total[seg_edge], 1e-9)
+    seg_offset = (cum - seg_len - edge_before) * scale
+
+    if cell_in is None:
+        cell_in = float(np.median(seg_len)) if len(seg_len) > 0 else 1.0
+    cell_in = max(cell_in, 1.0)
+
+    low = np.floor(np.minimum(a, b) / cell_in).astype(np.int64)
+    high = np.floor(np.maximum(a, b) / cell_in).astype(np.int64)
+
+    grid = {}
+    for s in range(len(a)):
+        for i in range(low[s, 0], high[s, 0] + 1):
+            for j in range(low[s, 1], high[s, 1] + 1):
+                grid.setdefault((i, j), []).append(s)
+
+    index = {'a': a,
+             'b': b,
+             'a_xy': vertices_xy[first],
+             'b_xy': vertices_xy[first + 1],
+             'edge': seg_edge,
+             'offset': seg_offset,
+             'scale': scale,
+             'cell': cell_in,
+             'grid': grid}
+
+    return index
+
+
+def get_index(graph):
+    """
+    The index is built once per graph and kept with it, so every following snapping reuses it.
+
+    :param graph: graph, dict
+    :return: index, dict
+    """
+    if 'segment_index' not in graph:
+        graph['segment_index'] = build_index(graph)
+    return graph['segment_index']
+
+
+def candidates(index, points, ring):
+    """
+    This function collects the (point, segment) pairs for the cells within the Chebyshev distance ring from the cell of
+    every point.
+
+    :return: point ids, segment ids - arrays
+    """
+    cell = index['cell']
+    grid = index['grid']
+    cells = np.floor(points / cell).astype(np.int64)
+
+    pair_point = []
+    pair_seg = []
+    for p, (cx, cy) in enumerate(cells.tolist()):
+        for i in range(cx - ring, cx + ring + 1):
+            for j in range(cy - ring, cy + ring + 1):
+                members = grid.get((i, j))
+                if members:
+                    pair_point.extend([p] * len(members))
+                    pair_seg.extend(members)
+
+    return np.asarray(pair_point, dtype=np.int64), np.asarray(pair_seg, dtype=np.int64)
+
+
+def snap_points(graph, xy_in):
+    """
+    This function projects every point onto its closest street segment. The points are processed as a batch: the
+    candidates from the 3x3 cells around every point are compared in one vectorized pass. The result is exact for all
+    the points that are closer to the segment than one cell, the rest is searched again with the growing rings.
+
+    :param graph: graph, dict
+    :param xy_in: coordinates in the spatial reference of the graph, array (n, 2)
+    :return: dict of arrays: 'xy' snapped coordinates, 'edge' edge id, 'pos' offset along the edge from its start node
+             in meters, 'dist' distance to the street in meters
+    """
+    index = get_index(graph)
+    points = ng.metric_xy(graph, xy_in)
+    n = len(points)
+
+    best_d = np.full(n, np.inf)
+    best_seg = np.full(n, -1, dtype=np.int64)
+    best_t = np.zeros(n)
+
+    todo = np.arange(n)
+    ring = 1
+    while len(todo) > 0:
+        pair_point, pair_seg = candidates(index, points[todo], ring)
+
+        if len(pair_point) > 0:
+            a = index['a'][pair_seg]
+            ab = index['b'][pair_seg] - a
+            ap = points[todo][pair_point] - a
+            t = np.clip((ap * ab).sum(axis=1) / np.maximum((ab ** 2).sum(axis=1), 1e-12), 0.0, 1.0)
+            d = np.sqrt(((ap - ab * t[:, np.newaxis]) ** 2).sum(axis=1))
+
+            # The minimum per point: sort by point and distance, take the first of every point
+            order = np.lexsort((d, pair_point))
+            first = order[np.concatenate([[True], pair_point[order][1:] != pair_point[order][:-1]])]
+            found = todo[pair_point[first]]
+            best_d[found] = d[first]
+            best_seg[found] = pair_seg[first]
+            best_t[found] = t[first]
+
+        # Only the segments within (ring * cell) are guaranteed to be found
+        todo = todo[~(best_d[todo] <= ring * index['cell'])]
+        if ring * index['cell'] > 1e7:
+            break
+        ring *= 2
+
+    valid = best_seg >= 0
+    seg = np.where(valid, best_seg, 0)
+    a_xy = index['a_xy'][seg]
+    b_xy = index['b_xy'][seg]
+    seg_len = np.sqrt(((index['b'][seg] - index['a'][seg]) ** 2).sum(axis=1))
+
+    result = {'xy': a_xy + (b_xy - a_xy) * best_t[:, np.newaxis],
+              'edge': np.where(valid, index['edge'][seg], -1),
+              'pos': index['offset'][seg] + best_t * seg_len * index['scale'][seg],
+              'dist': best_d}
+
+    return result
+
+
+def read_locations(fc_in, graph):
+    """
+    This function returns the position of every point on the street graph. The points that were pushed to the streets
+    with the index already carry their edge and offset (EDGE_ID, EDGE_POS), so they are not located again. The other
+    points are snapped now.
+
+    :param fc_in: point feature class, path
+    :param graph: graph, dict
+    :return: list of the ids, list of (edge id, offset along the edge) pairs
+    """
+    import arcpy
+
+    fields = [field.name for field in arcpy.ListFields(fc_in)]
+
+    if 'EDGE_ID' in fields and 'EDGE_POS' in fields and 'EDGE_OID' in fields:
+        ids = []
+        locations = []
+        oids = []
+        with arcpy.da.SearchCursor(fc_in, ['OID@', 'EDGE_ID', 'EDGE_POS', 'EDGE_OID']) as cursor:
+            for row in cursor:
+                ids.append(row[0])
+                locations.append((row[1], row[2]))
+                oids.append(row[3])
+
+        # The edge ids are only valid for the graph the points were pushed to
+        edges = np.asarray([edge for edge, pos in locations], dtype=np.int64)
+        if np.all((edges >= 0) & (edges < graph['n_edges'])) and \
+                np.array_equal(graph['edge_oid'][edges], np.asarray(oids, dtype=np.int64)):
+            return ids, locations
+
+    return read_locations_snapped(fc_in, graph)
+
+
+def read_locations_snapped(fc_in, graph):
+    """
+    :param fc_in: point feature class, path
+    :param graph: graph, dict
+    :return: list of the ids, list of (edge id, offset along the edge) pairs
+    """
+    ids, xy = ng.read_points(fc_in, graph)
+    snapped = snap_points(graph, xy)
+
+    # The points without any street around are left out as the unlocated locations of the solver
+    valid = [i for i in range(len(ids)) if snapped['edge'][i] >= 0]
+
+    return [ids[i] for i in valid], [(int(snapped['edge'][i]), float(snapped['pos'][i])) for i in valid]
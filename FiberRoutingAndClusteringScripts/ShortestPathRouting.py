@@ -2,6 +2,11 @@ import arcpy
 import os
 import math
 
+import NetworkGraph as ng
+import BrownfieldIndex as bfi
+import SegmentIndex as si
+import ScratchWorkspace as sw
+
 
 def check_exists(name_in):
     """
@@ -44,9 +49,7 @@ def post_processing_fiber(routes_all_in, ff_routes_protection='#'):
     field_name = check_object_id(routes_all_in)
     arcpy.AddGeometryAttributes_management(routes_all_in, 'LENGTH_GEODESIC', 'METERS')
 
-    dissolved_name = os.path.join('in_memory', 'dissolved_all')
-
-    check_exists(dissolved_name)
+    dissolved_name = sw.scratch_name('dissolved_all')
 
     # Dissolve_management (in_features, out_feature_class, {dissolve_field}, {statistics_fields}, {multi_part},
     # {unsplit_lines})
@@ -67,9 +70,7 @@ def post_processing_fiber(routes_all_in, ff_routes_protection='#'):
         arcpy.AddGeometryAttributes_management(ff_routes_protection, 'LENGTH_GEODESIC', 'METERS')
 
 
-        dissolved_name_p = os.path.join('in_memory', 'dissolved_p')
-
-        check_exists(dissolved_name_p)
+        dissolved_name_p = sw.scratch_name('dissolved_p')
 
         arcpy.Dissolve_management(routes_all_in, dissolved_name, field_name_p, statistics_fields="LENGTH_GEO SUM")
 
@@ -77,13 +78,11 @@ def post_processing_fiber(routes_all_in, ff_routes_protection='#'):
             for row in rows:
                 fiber_p = row[0]  # fiber length
 
-        merge_routes_name = os.path.join('in_memory', 'merged_w_p')
-        check_exists(merge_routes_name)
+        merge_routes_name = sw.scratch_name('merged_w_p')
 
         arcpy.Merge_management([routes_all_in, ff_routes_protection], merge_routes_name)
 
-        dissolve_name_additional_duct = os.path.join('in_memory', 'dissolved_w_p')
-        check_exists(dissolve_name_additional_duct)
+        dissolve_name_additional_duct = sw.scratch_name('dissolved_w_p')
         field_name_w_p = check_object_id(merge_routes_name)
         arcpy.Dissolve_management(merge_routes_name, dissolve_name_additional_duct, field_name_w_p)
         arcpy.AddGeometryAttributes_management(dissolve_name_additional_duct, 'LENGTH_GEODESIC', 'METERS')
@@ -95,142 +94,316 @@ def post_processing_fiber(routes_all_in, ff_routes_protection='#'):
     return fiber_w, duct_w, fiber_p, duct_w_p - duct_w
 
 
-def route_fiber(nd_in, incidents_in, facilities_in, name_in, output_fc_in, pro_in, protection_in=False,
-                sp_protection_in=True, brownfield_duct='#'):
-    arcpy.CheckOutExtension('Network')
+def route_fiber_graph(graph, incidents_in, facilities_in, name_in, output_fc_in, weights_in=None, protection_in=False,
+                      sp_protection_in=True, capacity_in='#', planning_result_in=None):
+    """
+    This function routes every incident to its closest facility on the in-memory street graph. One multi-source
+    shortest path search from all the facilities gives the routes for all the incidents at once. The protection paths
+    are the point to point queries between the ends of every route, they are answered with the bidirectional A*, the
+    scaled weights of the single query are passed as the overrides of the few edges concerned.
+
+    :param graph: street graph, dict
+    :param incidents_in: incidents, point feature class
+    :param facilities_in: facilities, point feature class
+    :param name_in: name of the resulting routes
+    :param output_fc_in: where to save the routes
+    :param weights_in: edge weights, e.g., with the brownfield discount, the edge lengths if None
+    :param protection_in: if the protection paths are required, binary
+    :param sp_protection_in: shortest disjoint path if True, the sharing of the other ducts if False, binary
+    :param capacity_in: number of the ports of every facility or the name of the field with the ports, '#' for no
+                        limit, see assign_co
+    :param planning_result_in: planning result, the fiber and duct lengths per CO are added as 'co', see co_lengths
+    :return: path to the routes, the same fields as for the closest facility solver, path to the protection or '#'
+    """
+    # The demands pushed to the streets with the segment index are not located again
+    incident_ids, incident_locations = si.read_locations(incidents_in, graph)
+    facility_ids, facility_locations = si.read_locations(facilities_in, graph)
+
+    routes = assign_co(graph, facility_locations, incident_locations, weights_in,
+                       read_capacity(facilities_in, facility_ids, capacity_in))
+
+    routes_out = []
+    for k, i, pieces in routes:
+        routes_out.append((facility_ids[k], incident_ids[i], ng.pieces_vertices(graph, pieces),
+                           ng.pieces_length(pieces)))
+    layer_out_path = ng.write_routes(graph, routes_out, output_fc_in, name_in)
+    if planning_result_in is not None:
+        planning_result_in['co'] = co_lengths(facility_ids, routes)
+
+    if not protection_in:
+        return layer_out_path, '#'
+
+    protection = []
+    for k, i, p_pieces in protection_pieces(graph, routes, facility_locations, incident_locations, weights_in,
+                                            sp_protection_in):
+        protection.append((facility_ids[k], incident_ids[i], ng.pieces_vertices(graph, p_pieces),
+                           ng.pieces_length(p_pieces)))
+
+    name_protect = 'sp' if sp_protection_in else 'duct_sharing'
+    protection_out_path = ng.write_routes(graph, protection, output_fc_in,
+                                          '{0}_protection_{1}'.format(name_in, name_protect))
 
-    # Set local variables
-    layer_name = "ClosestFacility"
-    impedance = "Length"
+    return layer_out_path, protection_out_path
 
-    # MakeClosestFacilityLayer_na (in_network_dataset, out_network_analysis_layer, impedance_attribute,
-    # {travel_from_to}, {default_cutoff}, {default_number_facilities_to_find}, {accumulate_attribute_name},
-    # {UTurn_policy}, {restriction_attribute_name}, {hierarchy}, {hierarchy_settings}, {output_path_shape},
-    # {time_of_day}, {time_of_day_usage})
-    #
-    # http://desktop.arcgis.com/en/arcmap/10.3/tools/network-analyst-toolbox/make-closest-facility-layer.htm
-    result_object = arcpy.na.MakeClosestFacilityLayer(nd_in, layer_name, impedance, 'TRAVEL_TO', default_cutoff=None,
-                                                      default_number_facilities_to_find=1,
-                                                      output_path_shape='TRUE_LINES_WITH_MEASURES')
 
-    # Get the layer object from the result object. The Closest facility layer can
-    # now be referenced using the layer object.
-    layer_object = result_object.getOutput(0)
+def protection_pieces(graph, routes_in, facility_locations, incident_locations, weights_in=None, sp_protection_in=True):
+    """
+    This function finds the protection path of every working route. They are the point to point queries between the
+    ends of the route, answered with the bidirectional A*, the scaled weights of the single query are passed as the
+    overrides of the few edges concerned.
+
+    :param graph: street graph, dict
+    :param routes_in: working routes, list of (facility index, incident index, pieces) tuples
+    :param facility_locations: list of (edge id, offset along the edge) pairs
+    :param incident_locations: list of (edge id, offset along the edge) pairs
+    :param weights_in: edge weights, e.g., with the brownfield discount, the edge lengths if None
+    :param sp_protection_in: shortest disjoint path if True, the sharing of the other ducts if False, binary
+    :return: list of (facility index, incident index, pieces) tuples of the protection paths
+    """
+    import BidirectionalSearch as bs
 
-    # Get the names of all the sublayers within the Closest facility layer.
-    sublayer_names = arcpy.na.GetNAClassNames(layer_object)
+    weights = graph['weight'] if weights_in is None else list(weights_in)
+    used = set(edge for k, i, pieces in routes_in for edge, a, b in pieces)
 
-    # Stores the layer names that we will use later
-    incidents_layer_name = sublayer_names["Incidents"]  # as origins
-    facilities_layer_name = sublayer_names["Facilities"]  # as destinations
-    lines_layer_name = sublayer_names["CFRoutes"]  # as lines
+    protection = []
+    for k, i, pieces in routes_in:
+        if ng.pieces_length(pieces) == 0:
+            continue
 
-    arcpy.na.AddLocations(layer_object, incidents_layer_name, incidents_in)
-    arcpy.na.AddLocations(layer_object, facilities_layer_name, facilities_in)
+        # The working path is avoided with the same scaled cost as the line barriers of the solver
+        own = [edge for edge, a, b in pieces]
+        overrides = {}
+        if not sp_protection_in:
+            for edge in used.difference(own):
+                overrides[edge] = weights[edge] * 0.001
+        for edge in own:
+            overrides[edge] = weights[edge] * 10000000000
 
-    if brownfield_duct != '#':
-        mapping = "Name Name #;Attr_Length # " + '0,001' + "; BarrierType # 1"
-        arcpy.na.AddLocations(layer_object, "Line Barriers", brownfield_duct, mapping, search_tolerance="5 Meters")
+        result = bs.route_pieces(graph, [facility_locations[k]], incident_locations[i], weights, overrides)
+        if result:
+            protection.append((k, i, result[0][2]))
 
-    # Solve the Closest facility  layer
-    arcpy.na.Solve(layer_object)
+    return protection
 
-    # # Save the solved Closest facility layer as a layer file on disk
-    # output_layer_file = os.path.join(output_dir_in, layer_name)
-    # arcpy.MakeFeatureLayer_management(layer_object, output_layer_file)
 
-    # Get the Lines Sublayer (all the distances)
-    if pro_in:
-        lines_sublayer = layer_object.listLayers(lines_layer_name)[0]
-    elif not pro_in:
-        lines_sublayer = arcpy.mapping.ListLayers(layer_object, lines_layer_name)[0]
+def route_fiber_steiner(graph, incidents_in, facilities_in, name_in, output_fc_in, weights_in=None):
+    """
+    This function connects the incidents of one cluster to its head with the Steiner tree on the in-memory street
+    graph instead of the separate shortest paths, so the trench of the cluster is as short as possible. Every fiber
+    follows the tree from the head to its incident, it can be longer than the shortest path.
+
+    :param graph: street graph, dict
+    :param incidents_in: incidents, point feature class
+    :param facilities_in: cluster head, point feature class
+    :param name_in: name of the resulting routes
+    :param output_fc_in: where to save the routes
+    :param weights_in: edge weights, e.g., with the brownfield discount, the edge lengths if None
+    :return: path to the routes, list of the pieces of every route
+    """
+    import SteinerRouting as st
 
-    layer_out_path = os.path.join(output_fc_in, name_in)
-    arcpy.management.CopyFeatures(lines_sublayer, layer_out_path)
+    incident_ids, incident_locations = si.read_locations(incidents_in, graph)
+    facility_ids, facility_locations = si.read_locations(facilities_in, graph)
 
-    protection_out_path = "#"
+    routes = st.route_pieces(graph, facility_locations[0], incident_locations, weights_in)
 
-    # If requested route the protection paths
-    if protection_in:
-        # For all the routed apths the disjoint path has to be found
-        n_paths = int(arcpy.GetCount_management(incidents_in).getOutput(0))
+    routes_out = []
+    for k, i, pieces in routes:
+        routes_out.append((facility_ids[k], incident_ids[i], ng.pieces_vertices(graph, pieces),
+                           ng.pieces_length(pieces)))
 
-        field_objects = arcpy.ListFields(layer_out_path)
-        fields = [field.name for field in field_objects if field.type != 'Geometry']
+    return ng.write_routes(graph, routes_out, output_fc_in, name_in), [pieces for k, i, pieces in routes]
 
-        if 'Total_Length' in fields:
-            field_len = 'Total_Length'
-        elif 'Shape_Length' in fields:
-            field_len = 'Shape_Length'
 
-        # Iterate through all the facility-demand pairs and their respective routes
-        cursor_r = arcpy.da.SearchCursor(layer_out_path, ['SHAPE@', field_len])
-        cursor_n = arcpy.da.SearchCursor(incidents_in, 'SHAPE@')
+def graph_weights(graph, brownfield_duct='#'):
+    """
+    :param graph: street graph, dict
+    :param brownfield_duct: brownfield ducts, either a line feature class or a snapped index, '#' if none
+    :return: edge weights with the brownfield discount, None for the edge lengths
+    """
+    if brownfield_duct == '#':
+        return None
+    return bfi.apply_index(bfi.get_index(graph, brownfield_duct), graph['edge_length'])
 
-        if sp_protection_in:
-            name_protect = 'sp'
-        else:
-            name_protect = 'duct_sharing'
-
-        protection_out_path = os.path.join(output_fc_in, '{0}_protection_{1}'.format(name_in, name_protect))
-        check_exists(protection_out_path)
-        arcpy.CreateFeatureclass_management(output_fc_in, '{0}_protection_{1}'.format(name_in, name_protect),
-                                            template=layer_out_path)
-
-        for i in range(n_paths):
-            path = cursor_r.next()
-            node = cursor_n.next()
-            if not path[1] == 0:
-                if sp_protection_in:
-                    tmp = protection_routing(nd_in, facilities_in, node[0], path[0], pro_in)
-                    # Add the protection route to the output feature class
-                    arcpy.Append_management(tmp, protection_out_path, schema_type="NO_TEST")
-                else:
-                    all_paths = os.path.join('in_memory', 'all_paths_{0}'.format(i))
-                    check_exists(all_paths)
-                    arcpy.CopyFeatures_management(layer_out_path, all_paths)
-
-                    other_paths_tmp = os.path.join('in_memory', 'other_paths_{0}_dissolved'.format(i))
-                    check_exists(other_paths_tmp)
-                    arcpy.Dissolve_management(all_paths, other_paths_tmp)
-
-                    other_paths = os.path.join('in_memory', 'other_paths_{0}'.format(i))
-                    check_exists(other_paths)
-                    arcpy.FeatureToLine_management(other_paths_tmp, other_paths)
-
-                    other_paths_layer = os.path.join('in_memory', 'other_paths_layer_{0}'.format(i))
-                    check_exists(other_paths_layer)
-                    arcpy.MakeFeatureLayer_management(other_paths, other_paths_layer)
-
-                    arcpy.SelectLayerByLocation_management(other_paths_layer, 'SHARE_A_LINE_SEGMENT_WITH', path[0],
-                                                           selection_type='NEW_SELECTION',
-                                                           invert_spatial_relationship='INVERT')
-
-                    scaled_cost = os.path.join('in_memory', 'scaled_cost_{0}'.format(i))
-                    check_exists(scaled_cost)
-                    arcpy.CopyFeatures_management(other_paths_layer, scaled_cost)
-
-                    tmp = protection_routing(nd_in, facilities_in, node[0], path[0], pro_in, scaled_cost)
-                    # Add the protection route to the output feature class
-                    arcpy.Append_management(tmp, protection_out_path, schema_type="NO_TEST")
 
-    return layer_out_path, protection_out_path
+def read_capacity(co_in, co_ids, capacity_in):
+    """
+    :param co_in: COs, point feature class
+    :param co_ids: ids of the COs
+    :param capacity_in: number of the ports of every CO or the name of the field with the ports, '#' for no limit
+    :return: list of the capacities, None for no limit
+    """
+    if capacity_in == '#':
+        return None
 
+    try:
+        return [int(capacity_in)] * len(co_ids)
+    except ValueError:
+        ports = {}
+        with arcpy.da.SearchCursor(co_in, ['OID@', capacity_in]) as cursor:
+            for row in cursor:
+                ports[row[0]] = int(row[1])
+        return [ports[co_id] for co_id in co_ids]
 
-def protection_routing(nd_in, start_in, end_in, route_in, pro_in, other_routes='#'):
+
+def assign_co(graph, co_locations, incident_locations, weights_in=None, capacity_in=None):
     """
-    This function finds a disjoint path between given start-end node pars to the given existing working path. 
-    The general procedure is the same as for the fiber routing but with additional constraint (line barrier) and thus 
-    restricted on one node pair (facility-demand).
-
-    :param nd_in: network dataset on which the shortest path routing is done, network dataset
-    :param start_in: starting node, feature class
-    :param end_in: end node, feature class
-    :param route_in: working path, feature class
-    :param pro_in: if the script is executed in arcgis pro, binary
+    This function assigns every incident to its nearest CO with one multi-source search from all the COs. If the
+    capacities of the COs are exceeded, the trees of the single COs are computed and the incidents are assigned to the
+    COs with the minimum total distance and no CO over its ports, see FlowAssignment.assign.
+
+    :param graph: street graph, dict
+    :param co_locations: list of (edge id, offset along the edge) pairs
+    :param incident_locations: list of (edge id, offset along the edge) pairs
+    :param weights_in: edge weights, the edge lengths if None
+    :param capacity_in: list of the number of the ports of every CO, None for no limit
+    :return: list of (CO index, incident index, pieces) tuples
+    """
+    routes = ng.route_pieces(graph, co_locations, incident_locations, weights_in)
+    if capacity_in is None:
+        return routes
+
+    load = [0] * len(co_locations)
+    for k, i, pieces in routes:
+        load[k] += 1
+    if all(load[k] <= capacity_in[k] for k in range(len(co_locations))):
+        return routes
+
+    import FlowAssignment as fa
+
+    arcs = [{} for _ in incident_locations]
+    options = {}
+    for k, location in enumerate(co_locations):
+        for kk, i, pieces in ng.route_pieces(graph, [location], incident_locations, weights_in):
+            arcs[i][k] = ng.pieces_cost(graph, pieces, weights_in)
+            options[(k, i)] = pieces
+
+    labels = fa.assign(arcs, capacity_in)
+    routes = [(k, i, options[(k, i)]) for i, k in enumerate(labels.tolist()) if k != -1]
+
+    if len(routes) < len(incident_locations):
+        arcpy.AddWarning('{0} demands exceed the capacity of all the COs and were not connected'.format(
+            len(incident_locations) - len(routes)))
+
+    return routes
+
 
-    :return: the resulting line layer -> path
+def route_fiber_co(graph, incidents_in, co_in, name_in, output_fc_in, weights_in=None, capacity_in='#'):
     """
+    This function routes the feeder from several COs at once, every incident is connected to its nearest CO, if
+    needed within the port capacity of the COs.
+
+    :param graph: street graph, dict
+    :param incidents_in: cluster heads or P2P demands, point feature class
+    :param co_in: COs, point feature class
+    :param name_in: name of the resulting routes
+    :param output_fc_in: where to save the routes
+    :param weights_in: edge weights, the edge lengths if None
+    :param capacity_in: number of the ports of every CO or the name of the field with the ports, '#' for no limit
+    :return: path to the routes, dict CO id - {'fiber': length, 'duct': length, 'n': number of the incidents}
+    """
+    incident_ids, incident_locations = si.read_locations(incidents_in, graph)
+    co_ids, co_locations = si.read_locations(co_in, graph)
+
+    routes = assign_co(graph, co_locations, incident_locations, weights_in, read_capacity(co_in, co_ids, capacity_in))
+
+    routes_out = []
+    for k, i, pieces in routes:
+        routes_out.append((co_ids[k], incident_ids[i], ng.pieces_vertices(graph, pieces), ng.pieces_length(pieces)))
+
+    return ng.write_routes(graph, routes_out, output_fc_in, name_in), co_lengths(co_ids, routes)
+
+
+def co_lengths(co_ids, routes_in):
+    """
+    :param co_ids: ids of the COs
+    :param routes_in: list of (CO index, incident index, pieces) tuples
+    :return: dict CO id - {'fiber': length, 'duct': length, 'n': number of the incidents}
+    """
+    per_co = {}
+    for k, co_id in enumerate(co_ids):
+        pieces = [route[2] for route in routes_in if route[0] == k]
+        per_co[str(co_id)] = {'fiber': float(sum(ng.pieces_length(p) for p in pieces)),
+                              'duct': ng.pieces_duct_length(pieces),
+                              'n': len(pieces)}
+    return per_co
+
+
+def route_fiber_shared(graph, incidents_in, facilities_in, name_in, output_fc_in, weights_in, discount_in=0.5,
+                       shared_in=None, weights_sp=None):
+    """
+    This function routes the incidents one by one to their closest facilities, the edges already carrying fiber are
+    cheaper for the following routes, see DuctSharing. The shortest paths are routed as well, they are the reference
+    of the fiber and duct trade-off.
+
+    :param graph: street graph, dict
+    :param incidents_in: incidents, point feature class
+    :param facilities_in: facilities, point feature class
+    :param name_in: name of the resulting routes
+    :param output_fc_in: where to save the routes
+    :param weights_in: edge weights, list, updated in place with the discount
+    :param discount_in: factor of the weight of the edges carrying fiber
+    :param shared_in: edges already carrying fiber, set, updated in place
+    :param weights_sp: edge weights of the shortest paths, the edge lengths if None
+    :return: path to the routes, list of (facility index, incident index, pieces) tuples of the routes and of the
+             shortest paths, ids of the facilities
+    """
+    import DuctSharing as ds
+
+    incident_ids, incident_locations = si.read_locations(incidents_in, graph)
+    facility_ids, facility_locations = si.read_locations(facilities_in, graph)
+
+    routes = ds.route_pieces(graph, facility_locations, incident_locations, weights_in, discount_in, shared=shared_in)
+    routes_sp = ng.route_pieces(graph, facility_locations, incident_locations, weights_sp)
+
+    routes_out = []
+    for k, i, pieces in routes:
+        routes_out.append((facility_ids[k], incident_ids[i], ng.pieces_vertices(graph, pieces),
+                           ng.pieces_length(pieces)))
+
+    return ng.write_routes(graph, routes_out, output_fc_in, name_in), routes, routes_sp, facility_ids
+
+
+def sharing_result(pieces_in, pieces_sp, discount_in):
+    """
+    :return: dict with the fiber and duct of the shared routes and of the shortest paths
+    """
+    return {'discount': discount_in,
+            'fiber': float(sum(ng.pieces_length(pieces) for pieces in pieces_in)),
+            'duct': ng.pieces_duct_length(pieces_in),
+            'fiber_sp': float(sum(ng.pieces_length(pieces) for pieces in pieces_sp)),
+            'duct_sp': ng.pieces_duct_length(pieces_sp)}
+
+
+def route_fiber(nd_in, incidents_in, facilities_in, name_in, output_fc_in, pro_in, protection_in=False,
+                sp_protection_in=True, brownfield_duct='#'):
+    """
+    This function routes every incident to its closest facility. The protection paths and the routes with the snapped
+    brownfield index are searched on the in-memory street graph, see route_fiber_graph, the other routes are solved
+    with the closest facility solver of the network analyst.
+
+    :param nd_in: network dataset
+    :param incidents_in: incidents, point feature class
+    :param facilities_in: facilities, point feature class
+    :param name_in: name of the resulting routes
+    :param output_fc_in: where to save the routes
+    :param pro_in: if the script is executed in arcgis pro, binary
+    :param protection_in: if the protection paths are required, binary
+    :param sp_protection_in: shortest disjoint path if True, the sharing of the other ducts if False, binary
+    :param brownfield_duct: brownfield ducts, either a line feature class or a snapped index, '#' if none
+    :return: path to the routes, path to the protection or '#'
+    """
+    if protection_in or bfi.is_index(brownfield_duct):
+        # The disjoint paths are point to point queries answered with the bidirectional A* instead of one solve of the
+        # closest facility layer per pair, the brownfield discount is applied as the weight overrides
+        graph = ng.get_graph(nd_in)
+        return route_fiber_graph(graph, incidents_in, facilities_in, name_in, output_fc_in,
+                                 graph_weights(graph, brownfield_duct), protection_in, sp_protection_in)
+
+    arcpy.CheckOutExtension('Network')
+
+    layer_out_path = os.path.join(output_fc_in, name_in)
+
     # Set local variables
     layer_name = "ClosestFacility"
     impedance = "Length"
@@ -241,8 +414,8 @@ def protection_routing(nd_in, start_in, end_in, route_in, pro_in, other_routes='
     # {time_of_day}, {time_of_day_usage})
     #
     # http://desktop.arcgis.com/en/arcmap/10.3/tools/network-analyst-toolbox/make-closest-facility-layer.htm
-    result_object = arcpy.na.MakeClosestFacilityLayer(nd_in, layer_name, impedance, 'TRAVEL_TO', default_cutoff=None,
-                                                      default_number_facilities_to_find=1,
+    result_object = arcpy.na.MakeClosestFacilityLayer(nd_in, layer_name, impedance, 'TRAVEL_TO',
+                                                      default_cutoff=None, default_number_facilities_to_find=1,
                                                       output_path_shape='TRUE_LINES_WITH_MEASURES')
 
     # Get the layer object from the result object. The Closest facility layer can
@@ -257,20 +430,13 @@ def protection_routing(nd_in, start_in, end_in, route_in, pro_in, other_routes='
     facilities_layer_name = sublayer_names["Facilities"]  # as destinations
     lines_layer_name = sublayer_names["CFRoutes"]  # as lines
 
-    arcpy.na.AddLocations(layer_object, incidents_layer_name, end_in)
-    arcpy.na.AddLocations(layer_object, facilities_layer_name, start_in)
-
-    # Cost attribute for disjoint paths
-    sc_tmp1 = 10000000000
-
-    # Add the cost upscaled working path to the restrictions as the scaled cost
-    mapping = "Name Name #;Attr_Length # " + str(sc_tmp1) + "; BarrierType # 1"
-    arcpy.na.AddLocations(layer_object, "Line Barriers", route_in, mapping, search_tolerance="5 Meters")
+    arcpy.na.AddLocations(layer_object, incidents_layer_name, incidents_in)
+    arcpy.na.AddLocations(layer_object, facilities_layer_name, facilities_in)
 
-    # Add the downscaled other duct if required
-    if other_routes != '#':
+    if brownfield_duct != '#':
         mapping = "Name Name #;Attr_Length # " + '0,001' + "; BarrierType # 1"
-        arcpy.na.AddLocations(layer_object, "Line Barriers", other_routes, mapping, search_tolerance="5 Meters")
+        arcpy.na.AddLocations(layer_object, "Line Barriers", brownfield_duct, mapping,
+                              search_tolerance="5 Meters")
 
     # Solve the Closest facility  layer
     arcpy.na.Solve(layer_object)
@@ -285,15 +451,21 @@ def protection_routing(nd_in, start_in, end_in, route_in, pro_in, other_routes='
     elif not pro_in:
         lines_sublayer = arcpy.mapping.ListLayers(layer_object, lines_layer_name)[0]
 
-    return lines_sublayer
+    arcpy.management.CopyFeatures(lines_sublayer, layer_out_path)
+
+    return layer_out_path, '#'
 
 
 def main(network_nd, n_clusters, stage, co, name, output_fds, pro, ff_protection=False,
-         sp_protection_in=True, p2p_demands='#', brownfield_duct='#', save_lmf_df=False, save_clusters=False):
+         sp_protection_in=True, p2p_demands='#', brownfield_duct='#', save_lmf_df=False, save_clusters=False,
+         co_capacity='#', planning_result_in=None, steiner=False, duct_sharing='#'):
 
     routes_all_list = []
     path_out_p = 0
 
+    # The scratch data of the stage are released at its end
+    sw.begin_stage('routing_{0}'.format(stage.lower()))
+
     if not save_clusters:
         output_clusters = 'in_memory'
     else:
@@ -306,13 +478,39 @@ def main(network_nd, n_clusters, stage, co, name, output_fds, pro, ff_protection
         else:
             output_lmf_df = output_fds
 
+        if steiner or duct_sharing != '#':
+            # The clusters are connected on the graph, the lengths are taken from the pieces of the routes
+            graph = ng.get_graph(network_nd)
+            weights = graph_weights(graph, brownfield_duct)
+            pieces_all = []
+
+        if steiner and duct_sharing != '#':
+            arcpy.AddWarning('The Steiner trees share the ducts already, the duct sharing is not applied')
+        elif duct_sharing != '#':
+            # The ducts of the clusters routed before are shared as well
+            weights_shared = list(graph['weight'] if weights is None else weights)
+            shared = set()
+            pieces_sp = []
+
         for i in range(n_clusters):
             cluster = os.path.join(output_clusters, 'Cluster_{0}_{1}'.format(i, name))
             cluster_head = os.path.join(output_clusters, 'Cluster_head_{0}_{1}'.format(i, name))
             name_out = 'SP_{0}_{1}_{2}'.format(stage, i, name)
             check_exists(os.path.join(output_lmf_df, name_out))
-
-            if brownfield_duct != '#':
+            if not save_lmf_df:
+                # The routes of the single clusters are only merged
+                sw.track(os.path.join(output_lmf_df, name_out))
+
+            if steiner:
+                route, pieces = route_fiber_steiner(graph, cluster, cluster_head, name_out, output_lmf_df, weights)
+                pieces_all.extend(pieces)
+            elif duct_sharing != '#':
+                route, routes, routes_sp, head_ids = route_fiber_shared(graph, cluster, cluster_head, name_out,
+                                                                        output_lmf_df, weights_shared, duct_sharing,
+                                                                        shared, weights)
+                pieces_all.extend(pieces for k, j, pieces in routes)
+                pieces_sp.extend(pieces for k, j, pieces in routes_sp)
+            elif brownfield_duct != '#':
                 route = route_fiber(network_nd, cluster, cluster_head, name_out, output_lmf_df, pro,
                                     brownfield_duct=brownfield_duct)
             else:
@@ -324,7 +522,16 @@ def main(network_nd, n_clusters, stage, co, name, output_fds, pro, ff_protection
         check_exists(path_out)
         routes_all = arcpy.Merge_management(routes_all_list, path_out)
 
-        fiber_w, duct_w, fiber_p, duct_p = post_processing_fiber(routes_all)
+        if steiner or duct_sharing != '#':
+            fiber_w = float(sum(ng.pieces_length(pieces) for pieces in pieces_all))
+            duct_w = ng.pieces_duct_length(pieces_all)
+            fiber_p, duct_p = 0, 0
+
+            if not steiner and planning_result_in is not None:
+                sharing = planning_result_in.setdefault('duct_sharing', {})
+                sharing[stage.lower()] = sharing_result(pieces_all, pieces_sp, duct_sharing)
+        else:
+            fiber_w, duct_w, fiber_p, duct_p = post_processing_fiber(routes_all)
 
     elif stage == 'FF':
         if p2p_demands == '#':
@@ -335,7 +542,48 @@ def main(network_nd, n_clusters, stage, co, name, output_fds, pro, ff_protection
         name_out = 'SP_{0}_{1}'.format(stage, name)
         check_exists(os.path.join('in_memory', name_out))
 
-        if not ff_protection:
+        n_co = int(arcpy.GetCount_management(co).getOutput(0))
+
+        if duct_sharing != '#' and (ff_protection or co_capacity != '#'):
+            arcpy.AddWarning('The duct sharing is not applied to the feeder with the protection or the CO capacity')
+
+        if not ff_protection and duct_sharing != '#' and co_capacity == '#':
+            # The feeder routes share the ducts, the COs as the facilities of one search
+            graph = ng.get_graph(network_nd)
+            weights = graph_weights(graph, brownfield_duct)
+            weights_shared = list(graph['weight'] if weights is None else weights)
+
+            check_exists(os.path.join(output_fds, name_out))
+            ff_routes, routes, routes_sp, co_ids = route_fiber_shared(graph, cluster, co, name_out, output_fds,
+                                                                      weights_shared, duct_sharing, weights_sp=weights)
+            pieces_all = [pieces for k, j, pieces in routes]
+            fiber_w = float(sum(ng.pieces_length(pieces) for pieces in pieces_all))
+            duct_w = ng.pieces_duct_length(pieces_all)
+            fiber_p, duct_p = 0, 0
+
+            if planning_result_in is not None:
+                sharing = planning_result_in.setdefault('duct_sharing', {})
+                sharing['ff'] = sharing_result(pieces_all, [pieces for k, j, pieces in routes_sp], duct_sharing)
+                if n_co > 1:
+                    planning_result_in['co'] = co_lengths(co_ids, routes)
+
+            path_out = ff_routes
+
+        elif not ff_protection and (n_co > 1 or co_capacity != '#'):
+            # Several COs: one multi-source search on the graph assigns every head to its nearest CO
+            graph = ng.get_graph(network_nd)
+            weights = graph_weights(graph, brownfield_duct)
+
+            check_exists(os.path.join(output_fds, name_out))
+            ff_routes, per_co = route_fiber_co(graph, cluster, co, name_out, output_fds, weights, co_capacity)
+            fiber_w, duct_w, fiber_p, duct_p = post_processing_fiber(ff_routes)
+
+            if planning_result_in is not None:
+                planning_result_in['co'] = per_co
+
+            path_out = ff_routes
+
+        elif not ff_protection:
             if brownfield_duct == '#':
                 ff_routes = route_fiber(network_nd, cluster, co, name_out, output_fds, pro)[0]
             else:
@@ -344,6 +592,19 @@ def main(network_nd, n_clusters, stage, co, name, output_fds, pro, ff_protection
             fiber_w, duct_w, fiber_p, duct_p = post_processing_fiber(ff_routes)
 
             path_out = ff_routes
+        elif co_capacity != '#':
+            # The heads are assigned to the COs within their ports on the graph, the protection follows the routes
+            graph = ng.get_graph(network_nd)
+            weights = graph_weights(graph, brownfield_duct)
+
+            check_exists(os.path.join(output_fds, name_out))
+            ff_routes, ff_routes_protection = route_fiber_graph(graph, cluster, co, name_out, output_fds, weights,
+                                                                ff_protection, sp_protection_in, co_capacity,
+                                                                planning_result_in)
+            path_out = ff_routes
+            path_out_p = ff_routes_protection
+
+            fiber_w, duct_w, fiber_p, duct_p = post_processing_fiber(ff_routes, ff_routes_protection)
         else:
             if brownfield_duct == '#':
                 ff_routes, ff_routes_protection = route_fiber(network_nd, cluster, co, name_out, output_fds, pro,
@@ -357,6 +618,10 @@ def main(network_nd, n_clusters, stage, co, name, output_fds, pro, ff_protection
 
             fiber_w, duct_w, fiber_p, duct_p = post_processing_fiber(ff_routes, ff_routes_protection)
 
+    scratch_usage = sw.end_stage()
+    if planning_result_in is not None:
+        planning_result_in.setdefault('scratch', {})[stage.lower()] = scratch_usage
+
     return fiber_w, duct_w, fiber_p, duct_p, path_out, path_out_p
 
 if __name__ == '__main__':
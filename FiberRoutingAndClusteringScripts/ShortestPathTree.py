@@ -0,0 +1,297 @@
+import os
+
+import numpy as np
+
+import NetworkGraph as ng
+
+
+def search(graph, co_locations, weights=None):
+    """
+    The complete search from the COs, it does not depend on the demands, so it can be shared by all the trees on the
+    same network.
+
+    :param graph: graph, dict
+    :param co_locations: list of (edge id, offset along the edge) pairs
+    :param weights: edge weights, the edge lengths if None
+    :return: distances, predecessor edges and the index of the source - dicts over the nodes
+    """
+    if weights is None:
+        weights = np.asarray(graph['weight'], dtype=np.float64)
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+    factor = weights / np.maximum(graph['edge_length'], 1e-9)
+
+    sources = []
+    for edge, pos in co_locations:
+        sources.append((int(graph['edge_u'][edge]), pos * factor[edge]))
+        sources.append((int(graph['edge_v'][edge]), (graph['edge_length'][edge] - pos) * factor[edge]))
+
+    return ng.dijkstra(graph, sources, weights)
+
+
+def build_tree(graph, co_locations, demand_locations, weights=None, search_in=None):
+    """
+    This function keeps the P2P feeder as one shortest path tree instead of one polyline per demand. Every node of the
+    tree stores only its parent edge, every demand the node where it leaves the tree and its offset on the last edge.
+    The path of a demand is followed back along the parent edges only when its geometry is needed.
+
+    :param graph: graph, dict
+    :param co_locations: list of (edge id, offset along the edge) pairs
+    :param demand_locations: list of (edge id, offset along the edge) pairs
+    :param weights: edge weights, the edge lengths if None
+    :param search_in: result of search for the same COs and weights, it is computed if None
+    :return: tree, dict of arrays
+    """
+    if weights is None:
+        weights = np.asarray(graph['weight'], dtype=np.float64)
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+    factor = weights / np.maximum(graph['edge_length'], 1e-9)
+
+    if search_in is None:
+        search_in = search(graph, co_locations, weights)
+    dist, pred, root = search_in
+
+    n_nodes = graph['n_nodes']
+    parent_edge = np.full(n_nodes, -1, dtype=np.int64)
+    seed = np.full(n_nodes, -1, dtype=np.int64)
+    for node, edge in pred.items():
+        if edge == -1:
+            seed[node] = root[node] // 2
+        else:
+            parent_edge[node] = edge
+
+    # The nodes from the farthest to the closest, so the subtree of a node is complete before its parent
+    reached = np.asarray(list(dist.keys()), dtype=np.int64)
+    order = reached[np.argsort(np.asarray(list(dist.values())), kind='mergesort')[::-1]]
+
+    cos_on_edge = {}
+    for k, (edge, pos) in enumerate(co_locations):
+        cos_on_edge.setdefault(edge, []).append(k)
+
+    n = len(demand_locations)
+    leaf_node = np.full(n, -1, dtype=np.int64)
+    leaf_co = np.full(n, -1, dtype=np.int64)
+    leaf_edge = np.zeros(n, dtype=np.int64)
+    leaf_pos = np.zeros(n)
+
+    inf = float('inf')
+    for i, (edge, pos) in enumerate(demand_locations):
+        u = int(graph['edge_u'][edge])
+        v = int(graph['edge_v'][edge])
+        length_e = float(graph['edge_length'][edge])
+
+        best = (dist.get(u, inf) + pos * factor[edge], u)
+        best = min(best, (dist.get(v, inf) + (length_e - pos) * factor[edge], v))
+
+        # Directly along the edge from a CO on the same edge
+        for k in cos_on_edge.get(edge, []):
+            d = abs(co_locations[k][1] - pos) * factor[edge]
+            if d <= best[0]:
+                best = (d, -1)
+                leaf_co[i] = k
+
+        leaf_edge[i] = edge
+        leaf_pos[i] = pos
+        if best[0] == inf:
+            leaf_node[i] = -2
+        elif best[1] != -1:
+            leaf_node[i] = best[1]
+            leaf_co[i] = -1
+
+    tree = {'parent_edge': parent_edge,
+            'seed': seed,
+            'order': order,
+            'co_edge': np.asarray([edge for edge, pos in co_locations], dtype=np.int64),
+            'co_pos': np.asarray([pos for edge, pos in co_locations], dtype=np.float64),
+            'leaf_node': leaf_node,
+            'leaf_co': leaf_co,
+            'leaf_edge': leaf_edge,
+            'leaf_pos': leaf_pos}
+
+    return tree
+
+
+def seed_piece(graph, tree, node):
+    """
+    :return: the piece from the CO to the root node of its subtree
+    """
+    k = tree['seed'][node]
+    edge = int(tree['co_edge'][k])
+    end = 0.0 if node == int(graph['edge_u'][edge]) else float(graph['edge_length'][edge])
+    return edge, float(tree['co_pos'][k]), end
+
+
+def leaf_piece(graph, tree, i):
+    """
+    :return: the piece from the tree to the demand, from the CO if the demand is on the edge of the CO
+    """
+    edge = int(tree['leaf_edge'][i])
+    node = tree['leaf_node'][i]
+    if node == -1:
+        return edge, float(tree['co_pos'][tree['leaf_co'][i]]), float(tree['leaf_pos'][i])
+    start = 0.0 if node == int(graph['edge_u'][edge]) else float(graph['edge_length'][edge])
+    return edge, start, float(tree['leaf_pos'][i])
+
+
+def subtree_demands(graph, tree):
+    """
+    :return: the number of the demands below every node, array (n_nodes)
+    """
+    count = np.bincount(tree['leaf_node'][tree['leaf_node'] >= 0], minlength=graph['n_nodes'])
+    parent_edge = tree['parent_edge']
+    for node in tree['order'].tolist():
+        edge = parent_edge[node]
+        if edge != -1 and count[node] > 0:
+            count[ng.other_end(graph, edge, node)] += count[node]
+    return count
+
+
+def tree_pieces(graph, tree):
+    """
+    This function lists the pieces of the tree, each with the number of the demands, whose route uses it.
+
+    :return: list of (edge id, offset from, offset to, number of the demands) tuples
+    """
+    count = subtree_demands(graph, tree)
+    pieces = []
+
+    used = np.nonzero((count > 0) & (tree['parent_edge'] >= 0))[0]
+    for node in used.tolist():
+        edge = int(tree['parent_edge'][node])
+        pieces.append((edge, 0.0, float(graph['edge_length'][edge]), int(count[node])))
+
+    for node in np.nonzero((count > 0) & (tree['seed'] >= 0))[0].tolist():
+        edge, a, b = seed_piece(graph, tree, node)
+        pieces.append((edge, a, b, int(count[node])))
+
+    for i in np.nonzero(tree['leaf_node'] != -2)[0].tolist():
+        edge, a, b = leaf_piece(graph, tree, i)
+        pieces.append((edge, a, b, 1))
+
+    return [piece for piece in pieces if piece[1] != piece[2]]
+
+
+def tree_lengths(graph, tree):
+    """
+    The fiber is the length of every piece times the number of the demands routed over it, the duct is the union of
+    the pieces.
+
+    :return: fiber length, duct length - meters
+    """
+    pieces = tree_pieces(graph, tree)
+    fiber = float(sum(abs(b - a) * n for edge, a, b, n in pieces))
+    duct = ng.pieces_duct_length([[(edge, a, b) for edge, a, b, n in pieces]])
+    return fiber, duct
+
+
+def demand_pieces(graph, tree, i):
+    """
+    This function follows the parent edges from the demand back to its CO.
+
+    :param graph: graph, dict
+    :param tree: tree, dict
+    :param i: index of the demand
+    :return: list of (edge id, offset from, offset to) pieces from the CO to the demand, empty if not reached
+    """
+    node = tree['leaf_node'][i]
+    if node == -2:
+        return []
+
+    last = leaf_piece(graph, tree, i)
+    if node == -1:
+        return [last]
+
+    pieces = [last]
+    node = int(node)
+    while tree['parent_edge'][node] != -1:
+        edge = int(tree['parent_edge'][node])
+        parent = ng.other_end(graph, edge, node)
+        if parent == int(graph['edge_u'][edge]):
+            pieces.append((edge, 0.0, float(graph['edge_length'][edge])))
+        else:
+            pieces.append((edge, float(graph['edge_length'][edge]), 0.0))
+        node = parent
+    pieces.append(seed_piece(graph, tree, node))
+    pieces.reverse()
+
+    return [piece for piece in pieces if piece[1] != piece[2]]
+
+
+def write_tree(graph, tree, output_fc_in, name_in):
+    """
+    This function saves the tree once: one feature per piece with the number of the demands routed over it.
+
+    :return: path to the feature class
+    """
+    import arcpy
+
+    spatial_ref = arcpy.SpatialReference()
+    spatial_ref.loadFromString(graph['spatial_reference'])
+
+    out_path = os.path.join(output_fc_in, name_in)
+    if arcpy.Exists(out_path):
+        arcpy.Delete_management(out_path)
+
+    arcpy.CreateFeatureclass_management(output_fc_in, name_in, 'POLYLINE', spatial_reference=spatial_ref)
+    arcpy.AddField_management(out_path, 'Demands', 'LONG')
+    arcpy.AddField_management(out_path, 'Total_Length', 'DOUBLE')
+
+    with arcpy.da.InsertCursor(out_path, ['SHAPE@', 'Demands', 'Total_Length']) as cursor:
+        for edge, a, b, n in tree_pieces(graph, tree):
+            vertices = ng.edge_cut(graph, edge, a, b)
+            shape = arcpy.Polyline(arcpy.Array([arcpy.Point(x, y) for x, y in vertices]), spatial_ref)
+            cursor.insertRow([shape, n, abs(b - a)])
+
+    return out_path
+
+
+def export_routes(graph, tree, demand_ids, co_ids, output_fc_in, name_in):
+    """
+    This function materializes the route of every demand, e.g., for the export to the other tools. The routes are
+    generated one by one while they are written, so they are never all in the memory.
+
+    :return: path to the feature class
+    """
+    def routes():
+        for i, demand_id in enumerate(demand_ids):
+            pieces = demand_pieces(graph, tree, i)
+            if not pieces:
+                continue
+            yield (co_ids[root_co(graph, tree, i)], demand_id, ng.pieces_vertices(graph, pieces),
+                   ng.pieces_length(pieces))
+
+    return ng.write_routes(graph, routes(), output_fc_in, name_in)
+
+
+def root_co(graph, tree, i):
+    """
+    :return: index of the CO the demand is connected to
+    """
+    node = tree['leaf_node'][i]
+    if node == -1:
+        return int(tree['leaf_co'][i])
+
+    node = int(node)
+    while tree['parent_edge'][node] != -1:
+        node = ng.other_end(graph, int(tree['parent_edge'][node]), node)
+    return int(tree['seed'][node])
+
+
+def save_tree(tree, path_in):
+    """
+    :param tree: tree, dict
+    :param path_in: path to the .npz file
+    :return:
+    """
+    np.savez(path_in, **tree)
+    return
+
+
+def load_tree(path_in):
+    """
+    :param path_in: path to the .npz file
+    :return: tree, dict
+    """
+    data = np.load(path_in)
+    return dict((key, data[key]) for key in data.files)
@@ -0,0 +1,411 @@
+import heapq
+import itertools
+
+import numpy as np
+
+import NetworkGraph as ng
+
+
+def end_pos(graph, edge, node):
+    """
+    :return: offset of the end node along the edge
+    """
+    return 0.0 if node == int(graph['edge_u'][edge]) else float(graph['edge_length'][edge])
+
+
+def piece_cost(graph, piece, weights):
+    """
+    :return: weighted length of the (edge id, offset from, offset to) piece
+    """
+    edge, a, b = piece
+    return abs(b - a) * weights[edge] / max(graph['edge_length'][edge], 1e-9)
+
+
+def mehlhorn(graph, terminals_in, weights):
+    """
+    Mehlhorn's 2-approximation of the Steiner tree. One search from all the terminals splits the graph into their
+    Voronoi regions, every edge between two regions is a bridge between their terminals and the minimum spanning tree
+    of the bridges is the tree. The bridges are merged while the search runs: a bridge is final as soon as the search
+    is past its cost, so the search stops when all the terminals are connected and only the neighbourhood of the
+    terminals is explored.
+
+    :param graph: graph, dict
+    :param terminals_in: list of (edge id, offset along the edge) pairs
+    :param weights: edge weights, list
+    :return: dict (vertex, vertex) - piece, the vertices are the nodes and n_nodes + the index of the terminal
+    """
+    n_nodes = graph['n_nodes']
+    indptr = graph['indptr']
+    adj_node = graph['adj_node']
+    adj_edge = graph['adj_edge']
+    inf = float('inf')
+
+    def scaled(edge, length):
+        return length * weights[edge] / max(graph['edge_length'][edge], 1e-9)
+
+    # Union-find over the terminals
+    parent = list(range(len(terminals_in)))
+
+    def find(t):
+        while parent[t] != t:
+            parent[t] = parent[parent[t]]
+            t = parent[t]
+        return t
+
+    counter = itertools.count()
+    bridges = []
+
+    # The terminals on the same edge are bridged directly along it
+    on_edge = {}
+    for t, (edge, pos) in enumerate(terminals_in):
+        on_edge.setdefault(edge, []).append((pos, t))
+    for edge, items in on_edge.items():
+        items.sort()
+        for (pos_a, t_a), (pos_b, t_b) in zip(items[:-1], items[1:]):
+            bridges.append((scaled(edge, pos_b - pos_a), next(counter), 'direct', (t_a, t_b)))
+    heapq.heapify(bridges)
+
+    dist = {}
+    pred = {}
+    root = {}
+    attach = {}
+    heap = []
+    for t, (edge, pos) in enumerate(terminals_in):
+        for node, offset in ((int(graph['edge_u'][edge]), scaled(edge, pos)),
+                             (int(graph['edge_v'][edge]), scaled(edge, graph['edge_length'][edge] - pos))):
+            attach.setdefault(node, []).append((t, offset))
+            if offset < dist.get(node, inf):
+                dist[node] = offset
+                pred[node] = -1
+                root[node] = t
+                heap.append((offset, node))
+    heapq.heapify(heap)
+
+    settled = set()
+    chosen = []
+    components = len(terminals_in)
+    while components > 1:
+        # Every bridge not found yet goes through a node that is not settled, so it is not cheaper than the front
+        front = heap[0][0] if heap else inf
+        while bridges and bridges[0][0] <= front and components > 1:
+            cost, k, kind, data = heapq.heappop(bridges)
+            root_a, root_b = find(data[0]), find(data[1])
+            if root_a != root_b:
+                parent[root_a] = root_b
+                components -= 1
+                chosen.append((kind, data))
+        if components == 1 or not heap:
+            break
+
+        d, node = heapq.heappop(heap)
+        if node in settled:
+            continue
+        settled.add(node)
+        r = root[node]
+
+        # A terminal reached through the end of its edge from another region
+        for t, offset in attach.get(node, ()):
+            if t != r:
+                heapq.heappush(bridges, (d + offset, next(counter), 'attach', (t, r, node)))
+
+        for k in range(indptr[node], indptr[node + 1]):
+            nbr = adj_node[k]
+            edge = adj_edge[k]
+            nd = d + weights[edge]
+            if nbr in settled:
+                if root[nbr] != r:
+                    heapq.heappush(bridges, (nd + dist[nbr], next(counter), 'cross', (r, root[nbr], node, nbr, edge)))
+            elif nd < dist.get(nbr, inf):
+                dist[nbr] = nd
+                pred[nbr] = edge
+                root[nbr] = r
+                heapq.heappush(heap, (nd, nbr))
+
+    # The tree: the bridges and the paths from their ends back to the terminals of the regions
+    tree = {}
+    in_tree = set()
+
+    def add(vertex_a, vertex_b, piece):
+        if (vertex_b, vertex_a) not in tree:
+            tree[(vertex_a, vertex_b)] = piece
+
+    def trace(node):
+        while node not in in_tree:
+            in_tree.add(node)
+            edge = pred[node]
+            if edge == -1:
+                t = root[node]
+                t_edge, t_pos = terminals_in[t]
+                add(node, n_nodes + t, (t_edge, end_pos(graph, t_edge, node), float(t_pos)))
+                break
+            previous = ng.other_end(graph, edge, node)
+            add(previous, node, (edge, end_pos(graph, edge, previous), end_pos(graph, edge, node)))
+            node = previous
+
+    for kind, data in chosen:
+        if kind == 'direct':
+            t_a, t_b = data
+            edge = terminals_in[t_a][0]
+            add(n_nodes + t_a, n_nodes + t_b, (edge, float(terminals_in[t_a][1]), float(terminals_in[t_b][1])))
+        elif kind == 'attach':
+            t, r, node = data
+            t_edge, t_pos = terminals_in[t]
+            add(n_nodes + t, node, (t_edge, float(t_pos), end_pos(graph, t_edge, node)))
+            trace(node)
+        else:
+            r_a, r_b, node_a, node_b, edge = data
+            add(node_a, node_b, (edge, end_pos(graph, edge, node_a), end_pos(graph, edge, node_b)))
+            trace(node_a)
+            trace(node_b)
+
+    return tree
+
+
+def tree_adjacency(tree_in):
+    """
+    :return: dict vertex - dict neighbour - (vertex, vertex) key of the tree edge
+    """
+    adjacency = {}
+    for key in tree_in:
+        adjacency.setdefault(key[0], {})[key[1]] = key
+        adjacency.setdefault(key[1], {})[key[0]] = key
+    return adjacency
+
+
+def key_paths(graph, tree_in, adjacency):
+    """
+    The key paths are the paths of the tree between the terminals and the branching nodes, all their inner nodes are
+    the Steiner nodes of degree two.
+
+    :return: list of (list of the tree edges, list of the inner vertices, first vertex, last vertex) tuples
+    """
+    n_nodes = graph['n_nodes']
+
+    def is_key(vertex):
+        return vertex >= n_nodes or len(adjacency.get(vertex, ())) != 2
+
+    paths = []
+    for start in list(adjacency):
+        if not is_key(start):
+            continue
+        for nbr, key in adjacency[start].items():
+            edges = [key]
+            inner = []
+            previous, vertex = start, nbr
+            while not is_key(vertex):
+                inner.append(vertex)
+                following = [v for v in adjacency[vertex] if v != previous][0]
+                edges.append(adjacency[vertex][following])
+                previous, vertex = vertex, following
+            # Every path is found from both of its ends
+            if start < vertex:
+                paths.append((edges, inner, start, vertex))
+    return paths
+
+
+def component(adjacency, vertex):
+    """
+    :return: the vertices of the part of the tree with the vertex, list
+    """
+    seen = set([vertex])
+    stack = [vertex]
+    while stack:
+        for nbr in adjacency[stack.pop()]:
+            if nbr not in seen:
+                seen.add(nbr)
+                stack.append(nbr)
+    # The nodes first, so they are preferred to the terminals at the same node
+    return sorted(seen)
+
+
+def reconnect(graph, terminals_in, weights, component_a, component_b, cutoff):
+    """
+    This function finds the shortest connection between the two parts of the tree, which is cheaper than the cutoff.
+    All the nodes of the first part are the sources, the terminals are reached along their edges.
+
+    :return: list of the new tree edges (vertex, vertex, piece) or None
+    """
+    n_nodes = graph['n_nodes']
+    indptr = graph['indptr']
+    adj_node = graph['adj_node']
+    adj_edge = graph['adj_edge']
+    inf = float('inf')
+
+    def ends(vertex):
+        t_edge, t_pos = terminals_in[vertex - n_nodes]
+        return ((int(graph['edge_u'][t_edge]), piece_cost(graph, (t_edge, 0.0, t_pos), weights)),
+                (int(graph['edge_v'][t_edge]), piece_cost(graph, (t_edge, t_pos, graph['edge_length'][t_edge]),
+                                                          weights)))
+
+    dist = {}
+    pred = {}
+    source = {}
+    for vertex in component_a:
+        for node, offset in (((vertex, 0.0),) if vertex < n_nodes else ends(vertex)):
+            if offset < dist.get(node, inf):
+                dist[node] = offset
+                pred[node] = -1
+                source[node] = vertex
+
+    target = {}
+    for vertex in component_b:
+        for node, offset in (((vertex, 0.0),) if vertex < n_nodes else ends(vertex)):
+            if offset < target.get(node, (inf, -1))[0]:
+                target[node] = (offset, vertex)
+
+    heap = [(d, node) for node, d in dist.items()]
+    heapq.heapify(heap)
+
+    best = (cutoff, -1)
+    settled = set()
+    while heap:
+        d, node = heapq.heappop(heap)
+        if d >= best[0]:
+            break
+        if node in settled:
+            continue
+        settled.add(node)
+        if node in target and d + target[node][0] < best[0]:
+            best = (d + target[node][0], node)
+        for k in range(indptr[node], indptr[node + 1]):
+            nd = d + weights[adj_edge[k]]
+            if nd < dist.get(adj_node[k], inf) and nd < best[0]:
+                dist[adj_node[k]] = nd
+                pred[adj_node[k]] = adj_edge[k]
+                heapq.heappush(heap, (nd, adj_node[k]))
+
+    if best[1] == -1:
+        return None
+
+    node = best[1]
+    new_edges = []
+    vertex_b = target[node][1]
+    if vertex_b != node:
+        t_edge, t_pos = terminals_in[vertex_b - n_nodes]
+        new_edges.append((node, vertex_b, (t_edge, end_pos(graph, t_edge, node), float(t_pos))))
+    while pred[node] != -1:
+        edge = pred[node]
+        previous = ng.other_end(graph, edge, node)
+        new_edges.append((previous, node, (edge, end_pos(graph, edge, previous), end_pos(graph, edge, node))))
+        node = previous
+    vertex_a = source[node]
+    if vertex_a != node:
+        t_edge, t_pos = terminals_in[vertex_a - n_nodes]
+        new_edges.append((vertex_a, node, (t_edge, float(t_pos), end_pos(graph, t_edge, node))))
+    return new_edges
+
+
+def improve_key_paths(graph, terminals_in, tree_in, weights, max_rounds=2):
+    """
+    Key-path exchange: every key path is removed from the tree and the two parts are joined again by the shortest
+    connection between them, if it is cheaper. The rounds are repeated until no key path is replaced.
+
+    :param graph: graph, dict
+    :param terminals_in: list of (edge id, offset along the edge) pairs
+    :param tree_in: tree, see mehlhorn, it is changed in place
+    :param weights: edge weights, list
+    :param max_rounds: maximum number of the rounds
+    :return: number of the replaced key paths
+    """
+    replaced = 0
+    for _ in range(max_rounds):
+        adjacency = tree_adjacency(tree_in)
+        improved = False
+        for edges, inner, first, last in key_paths(graph, tree_in, adjacency):
+            # An earlier exchange of the round could have changed the path
+            if any(key not in tree_in for key in edges) or any(len(adjacency[v]) != 2 for v in inner):
+                continue
+            cost = sum(piece_cost(graph, tree_in[key], weights) for key in edges)
+
+            for key in edges:
+                del adjacency[key[0]][key[1]]
+                del adjacency[key[1]][key[0]]
+
+            new_edges = reconnect(graph, terminals_in, weights, component(adjacency, first), component(adjacency, last),
+                                  cost - 1e-9)
+            if new_edges is None:
+                for key in edges:
+                    adjacency[key[0]][key[1]] = key
+                    adjacency[key[1]][key[0]] = key
+                continue
+
+            for key in edges:
+                del tree_in[key]
+            for v in inner:
+                del adjacency[v]
+            for vertex_a, vertex_b, piece in new_edges:
+                tree_in[(vertex_a, vertex_b)] = piece
+                adjacency.setdefault(vertex_a, {})[vertex_b] = (vertex_a, vertex_b)
+                adjacency.setdefault(vertex_b, {})[vertex_a] = (vertex_a, vertex_b)
+            replaced += 1
+            improved = True
+
+        if not improved:
+            break
+    return replaced
+
+
+def steiner_tree(graph, terminals_in, weights=None, improve=True, max_rounds=2):
+    """
+    :param graph: graph, dict
+    :param terminals_in: list of (edge id, offset along the edge) pairs
+    :param weights: edge weights, the edge lengths if None
+    :param improve: if the key paths are exchanged after Mehlhorn's tree, binary
+    :param max_rounds: maximum number of the rounds of the key-path exchange
+    :return: tree, dict (vertex, vertex) - (edge id, offset from, offset to) piece, the vertices are the nodes and
+             n_nodes + the index of the terminal
+    """
+    if weights is None:
+        weights = graph['weight']
+    elif isinstance(weights, np.ndarray):
+        weights = weights.tolist()
+
+    tree = mehlhorn(graph, terminals_in, weights)
+    if improve and len(terminals_in) > 2:
+        improve_key_paths(graph, terminals_in, tree, weights, max_rounds)
+    return tree
+
+
+def route_pieces(graph, facility_in, incidents_in, weights=None, improve=True):
+    """
+    This function routes the incidents from the facility along one Steiner tree, so the routes share the trenches.
+    The fiber to every incident follows the tree, the duct is the length of the tree.
+
+    :param graph: graph, dict
+    :param facility_in: (edge id, offset along the edge) pair
+    :param incidents_in: list of (edge id, offset along the edge) pairs
+    :param weights: edge weights, the edge lengths if None
+    :param improve: if the key paths are exchanged, binary
+    :return: list of (0, incident index, list of (edge id, offset from, offset to) pieces) tuples as in
+             NetworkGraph.route_pieces, the incidents not connected to the facility are left out
+    """
+    n_nodes = graph['n_nodes']
+    tree = steiner_tree(graph, [facility_in] + list(incidents_in), weights, improve)
+    adjacency = tree_adjacency(tree)
+
+    # The tree from the facility: the parent of every vertex and the pieces oriented from the parent
+    head = n_nodes
+    parent = {head: (None, None)}
+    stack = [head]
+    while stack:
+        vertex = stack.pop()
+        for nbr, key in adjacency.get(vertex, {}).items():
+            if nbr in parent:
+                continue
+            edge, a, b = tree[key]
+            parent[nbr] = (vertex, (edge, a, b) if key[0] == vertex else (edge, b, a))
+            stack.append(nbr)
+
+    routes = []
+    for i in range(len(incidents_in)):
+        vertex = n_nodes + 1 + i
+        if vertex not in parent:
+            continue
+        pieces = []
+        while vertex != head:
+            vertex, piece = parent[vertex]
+            if piece[1] != piece[2]:
+                pieces.append(piece)
+        routes.append((0, i, pieces[::-1]))
+
+    return routes
@@ -0,0 +1,381 @@
+import os
+import json
+import multiprocessing
+
+import numpy as np
+
+import NetworkGraph as ng
+
+# Routed stages and the keys of their fiber and duct lengths in the planning result
+STAGE_KEYS = {'LMF': ('lmf', 'lm_d'),
+              'DF': ('df', 'd_d')}
+
+
+def check_exists(name_in):
+    """
+    This function check existence of the feature class, which name is specified, and deletes it, if it exists. Some
+    arcpy functions even with the activated overwrite output return errors if the feature class already exists
+
+    :param name_in: check if this file already exists
+    :return:
+    """
+    import arcpy
+
+    if arcpy.Exists(name_in):
+        arcpy.Delete_management(name_in)
+    return
+
+
+def make_tiles(demands_xy, geographic, tile_size, halo):
+    """
+    This function partitions the demands into the square tiles. Every demand belongs to the core of exactly one tile,
+    the halo around the core only extends the candidate locations of the remote nodes, so the clusters at the tile
+    borders can still use the intersections across the border.
+
+    :param demands_xy: coordinates of the demands, array (n, 2)
+    :param geographic: if the coordinates are in degrees, binary
+    :param tile_size: side of the tile core, meters
+    :param halo: width of the halo around the core, meters
+    :return: list of the tiles, every tile is a dict with the 'members' (indices of the demands) and the 'box' (extent
+             of the core with the halo in the coordinates of the demands)
+    """
+    scale = ng.metric_scale(geographic, float(np.mean(demands_xy[:, 1])))
+    origin = demands_xy.min(axis=0)
+
+    cells = np.floor((demands_xy - origin) * scale / tile_size).astype(np.int64)
+
+    tiles = []
+    for key in sorted(set(map(tuple, cells.tolist()))):
+        members = np.nonzero((cells[:, 0] == key[0]) & (cells[:, 1] == key[1]))[0]
+        low = origin + (np.asarray(key) * tile_size - halo) / scale
+        high = origin + ((np.asarray(key) + 1) * tile_size + halo) / scale
+        tiles.append({'members': members, 'box': (low[0], low[1], high[0], high[1])})
+
+    return tiles
+
+
+def select_by_ids(fc_in, ids_in, out_path):
+    """
+    This function copies the features with the given object ids.
+
+    :param fc_in: feature class
+    :param ids_in: list of the object ids
+    :param out_path: path to the copy
+    :return: path to the copy
+    """
+    import arcpy
+
+    oid_field = arcpy.Describe(fc_in).OIDFieldName
+
+    layer = 'tile_selection'
+    check_exists(layer)
+    clause = '{0} IN ({1})'.format(arcpy.AddFieldDelimiters(fc_in, oid_field), ','.join(str(i) for i in ids_in))
+    arcpy.MakeFeatureLayer_management(fc_in, layer, clause)
+
+    check_exists(out_path)
+    arcpy.CopyFeatures_management(layer, out_path)
+    arcpy.Delete_management(layer)
+
+    return out_path
+
+
+def plan_tile(job):
+    """
+    This function clusters and routes the last-mile and the distribution stages of one tile. It runs in a worker
+    process, so all the results are saved to the own geodatabase of the tile.
+
+    :param job: dict with the parameters of the tile
+    :return: dict with the path to the remote nodes for the feeder stage, the paths to the routes of every stage, the
+             number of the clusters of every stage and the statistics of the local search
+    """
+    import arcpy
+    import ShortestPathRouting as spr
+    import ClusteringLocationAllocation as clst
+
+    arcpy.env.overwriteOutput = True
+
+    network_nd = job['network_nd']
+    gdb = job['gdb']
+    demands = job['demands']
+    intersections = job['intersections']
+    name = job['name']
+    pro = job['pro']
+    brownfield_duct = job['brownfield_duct']
+    local_search = job['local_search']
+    facilities = 'Intersections'
+
+    if local_search != '#':
+        import LocalSearch as ls
+
+    def route(n_clusters, stage, name_clst):
+        return spr.main(network_nd, n_clusters, stage, '#', name_clst, gdb, pro, brownfield_duct=brownfield_duct,
+                        save_lmf_df=True, save_clusters=True, steiner=job['steiner'],
+                        duct_sharing=job['duct_sharing'])[4]
+
+    routes = {}
+    counts = {}
+    local_search_result = {}
+
+    if job['topology'] == 'fttb':
+        if job['clustering_allocation']:
+            name_clst = name + '_loc'
+            counts['lmf'] = clst.main(network_nd, demands, intersections, facilities, job['sr'], gdb, name_clst, pro,
+                                      '#')
+        else:
+            import BuildingsClusterCPM as cmpm
+            name_clst = name + '_cmpm'
+            counts['lmf'] = cmpm.main(network_nd, demands, job['sr'], intersections, gdb, pro, name_clst)
+
+        if local_search != '#':
+            local_search_result['lmf'] = ls.improve_clusters(network_nd, intersections, gdb, name_clst, counts['lmf'],
+                                                             job['sr'], job['co'], brownfield_duct,
+                                                             time_budget=local_search)
+
+        routes['LMF'] = route(counts['lmf'], 'LMF', name_clst)
+        name_heads = name_clst
+
+    elif job['topology'] == 'fttcab':
+        name_dsl = name + '_dsl_loc'
+        counts['dsl'] = clst.main(network_nd, demands, intersections, facilities, job['sr_dsl'], gdb, name_dsl, pro,
+                                  job['dsl_reach'], job['lines'])
+
+        if local_search != '#':
+            local_search_result['copper'] = ls.improve_clusters(network_nd, intersections, gdb, name_dsl,
+                                                                counts['dsl'], job['sr_dsl'],
+                                                                brownfield_duct=brownfield_duct,
+                                                                max_distance=job['dsl_reach'],
+                                                                time_budget=local_search)
+        cabinets = os.path.join(gdb, 'Cluster_heads_{0}'.format(name_dsl))
+
+        name_fiber = name + '_fiber'
+        counts['df'] = clst.main(network_nd, cabinets, intersections, facilities, job['sr'], gdb, name_fiber, pro)
+
+        if local_search != '#':
+            local_search_result['df'] = ls.improve_clusters(network_nd, intersections, gdb, name_fiber, counts['df'],
+                                                            job['sr'], job['co'], brownfield_duct,
+                                                            time_budget=local_search)
+
+        routes['DF'] = route(counts['df'], 'DF', name_fiber)
+        name_heads = name_fiber
+
+    else:
+        if job['clustering_allocation']:
+            name_rn2 = name + '_rn2_loc'
+            counts['lmf'] = clst.main(network_nd, demands, intersections, facilities, job['sr_rn2'], gdb, name_rn2,
+                                      pro)
+        else:
+            import BuildingsClusterCPM as cmpm
+            name_rn2 = name + '_rn2_cmpm'
+            counts['lmf'] = cmpm.main(network_nd, demands, job['sr_rn2'], intersections, gdb, pro, name_rn2)
+
+        if local_search != '#':
+            local_search_result['lmf'] = ls.improve_clusters(network_nd, intersections, gdb, name_rn2, counts['lmf'],
+                                                             job['sr_rn2'], brownfield_duct=brownfield_duct,
+                                                             time_budget=local_search)
+        rns2 = os.path.join(gdb, 'Cluster_heads_{0}'.format(name_rn2))
+
+        name_rn1 = name + '_rn1_loc'
+        counts['df'] = clst.main(network_nd, rns2, intersections, facilities, job['sr'], gdb, name_rn1, pro, '#')
+
+        if local_search != '#':
+            local_search_result['df'] = ls.improve_clusters(network_nd, intersections, gdb, name_rn1, counts['df'],
+                                                            job['sr'], job['co'], brownfield_duct,
+                                                            time_budget=local_search)
+
+        routes['LMF'] = route(counts['lmf'], 'LMF', name_rn2)
+        routes['DF'] = route(counts['df'], 'DF', name_rn1)
+        name_heads = name_rn1
+
+    return {'heads': os.path.join(gdb, 'Cluster_heads_{0}'.format(name_heads)), 'routes': routes, 'counts': counts,
+            'local_search': local_search_result}
+
+
+def main(network_nd, topology, ff_protection, sp_protection, demands, intersections, co, output_dir, output_fds,
+         output_name, tile_size, halo, n_workers=4, clustering_allocation=True, sr=32, sr_rn2=8, sr_dsl=8,
+         dsl_reach=1000, lines='#', brownfield_duct='#', pro=False, co_capacity='#', result_store='#',
+         local_search='#', steiner=False, duct_sharing='#'):
+    """
+    Tiled planning of the large service areas. The demands and the candidate remote node locations are partitioned into
+    the overlapping tiles, the last-mile and the distribution stages are clustered and routed per tile in parallel
+    workers and only the feeder stage is planned globally, from the remote nodes of all the tiles to the CO. The ducts
+    are merged over all the tiles, so the ducts across the tile borders are counted once.
+
+    :param topology: 'fttb' (FiberLayout), 'fttcab' or 'hpon' (2stage_ngpon)
+    :param tile_size: side of the tile core, meters
+    :param halo: width of the halo around the core, meters
+    :param n_workers: number of the worker processes
+    :param sr: splitting ratio of the remote nodes connected to the CO (RN1 for fttcab and hpon)
+    :param sr_rn2: splitting ratio of the second stage remote nodes (hpon)
+    :param sr_dsl: splitting ratio of the DSLAMs (fttcab)
+    :param co_capacity: ports of every CO, a number or the name of the field of the COs, '#' for no limit
+    :param result_store: the .sqlite file the run is appended to, see ResultStore, '#' if none
+    :param local_search: seconds of the local search improving every clustering stage of every tile, '#' for none
+    :param steiner: connect every cluster with the Steiner tree of the streets, binary
+    :param duct_sharing: factor of the weight of the streets already carrying fiber, '#' for none
+    :return: planning result, dict with the same keys as the one of the topology
+    :raise ValueError: if there are no demands
+    """
+    import arcpy
+    import ShortestPathRouting as spr
+
+    arcpy.env.overwriteOutput = True
+
+    # The tile boxes are computed from the demands, the intersections are compared to them in the same coordinates
+    spatial_ref = arcpy.Describe(demands).spatialReference
+    demand_ids, demands_xy = ng.read_points(demands)
+    intersection_ids, intersections_xy = ng.read_points(intersections,
+                                                        spatial_reference=spatial_ref.exportToString())
+
+    # A run without the demands has no result with the keys of the topology
+    if len(demand_ids) == 0:
+        raise ValueError('There are no demands in {0}, nothing to plan'.format(demands))
+
+    tiles = make_tiles(demands_xy, spatial_ref.type == 'Geographic', tile_size, halo)
+    arcpy.AddMessage('The service area was split into {0} tiles'.format(len(tiles)))
+
+    # Every tile gets its own geodatabase, the file geodatabases can not be written by several processes
+    jobs = []
+    for i, tile in enumerate(tiles):
+        gdb_name = '{0}_tile{1}.gdb'.format(output_name, i)
+        gdb = os.path.join(output_dir, gdb_name)
+        check_exists(gdb)
+        arcpy.CreateFileGDB_management(output_dir, gdb_name)
+
+        x_min, y_min, x_max, y_max = tile['box']
+        in_halo = (intersections_xy[:, 0] >= x_min) & (intersections_xy[:, 0] <= x_max) & \
+                  (intersections_xy[:, 1] >= y_min) & (intersections_xy[:, 1] <= y_max)
+        if not in_halo.any():
+            in_halo[:] = True
+
+        tile_demands = select_by_ids(demands, [demand_ids[k] for k in tile['members']],
+                                     os.path.join(gdb, 'Demands'))
+        tile_intersections = select_by_ids(intersections, [intersection_ids[k] for k in np.nonzero(in_halo)[0]],
+                                           os.path.join(gdb, 'Intersections'))
+
+        jobs.append({'network_nd': network_nd, 'gdb': gdb, 'demands': tile_demands,
+                     'intersections': tile_intersections, 'name': '{0}_tile{1}'.format(output_name, i), 'pro': pro,
+                     'topology': topology, 'clustering_allocation': clustering_allocation, 'sr': sr,
+                     'sr_rn2': sr_rn2, 'sr_dsl': sr_dsl, 'dsl_reach': dsl_reach, 'lines': lines,
+                     'brownfield_duct': brownfield_duct, 'co': co, 'local_search': local_search,
+                     'steiner': steiner, 'duct_sharing': duct_sharing})
+
+    if n_workers > 1:
+        pool = multiprocessing.Pool(max(1, min(n_workers, len(jobs))))
+        tile_results = pool.map(plan_tile, jobs)
+        pool.close()
+        pool.join()
+    else:
+        tile_results = [plan_tile(job) for job in jobs]
+
+    arcpy.AddMessage('All the tiles were planned, starting with the feeder fiber routing')
+
+    planning_result = {}
+    if local_search != '#':
+        planning_result['local_search'] = [result['local_search'] for result in tile_results]
+
+    # Stitch the routes of the tiles, the dissolve counts the shared ducts across the tile borders once
+    routes_all = []
+    for stage in sorted(tile_results[0]['routes'].keys()):
+        path_out = os.path.join(output_fds, 'SP_{0}_{1}_all_fiber'.format(stage, output_name))
+        check_exists(path_out)
+        arcpy.Merge_management([result['routes'][stage] for result in tile_results], path_out)
+
+        fiber_key, duct_key = STAGE_KEYS[stage]
+        planning_result[fiber_key], planning_result[duct_key] = spr.post_processing_fiber(path_out)[0:2]
+        routes_all.append(path_out)
+
+    # Feeder from the remote nodes of all the tiles
+    heads = os.path.join(output_fds, 'Cluster_heads_{0}'.format(output_name))
+    check_exists(heads)
+    arcpy.Merge_management([result['heads'] for result in tile_results], heads)
+
+    n_heads = int(arcpy.GetCount_management(heads).getOutput(0))
+    if not ff_protection:
+        planning_result['ff'], planning_result['f_d'], a, b, ff, c = spr.main(network_nd, n_heads, 'FF', co,
+                                                                              output_name, output_fds, pro,
+                                                                              brownfield_duct=brownfield_duct,
+                                                                              save_clusters=True,
+                                                                              co_capacity=co_capacity,
+                                                                              planning_result_in=planning_result,
+                                                                              duct_sharing=duct_sharing)
+        routes_all.append(ff)
+    else:
+        planning_result['ff'], planning_result['f_d'], \
+        planning_result['ff_sp_p'], planning_result['f_d_add_p'], ff, ff_p = spr.main(
+            network_nd, n_heads, 'FF', co, output_name, output_fds, pro, ff_protection, sp_protection,
+            brownfield_duct=brownfield_duct, save_clusters=True, co_capacity=co_capacity,
+            planning_result_in=planning_result, duct_sharing=duct_sharing)
+        routes_all.extend([ff, ff_p])
+
+    # Save total fibers and ducts to be used as brownfield for further scenarios
+    total_fiber = os.path.join(output_fds, 'Total_fiber_{0}'.format(output_name))
+    check_exists(total_fiber)
+    arcpy.Merge_management(routes_all, total_fiber)
+    arcpy.AddGeometryAttributes_management(total_fiber, 'LENGTH_GEODESIC', 'METERS')
+
+    total_duct = os.path.join(output_fds, 'Total_duct_{0}'.format(output_name))
+    check_exists(total_duct)
+    arcpy.Dissolve_management(total_fiber, total_duct)
+    arcpy.AddGeometryAttributes_management(total_duct, 'LENGTH_GEODESIC', 'METERS')
+
+    # Trench of the merged tiles and equipment counts of all the tiles for the cost evaluation, the same items as in
+    # the main of the topology
+    import CostModel as cm
+    planning_result['trench'], planning_result['trench_reused'] = cm.trench_lengths(network_nd, total_duct,
+                                                                                     brownfield_duct)
+    counts = {}
+    for result in tile_results:
+        for key, count in result['counts'].items():
+            counts[key] = counts.get(key, 0) + count
+
+    if topology == 'fttb':
+        pairs = [(cm.splitter(sr), counts['lmf']), ('olt_port', counts['lmf'])]
+    elif topology == 'fttcab':
+        pairs = [('cabinet', counts['dsl']), ('dslam', counts['dsl']), (cm.splitter(sr), counts['df']),
+                 ('olt_port', counts['df'])]
+    else:
+        pairs = [(cm.splitter(sr_rn2), counts['lmf']), (cm.splitter(sr), counts['df']), ('olt_port', counts['df'])]
+    planning_result['equipment'] = cm.equipment_counts(pairs)
+
+    arcpy.AddMessage(planning_result)
+
+    output_file_planning = os.path.join(output_dir, '{0}.txt'.format(output_name))
+    with open(output_file_planning, 'w') as f_p:
+        json.dump(planning_result, f_p)
+
+    # Append the run to the store shared by all the scenarios
+    if result_store != '#':
+        import ResultStore as rs
+        rs.append(result_store, {'name': output_name, 'topology': topology, 'sr': sr, 'sr_rn2': sr_rn2,
+                                 'sr_dsl': sr_dsl, 'dsl_reach': dsl_reach, 'ff_protection': ff_protection,
+                                 'sp_protection': sp_protection, 'brownfield': brownfield_duct,
+                                 'local_search': local_search, 'steiner': steiner, 'duct_sharing': duct_sharing,
+                                 'co_capacity': co_capacity}, planning_result)
+
+    return planning_result
+
+
+if __name__ == '__main__':
+    import arcpy
+
+    network_nd_in = arcpy.GetParameterAsText(0)
+    topology_in = arcpy.GetParameterAsText(1)
+
+    ff_protection_in = bool(arcpy.GetParameterAsText(2))
+    sp_protection_in = bool(arcpy.GetParameterAsText(3))
+
+    demands_in = arcpy.GetParameterAsText(4)
+    intersections_in = arcpy.GetParameterAsText(5)
+    co_in = arcpy.GetParameterAsText(6)
+
+    tile_size_in = float(arcpy.GetParameterAsText(7))
+    halo_in = float(arcpy.GetParameterAsText(8))
+    n_workers_in = int(arcpy.GetParameterAsText(9))
+    sr_in = int(arcpy.GetParameterAsText(10))
+
+    output_dir_in = arcpy.GetParameterAsText(11)
+    output_fds_in = arcpy.GetParameterAsText(12)
+    output_name_in = arcpy.GetParameterAsText(13)
+
+    main(network_nd_in, topology_in, ff_protection_in, sp_protection_in, demands_in, intersections_in, co_in,
+         output_dir_in, output_fds_in, output_name_in, tile_size_in, halo_in, n_workers_in, sr=sr_in)
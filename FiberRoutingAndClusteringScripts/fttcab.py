@@ -23,7 +23,9 @@ def check_exists(name_in):
 ########################################################################################################################
 def main(network_nd, lines, ff_protection, sp_protection, demands, intersections,
          co, sr_fttcab_rn, sr_fttcab_b_dsl, dsl_reach, output_dir, output_fds, output_name, pro, copper_routes=False,
-         brownfield_duct='#', save_lmf_df=False, save_clusters=False):
+         brownfield_duct='#', save_lmf_df=False, save_clusters=False, save_duct_index=False,
+         co_capacity='#', result_store='#', local_search='#', steiner=False,
+         duct_sharing='#'):
 
     import ShortestPathRouting as spr
     planning_result = {}
@@ -51,6 +53,16 @@ def main(network_nd, lines, ff_protection, sp_protection, demands, intersections
                                   name_clst, pro, dsl_reach, lines)
     print(n_clusters_copper)
 
+    # Improve the clusters for the given number of seconds, the copper stays within the DSL reach
+    if local_search != '#':
+        import LocalSearch as ls
+        planning_result['local_search'] = {}
+        planning_result['local_search']['copper'] = ls.improve_clusters(network_nd, intersections, output_fds_cluster,
+                                                                        name_clst, n_clusters_copper, sr_fttcab_b_dsl,
+                                                                        brownfield_duct=brownfield_duct,
+                                                                        max_distance=dsl_reach,
+                                                                        time_budget=local_search)
+
     name_onus = 'Cluster_heads_{0}'.format(name_clst)
     rns2 = os.path.join(output_fds_cluster, name_onus)
 
@@ -67,6 +79,11 @@ def main(network_nd, lines, ff_protection, sp_protection, demands, intersections
     n_clusters_cab = clst.main(network_nd, rns2, intersections, facilities, sr_fttcab_rn, output_fds_cluster,
                                output_name_fiber, pro)
 
+    if local_search != '#':
+        planning_result['local_search']['df'] = ls.improve_clusters(network_nd, intersections, output_fds_cluster,
+                                                                    output_name_fiber, n_clusters_cab, sr_fttcab_rn, co,
+                                                                    brownfield_duct, time_budget=local_search)
+
     if not save_clusters:
         name_rns = 'Cluster_heads_{0}'.format(output_name_fiber)
         rns1 = os.path.join(output_fds_cluster, name_rns)
@@ -93,31 +110,44 @@ def main(network_nd, lines, ff_protection, sp_protection, demands, intersections
         planning_result['df'], planning_result['d_d'], a, b, df, c = spr.main(network_nd, n_clusters_cab, 'DF', co,
                                                                        output_name_fiber, output_fds, pro,
                                                                        save_lmf_df=save_lmf_df,
-                                                                       save_clusters=save_clusters)
+                                                                       save_clusters=save_clusters,
+                                                                       steiner=steiner,
+                                                                       duct_sharing=duct_sharing,
+                                                                       planning_result_in=planning_result)
     else:
         planning_result['df'], planning_result['d_d'], a, b, df, c = spr.main(network_nd, n_clusters_cab, 'DF', co,
                                                                        output_name_fiber, output_fds, pro,
                                                                        brownfield_duct=brownfield_duct,
                                                                        save_lmf_df=save_lmf_df,
-                                                                       save_clusters=save_clusters)
+                                                                       save_clusters=save_clusters,
+                                                                       steiner=steiner,
+                                                                       duct_sharing=duct_sharing,
+                                                                       planning_result_in=planning_result)
 
     #FF
     if not ff_protection:
         if brownfield_duct == '#':
             planning_result['ff'], planning_result['f_d'], a, b, ff, c = spr.main(network_nd, 1, 'FF', co, output_name_fiber,
-                                                                       output_fds, pro)
+                                                                       output_fds, pro, co_capacity=co_capacity,
+                                                                       planning_result_in=planning_result,
+                                                                       duct_sharing=duct_sharing)
         else:
             planning_result['ff'], planning_result['f_d'], a, b, ff, c = spr.main(network_nd, 1, 'FF', co, output_name_fiber,
                                                                            output_fds, pro,
                                                                            brownfield_duct=brownfield_duct,
-                                                                           save_clusters=save_clusters)
+                                                                           save_clusters=save_clusters,
+                                                                           co_capacity=co_capacity,
+                                                                           planning_result_in=planning_result,
+                                                                           duct_sharing=duct_sharing)
     else:
         if brownfield_duct == '#':
             planning_result['ff'], planning_result['f_d'], \
             planning_result['ff_sp_p'], planning_result['f_d_add_p'], ff, ff_p = spr.main(network_nd, 1, 'FF', co, output_name_fiber,
                                                                                 output_fds, pro, ff_protection,
                                                                                 sp_protection,
-                                                                                save_clusters=save_clusters)
+                                                                                save_clusters=save_clusters,
+                                                                                co_capacity=co_capacity,
+                                                                                planning_result_in=planning_result)
         else:
             planning_result['ff'], planning_result['f_d'], \
             planning_result['ff_sp_p'], planning_result['f_d_add_p'], ff, ff_p  = spr.main(network_nd, 1, 'FF', co,
@@ -125,13 +155,9 @@ def main(network_nd, lines, ff_protection, sp_protection, demands, intersections
                                                                                 output_fds, pro, ff_protection,
                                                                                 sp_protection,
                                                                                 brownfield_duct=brownfield_duct,
-                                                                                save_clusters=save_clusters)
-
-    arcpy.AddMessage(planning_result)
-
-    output_file_planning = os.path.join(output_dir, '{0}.txt'.format(output_name))
-    f_p = open(output_file_planning, 'w')
-    json.dump(planning_result, f_p)
+                                                                                save_clusters=save_clusters,
+                                                                                co_capacity=co_capacity,
+                                                                                planning_result_in=planning_result)
 
     # Save total fibers and ducts to be used as brownfield for further scenarios
     total_fiber = os.path.join(output_fds, 'Total_fiber_{0}'.format(output_name_fiber))
@@ -151,6 +177,34 @@ def main(network_nd, lines, ff_protection, sp_protection, demands, intersections
 
     arcpy.AddGeometryAttributes_management(total_duct, 'LENGTH_GEODESIC', 'METERS')
 
+    # Trench and equipment counts for the cost evaluation
+    import CostModel as cm
+    planning_result['trench'], planning_result['trench_reused'] = cm.trench_lengths(network_nd, total_duct,
+                                                                                     brownfield_duct)
+    planning_result['equipment'] = cm.equipment_counts([('cabinet', n_clusters_copper), ('dslam', n_clusters_copper),
+                                                      (cm.splitter(sr_fttcab_rn), n_clusters_cab),
+                                                      ('olt_port', n_clusters_cab)])
+
+    arcpy.AddMessage(planning_result)
+
+    output_file_planning = os.path.join(output_dir, '{0}.txt'.format(output_name))
+    with open(output_file_planning, 'w') as f_p:
+        json.dump(planning_result, f_p)
+
+    # Append the run to the store shared by all the scenarios
+    if result_store != '#':
+        import ResultStore as rs
+        rs.append(result_store, {'name': output_name, 'topology': 'fttcab', 'sr': sr_fttcab_rn,
+                                 'sr_dsl': sr_fttcab_b_dsl, 'dsl_reach': dsl_reach, 'ff_protection': ff_protection,
+                                 'sp_protection': sp_protection, 'brownfield': brownfield_duct,
+                                 'local_search': local_search, 'steiner': steiner, 'duct_sharing': duct_sharing,
+                                 'co_capacity': co_capacity}, planning_result)
+
+    # Snap the ducts to the network edges once, the following scenarios can pass the index as the brownfield
+    if save_duct_index:
+        import BrownfieldIndex as bfi
+        bfi.main(network_nd, total_duct, output_dir, 'Total_duct_{0}'.format(output_name_fiber))
+
     return
 
 
@@ -21,7 +21,8 @@ def check_exists(name_in):
 
 ########################################################################################################################
 def main(network_nd, ff_protection, sp_protection, demands, co, pro, output_dir, output_fds, output_name,
-         brownfield_duct):
+         brownfield_duct, save_duct_index=False, co_capacity='#', compact_tree=False, result_store='#',
+         duct_sharing='#'):
 
     import ShortestPathRouting as spr
 
@@ -31,32 +32,56 @@ def main(network_nd, ff_protection, sp_protection, demands, co, pro, output_dir,
     n_nodes = int(arcpy.GetCount_management(demands).getOutput(0))
     output_name_p2p = output_name
 
-    if not ff_protection:
+    if compact_tree and not ff_protection:
+        # One shortest path tree instead of one polyline per demand, the shared trunk is stored once
+        import NetworkGraph as ng
+        import SegmentIndex as si
+        import ShortestPathTree as spt
+
+        if co_capacity != '#':
+            arcpy.AddWarning('The CO capacity is not applied to the compact tree, every demand uses its nearest CO')
+        if duct_sharing != '#':
+            arcpy.AddWarning('The duct sharing is not applied to the compact tree, the tree shares the ducts already')
+
+        graph = ng.get_graph(network_nd)
+        demand_locations = si.read_locations(demands, graph)[1]
+        co_locations = si.read_locations(co, graph)[1]
+
+        tree = spt.build_tree(graph, co_locations, demand_locations, spr.graph_weights(graph, brownfield_duct))
+        spt.save_tree(tree, os.path.join(output_dir, 'SP_FF_{0}_tree.npz'.format(output_name_p2p)))
+
+        planning_result['fiber'], planning_result['duct'] = spt.tree_lengths(graph, tree)
+        ff = spt.write_tree(graph, tree, output_fds, 'SP_FF_{0}_tree'.format(output_name_p2p))
+
+    elif not ff_protection:
         if brownfield_duct == '#':
             planning_result['fiber'], planning_result['duct'], a, b, ff, c = spr.main(network_nd, n_nodes, 'FF', co,
                                                                                output_name_p2p, output_fds, pro,
-                                                                               ff_protection, p2p_demands=demands)
+                                                                               ff_protection, p2p_demands=demands,
+                                                                               co_capacity=co_capacity,
+                                                                               planning_result_in=planning_result,
+                                                                               duct_sharing=duct_sharing)
         else:
             planning_result['fiber'], planning_result['duct'], a, b, ff, c = spr.main(network_nd, n_nodes, 'FF', co,
                                                                                output_name_p2p, output_fds, pro,
                                                                                ff_protection, p2p_demands=demands,
-                                                                               brownfield_duct=brownfield_duct)
+                                                                               brownfield_duct=brownfield_duct,
+                                                                               co_capacity=co_capacity,
+                                                                               planning_result_in=planning_result,
+                                                                               duct_sharing=duct_sharing)
     else:
         if brownfield_duct == '#':
             planning_result['fiber'], planning_result['duct'], planning_result['fiber_p'], \
             planning_result['duct_add_p'], ff, ff_p = spr.main(network_nd, n_nodes, 'FF', co, output_name_p2p, output_fds,
-                                                     pro, ff_protection, sp_protection, p2p_demands=demands)
+                                                     pro, ff_protection, sp_protection, p2p_demands=demands,
+                                                     co_capacity=co_capacity, planning_result_in=planning_result,
+                                                     duct_sharing=duct_sharing)
         else:
             planning_result['fiber'], planning_result['duct'], planning_result['fiber_p'], \
             planning_result['duct_add_p'], ff, ff_p = spr.main(network_nd, n_nodes, 'FF', co, output_name_p2p, output_fds,
                                                      pro, ff_protection, sp_protection, p2p_demands=demands,
-                                                     brownfield_duct=brownfield_duct)
-
-    arcpy.AddMessage(planning_result)
-
-    output_file_planning = os.path.join(output_dir, '{0}.txt'.format(output_name))
-    f_p = open(output_file_planning, 'w')
-    json.dump(planning_result, f_p)
+                                                     brownfield_duct=brownfield_duct, co_capacity=co_capacity,
+                                                     planning_result_in=planning_result, duct_sharing=duct_sharing)
 
     # Save total fibers and ducts to be used as brownfield for further scenarios
     total_fiber = os.path.join(output_fds, 'Total_fiber_{0}'.format(output_name_p2p))
@@ -64,7 +89,9 @@ def main(network_nd, ff_protection, sp_protection, demands, co, pro, output_dir,
 
     if ff_protection:
         arcpy.Merge_management([ff, ff_p], total_fiber)
-        arcpy.AddGeometryAttributes_management(total_fiber,'LENGTH_GEODESIC', 'METERS')
+    else:
+        arcpy.CopyFeatures_management(ff, total_fiber)
+    arcpy.AddGeometryAttributes_management(total_fiber,'LENGTH_GEODESIC', 'METERS')
 
     total_duct = os.path.join(output_fds, 'Total_duct_{0}'.format(output_name_p2p))
     check_exists(total_duct)
@@ -72,6 +99,30 @@ def main(network_nd, ff_protection, sp_protection, demands, co, pro, output_dir,
 
     arcpy.AddGeometryAttributes_management(total_duct, 'LENGTH_GEODESIC', 'METERS')
 
+    # Trench and equipment counts for the cost evaluation
+    import CostModel as cm
+    planning_result['trench'], planning_result['trench_reused'] = cm.trench_lengths(network_nd, total_duct,
+                                                                                     brownfield_duct)
+    planning_result['equipment'] = cm.equipment_counts([('olt_port', n_nodes)])
+
+    arcpy.AddMessage(planning_result)
+
+    output_file_planning = os.path.join(output_dir, '{0}.txt'.format(output_name))
+    with open(output_file_planning, 'w') as f_p:
+        json.dump(planning_result, f_p)
+
+    # Append the run to the store shared by all the scenarios
+    if result_store != '#':
+        import ResultStore as rs
+        rs.append(result_store, {'name': output_name, 'topology': 'p2p', 'ff_protection': ff_protection,
+                                 'sp_protection': sp_protection, 'brownfield': brownfield_duct,
+                                 'duct_sharing': duct_sharing, 'co_capacity': co_capacity}, planning_result)
+
+    # Snap the ducts to the network edges once, the following scenarios can pass the index as the brownfield
+    if save_duct_index:
+        import BrownfieldIndex as bfi
+        bfi.main(network_nd, total_duct, output_dir, 'Total_duct_{0}'.format(output_name_p2p))
+
     return
 
 
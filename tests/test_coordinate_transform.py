@@ -0,0 +1,51 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FiberRoutingAndClusteringScripts'))
+
+import CoordinateTransform as ct
+
+
+def test_round_trip():
+    rnd = np.random.RandomState(0)
+    for number in (1, 17, 31, 33, 60):
+        for north in (True, False):
+            lon0 = -183.0 + 6.0 * number
+            lat = rnd.uniform(0.0, 80.0, 200) * (1 if north else -1)
+            xy = np.column_stack([lon0 + rnd.uniform(-3.0, 3.0, 200), lat])
+            back = ct.inverse(ct.forward(xy, (number, north)), (number, north))
+            # 1e-8 degrees are about a millimeter
+            assert np.max(np.abs(back - xy)) < 1e-8
+
+
+def test_reference_points():
+    # The equator and 45 degrees on the central meridian of the zone 31, the meridian arc to 45 degrees is 4984944.378 m
+    xy = ct.forward([(3.0, 0.0), (3.0, 45.0)], (31, True))
+    assert xy[0] == pytest.approx([500000.0, 0.0], abs=1e-3)
+    assert xy[1] == pytest.approx([500000.0, 0.9996 * 4984944.378], abs=1e-2)
+
+    xy = ct.forward([(3.0, -45.0)], (31, False))
+    assert xy[0] == pytest.approx([500000.0, 10000000.0 - 0.9996 * 4984944.378], abs=1e-2)
+
+    # The CN Tower in Toronto, 17T 630084 4833438
+    lon, lat = -(79 + 23 / 60.0 + 13.7 / 3600.0), 43 + 38 / 60.0 + 33.24 / 3600.0
+    assert ct.detect_zone([(lon, lat)]) == (17, True)
+    assert ct.forward([(lon, lat)])[0] == pytest.approx([630084.0, 4833438.0], abs=1.0)
+
+
+def test_zones():
+    assert ct.utm_zone(-74.0, 40.7) == (18, True)
+    assert ct.utm_zone(151.2, -33.9) == (56, False)
+    # South-west Norway and Svalbard
+    assert ct.utm_zone(5.3, 60.4) == (32, True)
+    assert ct.utm_zone(10.0, 78.0) == (33, True)
+    assert ct.utm_zone(25.0, 78.0) == (35, True)
+
+
+def test_scale_factor():
+    assert ct.scale_factor([(3.0, 45.0)], (31, True))[0] == pytest.approx(0.9996, abs=1e-9)
+    # k0 (1 + (1 + e'^2) dlon^2 / 2) at the border of the zone on the equator
+    assert ct.scale_factor([(6.0, 0.0)], (31, True))[0] == pytest.approx(1.000981, abs=2e-6)
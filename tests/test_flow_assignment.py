@@ -0,0 +1,153 @@
+import itertools
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FiberRoutingAndClusteringScripts'))
+
+import FlowAssignment as fa
+import GraphClustering as gc
+import NetworkGraph as ng
+
+
+def random_arcs(rnd, n, k, density=0.6):
+    """
+    Random sparse arcs, every demand has at least one head.
+    """
+    arcs = []
+    for i in range(n):
+        row = dict((h, float(rnd.randint(1, 20))) for h in range(k) if rnd.rand() < density)
+        if not row:
+            row[rnd.randint(k)] = float(rnd.randint(1, 20))
+        arcs.append(row)
+    return arcs
+
+
+def brute_force(arcs, capacity):
+    """
+    :return: maximum number of the assigned demands and the minimum cost of such an assignment
+    """
+    best = (0, 0.0)
+    choices = [[-1] + sorted(row) for row in arcs]
+    for labels in itertools.product(*choices):
+        load = np.bincount([h for h in labels if h != -1], minlength=len(capacity))
+        if np.any(load > capacity):
+            continue
+        n_assigned = sum(1 for h in labels if h != -1)
+        cost = fa.total_cost(arcs, labels)
+        if n_assigned > best[0] or (n_assigned == best[0] and cost < best[1]):
+            best = (n_assigned, cost)
+    return best
+
+
+def test_assign_respects_capacity():
+    rnd = np.random.RandomState(0)
+    for _ in range(50):
+        n, k = rnd.randint(1, 12), rnd.randint(1, 5)
+        capacity = rnd.randint(0, 4, k)
+        labels = fa.assign(random_arcs(rnd, n, k), capacity.tolist())
+        load = np.bincount(labels[labels != -1], minlength=k)
+        assert np.all(load <= capacity)
+
+
+def test_assign_is_optimal():
+    rnd = np.random.RandomState(1)
+    for _ in range(60):
+        n, k = rnd.randint(1, 8), rnd.randint(1, 4)
+        arcs = random_arcs(rnd, n, k)
+        capacity = rnd.randint(1, 4, k)
+        labels = fa.assign(arcs, capacity.tolist())
+
+        n_assigned, cost = brute_force(arcs, capacity)
+        assert int(np.sum(labels != -1)) == n_assigned
+        if n_assigned == n:
+            assert fa.total_cost(arcs, labels) == pytest.approx(cost)
+
+
+def grid_graph(width, seed):
+    """
+    Grid of streets 100 m apart with some of the streets missing.
+    """
+    rnd = np.random.RandomState(seed)
+    xy = np.array([(i * 100.0, j * 100.0) for j in range(width) for i in range(width)])
+    u, v = [], []
+    for j in range(width):
+        for i in range(width):
+            a = j * width + i
+            if i < width - 1 and rnd.rand() < 0.9:
+                u.append(a)
+                v.append(a + 1)
+            if j < width - 1 and rnd.rand() < 0.9:
+                u.append(a)
+                v.append(a + width)
+    length = [float(np.hypot(*(xy[a] - xy[b]))) for a, b in zip(u, v)]
+    return ng.build_graph(xy, u, v, length, geographic=False)
+
+
+def random_locations(graph, rnd, n):
+    edges = rnd.randint(0, graph['n_edges'], n)
+    locations = [(int(e), float(rnd.uniform(0, graph['edge_length'][e]))) for e in edges]
+    return locations, location_xy(graph, locations)
+
+
+def location_xy(graph, locations):
+    xy = []
+    for edge, pos in locations:
+        a = graph['node_xy'][graph['edge_u'][edge]]
+        b = graph['node_xy'][graph['edge_v'][edge]]
+        xy.append(a + (b - a) * pos / graph['edge_length'][edge])
+    return np.asarray(xy)
+
+
+def network_distance(graph, a, b):
+    dist = ng.dijkstra(graph, list(gc.location_nodes(graph, [a])[0]))[0]
+    (u, d_u), (v, d_v) = gc.location_nodes(graph, [b])[0]
+    d = min(dist.get(u, np.inf) + d_u, dist.get(v, np.inf) + d_v)
+    if a[0] == b[0]:
+        d = min(d, abs(a[1] - b[1]))
+    return d
+
+
+def test_flow_clusters_within_max_distance():
+    graph = grid_graph(8, 2)
+    rnd = np.random.RandomState(3)
+    locations, xy = random_locations(graph, rnd, 60)
+    heads, heads_xy = random_locations(graph, rnd, 6)
+
+    # The present heads are random, most of them beyond the distance
+    labels = rnd.randint(0, len(heads), len(locations)).tolist()
+    clusters, stranded = gc.flow_clusters(graph, locations, xy, heads, heads_xy, 12, 300.0, labels_in=labels)
+
+    assert sorted(sum(clusters, []) + stranded) == list(range(len(locations)))
+    for h, members in enumerate(clusters):
+        assert len(members) <= 12
+        for i in members:
+            assert network_distance(graph, heads[h], locations[i]) <= 300.0 + 1e-6
+
+
+def test_flow_heads_serves_every_location():
+    graph = grid_graph(8, 4)
+    rnd = np.random.RandomState(5)
+    locations, xy = random_locations(graph, rnd, 80)
+    candidates, candidates_xy = random_locations(graph, rnd, 40)
+
+    heads, clusters = gc.flow_heads(graph, locations, xy, candidates, candidates_xy, [0, 1], 8, 350.0)
+
+    assert len(set(heads)) == len(heads)
+    assert sorted(sum(clusters, [])) == list(range(len(locations)))
+    for c, members in zip(heads, clusters):
+        assert len(members) <= 8
+        for i in members:
+            assert network_distance(graph, candidates[c], locations[i]) <= 350.0 + 1e-6
+
+
+def test_open_heads_out_of_reach():
+    graph = grid_graph(6, 6)
+    rnd = np.random.RandomState(7)
+    locations, xy = random_locations(graph, rnd, 10)
+    candidates, candidates_xy = random_locations(graph, rnd, 3)
+
+    with pytest.raises(ValueError):
+        gc.open_heads(graph, locations, xy, candidates, candidates_xy, 4, max_distance=1e-3)
@@ -0,0 +1,37 @@
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FiberRoutingAndClusteringScripts'))
+
+import PlanningSession as ps
+import ContractionHierarchy as ch
+
+
+def open_session(monkeypatch, hierarchy):
+    """
+    Opens a session on a stub network, every contraction of the network is recorded.
+    """
+    contracted = []
+    spr = types.ModuleType('ShortestPathRouting')
+    spr.graph_weights = lambda graph, brownfield_duct: None
+    monkeypatch.setitem(sys.modules, 'ShortestPathRouting', spr)
+    monkeypatch.setattr(ps.ng, 'get_graph', lambda network_nd, cache_dir: {})
+    monkeypatch.setattr(ps, 'read_locations', lambda graph, fc_in: {})
+    monkeypatch.setattr(ch, 'get_hierarchy', lambda graph, path_in, weights: contracted.append(path_in))
+
+    # The job server fills the session inputs that are not specified with '#'
+    ps.open_session('nd', 'demands', 'intersections', 'co', hierarchy=hierarchy)
+    return contracted
+
+
+def test_hash_skips_contraction(monkeypatch):
+    assert open_session(monkeypatch, '#') == []
+
+
+def test_false_skips_contraction(monkeypatch):
+    assert open_session(monkeypatch, False) == []
+
+
+def test_true_contracts(monkeypatch):
+    assert len(open_session(monkeypatch, True)) == 1
@@ -0,0 +1,92 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FiberRoutingAndClusteringScripts'))
+
+import BidirectionalSearch as bs
+import ContractionHierarchy as ch
+import GraphClustering as gc
+import Landmarks as lm
+import NetworkGraph as ng
+
+
+def grid_graph(width=10, seed=0):
+    """
+    Connected grid of streets about 100 m apart with some diagonals and the node positions jittered.
+    """
+    rnd = np.random.RandomState(seed)
+    xy = np.array([(i * 100.0 + rnd.rand() * 30, j * 100.0 + rnd.rand() * 30)
+                   for j in range(width) for i in range(width)])
+    u, v = [], []
+    for j in range(width):
+        for i in range(width):
+            a = j * width + i
+            if i < width - 1:
+                u.append(a)
+                v.append(a + 1)
+            if j < width - 1:
+                u.append(a)
+                v.append(a + width)
+            if i < width - 1 and j < width - 1 and rnd.rand() < 0.2:
+                u.append(a)
+                v.append(a + width + 1)
+    length = [float(np.hypot(*(xy[a] - xy[b]))) for a, b in zip(u, v)]
+    return ng.build_graph(xy, u, v, length, geographic=False)
+
+
+def discounted(graph, seed=1):
+    """
+    Edge weights with a random discount, as with the brownfield ducts.
+    """
+    rnd = np.random.RandomState(seed)
+    return (np.asarray(graph['edge_length']) * np.where(rnd.rand(graph['n_edges']) < 0.3, 0.5, 1.0)).tolist()
+
+
+def node_pairs(graph, n, seed=2):
+    rnd = np.random.RandomState(seed)
+    return [(int(a), int(b)) for a, b in rnd.randint(0, graph['n_nodes'], (n, 2))]
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_hierarchy_matches_dijkstra(weighted):
+    graph = grid_graph()
+    weights = discounted(graph) if weighted else None
+    hierarchy = ch.build_hierarchy(graph, weights)
+
+    rnd = np.random.RandomState(3)
+    edges = rnd.randint(0, graph['n_edges'], 30)
+    locations = [(int(e), float(rnd.uniform(0, graph['edge_length'][e]))) for e in edges]
+    dist = ch.many_to_many(graph, hierarchy, locations, locations)
+
+    w = graph['weight'] if weights is None else weights
+    ends = gc.location_nodes(graph, locations, w)
+    for i, (edge, pos) in enumerate(locations):
+        node_dist = ng.dijkstra(graph, list(ends[i]), w)[0]
+        for j, ((u, d_u), (v, d_v)) in enumerate(ends):
+            expected = min(node_dist[u] + d_u, node_dist[v] + d_v)
+            if locations[j][0] == edge:
+                expected = min(expected, abs(locations[j][1] - pos) * w[edge] / graph['edge_length'][edge])
+            assert dist[i, j] == pytest.approx(expected, rel=1e-9, abs=1e-6)
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_bidirectional_matches_dijkstra(weighted):
+    graph = grid_graph()
+    weights = discounted(graph) if weighted else None
+    for a, b in node_pairs(graph, 50):
+        expected = ng.dijkstra(graph, [a], weights, targets=[b])[0][b]
+        assert bs.search(graph, [(a, 0.0)], [(b, 0.0)], weights)[0] == pytest.approx(expected, rel=1e-9, abs=1e-6)
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_landmarks_match_dijkstra(weighted):
+    graph = grid_graph()
+    weights = discounted(graph) if weighted else None
+    landmarks = lm.build_landmarks(graph, 4, weights)
+    for a, b in node_pairs(graph, 50):
+        expected = ng.dijkstra(graph, [a], weights, targets=[b])[0][b]
+        assert lm.astar(graph, landmarks, [(a, 0.0)], [(b, 0.0)], weights)[0] == pytest.approx(expected, rel=1e-9,
+                                                                                               abs=1e-6)
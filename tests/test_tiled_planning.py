@@ -0,0 +1,45 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FiberRoutingAndClusteringScripts'))
+
+import NetworkGraph as ng
+import TiledPlanning as tp
+
+
+@pytest.mark.parametrize('geographic', [False, True])
+def test_tiles_cover_the_demands(geographic):
+    rnd = np.random.RandomState(0)
+    if geographic:
+        demands_xy = np.column_stack([rnd.uniform(13.30, 13.45, 500), rnd.uniform(52.45, 52.55, 500)])
+    else:
+        demands_xy = rnd.uniform(0.0, 5000.0, (500, 2))
+    tile_size, halo = 1000.0, 200.0
+    tiles = tp.make_tiles(demands_xy, geographic, tile_size, halo)
+
+    # Every demand is the member of exactly one tile
+    members = np.concatenate([tile['members'] for tile in tiles])
+    assert sorted(members.tolist()) == list(range(len(demands_xy)))
+
+    scale = ng.metric_scale(geographic, float(np.mean(demands_xy[:, 1])))
+    margin = halo / scale
+    # The cores are half-open, the rounding of the box coordinates is within a micrometer
+    eps = 1e-6 / scale
+    cores = []
+    for tile in tiles:
+        box = np.asarray(tile['box'])
+        low, high = box[:2] + margin, box[2:] - margin
+        # The box is the core with the halo around it, the core is a tile_size square
+        assert np.allclose((high - low) * scale, tile_size)
+        cores.append((low, high))
+
+        xy = demands_xy[tile['members']]
+        assert np.all(xy >= low - eps) and np.all(xy < high - eps)
+
+    # The cores do not overlap, no demand lies in the core of another tile
+    for xy in demands_xy:
+        inside = [np.all(xy >= low - eps) and np.all(xy < high - eps) for low, high in cores]
+        assert sum(inside) == 1